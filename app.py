@@ -19,15 +19,46 @@ import numpy_financial as npf
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime, date, timedelta
-from dateutil.relativedelta import relativedelta
 from contextlib import closing
 import sqlite3
 import uuid
 import logging
 import os
 import io
+import csv
 import html as _html
-import calendar
+import functools
+from concurrent.futures.process import BrokenProcessPool
+
+from nivesa.rates import revalue, revalue_parallel
+from nivesa.montecarlo import batch_plan, iter_batches
+from nivesa.db import (
+    DATA_DIR, DB_DIR, DatabaseError, NivesaError, connect as _connect, execute, get_ledger_revision,
+    get_market_revision, query_frame,
+)
+from nivesa.schema import init_db
+from nivesa.finance import (
+    BUSINESS_DAY_CONVENTIONS, DAY_COUNT_CONVENTIONS, DEFAULT_CURVE, FREQ_MAP, HOLIDAY_FILE, asof_index,
+    calc_days_to_maturity, cashflow_matrix, date_keys, holiday_calendar, parse_tenors, solve_yields,
+    year_fractions,
+)
+from nivesa.schedule import (
+    COUPON_TERM_COLUMNS, get_amortization_schedules, get_coupon_resets, get_coupon_terms,
+    rebuild_security_schedule, validate_coupon_terms,
+)
+from nivesa.lots import (
+    DISPOSAL_COLUMNS, LOT_LONG_TERM_MONTHS, LOT_METHODS, TRANSACTION_TYPES, financial_year, rebuild_tax_lots,
+    validate_ledger_chronology,
+)
+from nivesa.positions import (
+    CUBE_MEASURES, MATURITY_BUCKET_ORDER, aggregation_cube, analytics_key, cashflow_projection, latest_prices,
+    maturity_bucket, portfolio_analytics,
+)
+from nivesa.snapshots import load_snapshot_stage
+from nivesa.formatting import (
+    fmt_inr, fmt_inr_array, fmt_inr_short, fmt_inr_short_array, fmt_pct, fmt_pct_array,
+)
+from nivesa.columnar import export_frame, export_ledger, import_ledger
 
 # ═══════════════════════════════════════════════════════════════════════
 # APPLICATION CONSTANTS
@@ -42,7 +73,6 @@ TAGLINE = "Institutional Fixed Income Management · Portfolio Analytics · Cashf
 
 ACCOUNTS = ["REKHA", "HEMANG", "MANTHAN", "HIMA"]
 FREQUENCIES = ["Monthly", "Quarterly", "Semi-Annual", "Annual"]
-FREQ_MAP = {'Monthly': 12, 'Quarterly': 4, 'Semi-Annual': 2, 'Annual': 1}
 BOND_TYPES = [
     "NCD", "Corporate Bond", "Government Bond", "SDL",
     "T-Bill", "Tax-Free Bond", "Sovereign Gold Bond", "FD", "Other"
@@ -51,8 +81,6 @@ CREDIT_RATINGS = [
     "AAA", "AA+", "AA", "AA-", "A+", "A", "A-",
     "BBB+", "BBB", "BBB-", "BB+", "BB", "BB-", "B", "C", "D", "Unrated"
 ]
-DAY_COUNT_CONVENTIONS = ["30/360", "Actual/365", "Actual/360", "Actual/Actual"]
-TRANSACTION_TYPES = ["Buy", "Sell", "Interest_Receipt", "Principal_Repayment"]
 
 # ═══════════════════════════════════════════════════════════════════════
 # PAGE CONFIG & DATA PATHS
@@ -65,10 +93,7 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-DATA_DIR = os.environ.get("NIVESA_DATA_DIR", "data")
 LOG_DIR = os.path.join(DATA_DIR, "logs")
-DB_DIR = os.path.join(DATA_DIR, "db")
-DB_FILE = os.path.join(DB_DIR, "portfolio.db")
 LOG_FILE = os.path.join(LOG_DIR, "nivesa.log")
 
 os.makedirs(LOG_DIR, exist_ok=True)
@@ -108,98 +133,30 @@ load_css()
 # ═══════════════════════════════════════════════════════════════════════
 
 def db_init():
-    """Initialize / migrate database to current schema."""
+    """Initialize / migrate database to current schema (see nivesa.schema)."""
     try:
-        # closing() releases the handle; `conn` context scopes the txn
-        with closing(_connect()) as conn, conn:
-            c = conn.cursor()
-            c.execute("PRAGMA journal_mode=WAL")
-
-            c.execute("""
-            CREATE TABLE IF NOT EXISTS securities (
-                bond_id TEXT PRIMARY KEY,
-                issuer TEXT NOT NULL,
-                isin TEXT NOT NULL UNIQUE,
-                maturity_date TEXT NOT NULL,
-                frequency TEXT NOT NULL,
-                coupon_rate REAL NOT NULL,
-                face_value REAL NOT NULL
-            )""")
-
-            c.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                transaction_id TEXT PRIMARY KEY,
-                bond_id TEXT NOT NULL,
-                account TEXT NOT NULL,
-                trade_date TEXT NOT NULL,
-                transaction_type TEXT NOT NULL,
-                units REAL NOT NULL,
-                price REAL NOT NULL,
-                amount REAL NOT NULL,
-                notes TEXT,
-                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
-            )""")
-
-            c.execute("""
-            CREATE TABLE IF NOT EXISTS security_metadata (
-                bond_id TEXT PRIMARY KEY,
-                bond_type TEXT DEFAULT 'NCD',
-                credit_rating TEXT DEFAULT 'Unrated',
-                day_count TEXT DEFAULT 'Actual/365',
-                issue_date TEXT,
-                call_date TEXT,
-                put_date TEXT,
-                listing TEXT DEFAULT 'Unlisted',
-                sector TEXT DEFAULT 'Financials',
-                notes TEXT,
-                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
-            )""")
-
-            # Auto-populate metadata for any securities missing it
-            c.execute("""
-                INSERT OR IGNORE INTO security_metadata (bond_id)
-                SELECT bond_id FROM securities
-                WHERE bond_id NOT IN (SELECT bond_id FROM security_metadata)
-            """)
-
-            conn.commit()
-            logger.info("Database initialized / migrated OK.")
-    except sqlite3.Error as e:
-        st.error(f"Database initialization failed: {e}")
-        logger.error(f"DB init failed: {e}")
+        init_db()
+    except DatabaseError as e:
+        st.error(str(e))
         st.stop()
 
 
-def _connect():
-    """Create a connection with WAL mode and foreign key enforcement."""
-    conn = sqlite3.connect(DB_FILE, timeout=30.0)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    conn.execute("PRAGMA busy_timeout=30000")
-    return conn
-
-
 def db_query(query, params=()):
-    """Run SELECT; return DataFrame."""
+    """Run SELECT; return DataFrame (empty, with the error shown, on failure)."""
     try:
-        with closing(_connect()) as conn:
-            return pd.read_sql_query(query, conn, params=params)
-    except sqlite3.Error as e:
-        st.error(f"Query failed: {e}")
-        logger.error(f"Query failed: {e}")
+        return query_frame(query, params)
+    except DatabaseError as e:
+        st.error(str(e))
         return pd.DataFrame()
 
 
 def db_execute(query, params=()):
     """Run INSERT/UPDATE/DELETE; return success bool."""
     try:
-        with closing(_connect()) as conn, conn:
-            conn.cursor().execute(query, params)
-            conn.commit()
-            return True
-    except sqlite3.Error as e:
-        st.error(f"Execution failed: {e}")
-        logger.error(f"Execution failed: {e}")
+        execute(query, params)
+        return True
+    except DatabaseError as e:
+        st.error(str(e))
         return False
 
 
@@ -228,32 +185,6 @@ def show_notifications():
         st.session_state["notifications"] = []
 
 
-def validate_ledger_chronology(bond_id, conn):
-    """Ensure running balance of units for all accounts never drops below 0.
-
-    Same-day ties are ordered Buy-before-Sell: transaction_id is a random
-    UUID, so ordering by it made same-day Buy→Sell pairs pass or fail at
-    random depending on lexical UUID order. Buy-first is the most permissive
-    ordering consistent with same-day settlement netting.
-    """
-    c = conn.cursor()
-    c.execute(
-        "SELECT account, trade_date, units, transaction_type FROM transactions "
-        "WHERE bond_id=? AND transaction_type IN ('Buy', 'Sell') "
-        "ORDER BY trade_date, CASE transaction_type WHEN 'Buy' THEN 0 ELSE 1 END, transaction_id",
-        (bond_id,)
-    )
-    txns = c.fetchall()
-    
-    balances = {}
-    for account, tdate, units, ttype in txns:
-        balances[account] = balances.get(account, 0.0) + units
-        if balances[account] < -1e-5:
-            return False, account, tdate
-            
-    return True, None, None
-
-
 # ═══════════════════════════════════════════════════════════════════════
 # FORMATTING HELPERS
 # ═══════════════════════════════════════════════════════════════════════
@@ -265,46 +196,6 @@ def esc(text):
     return _html.escape(str(text)) if text is not None else ''
 
 
-def fmt_inr(amount):
-    """Indian numbering: ₹1,23,456.78"""
-    try:
-        amount = float(amount)
-        neg = amount < 0
-        amount = abs(amount)
-        parts = f"{amount:,.2f}".split('.')
-        digits = parts[0].replace(',', '')
-        dec = parts[1]
-        if len(digits) <= 3:
-            fmt = digits
-        else:
-            fmt = digits[-3:]
-            rem = digits[:-3]
-            while rem:
-                fmt = rem[-2:] + ',' + fmt
-                rem = rem[:-2]
-        return f"{'-₹' if neg else '₹'}{fmt}.{dec}"
-    except (ValueError, TypeError):
-        return "₹0.00"
-
-
-def fmt_inr_short(amount):
-    """Compact: ₹1.23 Cr, ₹4.56 L"""
-    try:
-        v = float(amount)
-        if abs(v) >= 1e7:   return f"₹{v/1e7:.2f} Cr"
-        if abs(v) >= 1e5:   return f"₹{v/1e5:.2f} L"
-        return fmt_inr(v)
-    except (ValueError, TypeError):
-        return "₹0"
-
-
-def fmt_pct(value, decimals=2):
-    try:
-        return f"{float(value)*100:.{decimals}f}%"
-    except (ValueError, TypeError):
-        return "0.00%"
-
-
 def rating_badge(rating):
     r = rating or "Unrated"
     if r == "Unrated":     cls = "badge-unrated"
@@ -316,545 +207,1440 @@ def rating_badge(rating):
     return f'<span class="badge {cls}">{r}</span>'
 
 
+# Column-at-a-time variants of the helpers above, used by _render_table and
+# chart labels. Each takes any array-like and returns an object ndarray of
+# strings identical, element for element, to the scalar helper. The number
+# formatters and their variants are in nivesa.formatting.
+
+_HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#x27;'))
+
+
+def esc_array(values):
+    """Vectorized esc(); None/NaN become ''."""
+    s = pd.Series(values, dtype=object)
+    out = s.where(s.notna(), '').astype(str)
+    for ch, rep in _HTML_ESCAPES:
+        out = out.str.replace(ch, rep, regex=False)
+    return out.to_numpy(dtype=object)
+
+
+RATING_BADGE_HTML = {r: rating_badge(r) for r in CREDIT_RATINGS}
+
+
+def rating_badge_array(ratings):
+    """Vectorized rating_badge() via a lookup of the pre-rendered badges."""
+    s = pd.Series(ratings, dtype=object).fillna('Unrated').replace('', 'Unrated')
+    out = s.map(RATING_BADGE_HTML)
+    missing = out.isna()
+    if missing.any():
+        out[missing] = s[missing].map(rating_badge)
+    return out.to_numpy(dtype=object)
+
+
+def security_cell_array(issuers, isins):
+    """Two-line issuer / ISIN cell markup for a whole column."""
+    return ("<div style='font-weight:600'>" + esc_array(issuers)
+            + "</div><div style='font-size:0.75rem;color:#888'>" + esc_array(isins) + "</div>")
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# POSITIONS ENGINE
+# ═══════════════════════════════════════════════════════════════════════
+
+def get_positions_dataframe():
+    """Positions and totals from the shared analytics cache (see
+    nivesa.positions), copied so pages can add columns."""
+    df, totals, _ = portfolio_analytics()
+    return df.copy(), dict(totals)
+
+
+def get_transaction_ledger_dataframe(account=None):
+    """Fetch transactions (optionally one account's) joined with security
+    master data."""
+    df = db_query(*ledger_export_query(account=account))
+    if not df.empty:
+        df['trade_date'] = pd.to_datetime(df['trade_date'])
+    return df
+
+
 # ═══════════════════════════════════════════════════════════════════════
-# FINANCIAL CALCULATIONS ENGINE
+# CASHFLOW ENGINE
 # ═══════════════════════════════════════════════════════════════════════
+# Projections come from nivesa.finance.project_cashflows, cached here per
+# ledger revision and valuation date for every tab that reads them.
+
+CASHFLOW_ROLLUPS = {'Monthly': 'M', 'Quarterly': 'Q', 'Yearly': 'Y'}
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def portfolio_cashflows(_positions, revision, as_of):
+    """cashflow_projection cached per ledger revision and valuation date,
+    taken from the shared analytics when they are for the same ones."""
+    key = analytics_key()
+    if key[0] == revision and key[2] == as_of:
+        return portfolio_analytics(key)[2]
+    return cashflow_projection(_positions, as_of)
 
-def day_count_fraction(start_date, end_date, convention="Actual/365"):
+
+def cashflow_rollup(cf, period='M', account='All'):
+    """Coupon/principal/total summed per calendar period ('M', 'Q' or 'Y'),
+    optionally for one account."""
+    sub = cf if account == 'All' else cf[cf['account'] == account]
+    out = sub.groupby(sub['date'].dt.to_period(period))[['coupon', 'principal', 'total']].sum()
+    out.index.name = 'period'
+    return out.reset_index()
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# YIELD CURVES
+# ═══════════════════════════════════════════════════════════════════════
+# Benchmark (G-Sec) par-yield curves are loaded from CSV files, from the
+# drop folder or an upload, into yield_curves keyed by (curve, date, tenor).
+# Every stored date is bootstrapped in one pass into semiannual zero rates
+# on a fixed tenor grid, cached per market revision. Valuation picks the
+# latest curve on or before the valuation date, so historical dates reuse
+# the cached set instead of reloading.
+
+CURVE_DIR = os.path.join(DATA_DIR, "curves")
+CURVE_IMPORT_COLUMNS = ['date', 'tenor', 'yield']     # optional: curve
+ZERO_GRID = np.concatenate([[0.25], np.arange(0.5, 30.5, 0.5)])
+ZERO_COMPOUNDING = 2
+SPREAD_COLUMNS = ['bond_id', 'account', 'issuer', 'isin', 'curve_date', 'price', 'z_spread', 'spread_duration']
+
+
+def parse_curve_points(raw, source):
+    """yield_curves rows from a curve file (date, tenor, yield in percent and
+    optionally curve), as (rows, None) or (None, error message)."""
+    cols = {str(c).strip().lower(): c for c in raw.columns}
+    missing = [c for c in CURVE_IMPORT_COLUMNS if c not in cols]
+    if missing:
+        return None, f"Missing columns: {', '.join(missing)}"
+    rows = pd.DataFrame({
+        'curve': raw[cols['curve']].astype(str).str.strip().str.upper() if 'curve' in cols else DEFAULT_CURVE,
+        'curve_date': pd.to_datetime(raw[cols['date']], errors='coerce').dt.strftime('%Y-%m-%d'),
+        'tenor': parse_tenors(raw[cols['tenor']]),
+        'par_yield': pd.to_numeric(raw[cols['yield']], errors='coerce') / 100,
+        'source': source,
+    })
+    bad = rows[['curve_date', 'tenor', 'par_yield']].isna().any(axis=1) | ~(rows['tenor'] > 0)
+    if bad.any():
+        return None, f"{int(bad.sum())} row(s) with an unreadable date, tenor or yield"
+    return rows.drop_duplicates(['curve', 'curve_date', 'tenor'], keep='last'), None
+
+
+def store_curve_points(rows):
+    """Upsert curve points in one transaction. Unchanged points are left
+    alone, so reloading the same file does not bump the market revision.
+    Floating-rate securities are re-fixed (see COUPON TERMS) in the same
+    transaction. Returns the number of rows written, or None on failure."""
     try:
-        sd = pd.to_datetime(start_date).date()
-        ed = pd.to_datetime(end_date).date()
-        if convention == "30/360":
-            d1 = min(sd.day, 30)
-            d2 = min(ed.day, 30) if d1 == 30 else ed.day
-            days = 360 * (ed.year - sd.year) + 30 * (ed.month - sd.month) + (d2 - d1)
-            return max(0, days / 360.0)
-        elif convention == "Actual/360":
-            return max(0, (ed - sd).days / 360.0)
-        elif convention == "Actual/Actual":
-            # Proper ISDA Actual/Actual: split the interval by calendar year and
-            # divide each part's actual days by that year's length (365 or 366),
-            # summing whole years between. The old 365.25 shortcut mis-priced
-            # leap-year-spanning periods by ~0.2% (verified vs QuantLib ISDA).
-            if ed <= sd:
-                return 0.0
-            if sd.year == ed.year:
-                diy = 366 if calendar.isleap(sd.year) else 365
-                return (ed - sd).days / diy
-            frac = 0.0
-            diy1 = 366 if calendar.isleap(sd.year) else 365
-            frac += (date(sd.year + 1, 1, 1) - sd).days / diy1
-            frac += (ed.year - sd.year - 1)
-            diy2 = 366 if calendar.isleap(ed.year) else 365
-            frac += (ed - date(ed.year, 1, 1)).days / diy2
-            return max(0.0, frac)
-        else: # Actual/365
-            return max(0, (ed - sd).days / 365.0)
-    except (ValueError, TypeError):
-        return 0.0
+        with closing(_connect()) as conn, conn:
+            cur = conn.executemany(
+                "INSERT INTO yield_curves (curve, curve_date, tenor, par_yield, source) VALUES (?,?,?,?,?) "
+                "ON CONFLICT (curve, curve_date, tenor) DO UPDATE SET "
+                "par_yield=excluded.par_yield, source=excluded.source "
+                "WHERE par_yield != excluded.par_yield",
+                rows[['curve', 'curve_date', 'tenor', 'par_yield', 'source']].itertuples(index=False, name=None),
+            )
+            written = cur.rowcount
+            floating = [r[0] for r in conn.execute(
+                "SELECT DISTINCT bond_id FROM coupon_terms WHERE benchmark_tenor IS NOT NULL")]
+            if written and floating:
+                rebuild_security_schedule(conn, floating)
+            return written
+    except sqlite3.Error as e:
+        st.error(f"Curve import failed: {e}")
+        logger.error(f"Curve import failed: {e}")
+        return None
+
+
+def load_curve_folder(folder=CURVE_DIR):
+    """Parse and store every CSV in the curve drop folder. Returns (files
+    read, rows written, [(file, error)])."""
+    if not os.path.isdir(folder):
+        return 0, 0, []
+    files, written, errors = 0, 0, []
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith('.csv'):
+            continue
+        try:
+            rows, err = parse_curve_points(pd.read_csv(os.path.join(folder, name)), name)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            rows, err = None, str(e)
+        if err:
+            errors.append((name, err))
+            continue
+        n = store_curve_points(rows)
+        if n is None:
+            errors.append((name, "database write failed"))
+            continue
+        files, written = files + 1, written + n
+    logger.info(f"Curve folder load: {files} files, {written} rows written, {len(errors)} errors")
+    return files, written, errors
+
+
+def bootstrap_zero_rates(par):
+    """Zero rates (semiannual compounding) on ZERO_GRID from par yields on
+    ZERO_GRID, one curve per row. The 3M point is taken as a zero rate; from
+    6M on the grid is a semiannual par-bond strip solved in tenor order,
+    every curve at once."""
+    par = np.atleast_2d(par)
+    df = np.empty_like(par)
+    df[:, 0] = (1 + par[:, 0] / 2) ** (-2 * ZERO_GRID[0])
+    annuity = np.zeros(len(par))
+    for j in range(1, len(ZERO_GRID)):
+        c = par[:, j] / 2
+        df[:, j] = (1 - c * annuity) / (1 + c)
+        annuity += df[:, j]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2 * (df ** (-1 / (2 * ZERO_GRID)) - 1)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def zero_curves(market_revision, curve=DEFAULT_CURVE):
+    """(curve dates, zero rates on ZERO_GRID per date) for every stored date
+    of `curve`. Par yields between stored tenors are linearly interpolated
+    and held flat beyond them."""
+    pts = db_query(
+        "SELECT curve_date, tenor, par_yield FROM yield_curves WHERE curve=? ORDER BY curve_date, tenor", (curve,),
+    )
+    if pts.empty:
+        return np.array([], dtype='datetime64[D]'), np.empty((0, len(ZERO_GRID)))
+    groups = pts.groupby('curve_date', sort=True)
+    par = np.vstack([np.interp(ZERO_GRID, g['tenor'], g['par_yield']) for _, g in groups])
+    dates = np.array(list(groups.groups), dtype='datetime64[D]')
+    return dates, bootstrap_zero_rates(par)
+
+
+@functools.lru_cache(maxsize=64)
+def curve_for(as_of, market_revision, curve=DEFAULT_CURVE):
+    """(curve date, zero rates on ZERO_GRID) of the latest `curve` on or
+    before `as_of`, or None if there is none."""
+    dates, zeros = zero_curves(market_revision, curve)
+    i = int(np.searchsorted(dates, np.datetime64(as_of, 'D'), side='right')) - 1
+    return None if i < 0 else (dates[i], zeros[i])
+
+
+def zero_rates(t, curve):
+    """Zero rates at times `t` (years, any shape) on a curve_for() curve."""
+    return np.interp(t, ZERO_GRID, curve[1])
+
+
+def z_spreads(price, cfm, tm, curve):
+    """Per-row Z-spread over `curve` (semiannual) pricing padded cashflows
+    `cfm` at times `tm` to `price`."""
+    freq = np.full(len(price), ZERO_COMPOUNDING)
+    return solve_yields(price, cfm, tm, freq, base=zero_rates(tm, curve))
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def spread_analytics(_positions, revision, as_of, market_revision):
+    """SPREAD_COLUMNS per position priced at valuation_price: Z-spread over
+    the curve in force on `as_of`, and spread duration (value sensitivity to
+    the spread). Empty when no curve is loaded."""
+    curve = curve_for(as_of, market_revision)
+    if _positions.empty or curve is None:
+        return pd.DataFrame(columns=SPREAD_COLUMNS)
+    _, _, _, cfm, tm = cashflow_matrix(_positions, portfolio_cashflows(_positions, revision, as_of), as_of)
+    price = valuation_price(_positions)
+    priced = (price > 0) & (cfm.sum(axis=1) > 0)
+    s = np.where(priced, z_spreads(price, cfm, tm, curve), np.nan)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        factor = 1 + (zero_rates(tm, curve) + s[:, None]) / ZERO_COMPOUNDING
+        sdur = (tm * cfm * factor ** (-ZERO_COMPOUNDING * tm - 1)).sum(axis=1) / price
+    out = _positions[['bond_id', 'account', 'issuer', 'isin']].reset_index(drop=True)
+    out['curve_date'] = pd.Timestamp(curve[0])
+    out['price'] = price
+    out['z_spread'] = s
+    out['spread_duration'] = np.where(np.isfinite(s), sdur, np.nan)
+    return out[np.isfinite(s)].reset_index(drop=True)
 
 
-def calc_accrued_interest(face_value, coupon_rate, frequency, day_count="Actual/365", last_coupon_date=None, maturity_date=None):
+# ═══════════════════════════════════════════════════════════════════════
+# MARK TO MARKET
+# ═══════════════════════════════════════════════════════════════════════
+# End-of-day clean prices (per unit, like transaction prices) arrive as
+# CSV/XLSX files with isin, date and price columns in the price drop folder
+# or as an upload. Loading is an upsert that leaves unchanged prices alone,
+# and folder loads skip files already loaded with the same size and mtime,
+# so re-running a load is cheap and idempotent. Each position is marked at
+# the latest price on or before the valuation date.
+
+PRICE_DIR = os.path.join(DATA_DIR, "prices")
+PRICE_IMPORT_COLUMNS = ['isin', 'date', 'price']
+PRICE_FILE_TYPES = ('.csv', '.xlsx')
+
+
+def read_price_file(source, name):
+    """Raw frame from a CSV or XLSX price file (path or upload)."""
+    if name.lower().endswith('.xlsx'):
+        return pd.read_excel(source)
+    return pd.read_csv(source)
+
+
+def parse_price_rows(raw, source):
+    """prices rows from a price file, as (rows, None) or (None, error)."""
+    cols = {str(c).strip().lower(): c for c in raw.columns}
+    missing = [c for c in PRICE_IMPORT_COLUMNS if c not in cols]
+    if missing:
+        return None, f"Missing columns: {', '.join(missing)}"
+    rows = pd.DataFrame({
+        'isin': raw[cols['isin']].astype(str).str.strip().str.upper(),
+        'price_date': pd.to_datetime(raw[cols['date']], errors='coerce').dt.strftime('%Y-%m-%d'),
+        'clean_price': pd.to_numeric(raw[cols['price']], errors='coerce'),
+        'source': source,
+    })
+    bad = rows[['price_date', 'clean_price']].isna().any(axis=1) | ~(rows['clean_price'] > 0) | (rows['isin'] == '')
+    if bad.any():
+        return None, f"{int(bad.sum())} row(s) with an unreadable ISIN, date or price"
+    return rows.drop_duplicates(['isin', 'price_date'], keep='last'), None
+
+
+def store_prices(rows, conn=None):
+    """Upsert prices; unchanged rows are not rewritten (and do not bump the
+    market revision). Returns rows written, or None on failure."""
+    sql = (
+        "INSERT INTO prices (isin, price_date, clean_price, source) VALUES (?,?,?,?) "
+        "ON CONFLICT (isin, price_date) DO UPDATE SET "
+        "clean_price=excluded.clean_price, source=excluded.source "
+        "WHERE clean_price != excluded.clean_price"
+    )
+    params = rows[['isin', 'price_date', 'clean_price', 'source']].itertuples(index=False, name=None)
+    if conn is not None:
+        return conn.executemany(sql, params).rowcount
     try:
-        today = date.today()
-        if maturity_date is not None:
-            mat = pd.to_datetime(maturity_date).date()
-            if mat <= today:
-                return 0.0
-        
-        if last_coupon_date is None:
-            freq = FREQ_MAP.get(frequency, 1)
-            days = ((365.25 / freq) / 2)
-            return face_value * coupon_rate / 365.25 * days
-        
-        frac = day_count_fraction(last_coupon_date, today, day_count)
-        return face_value * coupon_rate * frac
-    except (ValueError, TypeError):
-        return 0.0
+        with closing(_connect()) as conn, conn:
+            return conn.executemany(sql, params).rowcount
+    except sqlite3.Error as e:
+        st.error(f"Price import failed: {e}")
+        logger.error(f"Price import failed: {e}")
+        return None
+
+
+def load_price_folder(folder=PRICE_DIR):
+    """Load new or changed price files from the drop folder. Each file and
+    its price_files entry commit together. Returns (files loaded, files
+    skipped as unchanged, rows written, [(file, error)])."""
+    if not os.path.isdir(folder):
+        return 0, 0, 0, []
+    seen = db_query("SELECT name, size, mtime FROM price_files")
+    seen = {r.name: (r.size, r.mtime) for r in seen.itertuples()} if not seen.empty else {}
+    loaded = skipped = written = 0
+    errors = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not name.lower().endswith(PRICE_FILE_TYPES) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if seen.get(name) == (stat.st_size, stat.st_mtime):
+            skipped += 1
+            continue
+        try:
+            rows, err = parse_price_rows(read_price_file(path, name), name)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            rows, err = None, str(e)
+        if err:
+            errors.append((name, err))
+            continue
+        try:
+            with closing(_connect()) as conn, conn:
+                written += store_prices(rows, conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO price_files (name, size, mtime, rows, loaded_at) VALUES (?,?,?,?,?)",
+                    (name, stat.st_size, stat.st_mtime, len(rows), datetime.now().isoformat(timespec='seconds')),
+                )
+            loaded += 1
+        except sqlite3.Error as e:
+            errors.append((name, f"database write failed: {e}"))
+    logger.info(f"Price folder load: {loaded} loaded, {skipped} unchanged, {written} rows written, {len(errors)} errors")
+    return loaded, skipped, written, errors
+
+
+def valuation_price(positions):
+    """Value each position is priced at for spread and scenario analytics:
+    its dirty market value where marked, else its cost basis."""
+    cost = positions['cost_basis'].to_numpy(dtype=float)
+    if 'dirty_value' not in positions:
+        return cost
+    return np.where(np.isfinite(positions['dirty_value'].to_numpy(dtype=float)), positions['dirty_value'], cost)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# RATE SCENARIOS
+# ═══════════════════════════════════════════════════════════════════════
+# Every position's projected cashflows are revalued under a grid of curve
+# shocks in one matrix pass (cashflows x scenarios, summed per position).
+# Each position is discounted at a base rate calibrated to its valuation
+# price (see scenario_book), so the unshocked value is that price, plus the
+# shock at each cashflow's tenor. A shock is a bp bump
+# per key tenor, interpolated with triangular key-rate weights, so parallel
+# moves, twists and custom key-rate bumps share one representation.
+
+KEY_RATE_TENORS = [0.5, 1, 2, 3, 5, 7, 10, 15, 30]
+KEY_RATE_LABELS = ['6M', '1Y', '2Y', '3Y', '5Y', '7Y', '10Y', '15Y', '30Y']
+SCENARIO_POOL_MIN_CELLS = 2_000_000   # cashflow rows x scenarios before fanning out
+SCENARIO_COLUMNS = ['scenario', 'bond_id', 'account', 'issuer', 'isin', 'base_value', 'value', 'pnl']
+
+
+def _twist(bp):
+    """Key-rate bumps rotating the curve by `bp` between 1Y and 10Y (short
+    end down bp/2, long end up bp/2, flat beyond); negative flattens."""
+    shape = np.interp(np.log(KEY_RATE_TENORS), np.log([1, 10]), [-bp / 2, bp / 2])
+    return tuple(float(v) for v in shape.round(4))
+
+
+SCENARIO_PRESETS = {
+    **{f"Parallel {s:+d}bp": (float(s),) * len(KEY_RATE_TENORS)
+       for s in (-200, -100, -50, -25, 25, 50, 100, 200)},
+    "Steepener 50bp": _twist(50), "Flattener 50bp": _twist(-50),
+    "Steepener 100bp": _twist(100), "Flattener 100bp": _twist(-100),
+}
+SCENARIO_DEFAULTS = [
+    "Parallel -100bp", "Parallel -50bp", "Parallel +50bp", "Parallel +100bp",
+    "Steepener 50bp", "Flattener 50bp",
+]
+
+
+def scenario_book(positions, cashflows, as_of, curve=None):
+    """(book, solved) for nivesa.rates: long arrays over the cashflow rows
+    of positions whose base rate could be solved, and a per-position mask
+    of those. Positions are priced at valuation_price (market where marked,
+    else cost). Without a curve each position is discounted at the yield
+    implied by that price; with one (see curve_for) at the zero rate for
+    each cashflow's tenor plus the position's Z-spread."""
+    n = len(positions)
+    pos, amounts, t, cfm, tm = cashflow_matrix(positions, cashflows, as_of)
+    price = valuation_price(positions)
+    priced = (price > 0) & (cfm.sum(axis=1) > 0)
+    if curve is None:
+        freq = positions['frequency'].map(FREQ_MAP).fillna(1).to_numpy(dtype=int)
+        y = np.where(priced, solve_yields(price, cfm, tm, freq), np.nan)
+        rate, row_freq = y[pos], freq[pos].astype(float)
+    else:
+        y = np.where(priced, z_spreads(price, cfm, tm, curve), np.nan)
+        rate, row_freq = zero_rates(t, curve) + y[pos], np.full(len(pos), float(ZERO_COMPOUNDING))
+    ok = np.isfinite(y[pos])
+    book = (amounts[ok], t[ok], row_freq[ok], rate[ok], pos[ok], n)
+    return book, np.isfinite(y)
+
+
+def revalue_scenarios(book, shifts_bp):
+    """Position values (positions x scenarios) for a bp shift grid. Large
+    books fan the scenario grid out over a process pool; if processes can't
+    be started the grid is evaluated in-process."""
+    keys = np.asarray(KEY_RATE_TENORS, dtype=float)
+    workers = min(os.cpu_count() or 1, len(shifts_bp))
+    if workers > 1 and len(book[0]) * len(shifts_bp) >= SCENARIO_POOL_MIN_CELLS:
+        try:
+            return revalue_parallel(book, keys, shifts_bp, workers)
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"Scenario pool unavailable, revaluing in-process: {e}")
+    return revalue(book, keys, shifts_bp)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def rate_scenarios(_positions, revision, as_of, market_revision, scenarios):
+    """SCENARIO_COLUMNS per (scenario, position) for `scenarios`, a tuple of
+    (name, key-rate bp tuple) pairs; positions without a solvable base rate
+    are left out. Cached per ledger and market revision, valuation date and
+    grid."""
+    if _positions.empty or not scenarios:
+        return pd.DataFrame(columns=SCENARIO_COLUMNS)
+    cashflows = portfolio_cashflows(_positions, revision, as_of)
+    book, solved = scenario_book(_positions, cashflows, as_of, curve_for(as_of, market_revision))
+    shifts = np.array([(0.0,) * len(KEY_RATE_TENORS)] + [bp for _, bp in scenarios])
+    values = revalue_scenarios(book, shifts)
+    keep = np.flatnonzero(solved)
+    base, shocked = values[keep, :1], values[keep, 1:]
+    names = [name for name, _ in scenarios]
+    info = _positions.iloc[keep][['bond_id', 'account', 'issuer', 'isin']].reset_index(drop=True)
+    out = pd.concat([info] * len(names), ignore_index=True)
+    out.insert(0, 'scenario', np.repeat(names, len(keep)))
+    out['base_value'] = np.tile(base[:, 0], len(names))
+    out['value'] = shocked.T.ravel()
+    out['pnl'] = out['value'] - out['base_value']
+    return out
+
+
+KRD_BUMP_BP = 1.0
+KRD_COLUMNS = ['bond_id', 'account', 'issuer', 'isin', 'base_value'] + KEY_RATE_LABELS + ['total']
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def key_rate_durations(_positions, revision, as_of, market_revision):
+    """KRD_COLUMNS per position: the duration to each key tenor by central
+    bump-and-reprice of the cashflow book, one +/-KRD_BUMP_BP triangular bump
+    per tenor. The tenors sum to the position's effective duration."""
+    if _positions.empty:
+        return pd.DataFrame(columns=KRD_COLUMNS)
+    cashflows = portfolio_cashflows(_positions, revision, as_of)
+    book, solved = scenario_book(_positions, cashflows, as_of, curve_for(as_of, market_revision))
+    k = len(KEY_RATE_TENORS)
+    bumps = np.eye(k) * KRD_BUMP_BP
+    values = revalue_scenarios(book, np.vstack([np.zeros(k), bumps, -bumps]))
+    keep = np.flatnonzero(solved)
+    base, up, down = values[keep, 0], values[keep, 1:k + 1], values[keep, k + 1:]
+    krd = (down - up) / (2 * KRD_BUMP_BP / 1e4 * base[:, None])
+    out = _positions.iloc[keep][['bond_id', 'account', 'issuer', 'isin']].reset_index(drop=True)
+    out['base_value'] = base
+    out[KEY_RATE_LABELS] = krd
+    out['total'] = krd.sum(axis=1)
+    return out
+
+
+def krd_by_account(krd):
+    """Value-weighted key-rate durations per account plus a 'Portfolio' row,
+    with KR01 (value change for a 1bp move at every tenor)."""
+    cols = KEY_RATE_LABELS + ['total']
+    weighted = krd[cols].mul(krd['base_value'], axis=0).assign(account=krd['account'], base_value=krd['base_value'])
+    sums = weighted.groupby('account').sum()
+    sums.loc['Portfolio'] = weighted.drop(columns='account').sum()
+    out = sums[cols].div(sums['base_value'].where(sums['base_value'] > 0), axis=0).fillna(0.0)
+    out['base_value'] = sums['base_value']
+    out['kr01'] = sums['total'] / 1e4
+    return out.rename_axis('account').reset_index()
+
+
+def scenario_breakdown(results, by):
+    """Base value, shocked value and P&L per scenario and `by` ('account',
+    'issuer' or 'isin'), with P&L as a fraction of base value."""
+    keys = ['scenario', by] + (['issuer', 'account'] if by == 'isin' else [])
+    out = results.groupby(keys, sort=False)[['base_value', 'value', 'pnl']].sum().reset_index()
+    out['pnl_pct'] = np.divide(out['pnl'], out['base_value'],
+                               out=np.zeros(len(out)), where=out['base_value'].to_numpy() > 0)
+    return out
+
 
+# ═══════════════════════════════════════════════════════════════════════
+# VALUE AT RISK
+# ═══════════════════════════════════════════════════════════════════════
+# Historical simulation: each stored benchmark curve date's change in zero
+# rates at the key tenors (over 1 or 10 curve observations, overlapping) is
+# one shock, applied to the current book through the scenario kernels. The
+# history is revalued in chunks of VAR_CHUNK_SCENARIOS shocks and folded
+# into per-account P&L as it goes, so memory stays bounded by the chunk
+# rather than the length of the history.
+
+VAR_HORIZONS = {'1D': 1, '10D': 10}
+VAR_CONFIDENCES = [0.95, 0.975, 0.99]
+VAR_CHUNK_SCENARIOS = 250
+VAR_MIN_HISTORY = 20
+
+
+def curve_history_shocks(market_revision, as_of, horizon):
+    """(end dates, bp change at each KEY_RATE_TENORS tenor) between stored
+    curves `horizon` observations apart, for curves on or before `as_of`."""
+    dates, zeros = zero_curves(market_revision)
+    keep = dates <= np.datetime64(as_of, 'D')
+    dates, zeros = dates[keep], zeros[keep]
+    if len(dates) <= horizon:
+        return dates[:0], np.empty((0, len(KEY_RATE_TENORS)))
+    at_keys = zeros[:, np.searchsorted(ZERO_GRID, KEY_RATE_TENORS)]
+    return dates[horizon:], (at_keys[horizon:] - at_keys[:-horizon]) * 1e4
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def historical_pnl(_positions, revision, as_of, market_revision, horizon):
+    """(P&L per historical shock, base value) by account: a frame indexed by
+    shock end date with one column per account plus 'Portfolio', and the
+    matching base values as a Series."""
+    dates, shocks = curve_history_shocks(market_revision, as_of, horizon)
+    accounts, codes = np.unique(_positions['account'].to_numpy(dtype=str), return_inverse=True)
+    cols = list(accounts) + ['Portfolio']
+    if not len(dates):
+        return pd.DataFrame(columns=cols), pd.Series(0.0, index=cols)
+    book, _ = scenario_book(_positions, portfolio_cashflows(_positions, revision, as_of), as_of,
+                            curve_for(as_of, market_revision))
+    to_acct = np.zeros((len(accounts), len(_positions)))
+    to_acct[codes, np.arange(len(_positions))] = 1.0
+    base = revalue_scenarios(book, np.zeros((1, len(KEY_RATE_TENORS))))[:, 0]
+    pnl = np.empty((len(dates), len(accounts)))
+    for start in range(0, len(dates), VAR_CHUNK_SCENARIOS):
+        chunk = shocks[start:start + VAR_CHUNK_SCENARIOS]
+        pnl[start:start + len(chunk)] = (to_acct @ (revalue_scenarios(book, chunk) - base[:, None])).T
+    out = pd.DataFrame(pnl, index=pd.DatetimeIndex(dates, name='date'), columns=list(accounts))
+    out['Portfolio'] = pnl.sum(axis=1)
+    base_by_acct = pd.Series(np.append(to_acct @ base, base.sum()), index=cols)
+    return out, base_by_acct
+
+
+def var_summary(pnl, confidence):
+    """VaR and expected shortfall (as positive losses) at `confidence` for
+    each column of a historical_pnl frame, plus the worst loss and its date."""
+    values = pnl.to_numpy(dtype=float)
+    cutoff = np.quantile(values, 1 - confidence, axis=0, method='lower')
+    tail = np.where(values <= cutoff, values, np.nan)
+    return pd.DataFrame({
+        'account': pnl.columns,
+        'var': -cutoff,
+        'es': -np.nanmean(tail, axis=0),
+        'worst': -values.min(axis=0),
+        'worst_date': pnl.index[values.argmin(axis=0)],
+    })
 
-def calc_macaulay_duration(fv, coupon_rate, frequency, maturity_str, ytm, day_count="Actual/365"):
+
+# ═══════════════════════════════════════════════════════════════════════
+# RATE SIMULATION
+# ═══════════════════════════════════════════════════════════════════════
+# Distributional reinvestment outcomes. Short rates follow a Vasicek
+# process (see nivesa.montecarlo) started from the benchmark curve's 3M
+# zero rate and reverting towards its 10Y rate. Projected coupons and
+# principal are bucketed by month and reinvested at each path's short rate
+# until the horizon; cashflows beyond it are valued off the terminal short
+# rate. Paths run in seeded batches, over a process pool for large runs,
+# and a run interrupted between batches keeps the batches it finished.
+
+MC_PERCENTILES = [5, 25, 50, 75, 95]
+MC_BATCH_PATHS = 1000
+MC_MAX_PATHS = 20000
+MC_POOL_MIN_CELLS = 2_000_000   # paths x months before fanning out
+MC_FALLBACK = {'r0': 0.065, 'b': 0.07, 'sigma': 0.01, 'a': 0.15}
+MC_COLUMNS = ['account', 'metric'] + [f'p{q}' for q in MC_PERCENTILES] + ['mean']
+
+
+def _continuous(z):
+    """Semiannual zero rates as continuously compounded ones."""
+    return ZERO_COMPOUNDING * np.log1p(np.asarray(z, dtype=float) / ZERO_COMPOUNDING)
+
+
+def mc_defaults(as_of, market_revision):
+    """Vasicek parameters (r0, b, sigma, a) read off the benchmark curve:
+    the 3M and 10Y zero rates of the latest curve and the annualised
+    volatility of 3M changes over the stored history. Mean reversion is
+    not estimated (a few years of history pin it down poorly); it and
+    anything without curve data come from MC_FALLBACK."""
+    params = dict(MC_FALLBACK)
+    curve = curve_for(as_of, market_revision)
+    if curve is None:
+        return params
+    params['r0'] = float(_continuous(curve[1][0]))
+    params['b'] = float(_continuous(zero_rates(10.0, curve)))
+    dates, zeros = zero_curves(market_revision)
+    keep = dates <= np.datetime64(as_of, 'D')
+    if keep.sum() > VAR_MIN_HISTORY:
+        short = _continuous(zeros[keep, 0])
+        years = (dates[keep][-1] - dates[keep][0]).astype(int) / 365.25
+        params['sigma'] = float(np.diff(short).std(ddof=1) * np.sqrt((len(short) - 1) / years))
+    return params
+
+
+def monte_carlo_spec(positions, cashflows, as_of, horizon_years, params):
+    """(spec, accounts) for nivesa.montecarlo: projected cashflows summed
+    per account into the month (as_of + k months, as_of + k+1 months] they
+    fall in, split at the horizon, with the model `params` merged in.
+    Spec rows follow `accounts`."""
+    steps = int(horizon_years) * 12
+    accounts = np.unique(positions['account'].to_numpy(dtype=str))
+    anchor = np.datetime64(as_of, 'D')
+    cf = cashflows[cashflows['total'] > 0]
+    dates = cf['date'].to_numpy().astype('datetime64[D]')
+    last = dates.max() if len(dates) else anchor
+    months = max(steps, int((last.astype('datetime64[M]') - anchor.astype('datetime64[M]')).astype(int)) + 1)
+
+    # Month ends as_of + k months, clipped to the month's length.
+    grid = anchor.astype('datetime64[M]') + np.arange(1, months + 1)
+    month_len = ((grid + 1).astype('datetime64[D]') - grid.astype('datetime64[D]')).astype(int)
+    day = int((anchor - anchor.astype('datetime64[M]').astype('datetime64[D]')).astype(int)) + 1
+    ends = grid.astype('datetime64[D]') + (np.minimum(day, month_len) - 1)
+
+    bucket = np.searchsorted(ends, dates, side='left')
+    acct = np.searchsorted(accounts, cf['account'].to_numpy(dtype=str))
+    inflows, coupons = np.zeros((len(accounts), months)), np.zeros((len(accounts), months))
+    np.add.at(inflows, (acct, bucket), cf['total'].to_numpy(dtype=float))
+    np.add.at(coupons, (acct, bucket), cf['coupon'].to_numpy(dtype=float))
+    spec = dict(
+        params, dt=1 / 12, steps=steps,
+        inflows=inflows[:, :steps], coupons=coupons[:, :steps],
+        tail=inflows[:, steps:], tail_tau=np.arange(1, months - steps + 1) / 12,
+    )
+    return spec, list(accounts)
+
+
+def run_monte_carlo(spec, n_paths, seed, on_batch=None):
+    """simulate_batch results keyed by batch index for a run of `n_paths`
+    paths from `seed`. `on_batch(done, total)` is called as each batch
+    lands; returning True stops the run there, and an exception raised in
+    it (Streamlit interrupting the script) leaves the batches so far in
+    `done`. Large runs spread batches over a process pool and finish
+    in-process if the pool can't be started or breaks."""
+    plan = batch_plan(seed, n_paths, MC_BATCH_PATHS)
+    workers = min(os.cpu_count() or 1, len(plan)) if n_paths * spec['steps'] >= MC_POOL_MIN_CELLS else 1
+    done = {}
+    while True:
+        try:
+            with closing(iter_batches(spec, plan, workers, skip=set(done))) as batches:
+                for i, result in batches:
+                    done[i] = result
+                    if on_batch is not None and on_batch(done, len(plan)):
+                        break
+            return done
+        except (OSError, BrokenProcessPool) as e:
+            if workers <= 1:
+                raise
+            logger.warning(f"Simulation pool unavailable, continuing in-process: {e}")
+            workers = 1
+
+
+def mc_summary(done, accounts):
+    """(percentiles, fan, paths) from run_monte_carlo batches: MC_COLUMNS
+    rows of income and terminal value per account and for the 'Portfolio',
+    the portfolio's reinvested cash percentiles per month, and the number
+    of paths behind them. Batches are combined in index order, so a seed
+    gives the same figures however the run was scheduled."""
+    parts = [done[i] for i in sorted(done)]
+    labels = list(accounts) + ['Portfolio']
+    rows = []
+    for metric, k in (('Income', 0), ('Terminal Value', 1)):
+        values = np.vstack([p[k] for p in parts])
+        values = np.column_stack([values, values.sum(axis=1)])
+        frame = pd.DataFrame(np.percentile(values, MC_PERCENTILES, axis=0).T,
+                             columns=[f'p{q}' for q in MC_PERCENTILES])
+        frame.insert(0, 'metric', metric)
+        frame.insert(0, 'account', labels)
+        frame['mean'] = values.mean(axis=0)
+        rows.append(frame)
+    cash = np.vstack([p[2] for p in parts])
+    fan = pd.DataFrame(np.percentile(cash, MC_PERCENTILES, axis=0).T,
+                       columns=[f'p{q}' for q in MC_PERCENTILES],
+                       index=pd.RangeIndex(1, cash.shape[1] + 1, name='month'))
+    return pd.concat(rows, ignore_index=True)[MC_COLUMNS], fan, len(cash)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# COUPON TERMS
+# ═══════════════════════════════════════════════════════════════════════
+# Step-up and floating terms expand into coupon_resets in nivesa.schedule;
+# saving a security's terms rewrites its resets and calendar at once.
+
+def replace_coupon_terms(terms, bond_id):
+    """Replace `bond_id`'s coupon terms with `terms` (COUPON_TERM_COLUMNS)
+    and rebuild its resets and calendar, atomically."""
     try:
-        mat_date = pd.to_datetime(maturity_str).date()
-        today = date.today()
-        if mat_date <= today or ytm <= 0: return 0.0
-        
-        schedule = generate_cashflow_schedule(fv, coupon_rate, frequency, maturity_str)
-        if not schedule: return 0.0
-        
-        freq = FREQ_MAP.get(frequency, 1)
-        pv_w = pv_s = 0.0
-        for cf in schedule:
-            t = day_count_fraction(today, cf['date'], day_count)
-            if t > 0:
-                pv = cf['total'] / ((1 + ytm / freq) ** (freq * t))
-                pv_w += t * pv
-                pv_s += pv
-        return pv_w / pv_s if pv_s else 0.0
-    except (ValueError, TypeError, ZeroDivisionError):
-        return 0.0
-
-
-def calc_modified_duration(mac, ytm, frequency):
-    freq = FREQ_MAP.get(frequency, 1)
-    return mac / (1 + ytm / freq) if ytm > 0 else mac
-
-
-def calc_yield_to_cost(fv_pu, cost_pu, coupon_rate, maturity_str, frequency, day_count="Actual/365", as_of=None):
-    """Yield actually locked in at purchase: the IRR equating the price paid
-    per unit to ALL cashflows from the purchase date to maturity.
-
-    `as_of` is the valuation/purchase anchor (default today). Anchoring at the
-    purchase date is what makes this a true *yield-to-cost*: discounting only
-    the REMAINING cashflows from today against the ORIGINAL cost — while
-    dropping coupons already received — made the number drift as the bond
-    seasoned (verified: +72bps on a seasoned discount bond, -66bps on a
-    premium bond). Anchoring at purchase makes it invariant to seasoning."""
+        with closing(_connect()) as conn, conn:
+            conn.execute("DELETE FROM coupon_terms WHERE bond_id=?", (bond_id,))
+            floating = terms['benchmark_tenor'].fillna('').astype(str).str.strip().ne('')
+            conn.executemany(
+                f"INSERT INTO coupon_terms (bond_id, {', '.join(COUPON_TERM_COLUMNS)}) VALUES (?,?,?,?,?,?)",
+                zip([bond_id] * len(terms), pd.to_datetime(terms['effective_date']).dt.strftime('%Y-%m-%d'),
+                    terms['coupon_rate'].where(~floating).astype(object).where(~floating, None),
+                    terms['benchmark_tenor'].where(floating).astype(object).where(floating, None),
+                    terms['spread'].fillna(0).where(floating, 0.0).astype(float),
+                    terms['reset_months'].where(floating).astype(object).where(floating, None)),
+            )
+            rebuild_security_schedule(conn, [bond_id])
+            conn.commit()
+        return True
+    except sqlite3.Error as e:
+        st.error(f"Saving coupon terms failed: {e}")
+        logger.error(f"Saving coupon terms failed: {e}")
+        return False
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# COUPON CALENDAR
+# ═══════════════════════════════════════════════════════════════════════
+# security_schedule is built by nivesa.schedule inside the same transaction
+# as any write to a security or its ledger; these are the app's writes to
+# contractual amortization and on-demand rebuilds.
+
+AMORTIZATION_IMPORT_COLUMNS = ['isin', 'payment_date', 'principal']
+
+
+def validate_amortization_rows(rows, maturity, face_value):
+    """Error message for a (payment_date, principal) frame, or None.
+    Installments must be positive, unique per date, fall on or before
+    maturity and not exceed the face value per unit in total."""
+    if rows['payment_date'].isna().any():
+        return "Every installment needs a payment date."
+    if not (rows['principal'] > 0).all():
+        return "Installment amounts must be positive."
+    if rows['payment_date'].duplicated().any():
+        return "Payment dates must be unique."
+    if (rows['payment_date'] > pd.Timestamp(maturity)).any():
+        return "Installments cannot fall after maturity."
+    # face_value is the current outstanding face, so only installments still
+    # ahead have to fit within it.
+    ahead = rows.loc[rows['payment_date'] > pd.Timestamp(date.today()), 'principal'].sum()
+    if ahead > face_value + 1e-6:
+        return f"Future installments ({fmt_inr(ahead)}) exceed the outstanding face per unit ({fmt_inr(face_value)})."
+    return None
+
+
+def replace_amortization_schedules(schedules, bond_ids=None):
+    """Replace the stored schedules of `bond_ids` (default: every bond in
+    `schedules`) with the rows of `schedules` (bond_id, payment_date,
+    principal) and rebuild their calendars, atomically. A bond listed in
+    `bond_ids` with no rows goes back to the inferred cadence."""
+    bond_ids = list(bond_ids) if bond_ids is not None else schedules['bond_id'].unique().tolist()
     try:
-        mat_date = pd.to_datetime(maturity_str).date()
-        anchor = as_of if as_of is not None else date.today()
-        if mat_date <= anchor or cost_pu <= 0: return 0.0
-
-        schedule = generate_cashflow_schedule(fv_pu, coupon_rate, frequency, maturity_str, as_of=anchor)
-        if not schedule: return 0.0
-
-        freq = FREQ_MAP.get(frequency, 1)
-        cfs = []
-        for cf in schedule:
-            t = day_count_fraction(anchor, cf['date'], day_count)
-            if t > 0:
-                cfs.append((t, cf['total']))
-
-        if not cfs: return 0.0
-
-        y = 0.08
-        for _ in range(100):
-            npv = -cost_pu
-            d_npv = 0.0
-            for t, cf in cfs:
-                factor = 1 + y / freq
-                if factor <= 0.0001:
-                    y = -freq + 0.0001 * freq
-                    factor = 1 + y / freq
-                term = factor ** (-freq * t)
-                npv += cf * term
-                d_npv += -t * cf * (factor ** (-freq * t - 1))
-
-            if abs(d_npv) < 1e-12:
-                break
+        with closing(_connect()) as conn, conn:
+            conn.executemany("DELETE FROM amortization_schedule WHERE bond_id=?", [(b,) for b in bond_ids])
+            conn.executemany(
+                "INSERT INTO amortization_schedule (bond_id, payment_date, principal) VALUES (?,?,?)",
+                zip(schedules['bond_id'], pd.to_datetime(schedules['payment_date']).dt.strftime('%Y-%m-%d'),
+                    schedules['principal'].astype(float)),
+            )
+            rebuild_security_schedule(conn, bond_ids)
+            conn.commit()
+        return True
+    except sqlite3.Error as e:
+        st.error(f"Saving amortization schedule failed: {e}")
+        logger.error(f"Saving amortization schedule failed: {e}")
+        return False
 
-            dy = npv / d_npv
-            y_new = y - dy
-            if abs(dy) < 1e-8:
-                y = y_new
-                break
-            y = y_new
-
-        if np.isnan(y) or np.isinf(y) or y < -1.0 or y > 5.0:
-            return 0.0
-        return y
-    except (ValueError, TypeError, FloatingPointError):
-        return 0.0
-
-
-def _xirr(cashflows):
-    """Money-weighted IRR of dated (date, amount) cashflows. Newton on
-    Actual/365 time from the earliest date; returns 0.0 if degenerate."""
-    if len(cashflows) < 2:
-        return 0.0
-    cfs = sorted(cashflows)
-    d0 = cfs[0][0]
-    ts = [(((d - d0).days) / 365.0, a) for d, a in cfs]
-    # need at least one sign change to have a root
-    signs = {1 if a > 0 else (-1 if a < 0 else 0) for _, a in ts}
-    if not (1 in signs and -1 in signs):
-        return 0.0
-    y = 0.10
-    for _ in range(200):
-        f = df = 0.0
-        for t, a in ts:
-            base = 1 + y
-            if base <= 1e-6:
-                y = -1 + 1e-6
-                base = 1 + y
-            f  += a / base ** t
-            df += -t * a / base ** (t + 1)
-        if abs(df) < 1e-12:
-            break
-        step = f / df
-        y -= step
-        if abs(step) < 1e-9:
-            break
-    if np.isnan(y) or np.isinf(y) or y < -0.999 or y > 5.0:
-        return 0.0
-    return y
-
-
-def calc_position_yield_to_cost(txns, coupon_rate, frequency, maturity_str,
-                                face_value_pu, day_count="Actual/365"):
-    """True money-weighted yield-to-cost for a whole position, robust to
-    principal amortization and multiple purchases.
-
-    Cashflows: Buys are outflows; Sells, Interest_Receipts and
-    Principal_Repayments are inflows (at their actual dates). Coupons are
-    projected on the OUTSTANDING balance, which steps down at each recorded
-    principal repayment — so an amortizing bond earns coupon on the declining
-    balance, not on a phantom bullet. The remaining outstanding principal is
-    redeemed at maturity.
-
-    `face_value_pu` is the CURRENT outstanding face per unit. The prior engine
-    computed remaining face as `units*face_value - principal_repaid`, which
-    DOUBLE-COUNTED amortization when face_value already reflected the
-    outstanding (post-repayment) balance — driving YTC negative. Reconstructing
-    the original face as `outstanding + total_repaid` and treating repayments
-    as the inflows they are removes that error. For a plain bullet bond (no
-    repayments) this reduces exactly to the purchase-anchored bullet YTC."""
+
+def refresh_security_schedule(bond_ids=None):
+    """Rebuild calendars in their own transaction; returns rows written, or
+    None on failure."""
     try:
-        freq = FREQ_MAP.get(frequency, 1)
-        months = 12 // freq
-        mat = pd.to_datetime(maturity_str).date()
-        # A matured bond has no future cashflows; an XIRR over purely historical
-        # flows converges to a meaningless number. Report N/A instead.
-        if mat <= date.today():
-            return 0.0
-
-        trade = txns[txns['transaction_type'].isin(['Buy', 'Sell'])]
-        cur_u = trade['units'].sum()
-        if cur_u <= 0:
-            return 0.0
-        total_repaid = txns[txns['transaction_type'] == 'Principal_Repayment']['amount'].sum()
-        outstanding = cur_u * face_value_pu
-        original_face = outstanding + total_repaid
-        if outstanding <= 0:
-            return 0.0
-
-        reps = sorted(
-            (pd.to_datetime(r['trade_date']).date(), r['amount'])
-            for _, r in txns[txns['transaction_type'] == 'Principal_Repayment'].iterrows()
+        with closing(_connect()) as conn, conn:
+            rows = rebuild_security_schedule(conn, bond_ids)
+            conn.commit()
+        return rows
+    except sqlite3.Error as e:
+        st.error(f"Schedule rebuild failed: {e}")
+        logger.error(f"Schedule rebuild failed: {e}")
+        return None
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# COUPON RECONCILIATION
+# ═══════════════════════════════════════════════════════════════════════
+# Expected coupons come from the calendar: one per coupon date per account
+# holding units on the record date, for units x face per unit at the time x
+# period rate. Recorded Interest_Receipts are matched to them per (bond,
+# account) with as-of joins: each due coupon takes the first unclaimed
+# receipt from RECON_EARLY_DAYS before to RECON_LATE_DAYS after its date.
+# Results persist in coupon_reconciliation; a position is recomputed only
+# when its inputs (fingerprint) change or one of its coupons falls due.
+
+COUPON_RECORD_DAYS = 15      # record date precedes the payment date
+RECON_EARLY_DAYS = 7         # receipts booked up to this early still match
+RECON_LATE_DAYS = 45         # ... and up to this late (flagged Late)
+RECON_GRACE_DAYS = 3         # on time within this; unmatched younger dues are Pending
+RECON_AMOUNT_TOLERANCE = 0.01
+
+RECON_STATUSES = ['Missing', 'Short', 'Late', 'Unexpected', 'Pending', 'Matched']
+RECON_COLUMNS = [
+    'bond_id', 'account', 'due_date', 'units', 'expected', 'transaction_id',
+    'received_date', 'received', 'days_late', 'status',
+]
+
+
+def _hash_rows(frame, keys):
+    """Order-independent 64-bit hash of `frame` rows per `keys` group."""
+    h = pd.util.hash_pandas_object(frame.drop(columns=keys), index=False)
+    return h.groupby([frame[k] for k in keys]).sum()
+
+
+def _position_fingerprints(txns, secs, meta, amort, resets):
+    """{(bond_id, account): hex fingerprint} over everything a position's
+    reconciliation reads: its own transactions, the security's terms, issue
+    date, business-day convention, amortization schedule and coupon resets,
+    and every account's repayments of it (which set the face per unit on
+    past coupon dates)."""
+    own = _hash_rows(txns[['bond_id', 'account', 'transaction_id', 'trade_date',
+                           'transaction_type', 'units', 'price', 'amount']], ['bond_id', 'account'])
+    bond_parts = [
+        _hash_rows(secs[['bond_id', 'maturity_date', 'frequency', 'coupon_rate', 'face_value']], ['bond_id']),
+        _hash_rows(meta[['bond_id', 'issue_date', 'business_day']].astype(str), ['bond_id']),
+        _hash_rows(amort.astype({'payment_date': str}), ['bond_id']),
+        _hash_rows(resets[['bond_id', 'reset_date', 'coupon_rate']], ['bond_id']),
+        _hash_rows(txns.loc[txns['transaction_type'] == 'Principal_Repayment',
+                            ['bond_id', 'account', 'trade_date', 'units', 'price', 'amount']], ['bond_id']),
+    ]
+    bond = pd.concat(bond_parts).groupby(level=0).sum()
+    combined = own.to_numpy(dtype=np.uint64) + bond.reindex(own.index.get_level_values(0)).fillna(0).to_numpy(dtype=np.uint64)
+    return dict(zip(own.index, (f"{v:016x}" for v in combined)))
+
+
+def _units_on(events, trades, date_col):
+    """Units each (bond_id, account) held on events[date_col] (as-of join
+    against cumulative Buy/Sell units)."""
+    held = trades.sort_values('trade_date')
+    held = pd.DataFrame({
+        'bond_id': held['bond_id'], 'account': held['account'], 'held_at': held['trade_date'],
+        'held': held.groupby(['bond_id', 'account'])['units'].cumsum(),
+    })
+    out = pd.merge_asof(
+        events.sort_values(date_col), held,
+        left_on=date_col, right_on='held_at', by=['bond_id', 'account'], direction='backward',
+    )
+    return out.drop(columns='held_at').assign(held=lambda d: d['held'].fillna(0.0))
+
+
+def _repayments_per_unit(txns, trades):
+    """Principal repaid per unit of face, one row per (bond_id, trade_date):
+    the recorded price, or the amount over the units then held in that
+    account for rows without one; the median where accounts disagree."""
+    reps = txns[txns['transaction_type'] == 'Principal_Repayment']
+    if reps.empty:
+        return pd.DataFrame(columns=['bond_id', 'trade_date', 'per_unit'])
+    reps = _units_on(reps, trades, 'trade_date')
+    per_unit = np.where(reps['price'] > 0, reps['price'],
+                        reps['amount'] / reps['held'].where(reps['held'] > 0))
+    return (reps.assign(per_unit=per_unit).dropna(subset=['per_unit'])
+            .groupby(['bond_id', 'trade_date'])['per_unit'].median().reset_index())
+
+
+def expected_coupons(pairs, schedule, secs, txns, as_of):
+    """Expected coupon receipts for the (bond_id, account) `pairs` due on or
+    before `as_of`."""
+    ev = schedule[schedule['payment_date'] <= as_of].merge(pairs, on='bond_id')
+    if ev.empty:
+        return pd.DataFrame(columns=['bond_id', 'account', 'due_date', 'units', 'expected'])
+    ev = ev.rename(columns={'payment_date': 'due_date'})
+    ev['record_date'] = ev['due_date'] - pd.Timedelta(days=COUPON_RECORD_DAYS)
+    trades = txns[txns['transaction_type'].isin(['Buy', 'Sell'])]
+    ev = _units_on(ev, trades, 'record_date').rename(columns={'held': 'units'})
+    ev = ev[ev['units'] > 1e-9]
+
+    # Face per unit on the due date: today's face plus every per-unit
+    # repayment made on or after it (the coupon is paid on the balance
+    # before that date's principal).
+    reps = _repayments_per_unit(txns, trades)
+    if not reps.empty and not ev.empty:
+        reps = reps.sort_values('trade_date', ascending=False)
+        reps['repaid_after'] = reps.groupby('bond_id')['per_unit'].cumsum()
+        ev = pd.merge_asof(
+            ev.sort_values('due_date'), reps.sort_values('trade_date')[['bond_id', 'trade_date', 'repaid_after']],
+            left_on='due_date', right_on='trade_date', by='bond_id', direction='forward',
+        ).drop(columns='trade_date')
+    else:
+        ev['repaid_after'] = 0.0
+    terms = secs.set_index('bond_id')
+    face = terms['face_value'].reindex(ev['bond_id']).to_numpy(dtype=float) + ev['repaid_after'].fillna(0.0).to_numpy()
+    freq = terms['frequency'].map(FREQ_MAP).reindex(ev['bond_id']).fillna(1).to_numpy(dtype=float)
+    ev['expected'] = ev['units'].to_numpy() * face * ev['coupon_rate'].to_numpy(dtype=float) / freq
+    return ev[['bond_id', 'account', 'due_date', 'units', 'expected']].reset_index(drop=True)
+
+
+def match_receipts(expected, receipts, as_of):
+    """Pair expected coupons with receipts and classify each row.
+
+    Each pass as-of joins every unmatched receipt to the latest unmatched
+    due of its position up to RECON_LATE_DAYS before it and the earliest up
+    to RECON_EARLY_DAYS after it, and takes the closer. Where several
+    receipts reach for one due the closest wins; the others try again on
+    the next pass. Receipts and dues pair at most once."""
+    keys = ['bond_id', 'account']
+    exp = expected.assign(due_date=pd.to_datetime(expected['due_date']))
+    rec = receipts.rename(columns={'trade_date': 'received_date', 'amount': 'received'})
+    rec = rec.assign(received_date=pd.to_datetime(rec['received_date']))
+    pairs, dues = [], exp[keys + ['due_date']]
+    while not rec.empty and not dues.empty:
+        left, right = rec.sort_values('received_date'), dues.sort_values('due_date')
+        cands = [
+            pd.merge_asof(left, right, left_on='received_date', right_on='due_date', by=keys,
+                          direction=direction, tolerance=pd.Timedelta(days=days))
+            for direction, days in (('backward', RECON_LATE_DAYS), ('forward', RECON_EARLY_DAYS))
+        ]
+        joined = pd.concat(cands, ignore_index=True).dropna(subset=['due_date'])
+        joined['gap'] = (joined['received_date'] - joined['due_date']).dt.days.abs()
+        won = (joined.sort_values('gap', kind='stable')
+               .drop_duplicates('transaction_id')
+               .drop_duplicates(keys + ['due_date']))
+        if won.empty:
+            break
+        pairs.append(won.drop(columns='gap'))
+        rec = rec[~rec['transaction_id'].isin(won['transaction_id'])]
+        taken = won.set_index(keys + ['due_date']).index
+        dues = dues[~dues.set_index(keys + ['due_date']).index.isin(taken)]
+
+    paired = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(
+        columns=keys + ['due_date', 'transaction_id', 'received_date', 'received'])
+    out = pd.concat([exp.merge(paired, on=keys + ['due_date'], how='left'), rec], ignore_index=True)
+    out = out.reindex(columns=RECON_COLUMNS)
+    for col in ('due_date', 'received_date'):
+        out[col] = pd.to_datetime(out[col])
+    days_late = (out['received_date'] - out['due_date']).dt.days
+    short = out['received'] < out['expected'] * (1 - RECON_AMOUNT_TOLERANCE)
+    young = (pd.Timestamp(as_of) - out['due_date']).dt.days <= RECON_GRACE_DAYS
+    out['days_late'] = days_late.clip(lower=0)
+    out['status'] = np.select(
+        [out['due_date'].isna(), out['received_date'].isna() & young, out['received_date'].isna(),
+         short, days_late > RECON_GRACE_DAYS],
+        ['Unexpected', 'Pending', 'Missing', 'Short', 'Late'], 'Matched',
+    )
+    return out[RECON_COLUMNS]
+
+
+def reconcile_coupons(as_of=None):
+    """Bring coupon_reconciliation up to date as of `as_of` (default today),
+    recomputing only positions whose fingerprint changed or that had a
+    coupon fall due since their last run. Returns (results, recomputed)."""
+    as_of = pd.Timestamp(as_of or date.today())
+    with closing(_connect()) as conn, conn:
+        read = lambda q, params=(): pd.read_sql_query(q, conn, params=params)
+        txns = read("SELECT transaction_id, bond_id, account, trade_date, transaction_type, units, price, amount FROM transactions")
+        secs = read("SELECT bond_id, maturity_date, frequency, coupon_rate, face_value FROM securities")
+        meta = read("SELECT bond_id, issue_date, business_day FROM security_metadata")
+        amort = read("SELECT bond_id, payment_date, principal FROM amortization_schedule")
+        resets = read("SELECT bond_id, reset_date, coupon_rate FROM coupon_resets")
+        state = read("SELECT bond_id, account, fingerprint, as_of FROM reconciliation_state")
+        schedule = read(
+            "SELECT bond_id, payment_date, coupon_rate FROM security_schedule "
+            "WHERE event_type='Coupon' AND payment_date <= ?", (as_of.date().isoformat(),),
+        )
+        txns['trade_date'] = pd.to_datetime(txns['trade_date'])
+        schedule['payment_date'] = pd.to_datetime(schedule['payment_date'])
+
+        prints = _position_fingerprints(txns, secs, meta, amort, resets) if not txns.empty else {}
+        pairs = pd.DataFrame(list(prints), columns=['bond_id', 'account'])
+        pairs['fingerprint'] = list(prints.values())
+        prev = pairs.merge(state, on=['bond_id', 'account'], how='left', suffixes=('', '_prev'))
+        last = pd.to_datetime(prev['as_of']) - pd.Timedelta(days=RECON_GRACE_DAYS)
+        # Coupons falling due (or leaving the grace window) since the last run
+        # change a position's result even when its inputs did not.
+        due = schedule.groupby('bond_id')['payment_date'].max().reindex(prev['bond_id']).to_numpy()
+        dirty = prev['fingerprint_prev'].isna() | (prev['fingerprint'] != prev['fingerprint_prev']) | (
+            pd.Series(due, index=prev.index) > last)
+        todo = prev.loc[dirty, ['bond_id', 'account']]
+        gone = state.merge(pairs, on=['bond_id', 'account'], how='left', indicator=True)
+        gone = gone.loc[gone['_merge'] == 'left_only', ['bond_id', 'account']]
+
+        if not todo.empty:
+            scope = txns.merge(todo, on=['bond_id', 'account'])
+            receipts = scope.loc[scope['transaction_type'] == 'Interest_Receipt',
+                                 ['bond_id', 'account', 'transaction_id', 'trade_date', 'amount']]
+            # Repayments by every account set the face per unit.
+            reps = txns[(txns['transaction_type'] == 'Principal_Repayment') & txns['bond_id'].isin(todo['bond_id'])]
+            inputs = pd.concat([scope, reps]).drop_duplicates('transaction_id')
+            exp = expected_coupons(todo, schedule, secs, inputs, as_of)
+            result = match_receipts(exp, receipts, as_of)
+        else:
+            result = pd.DataFrame(columns=RECON_COLUMNS)
+
+        stale = pd.concat([todo, gone])
+        conn.executemany("DELETE FROM coupon_reconciliation WHERE bond_id=? AND account=?",
+                         stale.itertuples(index=False, name=None))
+        conn.executemany("DELETE FROM reconciliation_state WHERE bond_id=? AND account=?",
+                         gone.itertuples(index=False, name=None))
+        out = result.astype(object).where(result.notna(), None)
+        for col in ('due_date', 'received_date'):
+            out[col] = [d.strftime('%Y-%m-%d') if d is not None else None for d in out[col]]
+        conn.executemany(
+            f"INSERT INTO coupon_reconciliation ({', '.join(RECON_COLUMNS)}) VALUES ({','.join('?' * len(RECON_COLUMNS))})",
+            out.itertuples(index=False, name=None),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO reconciliation_state (bond_id, account, fingerprint, as_of) VALUES (?,?,?,?)",
+            [(b, a, prints[(b, a)], as_of.date().isoformat()) for b, a in todo.itertuples(index=False, name=None)],
         )
+        conn.commit()
+        results = read(f"SELECT {', '.join(RECON_COLUMNS)} FROM coupon_reconciliation")
+    for col in ('due_date', 'received_date'):
+        results[col] = pd.to_datetime(results[col])
+    return results, len(todo)
 
-        cfs = []
-        for _, r in txns.iterrows():
-            d = pd.to_datetime(r['trade_date']).date()
-            tt = r['transaction_type']
-            if tt == 'Buy':
-                cfs.append((d, -r['amount']))
-            elif tt == 'Sell':
-                cfs.append((d, r['amount']))
-            elif tt in ('Interest_Receipt', 'Principal_Repayment'):
-                cfs.append((d, r['amount']))
-
-        # Anchor coupon projection at the units-weighted average buy date, not
-        # the first buy: when capital is deployed in staggered lots (e.g. a
-        # small lot, then a larger lot months later), projecting coupons on the
-        # full reconstructed balance from the earliest date would credit coupons
-        # on capital not yet invested and overstate the yield. (Single-lot
-        # positions collapse to the buy date, matching the bullet-bond YTC.)
-        buys_df = txns[txns['transaction_type'] == 'Buy']
-        bu = buys_df['units'].abs()
-        word = (bu * buys_df['trade_date'].apply(lambda x: pd.to_datetime(x).toordinal())).sum()
-        anchor = date.fromordinal(int(round(word / bu.sum()))) if bu.sum() > 0 else pd.to_datetime(buys_df['trade_date'].min()).date()
-        cds, dd = [], mat
-        while dd > anchor:
-            cds.append(dd)
-            dd -= relativedelta(months=months)
-        for d in sorted(cds):
-            bal = original_face - sum(a for rd, a in reps if rd <= d)
-            if bal > 0:
-                cfs.append((d, bal * coupon_rate / freq))
-        cfs.append((mat, outstanding))  # redeem remaining principal at maturity
-
-        return _xirr(cfs)
-    except (ValueError, TypeError, ZeroDivisionError, FloatingPointError):
-        return 0.0
-
-
-def generate_amortizing_schedule(outstanding, coupon_rate, frequency, maturity_str,
-                                 installment, period_months, as_of=None):
-    """Project an amortizing bond's remaining cashflows: coupons on the
-    DECLINING balance plus principal installments on the inferred cadence,
-    with any residual redeemed at maturity. `installment`/`period_months` are
-    estimated from recorded repayment history; this is a projection, not a
-    contractual schedule. Falls back to a bullet if no cadence is known."""
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def coupon_reconciliation(revision, as_of):
+    """reconcile_coupons, run at most once per ledger revision and day."""
     try:
-        mat = pd.to_datetime(maturity_str).date()
-        anchor = as_of if as_of is not None else date.today()
-        freq = FREQ_MAP.get(frequency, 1)
-        cmonths = 12 // freq
-
-        # Future principal installment dates (inferred cadence), until balance
-        # is exhausted or maturity is reached.
-        prin_by_date = {}
-        if installment and installment > 0 and period_months and period_months > 0:
-            bal = outstanding
-            d = anchor + relativedelta(months=period_months)
-            guard = 0
-            while d < mat and bal > 1e-6 and guard < 600:
-                pay = min(installment, bal)
-                prin_by_date[d] = prin_by_date.get(d, 0.0) + pay
-                bal -= pay
-                d += relativedelta(months=period_months)
-                guard += 1
-            residual = max(0.0, bal)
-        else:
-            residual = outstanding
-        prin_by_date[mat] = prin_by_date.get(mat, 0.0) + residual
-
-        # Coupon dates from maturity back to anchor.
-        cds, d = [], mat
-        while d > anchor:
-            cds.append(d)
-            d -= relativedelta(months=cmonths)
-        cds = sorted(cds)
-
-        # Merge coupon and principal dates; coupon accrues on the balance
-        # outstanding just before each date.
-        all_dates = sorted(set(cds) | set(prin_by_date.keys()))
-        cfs = []
-        bal = outstanding
-        prev = anchor
-        for d in all_dates:
-            coupon = 0.0
-            if d in cds:
-                coupon = bal * coupon_rate / freq
-            prin = prin_by_date.get(d, 0.0)
-            cfs.append({'date': d, 'coupon': coupon, 'principal': prin,
-                        'total': coupon + prin,
-                        'type': 'Maturity + Coupon' if d == mat else ('Amortization' if prin > 0 else 'Coupon')})
-            bal = max(0.0, bal - prin)
-            prev = d
-        return cfs
-    except (ValueError, TypeError):
-        return []
+        return reconcile_coupons(as_of)[0]
+    except sqlite3.Error as e:
+        logger.error(f"Coupon reconciliation failed: {e}")
+        st.error(f"Coupon reconciliation failed: {e}")
+        return pd.DataFrame(columns=RECON_COLUMNS)
 
 
-def calc_days_to_maturity(s):
+# ═══════════════════════════════════════════════════════════════════════
+# TAX LOTS
+# ═══════════════════════════════════════════════════════════════════════
+# Lots are replayed by nivesa.lots with every ledger write; the app reads
+# the stored tax_lots and lot_disposals rows.
+
+def refresh_tax_lots(bond_ids=None):
+    """Replay lots in their own transaction; returns lots written, or None
+    on failure."""
     try:
-        return max(0, (pd.to_datetime(s) - pd.to_datetime(date.today())).days)
-    except (ValueError, TypeError):
-        return 0
+        with closing(_connect()) as conn, conn:
+            rows = rebuild_tax_lots(conn, bond_ids)
+            conn.commit()
+        return rows
+    except sqlite3.Error as e:
+        st.error(f"Tax lot rebuild failed: {e}")
+        logger.error(f"Tax lot rebuild failed: {e}")
+        return None
+
 
+def open_lots(bond_id, account):
+    """Open lots of one position in acquisition order."""
+    return db_query(
+        "SELECT lot_id, acquired, open_units, open_cost FROM tax_lots "
+        "WHERE bond_id=? AND account=? AND open_units > 0 ORDER BY acquired, lot_id",
+        (bond_id, account),
+    )
 
-def generate_cashflow_schedule(fv_pu, coupon_rate, frequency, maturity_str, units=1, as_of=None):
-    """Coupon schedule anchored to maturity, stepping back one period at a
-    time, emitting every cashflow strictly after `as_of` (default: today).
-    Passing the purchase date reconstructs the full original stream (used to
-    compute the yield actually locked in at cost)."""
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def realized_gains(revision):
+    """Stored disposals with issuer/ISIN, per ledger revision."""
+    out = db_query(
+        f"SELECT {', '.join('d.' + c for c in DISPOSAL_COLUMNS)}, s.issuer, s.isin FROM lot_disposals d "
+        "JOIN securities s ON d.bond_id = s.bond_id ORDER BY d.disposed, d.sell_id, d.acquired"
+    )
+    for col in ('acquired', 'disposed'):
+        out[col] = pd.to_datetime(out[col])
+    return out
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def lot_book(revision):
+    """Open lots with issuer/ISIN and the date each turns long-term."""
+    out = db_query(
+        "SELECT l.lot_id, l.bond_id, l.account, l.acquired, l.open_units, l.open_cost, "
+        "s.issuer, s.isin, m.listing FROM tax_lots l JOIN securities s ON l.bond_id = s.bond_id "
+        "LEFT JOIN security_metadata m ON l.bond_id = m.bond_id WHERE l.open_units > 0 ORDER BY l.acquired"
+    )
+    out['acquired'] = pd.to_datetime(out['acquired'])
+    months = np.where(out['listing'].isna() | (out['listing'] == 'Unlisted'),
+                      LOT_LONG_TERM_MONTHS['Unlisted'], LOT_LONG_TERM_MONTHS['Listed'])
+    out['long_term_from'] = pd.to_datetime(
+        [a + pd.DateOffset(months=int(m), days=1) for a, m in zip(out['acquired'], months)])
+    return out
+
+
+def gains_by_year(disposals):
+    """Short- and long-term realized gains per financial year and account,
+    plus an 'All' row per year."""
+    piv = disposals.pivot_table(index=['fy', 'account'], columns='term', values='gain',
+                                aggfunc='sum', fill_value=0.0)
+    piv = piv.reindex(columns=['Short', 'Long'], fill_value=0.0)
+    proceeds = disposals.groupby(['fy', 'account'])[['proceeds', 'cost']].sum()
+    out = piv.join(proceeds).reset_index()
+    total = out.groupby('fy', as_index=False)[['Short', 'Long', 'proceeds', 'cost']].sum().assign(account='All')
+    out = pd.concat([out, total], ignore_index=True)
+    out['total'] = out['Short'] + out['Long']
+    return out.sort_values(['fy', 'account'], ascending=[False, True], ignore_index=True)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# ACCRUALS
+# ═══════════════════════════════════════════════════════════════════════
+# Accrued interest at the close of any set of days for every (bond,
+# account) the ledger has traded, as positions x days arrays: units held
+# from the cumulative trades, face per unit from today's face plus the
+# per-unit repayments made after the day, and the coupon period holding
+# the day from security_schedule, measured under the bond's day count.
+# Each lookup is one searchsorted over (code, date) keys, so a year of
+# days costs about as much as a single date. Month-end figures can be
+# saved to accrual_snapshots as the numbers booked for the close.
+
+ACCRUAL_COLUMNS = ['month_end', 'bond_id', 'account', 'units', 'face', 'coupon_rate', 'accrued']
+
+
+def accrual_matrix(days, txns, secs, meta, schedule):
+    """(pairs, units, face, rate, accrued) for `days` (sorted datetime64[D]):
+    every (bond_id, account) with Buy/Sell rows in `txns`, and positions x
+    days arrays of units held, face per unit, coupon rate and accrued
+    interest at each day's close. On a coupon date the new period has just
+    started, so nothing is accrued."""
+    days = np.asarray(days, dtype='datetime64[D]')
+    trades = txns[txns['transaction_type'].isin(['Buy', 'Sell'])].copy()
+    trades['trade_date'] = pd.to_datetime(trades['trade_date'])
+    trades = trades.sort_values(['bond_id', 'account', 'trade_date'], kind='stable')
+    grp = trades.groupby(['bond_id', 'account'], sort=True)
+    pairs = grp.size().reset_index()[['bond_id', 'account']]
+    shape = (len(pairs), len(days))
+    if not len(pairs):
+        return pairs, np.zeros(shape), np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    code = {b: i for i, b in enumerate(secs['bond_id'])}
+    bcode = pairs['bond_id'].map(code).to_numpy()
+    row = np.arange(len(pairs))[:, None]
+
+    # Units: cumulative trades as of each day.
+    tpair = grp.ngroup().to_numpy()
+    tdate = trades['trade_date'].to_numpy().astype('datetime64[D]')
+    held = grp['units'].cumsum().to_numpy(dtype=float)
+    i = asof_index(date_keys(tpair, tdate), date_keys(row, days[None, :]))
+    units = np.where((i >= 0) & (tpair[np.maximum(i, 0)] == row), held[np.maximum(i, 0)], 0.0)
+
+    # Face per unit: today's face plus repayments made after the day.
+    face = np.repeat(secs['face_value'].to_numpy(dtype=float)[bcode][:, None], len(days), axis=1)
+    reps = _repayments_per_unit(txns.assign(trade_date=pd.to_datetime(txns['trade_date'])), trades)
+    if not reps.empty:
+        reps = reps.assign(code=reps['bond_id'].map(code)).sort_values(['code', 'trade_date'])
+        rcode = reps['code'].to_numpy()
+        rkeys = date_keys(rcode, reps['trade_date'].to_numpy().astype('datetime64[D]'))
+        through = reps.groupby('code')['per_unit'].cumsum().to_numpy(dtype=float)
+        total = reps.groupby('code')['per_unit'].sum().reindex(bcode).fillna(0.0).to_numpy()
+        j = asof_index(rkeys, date_keys(bcode[:, None], days[None, :]))
+        paid = np.where((j >= 0) & (rcode[np.maximum(j, 0)] == bcode[:, None]), through[np.maximum(j, 0)], 0.0)
+        face += total[:, None] - paid
+
+    # Coupon period: the first whose end is after the day, if it has begun.
+    per = schedule.assign(code=schedule['bond_id'].map(code)).dropna(subset=['code', 'period_start'])
+    per = per.sort_values(['code', 'period_end'])
+    pcode = per['code'].to_numpy(dtype=np.int64)
+    pstart = pd.to_datetime(per['period_start']).to_numpy().astype('datetime64[D]')
+    pend = pd.to_datetime(per['period_end']).to_numpy().astype('datetime64[D]')
+    k = np.searchsorted(date_keys(pcode, pend), date_keys(bcode[:, None], days[None, :]), side='right')
+    kk = np.minimum(k, max(len(per) - 1, 0))
+    live = (k < len(per)) & (units > 0)
+    if len(per):
+        live &= (pcode[kk] == bcode[:, None]) & (pstart[kk] <= days[None, :])
+    rate = np.where(live, per['coupon_rate'].to_numpy(dtype=float)[kk] if len(per) else 0.0, 0.0)
+
+    accrued = np.zeros(shape)
+    r, c = np.nonzero(live)
+    if len(r):
+        conv = meta.set_index('bond_id')['day_count'].reindex(pairs['bond_id']).fillna('Actual/365').to_numpy(dtype=object)
+        frac = year_fractions(pstart[kk[r, c]], days[c][:, None], conv[r])[:, 0]
+        accrued[r, c] = units[r, c] * face[r, c] * rate[r, c] * frac
+    return pairs, units, face, rate, accrued
+
+
+def _accrual_inputs():
+    """Ledger, terms, day counts and coupon periods for accrual_matrix."""
+    return (
+        db_query("SELECT bond_id, account, trade_date, transaction_type, units, price, amount FROM transactions"),
+        db_query("SELECT bond_id, face_value FROM securities"),
+        db_query("SELECT bond_id, day_count FROM security_metadata"),
+        db_query("SELECT bond_id, period_start, period_end, coupon_rate FROM security_schedule WHERE event_type='Coupon'"),
+    )
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def daily_accruals(revision, start, end):
+    """Accrued interest per day from `start` to `end` (ISO dates) with one
+    column per account plus 'Portfolio'."""
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    pairs, _, _, _, accrued = accrual_matrix(days, *_accrual_inputs())
+    out = pd.DataFrame(accrued, columns=pd.DatetimeIndex(days, name='date')).groupby(
+        pairs['account'].to_numpy()).sum().T
+    out['Portfolio'] = out.sum(axis=1)
+    return out
+
+
+def month_ends(start, end):
+    """Last day of every month from `start`'s to `end`'s (datetime64[D])."""
+    months = np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1)
+    return (months + 1).astype('datetime64[D]') - 1
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def month_end_accruals(revision, start, end):
+    """ACCRUAL_COLUMNS rows for each month end from `start` to `end`,
+    positions with units held only."""
+    ends = month_ends(start, end)
+    pairs, units, face, rate, accrued = accrual_matrix(ends, *_accrual_inputs())
+    r, c = np.nonzero(units > 1e-9)
+    return pd.DataFrame({
+        'month_end': pd.DatetimeIndex(ends[c]), 'bond_id': pairs['bond_id'].to_numpy()[r],
+        'account': pairs['account'].to_numpy()[r], 'units': units[r, c], 'face': face[r, c],
+        'coupon_rate': rate[r, c], 'accrued': accrued[r, c],
+    }).sort_values(['month_end', 'account', 'bond_id'], ignore_index=True)[ACCRUAL_COLUMNS]
+
+
+def get_accrual_snapshots(start, end):
+    """Saved month-end rows between `start` and `end` (ISO dates)."""
+    out = db_query(
+        f"SELECT {', '.join(ACCRUAL_COLUMNS)}, revision, saved_at FROM accrual_snapshots "
+        "WHERE month_end BETWEEN ? AND ? ORDER BY month_end, account, bond_id", (start, end),
+    )
+    out['month_end'] = pd.to_datetime(out['month_end'])
+    return out
+
+
+def save_accrual_snapshots(rows, revision):
+    """Replace the saved snapshots for every month end in `rows` with them,
+    in one transaction. Returns rows written, or None on failure."""
+    ends = sorted({d.strftime('%Y-%m-%d') for d in rows['month_end']})
+    out = rows.assign(month_end=rows['month_end'].dt.strftime('%Y-%m-%d'),
+                      revision=int(revision), saved_at=datetime.now().isoformat(timespec='seconds'))
+    cols = ACCRUAL_COLUMNS + ['revision', 'saved_at']
     try:
-        mat = pd.to_datetime(maturity_str).date()
-        anchor = as_of if as_of is not None else date.today()
-        freq = FREQ_MAP.get(frequency, 1)
-        months = 12 // freq
-        cpn = fv_pu * coupon_rate / freq * units
-        dates = []
-        d = mat
-        while d > anchor:
-            dates.append(d)
-            d -= relativedelta(months=months)
-        dates.sort()
-        cfs = []
-        for d in dates:
-            prin = fv_pu * units if d == mat else 0
-            cfs.append({'date': d, 'coupon': cpn, 'principal': prin, 'total': cpn + prin,
-                        'type': 'Maturity + Coupon' if d == mat else 'Coupon'})
-        return cfs
-    except (ValueError, TypeError):
-        return []
+        with closing(_connect()) as conn, conn:
+            conn.executemany("DELETE FROM accrual_snapshots WHERE month_end=?", [(d,) for d in ends])
+            conn.executemany(
+                f"INSERT INTO accrual_snapshots ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+                out[cols].itertuples(index=False, name=None),
+            )
+            conn.commit()
+        return len(out)
+    except sqlite3.Error as e:
+        st.error(f"Saving accrual snapshots failed: {e}")
+        logger.error(f"Saving accrual snapshots failed: {e}")
+        return None
 
 
 # ═══════════════════════════════════════════════════════════════════════
-# POSITIONS ENGINE
+# EXPORTS
 # ═══════════════════════════════════════════════════════════════════════
+# Exports are built only when a download is actually requested (deferred
+# download_button callables) and are streamed straight from a SQL cursor in
+# fixed-size batches: openpyxl's write-only mode and csv.writer never hold
+# more than one batch of rows, whatever the ledger size. Parquet exports go
+# through nivesa.columnar, which streams typed row groups the same way.
+# Results are cached by ledger revision, so repeated downloads of unchanged
+# data are free.
+
+EXPORT_BATCH_ROWS = 2000
+
+LEDGER_EXCEL_HEADERS = [
+    "Date", "Security", "ISIN", "Account", "Type",
+    "Units", "Price / Unit", "Total Amount", "Notes",
+]
+LEDGER_CSV_HEADERS = [
+    "trade_date", "issuer", "isin", "account", "transaction_type",
+    "units", "price", "amount", "notes",
+]
 
-def get_positions_dataframe():
-    secs = db_query("SELECT * FROM securities")
-    if secs.empty: return pd.DataFrame(), {}
-    secs['maturity_date'] = pd.to_datetime(secs['maturity_date'])
-
-    txns = db_query("SELECT * FROM transactions")
-    if txns.empty: return pd.DataFrame(), {}
-    txns['trade_date'] = pd.to_datetime(txns['trade_date'])
-
-    meta = db_query("SELECT * FROM security_metadata")
-    positions = []
-
-    for (bid, acct), grp in txns.groupby(['bond_id', 'account']):
-        si = secs[secs['bond_id'] == bid]
-        if si.empty: continue
-        si = si.iloc[0]
-        mi = meta[meta['bond_id'] == bid].iloc[0] if not meta.empty and bid in meta['bond_id'].values else None
-
-        # Chronological running average-cost engine.
-        # Realized P&L on a Sell must use the average cost of units held AT
-        # THE TIME OF SALE — a lifetime buy-VWAP would let buys made AFTER a
-        # sell retroactively change that sale's P&L (look-ahead). Same-day
-        # ties process Buys before Sells, matching validate_ledger_chronology.
-        trades = grp[grp['transaction_type'].isin(['Buy', 'Sell'])].copy()
-        trades['_ord'] = (trades['transaction_type'] == 'Sell').astype(int)
-        trades = trades.sort_values(['trade_date', '_ord'])
-
-        units_held = cost_held = r_pnl = 0.0
-        for _, tr in trades.iterrows():
-            if tr['transaction_type'] == 'Buy':
-                units_held += abs(tr['units'])
-                cost_held  += tr['amount']
-            else:  # Sell (stored with negative units)
-                su = abs(tr['units'])
-                avg = cost_held / units_held if units_held > 0 else 0.0
-                r_pnl      += tr['amount'] - su * avg
-                cost_held  -= su * avg
-                units_held -= su
-
-        cur_u = units_held
-        if cur_u <= 0: continue
-
-        avg_px   = cost_held / units_held if units_held > 0 else 0.0
-        int_recv = grp[grp['transaction_type'] == 'Interest_Receipt']['amount'].sum()
-        reps_df  = grp[grp['transaction_type'] == 'Principal_Repayment'].sort_values('trade_date')
-        prin_rep = reps_df['amount'].sum()
-        cost     = cost_held - prin_rep
-
-        # Infer the amortization cadence from recorded repayments so the cashflow
-        # projection can step the remaining principal down realistically instead
-        # of dropping it all at maturity as a phantom bullet. Estimate only —
-        # the forward schedule is not stored.
-        amort_installment = float(reps_df['amount'].median()) if len(reps_df) else 0.0
-        if len(reps_df) >= 2:
-            gaps = reps_df['trade_date'].diff().dropna().dt.days
-            amort_months = int(max(1, round(gaps.median() / 30.44)))
-        else:
-            amort_months = 12 // FREQ_MAP.get(si['frequency'], 1)
-
-        # Outstanding face = current units * current (post-amortization) face per
-        # unit. face_value already reflects the outstanding balance, so it must
-        # NOT be reduced by principal_repaid again — doing so double-counted
-        # amortization and drove YTC negative on amortizing bonds.
-        face     = cur_u * si['face_value']
-        cost_pu  = cost / cur_u if cur_u else 0
-        fv_pu    = face / cur_u if cur_u else 0
-        
-        day_count = mi['day_count'] if mi is not None and pd.notna(mi['day_count']) else 'Actual/365'
-
-        # YTC = true money-weighted yield-to-cost over the position's actual
-        # cashflows (repayments counted as inflows, coupons on the declining
-        # balance). Seasoning-invariant; reduces to the bullet YTC when there is
-        # no amortization.
-        ytc = calc_position_yield_to_cost(grp, si['coupon_rate'], si['frequency'], si['maturity_date'], si['face_value'], day_count)
-        # Duration is a TODAY risk metric: discount the REMAINING cashflows at a
-        # today-anchored yield (best current-yield proxy absent a market mark).
-        y_today = calc_yield_to_cost(fv_pu, cost_pu, si['coupon_rate'], si['maturity_date'], si['frequency'], day_count, as_of=date.today())
-        if y_today > 0:
-            mac = calc_macaulay_duration(fv_pu, si['coupon_rate'], si['frequency'], si['maturity_date'], y_today, day_count)
-            mod = calc_modified_duration(mac, y_today, si['frequency'])
-        else:
-            mac = 0.0
-            mod = 0.0
-            
-        dtm = calc_days_to_maturity(si['maturity_date'])
-        ann_cpn = cur_u * fv_pu * si['coupon_rate']
-        
-        # Compute real last coupon date
-        mat_date = pd.to_datetime(si['maturity_date']).date()
-        today = date.today()
-        freq = FREQ_MAP.get(si['frequency'], 1)
-        months = 12 // freq
-        last_coupon = mat_date
-        while last_coupon > today:
-            last_coupon -= relativedelta(months=months)
-        
-        # Cap last coupon at issue_date if available
-        issue_date = pd.to_datetime(mi['issue_date']).date() if mi is not None and pd.notna(mi['issue_date']) else None
-        if issue_date is not None:
-            last_coupon = max(last_coupon, issue_date)
-        
-        # Set accrued interest to 0 if matured
-        if mat_date <= today:
-            acc_int = 0.0
-        else:
-            acc_int = calc_accrued_interest(fv_pu, si['coupon_rate'], si['frequency'], day_count, last_coupon, mat_date) * cur_u
-            
-        first_buy = trades.loc[trades['transaction_type'] == 'Buy', 'trade_date'].min()
-        hold_days = (pd.to_datetime(date.today()) - first_buy).days if pd.notna(first_buy) else 0
-
-        positions.append({
-            'bond_id': bid, 'account': acct,
-            'issuer': si['issuer'], 'isin': si['isin'],
-            'maturity_date': si['maturity_date'],
-            'coupon_rate': si['coupon_rate'], 'frequency': si['frequency'],
-            'current_units': cur_u, 'cost_basis': cost, 'avg_buy_price': avg_px,
-            'realized_pnl': r_pnl, 'interest_received': int_recv,
-            'principal_repaid': prin_rep, 'position_face_value': face,
-            'amort_installment': amort_installment, 'amort_months': amort_months,
-            'annual_coupon_income': ann_cpn, 'nominal_yield': si['coupon_rate'],
-            'yield_to_cost': ytc, 'macaulay_duration': mac,
-            'modified_duration': mod, 'days_to_maturity': dtm,
-            'years_to_maturity': dtm / 365.25, 'accrued_interest': acc_int,
-            'holding_days': hold_days,
-            'bond_type':      mi['bond_type']      if mi is not None else 'NCD',
-            'credit_rating':  mi['credit_rating']  if mi is not None else 'Unrated',
-            'sector':         mi['sector']          if mi is not None else 'Financials',
-        })
-
-    if not positions: return pd.DataFrame(), {}
-    df = pd.DataFrame(positions)
-    
-    # Portfolio averages are weighted by cost basis (invested capital — the
-    # best available PV proxy in a ledger with no market marks). This matches
-    # the cost-weighted NY/YC aggregation used in every dashboard table, so
-    # headline and tables now share one statistical basis. Duration and YTC
-    # are averaged over VALID observations only: a position whose solver
-    # returned 0 renders as "N/A" in the table, so silently including it as
-    # 0% in the weighted average would corrupt the headline number.
-    tf = df['position_face_value'].sum()
-    tc = df['cost_basis'].sum()
-    df['weight'] = df['cost_basis'] / tc if tc > 0 else 0
-
-    def w(col, valid_mask=None):
-        sub = df if valid_mask is None else df[valid_mask]
-        ws = sub['cost_basis'].sum()
-        return (sub[col] * sub['cost_basis']).sum() / ws if ws > 0 else 0.0
-
-    totals = {
-        'Total Cost Basis':       tc,
-        'Total Face Value':       tf,
-        'Total Annual Coupon':    df['annual_coupon_income'].sum(),
-        'Total Accrued Interest': df['accrued_interest'].sum(),
-        'Total Interest Received':df['interest_received'].sum(),
-        'Total Principal Repaid': df['principal_repaid'].sum(),
-        'Total Realized PnL':    df['realized_pnl'].sum(),
-        'Num Positions':          len(df),
-        'Num Issuers':            df['issuer'].nunique(),
-        'Num Accounts':           df['account'].nunique(),
-        'Weighted Nominal Yield': w('nominal_yield'),
-        'Weighted YTC':           w('yield_to_cost', df['yield_to_cost'] > 0),
-        'Weighted Mac Duration':  w('macaulay_duration', df['macaulay_duration'] > 0),
-        'Weighted Mod Duration':  w('modified_duration', df['macaulay_duration'] > 0),
-        'Weighted Avg Maturity':  w('years_to_maturity'),
-    }
-    return df, totals
-
-
-def get_transaction_ledger_dataframe():
-    """Fetch all transactions joined with security master data."""
-    query = """
-    SELECT
-        t.trade_date,
-        s.issuer,
-        s.isin,
-        t.account,
-        t.transaction_type,
-        t.units,
-        t.price,
-        t.amount,
-        t.notes
-    FROM transactions t
-    JOIN securities s ON t.bond_id = s.bond_id
-    ORDER BY t.trade_date DESC
-    """
-    df = db_query(query)
-    if not df.empty:
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-    return df
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PARQUET_MIME = "application/vnd.apache.parquet"
+
+
+def ledger_export_query(account=None, ttype=None, search=None):
+    """Ledger SELECT (newest first) with optional filters; returns
+    (query, params) for db_query or iter_query_batches."""
+    query = (
+        "SELECT t.trade_date, s.issuer, s.isin, t.account, t.transaction_type, "
+        "t.units, t.price, t.amount, t.notes "
+        "FROM transactions t JOIN securities s ON t.bond_id=s.bond_id WHERE 1=1"
+    )
+    params = []
+    if account and account != 'All':
+        query += " AND t.account=?"
+        params.append(account)
+    if ttype and ttype != 'All':
+        query += " AND t.transaction_type=?"
+        params.append(ttype)
+    if search:
+        query += " AND s.issuer LIKE ?"
+        params.append(f"%{search}%")
+    query += " ORDER BY t.trade_date DESC"
+    return query, tuple(params)
+
+
+def iter_query_batches(query, params=(), batch_rows=EXPORT_BATCH_ROWS):
+    """Yield result rows of a SELECT as lists of at most `batch_rows` tuples."""
+    with closing(_connect()) as conn:
+        cur = conn.execute(query, params)
+        while True:
+            batch = cur.fetchmany(batch_rows)
+            if not batch:
+                break
+            yield batch
+
+
+def write_ledger_xlsx(query, params=()):
+    """Stream ledger rows into a write-only openpyxl workbook; returns bytes."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Transaction Ledger")
+    ws.append(LEDGER_EXCEL_HEADERS)
+    for batch in iter_query_batches(query, params):
+        for row in batch:
+            ws.append((date.fromisoformat(row[0][:10]),) + tuple(row[1:]))
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def write_ledger_csv(query, params=()):
+    """Stream ledger rows through csv.writer; dates as '%d %b %Y'."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(LEDGER_CSV_HEADERS)
+    for batch in iter_query_batches(query, params):
+        writer.writerows(
+            (date.fromisoformat(row[0][:10]).strftime('%d %b %Y'),) + tuple(row[1:])
+            for row in batch
+        )
+    return out.getvalue()
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def ledger_xlsx_export(revision, account=None):
+    """Excel ledger for `account` (or all). `revision` is the cache key."""
+    return write_ledger_xlsx(*ledger_export_query(account=account))
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def ledger_csv_export(revision, account=None, ttype=None, search=None):
+    """Filtered ledger CSV. `revision` is the cache key."""
+    return write_ledger_csv(*ledger_export_query(account, ttype, search))
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def ledger_parquet_export(revision, account=None, ttype=None, search=None):
+    """Filtered ledger as typed Parquet, with the ids import_ledger needs to
+    read it back. `revision` is the cache key."""
+    buffer = io.BytesIO()
+    export_ledger(buffer, 'parquet', account, ttype, search)
+    return buffer.getvalue()
+
+
+POSITION_EXPORT_COLUMNS = {
+    'issuer': 'Issuer', 'isin': 'ISIN', 'account': 'Account',
+    'credit_rating': 'Rating', 'current_units': 'Units',
+    'cost_basis': 'Cost Basis', 'position_face_value': 'Face Value',
+    'nominal_yield': 'Nominal Yield (%)', 'yield_to_cost': 'YTC (%)',
+    'yield_to_worst': 'YTW (%)', 'workout_date': 'Workout Date',
+    'macaulay_duration': 'Mac Duration', 'modified_duration': 'Mod Duration',
+    'duration_to_worst': 'Duration to Worst',
+    'price_date': 'Price Date', 'clean_price': 'Clean Price', 'dirty_price': 'Dirty Price',
+    'market_value': 'Market Value', 'unrealized_pnl': 'Unrealized PnL', 'ytm': 'YTM (%)',
+    'maturity_date': 'Maturity Date', 'annual_coupon_income': 'Annual Income',
+    'interest_received': 'Interest Received', 'days_to_maturity': 'Days Left'
+}
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def positions_csv_export(_positions, key, account='All'):
+    """Positions CSV for `account` (or all), sorted by cost. The frame is
+    not hashed: its analytics_key() fully determines it, market marks
+    included."""
+    filtered = _positions if account == 'All' else _positions[_positions['account'] == account]
+    exp = filtered.sort_values('cost_basis', ascending=False)[list(POSITION_EXPORT_COLUMNS)].copy()
+    exp['maturity_date'] = pd.to_datetime(exp['maturity_date']).dt.strftime('%Y-%m-%d')
+    exp['workout_date'] = pd.to_datetime(exp['workout_date']).dt.strftime('%Y-%m-%d')
+    exp['price_date'] = pd.to_datetime(exp['price_date']).dt.strftime('%Y-%m-%d')
+    # Yield columns are stored as decimal fractions; the export labels
+    # them '(%)', so scale to percent to match the label.
+    exp['nominal_yield'] = (exp['nominal_yield'] * 100).round(4)
+    exp['yield_to_cost'] = (exp['yield_to_cost'] * 100).round(4)
+    exp['yield_to_worst'] = (exp['yield_to_worst'] * 100).round(4)
+    exp['ytm'] = (exp['ytm'] * 100).round(4)
+    return exp.rename(columns=POSITION_EXPORT_COLUMNS).to_csv(index=False)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def positions_parquet_export(_positions, key, account='All'):
+    """Every positions column as typed Parquet for `account` (or all),
+    cached per analytics_key()."""
+    buffer = io.BytesIO()
+    export_frame(_positions if account == 'All' else _positions[_positions['account'] == account],
+                 'positions', buffer)
+    return buffer.getvalue()
+
+
+CASHFLOW_EXPORT_COLUMNS = {
+    'date': 'Date', 'issuer': 'Issuer', 'isin': 'ISIN', 'account': 'Account',
+    'type': 'Type', 'coupon': 'Coupon', 'principal': 'Principal', 'total': 'Total',
+}
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cashflows_csv_export(_cashflows, revision, as_of, account='All'):
+    """Projected cashflow schedule as CSV, optionally for one account."""
+    cf = _cashflows if account == 'All' else _cashflows[_cashflows['account'] == account]
+    exp = cf[list(CASHFLOW_EXPORT_COLUMNS)].copy()
+    exp['date'] = exp['date'].dt.strftime('%Y-%m-%d')
+    return exp.rename(columns=CASHFLOW_EXPORT_COLUMNS).to_csv(index=False)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cashflows_parquet_export(_cashflows, revision, as_of, account='All'):
+    """Projected cashflow schedule as typed Parquet, optionally for one
+    account."""
+    buffer = io.BytesIO()
+    export_frame(_cashflows if account == 'All' else _cashflows[_cashflows['account'] == account],
+                 'cashflows', buffer)
+    return buffer.getvalue()
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -874,18 +1660,51 @@ CL = dict(
 # PAGE: DASHBOARD
 # ═══════════════════════════════════════════════════════════════════════
 
-def _maturity_bucket(days):
-    """Classify days-to-maturity into ladder buckets."""
-    if days <= 90:   return "0-3M"
-    if days <= 180:  return "3-6M"
-    if days <= 365:  return "6-12M"
-    if days <= 730:  return "1-2Y"
-    if days <= 1095: return "2-3Y"
-    if days <= 1825: return "3-5Y"
-    return "5Y+"
-
+DASHBOARD_TABS = [
+    "Allocation & Risk", "Positions", "Maturity Ladder",
+    "Cashflow Schedule", "Issuer Detail", "Transaction Ledger",
+    "Coupon Reconciliation", "Rate Scenarios", "Key-Rate Durations",
+    "Value at Risk", "Rate Simulation", "Tax Lots", "Accruals",
+]
 
-MATURITY_BUCKET_ORDER = ["0-3M", "3-6M", "6-12M", "1-2Y", "2-3Y", "3-5Y", "5Y+"]
+# Aggregation cube (nivesa.positions.aggregation_cube): positions summed
+# over every dimension a dashboard table groups by, sliced by cube_slice.
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def position_cube(_positions, revision, as_of):
+    """The aggregation cube once per ledger revision and valuation date,
+    read from the nightly snapshot when it is current."""
+    key = analytics_key()
+    if key[0] == revision and key[2] == as_of:
+        cube = load_snapshot_stage('aggregates', key)
+        if cube is not None:
+            return cube
+    return aggregation_cube(_positions)
+
+
+def cube_accounts(cube):
+    """Account filter options for the dashboard selectboxes."""
+    return ['All'] + sorted(cube['account'].unique().tolist())
+
+
+def cube_slice(cube, by, account='All', positive_cost=False):
+    """Roll the cube up to `by`, optionally for one account.
+
+    Adds the cost weight within the slice (Wt), cost-weighted nominal yield
+    (NY) and yield-to-cost (YC), and the distinct issuer count (Issuers).
+    `positive_cost` drops cells with no positive cost basis first."""
+    sub = cube if account == 'All' else cube[cube['account'] == account]
+    if positive_cost:
+        sub = sub[sub['Cost'] > 0]
+    grouped = sub.groupby(by)
+    agg = grouped[CUBE_MEASURES].sum()
+    agg['Issuers'] = grouped['issuer'].nunique()
+    cost, valid = agg['Cost'].to_numpy(float), agg['ValidC'].to_numpy(float)
+    total = cost.sum()
+    agg['Wt'] = cost / total if total > 0 else 0.0
+    agg['NY'] = np.divide(agg['NY'].to_numpy(float), cost, out=np.zeros_like(cost), where=cost > 0)
+    agg['YC'] = np.divide(agg['YC'].to_numpy(float), valid, out=np.zeros_like(valid), where=valid > 0)
+    return agg.reset_index()
 
 
 def _render_metric(col, style, title, value, sub="", icon=""):
@@ -900,13 +1719,112 @@ def _render_metric(col, style, title, value, sub="", icon=""):
     )
 
 
-def _render_html_table(headers, rows_html):
-    """Wrap header list and row HTML into a styled table using portfolio-table layout."""
-    th = "".join(f"<th>{h}</th>" for h in headers)
-    return (
-        f"<div class='portfolio-table'><table>"
-        f"<thead><tr>{th}</tr></thead>"
-        f"<tbody>{rows_html}</tbody></table></div>"
+TABLE_PAGE_SIZE = 200
+
+# Numeric cell formatters for _render_table: (values, options) -> strings.
+TABLE_NUMERIC_KINDS = {
+    'inr':   lambda v, o: fmt_inr_array(v),
+    'pct':   lambda v, o: fmt_pct_array(v, o.get('decimals', 2)),
+    'int':   lambda v, o: np.char.mod('%d', np.asarray(v, dtype=float).astype(np.int64)).astype(object),
+    'num':   lambda v, o: np.char.mod(f"%.{o.get('decimals', 2)}f", np.asarray(v, dtype=float)).astype(object),
+    'days':  lambda v, o: (np.char.mod('%d', np.asarray(v, dtype=float).astype(np.int64)).astype(object) + 'd'),
+    'years': lambda v, o: (np.char.mod('%.2f', np.asarray(v, dtype=float)).astype(object) + 'y'),
+}
+
+# Client-side column sort, installed once per page via event delegation.
+# Numeric cells sort on their raw data-v value, others on their text.
+_TABLE_SORT_JS = """<script>
+(function () {
+  if (window.__nivesaTableSort) return;
+  window.__nivesaTableSort = true;
+  document.addEventListener('click', function (e) {
+    var th = e.target.closest && e.target.closest('.portfolio-table.sortable thead th');
+    if (!th) return;
+    var tbody = th.closest('table').tBodies[0];
+    var idx = Array.prototype.indexOf.call(th.parentNode.children, th);
+    var asc = th.getAttribute('aria-sort') !== 'ascending';
+    Array.prototype.forEach.call(th.parentNode.children, function (h) { h.removeAttribute('aria-sort'); });
+    th.setAttribute('aria-sort', asc ? 'ascending' : 'descending');
+    var key = function (row) {
+      var cell = row.cells[idx], v = cell.getAttribute('data-v');
+      return v !== null ? parseFloat(v) : cell.textContent.trim().toLowerCase();
+    };
+    Array.prototype.slice.call(tbody.rows)
+      .sort(function (a, b) { var x = key(a), y = key(b); return (x < y ? -1 : x > y ? 1 : 0) * (asc ? 1 : -1); })
+      .forEach(function (row) { tbody.appendChild(row); });
+  });
+})();
+</script>"""
+
+
+def _table_cells(frame, spec):
+    """Format one table column in a single pass; returns (th, td strings)."""
+    header, source, kind = spec[:3]
+    opts = spec[3] if len(spec) > 3 else {}
+    style = f" style='{opts['style']}'" if 'style' in opts else ""
+    values = frame[source]
+    sort_src = opts.get('sort')
+    if isinstance(kind, str) and kind in TABLE_NUMERIC_KINDS:
+        text = TABLE_NUMERIC_KINDS[kind](values, opts)
+        if 'zero' in opts:
+            text = np.where(np.asarray(values, dtype=float) == 0, opts['zero'], text)
+        if opts.get('na'):
+            text = np.where(np.asarray(values, dtype=float) > 0, text, "N/A")
+        sort_src = sort_src or source
+    elif kind == 'text':
+        text = esc_array(values)
+    elif kind == 'html':
+        text = pd.Series(values, dtype=object).fillna('').astype(str).to_numpy(dtype=object)
+    else:  # callable: source Series -> display strings
+        text = np.asarray(kind(values), dtype=object)
+    right = isinstance(kind, str) and kind in TABLE_NUMERIC_KINDS or opts.get('right', False)
+    cls = " class='numeric'" if right else ""
+    if sort_src is not None:
+        raw = frame[sort_src]
+        if pd.api.types.is_datetime64_any_dtype(raw):
+            raw = (raw - pd.Timestamp('1970-01-01')).dt.days
+        keys = np.char.mod('%.10g', pd.to_numeric(raw, errors='coerce').to_numpy(dtype=float)).astype(object)
+        cells = f"<td{cls}{style} data-v='" + keys + "'>" + text + "</td>"
+    else:
+        cells = f"<td{style}>" + text + "</td>"
+    return f"<th{cls}>{header}</th>", cells
+
+
+def _render_table(frame, columns, key=None, page_size=TABLE_PAGE_SIZE, sortable=True):
+    """Render `frame` as a portfolio-table, formatting column-at-a-time.
+
+    `columns` is a list of (header, source, kind[, options]) tuples. `kind`
+    is 'text' (escaped), 'html' (trusted markup), one of TABLE_NUMERIC_KINDS,
+    or a callable mapping the source Series to display strings. Numeric
+    kinds right-align and carry their raw value for the client-side sort.
+    Options: 'style' (inline cell CSS), 'sort' (column holding the sort key
+    for non-numeric kinds), 'right' (right-align a non-numeric kind), 'zero'
+    (display for zeros), 'na' (show non-positive values as N/A), 'decimals'.
+
+    Frames longer than `page_size` are paginated; only the visible page is
+    formatted. Pass a unique `key` for paginated tables."""
+    n = len(frame)
+    if page_size and n > page_size:
+        pages = -(-n // page_size)
+        page = st.selectbox(
+            "Page", range(1, pages + 1), key=f"{key}_page",
+            format_func=lambda p: f"Page {p} of {pages} · rows {(p - 1) * page_size + 1}–{min(p * page_size, n)} of {n}",
+        )
+        frame = frame.iloc[(page - 1) * page_size: page * page_size]
+
+    heads, body = [], None
+    for spec in columns:
+        th, cells = _table_cells(frame, spec)
+        heads.append(th)
+        body = cells if body is None else body + cells
+    rows = "".join("<tr>" + body + "</tr>") if body is not None and len(body) else ""
+    table_cls = "portfolio-table sortable" if sortable else "portfolio-table"
+    st.html(
+        f"<div class='{table_cls}'><table>"
+        f"<thead><tr>{''.join(heads)}</tr></thead>"
+        f"<tbody>{rows}</tbody></table></div>"
+        + (_TABLE_SORT_JS if sortable else ""),
+        unsafe_allow_javascript=sortable,
     )
 
 
@@ -920,491 +1838,980 @@ def page_dashboard():
         )
         return
 
-    # Precompute weighted-yield helper columns (used across tabs)
-    df['ny_c'] = df['nominal_yield'] * df['cost_basis']
-    # YTC weighting excludes N/A (ytc<=0) positions from BOTH the numerator and
-    # the denominator, matching the headline Weighted YTC. Zeroing only one side
-    # would let a negative/NA position corrupt the group average.
-    df['ytc_c'] = (df['yield_to_cost'] * df['cost_basis']).where(df['yield_to_cost'] > 0, 0.0)
-    df['ytc_valid_c'] = df['cost_basis'].where(df['yield_to_cost'] > 0, 0.0)
-
     # ── Metric Cards ──
     st.markdown('<div class="metric-cards-container">', unsafe_allow_html=True)
     c1, c2, c3, c4, c5 = st.columns(5)
+    invested_sub = f"Face Value: {fmt_inr_short(totals['Total Face Value'])}"
+    if totals['Marked Positions']:
+        invested_sub += (f" · Market: {fmt_inr_short(totals['Total Market Value'])}"
+                         f" ({totals['Marked Positions']}/{totals['Num Positions']} marked)")
     _render_metric(c1, "primary", "Total Invested (Cost)",
                    fmt_inr_short(totals['Total Cost Basis']),
-                   f"Face Value: {fmt_inr_short(totals['Total Face Value'])}", icon="briefcase")
+                   invested_sub, icon="briefcase")
     
     ytc_disp = fmt_pct(totals['Weighted YTC']) if totals['Weighted YTC'] > 0 else "N/A"
     _render_metric(c2, "info", "Portfolio Yield (WA)",
                    ytc_disp,
-                   f"Nominal: {fmt_pct(totals['Weighted Nominal Yield'])}", icon="trending")
+                   f"Nominal: {fmt_pct(totals['Weighted Nominal Yield'])} · YTW: {fmt_pct(totals['Weighted YTW'])}", icon="trending")
     _render_metric(c3, "warning", "Annual Coupon Income",
                    fmt_inr_short(totals['Total Annual Coupon']),
                    f"Monthly: ~{fmt_inr_short(totals['Total Annual Coupon'] / 12)}", icon="activity")
-    _render_metric(c4, "", "Weighted Duration",
-                   f"{totals['Weighted Mac Duration']:.2f}y",
-                   f"Modified: {totals['Weighted Mod Duration']:.2f}y", icon="crosshair")
+    _render_metric(c4, "", "Duration to Worst",
+                   f"{totals['Weighted Duration to Worst']:.2f}y",
+                   f"Modified: {totals['Weighted Mod Duration to Worst']:.2f}y · "
+                   f"To maturity: {totals['Weighted Mac Duration']:.2f}y", icon="crosshair")
     _render_metric(c5, "", "Portfolio Composition",
                    str(totals['Num Positions']),
                    f"{totals['Num Issuers']} issuers · {totals['Num Accounts']} accounts", icon="layers")
     st.markdown('</div>', unsafe_allow_html=True)
 
     # ── Tabs ──
-    tab_alloc, tab_pos, tab_mat, tab_cf, tab_issuer, tab_ledger = st.tabs([
-        "Allocation & Risk", "Positions", "Maturity Ladder",
-        "Cashflow Schedule", "Issuer Detail", "Transaction Ledger",
-    ])
+    cube = position_cube(df, get_ledger_revision(), date.today().isoformat())
+    _render_dashboard_tabs(df, cube)
+
+
+@st.fragment
+def _render_dashboard_tabs(df, cube):
+    """Render only the selected dashboard tab.
+
+    Tabs track state (`on_change="rerun"`) so hidden tabs do no work, and the
+    whole tab strip is a fragment: switching tabs reruns this fragment only,
+    reusing the positions frame and aggregation cube computed by
+    page_dashboard. Each tab body is
+    itself a fragment, so a filter widget reruns just its own section."""
+    tabs = st.tabs(DASHBOARD_TABS, key="dash_tab", on_change="rerun")
+    renderers = (
+        lambda: _tab_allocation(cube),
+        lambda: _tab_positions(df),
+        lambda: _tab_maturity(df, cube),
+        lambda: _tab_cashflows(df),
+        lambda: _tab_issuers(cube),
+        lambda: _tab_ledger(df),
+        lambda: _tab_reconciliation(df),
+        lambda: _tab_scenarios(df),
+        lambda: _tab_key_rates(df),
+        lambda: _tab_var(df),
+        lambda: _tab_montecarlo(df),
+        lambda: _tab_tax_lots(df),
+        lambda: _tab_accruals(df),
+    )
+    for tab, render in zip(tabs, renderers):
+        if tab.open:
+            with tab:
+                render()
 
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 1: Allocation & Risk (reimagined)
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_alloc:
-        sb = df[df['cost_basis'] > 0].copy()
 
-        total_cost = totals['Total Cost Basis']
+# ─────────────────────────────────────────────────────────────────────
+# TAB 1: Allocation & Risk (reimagined)
+# ─────────────────────────────────────────────────────────────────────
 
-        if sb.empty:
-            st.info("No positions with positive cost basis to display.")
-        else:
-            # Use positive-cost-basis total for accurate weight calculation
-            total_cost_alloc = sb['cost_basis'].sum()
-
-            # ── Account Capital Allocation Table ──
-            _render_section_header("Capital Allocation", "Portfolio distribution by account", icon="briefcase", accent="")
-            acct_agg = sb.groupby('account').agg(
-                Cost=('cost_basis', 'sum'),
-                Face=('position_face_value', 'sum'),
-                NY=('ny_c', 'sum'),
-                YC=('ytc_c', 'sum'),
-                ValidC=('ytc_valid_c', 'sum'),
-                Pos=('bond_id', 'count'),
-                Issuers=('issuer', 'nunique'),
-                Inc=('annual_coupon_income', 'sum'),
-            ).reset_index()
-            acct_agg['Wt'] = acct_agg['Cost'] / total_cost_alloc if total_cost_alloc > 0 else 0
-            acct_agg['NY'] = acct_agg.apply(lambda r: r['NY'] / r['Cost'] if r['Cost'] > 0 else 0, axis=1)
-            acct_agg['YC'] = acct_agg.apply(lambda r: r['YC'] / r['ValidC'] if r['ValidC'] > 0 else 0, axis=1)
-            acct_agg = acct_agg.sort_values('Cost', ascending=False)
-
-            acct_rows = ""
-            for _, r in acct_agg.iterrows():
-                acct_rows += (
-                    f"<tr><td><b>{r['account']}</b></td>"
-                    f"<td style='text-align:right'>{fmt_inr(r['Cost'])}</td>"
-                    f"<td style='text-align:right'>{fmt_inr(r['Face'])}</td>"
-                    f"<td style='text-align:right'>{fmt_pct(r['Wt'])}</td>"
-                    f"<td style='text-align:right'>{int(r['Pos'])}</td>"
-                    f"<td style='text-align:right'>{int(r['Issuers'])}</td>"
-                    f"<td style='text-align:right'>{fmt_pct(r['NY'])}</td>"
-                    f"<td style='text-align:right'>{fmt_pct(r['YC'])}</td>"
-                    f"<td style='text-align:right'>{fmt_inr(r['Inc'])}</td></tr>"
-                )
-            st.markdown(
-                _render_html_table(
-                    ["Account", "Cost Basis", "Face Value", "Weight", "Positions", "Issuers", "Nominal Yield", "Yield to Cost", "Annual Income"],
-                    acct_rows
-                ),
-                unsafe_allow_html=True
-            )
+def _tab_allocation(cube):
+    acct_agg = cube_slice(cube, 'account', positive_cost=True)
 
-        # ── Concentration Risk Table ──
-        _render_section_header("Concentration Risk", "Issuer-level position weighting", icon="scale", accent="warning")
+    if acct_agg.empty:
+        st.info("No positions with positive cost basis to display.")
+    else:
+        # ── Account Capital Allocation Table ──
+        _render_section_header("Capital Allocation", "Portfolio distribution by account", icon="briefcase", accent="")
+        acct_agg = acct_agg.sort_values('Cost', ascending=False)
+
+        _render_table(acct_agg, [
+            ("Account", "account", "text", {'style': 'font-weight:700'}),
+            ("Cost Basis", "Cost", "inr"),
+            ("Face Value", "Face", "inr"),
+            ("Weight", "Wt", "pct"),
+            ("Positions", "Pos", "int"),
+            ("Issuers", "Issuers", "int"),
+            ("Nominal Yield", "NY", "pct"),
+            ("Yield to Cost", "YC", "pct"),
+            ("Annual Income", "Inc", "inr"),
+        ])
+
+    _section_concentration(cube)
+
+
+@st.fragment
+def _section_concentration(cube):
+    # ── Concentration Risk Table ──
+    _render_section_header("Concentration Risk", "Issuer-level position weighting", icon="scale", accent="warning")
+
+    conc_filter = st.selectbox("Filter by Account", cube_accounts(cube), key="conc_acct")
+    ir = cube_slice(cube, 'issuer', conc_filter).sort_values('Cost', ascending=False)
+
+    _render_table(ir, [
+        ("Issuer", "issuer", "text", {'style': 'font-weight:700'}),
+        ("Cost Basis", "Cost", "inr"),
+        ("Face Value", "Face", "inr"),
+        ("Weight", "Wt", "pct"),
+        ("Nominal Yield", "NY", "pct"),
+        ("Yield to Cost", "YC", "pct"),
+        ("Positions", "Pos", "int"),
+    ], key="conc_table")
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 2: Positions
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_positions(df):
+    acct_filter = st.selectbox(
+        "Filter by Account",
+        ['All'] + sorted(df['account'].unique().tolist()),
+        key="pf",
+    )
+    filtered = df if acct_filter == 'All' else df[df['account'] == acct_filter]
+    filtered = filtered.sort_values('cost_basis', ascending=False)
+
+    dtm = filtered['days_to_maturity']
+    mat_badge = np.select(
+        [dtm <= 90, dtm <= 365],
+        [' <span class="badge badge-below">&lt; 90d</span>', ' <span class="badge badge-bbb">&lt; 1y</span>'],
+        '',
+    ).astype(object)
+    view = filtered.assign(
+        security=security_cell_array(filtered['issuer'], filtered['isin']),
+        rating=rating_badge_array(filtered['credit_rating']),
+        maturity=pd.to_datetime(filtered['maturity_date']).dt.strftime('%d %b %Y').to_numpy(dtype=object) + mat_badge,
+        mkt=filtered['market_value'].fillna(0.0),
+        upnl=filtered['unrealized_pnl'].fillna(0.0),
+    )
+    _render_table(view, [
+        ("Security", "security", "html"),
+        ("Rating", "rating", "html"),
+        ("Acct", "account", "text"),
+        ("Units", "current_units", "int"),
+        ("Cost", "cost_basis", "inr"),
+        ("Face", "position_face_value", "inr"),
+        ("Coupon", "nominal_yield", "pct"),
+        ("YTC", "yield_to_cost", "pct", {'na': True}),
+        ("YTW", "yield_to_worst", "pct", {'na': True}),
+        ("Duration", "duration_to_worst", "years", {'na': True}),
+        ("Mkt Value", "mkt", "inr", {'zero': '-'}),
+        ("Unrl P&L", "upnl", "inr", {'zero': '-'}),
+        ("YTM", "ytm", "pct", {'na': True}),
+        ("Maturity", "maturity", "html", {'sort': 'days_to_maturity', 'right': True}),
+        ("Annual Inc", "annual_coupon_income", "inr"),
+    ], key="pos_table")
+
+    key = analytics_key()
+    e1, e2, _ = st.columns([1, 1, 4])
+    e1.download_button(
+        "EXPORT CSV",
+        lambda: positions_csv_export(df, key, acct_filter),
+        "nivesa_positions.csv", "text/csv",
+    )
+    e2.download_button(
+        "EXPORT PARQUET",
+        lambda: positions_parquet_export(df, key, acct_filter),
+        f"nivesa_positions_{key[2]}.parquet", PARQUET_MIME,
+    )
 
-        conc_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="conc_acct",
-        )
-        conc_df = df if conc_filter == 'All' else df[df['account'] == conc_filter]
-        total_cost_conc = conc_df['cost_basis'].sum()
-
-        ir = conc_df.groupby('issuer').agg(
-            Cost=('cost_basis', 'sum'),
-            Face=('position_face_value', 'sum'),
-            NY=('ny_c', 'sum'),
-            YC=('ytc_c', 'sum'),
-            ValidC=('ytc_valid_c', 'sum'),
-            Pos=('bond_id', 'count'),
-        ).reset_index()
-        ir['Wt'] = ir['Cost'] / total_cost_conc if total_cost_conc > 0 else 0
-        ir['NY'] = ir.apply(lambda r: r['NY'] / r['Cost'] if r['Cost'] > 0 else 0, axis=1)
-        ir['YC'] = ir.apply(lambda r: r['YC'] / r['ValidC'] if r['ValidC'] > 0 else 0, axis=1)
-        ir = ir.sort_values('Cost', ascending=False)
-
-        ir_rows = ""
-        for _, r in ir.iterrows():
-            ir_rows += (
-                f"<tr><td><b>{esc(r['issuer'])}</b></td>"
-                f"<td style='text-align:right'>{fmt_inr(r['Cost'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(r['Face'])}</td>"
-                f"<td style='text-align:right'>{fmt_pct(r['Wt'])}</td>"
-                f"<td style='text-align:right'>{fmt_pct(r['NY'])}</td>"
-                f"<td style='text-align:right'>{fmt_pct(r['YC'])}</td>"
-                f"<td style='text-align:right'>{int(r['Pos'])}</td></tr>"
-            )
-        st.markdown(
-            _render_html_table(
-                ["Issuer", "Cost Basis", "Face Value", "Weight", "Nominal Yield", "Yield to Cost", "Positions"],
-                ir_rows
-            ),
-            unsafe_allow_html=True
-        )
 
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 2: Positions
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_pos:
-        acct_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="pf",
-        )
-        filtered = df if acct_filter == 'All' else df[df['account'] == acct_filter]
-        filtered = filtered.sort_values('cost_basis', ascending=False)
-
-        rows = ""
-        for _, p in filtered.iterrows():
-            if p['days_to_maturity'] <= 90:
-                mat_badge = '<span class="badge badge-below">&lt; 90d</span>'
-            elif p['days_to_maturity'] <= 365:
-                mat_badge = '<span class="badge badge-bbb">&lt; 1y</span>'
-            else:
-                mat_badge = ''
-            mat_str = pd.to_datetime(p['maturity_date']).strftime('%d %b %Y')
-            ytc_str = fmt_pct(p['yield_to_cost']) if p['yield_to_cost'] > 0 else "N/A"
-            mac_str = f"{p['macaulay_duration']:.2f}y" if p['macaulay_duration'] > 0 else "N/A"
-            rows += (
-                f"<tr><td><div style='font-weight:600'>{esc(p['issuer'])}</div>"
-                f"<div style='font-size:0.75rem;color:#888'>{esc(p['isin'])}</div></td>"
-                f"<td>{rating_badge(p['credit_rating'])}</td>"
-                f"<td>{p['account']}</td>"
-                f"<td style='text-align:right'>{int(p['current_units'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(p['cost_basis'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(p['position_face_value'])}</td>"
-                f"<td style='text-align:right'>{fmt_pct(p['nominal_yield'])}</td>"
-                f"<td style='text-align:right'>{ytc_str}</td>"
-                f"<td style='text-align:right'>{mac_str}</td>"
-                f"<td style='text-align:right'>{mat_str} {mat_badge}</td>"
-                f"<td style='text-align:right'>{fmt_inr(p['annual_coupon_income'])}</td></tr>"
-            )
-        st.markdown(
-            _render_html_table(
-                ["Security", "Rating", "Acct", "Units", "Cost", "Face",
-                 "Coupon", "YTC", "Duration", "Maturity", "Annual Inc"],
-                rows,
-            ),
-            unsafe_allow_html=True,
-        )
+# ─────────────────────────────────────────────────────────────────────
+# TAB 3: Maturity Ladder
+# ─────────────────────────────────────────────────────────────────────
 
-        export_cols = [
-            'issuer', 'isin', 'account', 'credit_rating', 'current_units',
-            'cost_basis', 'position_face_value', 'nominal_yield', 'yield_to_cost',
-            'macaulay_duration', 'modified_duration', 'maturity_date',
-            'annual_coupon_income', 'interest_received', 'days_to_maturity',
-        ]
-        col_map = {
-            'issuer': 'Issuer', 'isin': 'ISIN', 'account': 'Account',
-            'credit_rating': 'Rating', 'current_units': 'Units',
-            'cost_basis': 'Cost Basis', 'position_face_value': 'Face Value',
-            'nominal_yield': 'Nominal Yield (%)', 'yield_to_cost': 'YTC (%)',
-            'macaulay_duration': 'Mac Duration', 'modified_duration': 'Mod Duration',
-            'maturity_date': 'Maturity Date', 'annual_coupon_income': 'Annual Income',
-            'interest_received': 'Interest Received', 'days_to_maturity': 'Days Left'
-        }
-        exp = filtered[export_cols].copy()
-        exp['maturity_date'] = pd.to_datetime(exp['maturity_date']).dt.strftime('%Y-%m-%d')
-        # Yield columns are stored as decimal fractions; the export labels
-        # them '(%)', so scale to percent to match the label.
-        exp['nominal_yield'] = (exp['nominal_yield'] * 100).round(4)
-        exp['yield_to_cost'] = (exp['yield_to_cost'] * 100).round(4)
-        exp = exp.rename(columns=col_map)
-        st.download_button("EXPORT CSV", exp.to_csv(index=False), "nivesa_positions.csv", "text/csv")
-
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 3: Maturity Ladder
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_mat:
-
-        mat_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="mat_acct",
-        )
-        mat_df = df.copy() if mat_filter == 'All' else df[df['account'] == mat_filter].copy()
-
-        mat_df['mb'] = mat_df['days_to_maturity'].apply(_maturity_bucket)
-        bucket_agg = (
-            mat_df.groupby('mb')
-            .agg(Cost=('cost_basis', 'sum'), Face=('position_face_value', 'sum'), N=('bond_id', 'count'))
-            .reindex(MATURITY_BUCKET_ORDER)
-            .fillna(0)
+@st.fragment
+def _tab_maturity(df, cube):
+    mat_filter = st.selectbox("Filter by Account", cube_accounts(cube), key="mat_acct")
+    mat_df = df if mat_filter == 'All' else df[df['account'] == mat_filter]
+
+    bucket_agg = (
+        cube_slice(cube, 'mb', mat_filter)
+        .set_index('mb')
+        .reindex(MATURITY_BUCKET_ORDER)
+        .fillna(0)
+    )
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=bucket_agg.index, y=bucket_agg['Face'], name='Face Value',
+        marker_color='#FFC300',
+        text=fmt_inr_short_array(bucket_agg['Face']),
+        textposition='outside', textfont=dict(size=10, color='#EAEAEA'),
+    ))
+    fig.add_trace(go.Bar(
+        x=bucket_agg.index, y=bucket_agg['Cost'], name='Cost Basis',
+        marker_color='#06b6d4',
+        text=fmt_inr_short_array(bucket_agg['Cost']),
+        textposition='outside', textfont=dict(size=10, color='#EAEAEA'),
+    ))
+    fig.update_layout(
+        **CL,
+        title=dict(text="Maturity Profile", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=420, barmode='group',
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)'),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        legend=dict(orientation='h', yanchor='top', y=-0.1, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
+        margin=dict(l=40, r=20, t=65, b=55),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    if not mat_df.empty:
+        # Buckets are monotonic in days-to-maturity, so one sort orders the
+        # ladder bucket by bucket.
+        ladder = mat_df.sort_values('days_to_maturity', kind='stable')
+        ladder = ladder.assign(
+            mb=maturity_bucket(ladder['days_to_maturity']),
+            maturity=pd.to_datetime(ladder['maturity_date']).dt.strftime('%d %b %Y'),
         )
+        _render_table(ladder, [
+            ("Bucket", "mb", "text"),
+            ("Issuer", "issuer", "text", {'style': 'font-weight:600'}),
+            ("Acct", "account", "text"),
+            ("Face Value", "position_face_value", "inr"),
+            ("Coupon", "coupon_rate", "pct"),
+            ("Maturity", "maturity", "text", {'sort': 'days_to_maturity', 'right': True}),
+            ("Days Left", "days_to_maturity", "days"),
+        ], key="mat_table")
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 4: Cashflow Schedule
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_cashflows(df):
+    f1, f2 = st.columns([3, 1])
+    cf_filter = f1.selectbox(
+        "Filter by Account",
+        ['All'] + sorted(df['account'].unique().tolist()),
+        key="cf_acct",
+    )
+    rollup = f2.selectbox("Group by", list(CASHFLOW_ROLLUPS), key="cf_roll")
+    cf_df = df if cf_filter == 'All' else df[df['account'] == cf_filter]
+    has_amort = bool((cf_df['amort_source'] == 'inferred').any())
+
+    # No recorded-receipt dedup is needed here: transaction dates are
+    # capped at today (date_input max_value) while the projection emits
+    # only strictly-future dates, so the two sets can never overlap.
+    revision, as_of = get_ledger_revision(), date.today().isoformat()
+    all_cf = portfolio_cashflows(df, revision, as_of)
+    cdf = all_cf if cf_filter == 'All' else all_cf[all_cf['account'] == cf_filter]
+
+    if cdf.empty:
+        st.info("No future cashflows to project.")
+    else:
+        mcf = cashflow_rollup(cdf, CASHFLOW_ROLLUPS[rollup])
+        mcf['ms'] = mcf['period'].astype(str)
 
         fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=bucket_agg.index, y=bucket_agg['Face'], name='Face Value',
-            marker_color='#FFC300',
-            text=[fmt_inr_short(v) for v in bucket_agg['Face']],
-            textposition='outside', textfont=dict(size=10, color='#EAEAEA'),
-        ))
-        fig.add_trace(go.Bar(
-            x=bucket_agg.index, y=bucket_agg['Cost'], name='Cost Basis',
-            marker_color='#06b6d4',
-            text=[fmt_inr_short(v) for v in bucket_agg['Cost']],
-            textposition='outside', textfont=dict(size=10, color='#EAEAEA'),
-        ))
+        fig.add_trace(go.Bar(x=mcf['ms'], y=mcf['coupon'], name='Coupon', marker_color='#FFC300'))
+        fig.add_trace(go.Bar(x=mcf['ms'], y=mcf['principal'], name='Principal', marker_color='#06b6d4'))
         fig.update_layout(
             **CL,
-            title=dict(text="Maturity Profile", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
-            height=420, barmode='group',
-            xaxis=dict(gridcolor='rgba(255,255,255,0.05)'),
+            title=dict(text=f"Projected {rollup} Cashflows", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+            height=420, barmode='stack',
+            xaxis=dict(gridcolor='rgba(255,255,255,0.05)', tickangle=-45, type='category'),
             yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
-            legend=dict(orientation='h', yanchor='top', y=-0.1, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
-            margin=dict(l=40, r=20, t=65, b=55),
+            legend=dict(orientation='h', yanchor='top', y=-0.18, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
+            margin=dict(l=40, r=20, t=65, b=70),
         )
         st.plotly_chart(fig, use_container_width=True)
 
-        rows = ""
-        for bucket in MATURITY_BUCKET_ORDER:
-            for _, p in mat_df[mat_df['mb'] == bucket].sort_values('days_to_maturity').iterrows():
-                mat_str = pd.to_datetime(p['maturity_date']).strftime('%d %b %Y')
-                rows += (
-                    f"<tr><td>{bucket}</td>"
-                    f"<td style='font-weight:600'>{esc(p['issuer'])}</td>"
-                    f"<td>{p['account']}</td>"
-                    f"<td style='text-align:right'>{fmt_inr(p['position_face_value'])}</td>"
-                    f"<td style='text-align:right'>{fmt_pct(p['coupon_rate'])}</td>"
-                    f"<td style='text-align:right'>{mat_str}</td>"
-                    f"<td style='text-align:right'>{int(p['days_to_maturity'])}d</td></tr>"
-                )
-        if rows:
-            st.markdown(
-                _render_html_table(
-                    ["Bucket", "Issuer", "Acct", "Face Value", "Coupon", "Maturity", "Days Left"],
-                    rows,
-                ),
-                unsafe_allow_html=True,
+        if has_amort:
+            st.caption(
+                "Note: amortizing bonds without a stored amortization schedule have their "
+                "remaining principal projected on the cadence inferred from past repayments, with "
+                "coupons on the declining balance. This is an estimate — enter the contractual "
+                "schedule under Edit Security to replace it."
             )
 
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 4: Cashflow Schedule
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_cf:
-
-        cf_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="cf_acct",
+        total_cpn = cdf['coupon'].sum()
+        total_prin = cdf['principal'].sum()
+        s1, s2, s3 = st.columns(3)
+        _render_metric(s1, "", "Future Coupons", fmt_inr_short(total_cpn))
+        _render_metric(s2, "", "Principal Due", fmt_inr_short(total_prin))
+        _render_metric(s3, "", "Total Future CF", fmt_inr_short(total_cpn + total_prin))
+
+        cutoff = pd.to_datetime(date.today() + timedelta(days=365))
+        n12 = cdf[cdf['date'] <= cutoff]
+        if not n12.empty:
+            _render_section_header("Nearterm Cashflows", "Projected inflows within next 12 months", icon="activity", accent="info")
+            n12 = n12.assign(day=n12['date'].dt.strftime('%d %b %Y'))
+            _render_table(n12, [
+                ("Date", "day", "text", {'sort': 'date'}),
+                ("Issuer", "issuer", "text", {'style': 'font-weight:600'}),
+                ("Acct", "account", "text"),
+                ("Type", "type", "text"),
+                ("Coupon", "coupon", "inr"),
+                ("Principal", "principal", "inr", {'zero': '-'}),
+                ("Total", "total", "inr", {'style': 'font-weight:600'}),
+            ], key="cf_table")
+
+        e1, e2, _ = st.columns([1, 1, 4])
+        e1.download_button(
+            "EXPORT CSV",
+            lambda: cashflows_csv_export(all_cf, revision, as_of, cf_filter),
+            "nivesa_cashflows.csv", "text/csv",
+        )
+        e2.download_button(
+            "EXPORT PARQUET",
+            lambda: cashflows_parquet_export(all_cf, revision, as_of, cf_filter),
+            f"nivesa_cashflows_{as_of}.parquet", PARQUET_MIME,
         )
-        cf_df = df if cf_filter == 'All' else df[df['account'] == cf_filter]
-
-        # No recorded-receipt dedup is needed here: transaction dates are
-        # capped at today (date_input max_value) while the projected schedule
-        # emits only strictly-future dates, so the two sets can never overlap.
-        # A dedup-by-exact-date block previously here was provably dead code.
-        all_cf = []
-        has_amort = False
-        for _, p in cf_df.iterrows():
-            if p.get('amort_installment', 0) > 0 or p.get('principal_repaid', 0) > 0:
-                # Amortizing: project declining balance + inferred installments.
-                has_amort = True
-                schedule = generate_amortizing_schedule(
-                    p['position_face_value'], p['coupon_rate'], p['frequency'],
-                    p['maturity_date'], p.get('amort_installment', 0.0), p.get('amort_months', 0),
-                )
-            else:
-                fvpu = p['position_face_value'] / p['current_units'] if p['current_units'] > 0 else 0
-                schedule = generate_cashflow_schedule(
-                    fvpu, p['coupon_rate'], p['frequency'], p['maturity_date'], p['current_units'],
-                )
-            for cf in schedule:
-                cf['issuer'] = p['issuer']
-                cf['account'] = p['account']
-                all_cf.append(cf)
 
-        if not all_cf:
-            st.info("No future cashflows to project.")
-        else:
-            cdf = pd.DataFrame(all_cf)
-            cdf['date'] = pd.to_datetime(cdf['date'])
-            cdf = cdf.sort_values('date')
-            cdf['mo'] = cdf['date'].dt.to_period('M')
-
-            mcf = cdf.groupby('mo').agg(
-                Coupon=('coupon', 'sum'), Principal=('principal', 'sum'),
-            ).reset_index()
-            mcf['ms'] = mcf['mo'].astype(str)
-
-            fig = go.Figure()
-            fig.add_trace(go.Bar(x=mcf['ms'], y=mcf['Coupon'], name='Coupon', marker_color='#FFC300'))
-            fig.add_trace(go.Bar(x=mcf['ms'], y=mcf['Principal'], name='Principal', marker_color='#06b6d4'))
-            fig.update_layout(
-                **CL,
-                title=dict(text="Projected Monthly Cashflows", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
-                height=420, barmode='stack',
-                xaxis=dict(gridcolor='rgba(255,255,255,0.05)', tickangle=-45),
-                yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
-                legend=dict(orientation='h', yanchor='top', y=-0.18, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
-                margin=dict(l=40, r=20, t=65, b=70),
-            )
-            st.plotly_chart(fig, use_container_width=True)
-
-            if has_amort:
-                st.caption(
-                    "Note: amortizing bonds (those with recorded principal repayments) have their "
-                    "remaining principal projected on the cadence inferred from past repayments, with "
-                    "coupons on the declining balance. This is an estimate — the contractual "
-                    "amortization schedule is not stored."
-                )
 
-            total_cpn = cdf['coupon'].sum()
-            total_prin = cdf['principal'].sum()
-            s1, s2, s3 = st.columns(3)
-            _render_metric(s1, "", "Future Coupons", fmt_inr_short(total_cpn))
-            _render_metric(s2, "", "Principal Due", fmt_inr_short(total_prin))
-            _render_metric(s3, "", "Total Future CF", fmt_inr_short(total_cpn + total_prin))
-
-            cutoff = pd.to_datetime(date.today() + timedelta(days=365))
-            n12 = cdf[cdf['date'] <= cutoff]
-            if not n12.empty:
-                _render_section_header("Nearterm Cashflows", "Projected inflows within next 12 months", icon="activity", accent="info")
-                rows = ""
-                for _, cf in n12.iterrows():
-                    prin_display = fmt_inr(cf['principal']) if cf['principal'] > 0 else '-'
-                    rows += (
-                        f"<tr><td>{cf['date'].strftime('%d %b %Y')}</td>"
-                        f"<td style='font-weight:600'>{esc(cf['issuer'])}</td>"
-                        f"<td>{cf['account']}</td><td>{cf['type']}</td>"
-                        f"<td style='text-align:right'>{fmt_inr(cf['coupon'])}</td>"
-                        f"<td style='text-align:right'>{prin_display}</td>"
-                        f"<td style='text-align:right;font-weight:600'>{fmt_inr(cf['total'])}</td></tr>"
-                    )
-                st.markdown(
-                    _render_html_table(
-                        ["Date", "Issuer", "Acct", "Type", "Coupon", "Principal", "Total"],
-                        rows,
-                    ),
-                    unsafe_allow_html=True,
-                )
+# ─────────────────────────────────────────────────────────────────────
+# TAB 5: Issuer Detail
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_issuers(cube):
+    iss_filter = st.selectbox("Filter by Account", cube_accounts(cube), key="iss_acct")
+    idd = cube_slice(cube, ['issuer', 'isin'], iss_filter).sort_values('Cost', ascending=False)
+
+    _render_table(idd, [
+        ("Issuer", "issuer", "text", {'style': 'font-weight:600'}),
+        ("ISIN", "isin", "text", {'style': 'font-size:0.8rem;color:#888'}),
+        ("Units", "Units", "int"),
+        ("Cost", "Cost", "inr"),
+        ("Face", "Face", "inr"),
+        ("Weight", "Wt", "pct", {'decimals': 1}),
+        ("Nominal", "NY", "pct"),
+        ("YTC", "YC", "pct"),
+        ("Annual Inc", "Inc", "inr"),
+    ], key="iss_table")
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 6: Transaction Ledger
+# ─────────────────────────────────────────────────────────────────────
+
+LEDGER_TYPE_BADGES = {
+    t: f'<span class="badge {cls}">{t}</span>'
+    for t, cls in zip(TRANSACTION_TYPES, ["badge-aaa", "badge-below", "badge-aa", "badge-a"])
+}
+
 
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 5: Issuer Detail
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_issuer:
+LEDGER_TYPE_LABELS = {
+    t: f"<span class='{cls}'>{t.replace('_', ' ')}</span>" if cls else t.replace('_', ' ')
+    for t, cls in zip(TRANSACTION_TYPES, ["positive", "negative", "positive", ""])
+}
+
+
+def _units_display(units):
+    """Whole units as integers, fractional units as stored."""
+    u = units.astype(float)
+    return np.where(u % 1 == 0, u.round().astype(np.int64).astype(str), u.astype(str))
+
+
+@st.fragment
+def _tab_ledger(df):
+    led_filter = st.selectbox(
+        "Filter by Account",
+        ['All'] + sorted(df['account'].unique().tolist()),
+        key="led_acct",
+    )
+
+    filt_ledger = get_transaction_ledger_dataframe(led_filter)
 
-        iss_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="iss_acct",
+    if filt_ledger.empty:
+        st.info("No transactions found.")
+    else:
+        view = filt_ledger.assign(
+            day=filt_ledger['trade_date'].dt.strftime('%d %b %Y'),
+            security=security_cell_array(filt_ledger['issuer'], filt_ledger['isin']),
+            type_badge=filt_ledger['transaction_type'].map(LEDGER_TYPE_BADGES),
         )
-        iss_df = df if iss_filter == 'All' else df[df['account'] == iss_filter]
-
-        idd = iss_df.groupby(['issuer', 'isin']).agg(
-            Cost=('cost_basis', 'sum'),
-            Face=('position_face_value', 'sum'),
-            NY=('ny_c', 'sum'),
-            YC=('ytc_c', 'sum'),
-            ValidC=('ytc_valid_c', 'sum'),
-            Units=('current_units', 'sum'),
-            Inc=('annual_coupon_income', 'sum'),
+        _render_table(view, [
+            ("Date", "day", "text", {'sort': 'trade_date'}),
+            ("Security", "security", "html"),
+            ("Acct", "account", "text"),
+            ("Type", "type_badge", "html"),
+            ("Units", "units", _units_display, {'sort': 'units', 'right': True}),
+            ("Price / Unit", "price", "inr"),
+            ("Total Amount", "amount", "inr", {'style': 'font-weight:600'}),
+            ("Notes", "notes", lambda s: np.where(s.isna() | (s == ''), '-', esc_array(s))),
+        ], key="dash_ledger_table")
+
+        # Excel export is built only when the button is clicked, then cached
+        # per ledger revision.
+        revision = get_ledger_revision()
+        st.download_button(
+            label="DOWNLOAD EXCEL",
+            data=lambda: ledger_xlsx_export(revision, led_filter),
+            file_name=f"nivesa_ledger_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+            mime=XLSX_MIME,
         )
-        total_cost_iss = iss_df['cost_basis'].sum()
-        idd['Wt'] = idd['Cost'] / total_cost_iss if total_cost_iss > 0 else 0
-        idd['NY'] = idd.apply(lambda r: r['NY'] / r['Cost'] if r['Cost'] > 0 else 0, axis=1)
-        idd['YC'] = idd.apply(lambda r: r['YC'] / r['ValidC'] if r['ValidC'] > 0 else 0, axis=1)
-        idd = idd.sort_values('Cost', ascending=False)
-
-        rows = ""
-        for (iss, isin), r in idd.iterrows():
-            rows += (
-                f"<tr><td style='font-weight:600'>{esc(iss)}</td>"
-                f"<td style='font-size:0.8rem;color:#888'>{esc(isin)}</td>"
-                f"<td style='text-align:right'>{int(r['Units'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(r['Cost'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(r['Face'])}</td>"
-                f"<td style='text-align:right'>{r['Wt']:.1%}</td>"
-                f"<td style='text-align:right'>{fmt_pct(r['NY'])}</td>"
-                f"<td style='text-align:right'>{fmt_pct(r['YC'])}</td>"
-                f"<td style='text-align:right'>{fmt_inr(r['Inc'])}</td></tr>"
-            )
-        st.markdown(
-            _render_html_table(
-                ["Issuer", "ISIN", "Units", "Cost", "Face", "Weight", "Nominal", "YTC", "Annual Inc"],
-                rows,
-            ),
-            unsafe_allow_html=True,
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 7: Coupon Reconciliation
+# ─────────────────────────────────────────────────────────────────────
+
+RECON_STATUS_BADGES = {
+    s: f'<span class="badge {cls}">{s}</span>'
+    for s, cls in zip(RECON_STATUSES, ["badge-below", "badge-bbb", "badge-a", "badge-bbb", "badge-aa", "badge-aaa"])
+}
+
+
+@st.fragment
+def _tab_reconciliation(df):
+    recon = coupon_reconciliation(get_ledger_revision(), date.today().isoformat())
+    if recon.empty:
+        st.info("No coupons have fallen due yet.")
+        return
+
+    f1, f2 = st.columns([1, 2])
+    rec_acct = f1.selectbox(
+        "Filter by Account",
+        ['All'] + sorted(recon['account'].unique().tolist()),
+        key="rec_acct",
+    )
+    rec_status = f2.multiselect(
+        "Status", RECON_STATUSES, default=['Missing', 'Short', 'Late', 'Unexpected'], key="rec_status",
+    )
+    scope = recon if rec_acct == 'All' else recon[recon['account'] == rec_acct]
+
+    by_status = scope.groupby('status').agg(
+        n=('status', 'size'), expected=('expected', 'sum'), received=('received', 'sum'),
+    ).reindex(RECON_STATUSES).fillna(0)
+    shortfall = (scope['expected'] - scope['received']).where(scope['status'] == 'Short', 0.0).sum()
+    s1, s2, s3, s4 = st.columns(4)
+    _render_metric(s1, "", "Missing Coupons", str(int(by_status.at['Missing', 'n'])),
+                   fmt_inr_short(by_status.at['Missing', 'expected']), icon="crosshair")
+    _render_metric(s2, "", "Short Receipts", str(int(by_status.at['Short', 'n'])),
+                   f"Shortfall {fmt_inr_short(shortfall)}", icon="scale")
+    _render_metric(s3, "", "Late Receipts", str(int(by_status.at['Late', 'n'])),
+                   f"Beyond {RECON_GRACE_DAYS} days", icon="activity")
+    _render_metric(s4, "", "Unexpected Receipts", str(int(by_status.at['Unexpected', 'n'])),
+                   fmt_inr_short(by_status.at['Unexpected', 'received']), icon="layers")
+
+    rows = scope[scope['status'].isin(rec_status)]
+    if rows.empty:
+        st.info("No coupons with the selected status.")
+        return
+    secs = db_query("SELECT bond_id, issuer, isin FROM securities")
+    rows = rows.merge(secs, on='bond_id', how='left').sort_values(['due_date', 'received_date'])
+    view = rows.assign(
+        security=security_cell_array(rows['issuer'], rows['isin']),
+        due=rows['due_date'].dt.strftime('%d %b %Y').fillna('-'),
+        recv=rows['received_date'].dt.strftime('%d %b %Y').fillna('-'),
+        badge=rows['status'].map(RECON_STATUS_BADGES),
+        **{c: rows[c].fillna(0.0) for c in ('units', 'expected', 'received', 'days_late')},
+    )
+    _render_table(view, [
+        ("Due", "due", "text", {'sort': 'due_date'}),
+        ("Security", "security", "html"),
+        ("Acct", "account", "text"),
+        ("Units", "units", "int", {'zero': '-'}),
+        ("Expected", "expected", "inr", {'zero': '-'}),
+        ("Received On", "recv", "text", {'sort': 'received_date'}),
+        ("Received", "received", "inr", {'zero': '-'}),
+        ("Days Late", "days_late", "days", {'zero': '-'}),
+        ("Status", "badge", "html"),
+    ], key="rec_table")
+
+    st.download_button(
+        "EXPORT CSV",
+        lambda: rows[['due_date', 'issuer', 'isin', 'account', 'units', 'expected',
+                      'received_date', 'received', 'days_late', 'status']].to_csv(index=False),
+        "nivesa_coupon_reconciliation.csv", "text/csv",
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 8: Rate Scenarios
+# ─────────────────────────────────────────────────────────────────────
+
+SCENARIO_GROUPS = {'Position': 'isin', 'Account': 'account', 'Issuer': 'issuer'}
+
+
+def _discounting_note(as_of, market_revision):
+    """Caption text naming the discount basis the rate tabs used."""
+    curve = curve_for(as_of, market_revision)
+    if curve is None:
+        return ("Positions are discounted at the yield that prices their remaining cashflows at market "
+                "value where marked, else at cost (no benchmark curve loaded).")
+    return (f"Positions are discounted at the {DEFAULT_CURVE} zero curve of "
+            f"{pd.Timestamp(curve[0]).strftime('%d %b %Y')} plus their Z-spread.")
+
+
+@st.fragment
+def _tab_scenarios(df):
+    f1, f2 = st.columns([3, 1])
+    picked = f1.multiselect("Scenarios", list(SCENARIO_PRESETS), default=SCENARIO_DEFAULTS, key="sc_presets")
+    by = f2.selectbox("Break down by", list(SCENARIO_GROUPS), key="sc_by")
+    with st.expander("Custom key-rate shock (bp)"):
+        cols = st.columns(len(KEY_RATE_LABELS))
+        custom = tuple(
+            float(c.number_input(label, -1000.0, 1000.0, 0.0, step=5.0, key=f"sc_kr_{label}"))
+            for c, label in zip(cols, KEY_RATE_LABELS)
+        )
+    scenarios = tuple((name, SCENARIO_PRESETS[name]) for name in picked)
+    if any(custom):
+        scenarios += (("Custom", custom),)
+    if not scenarios:
+        st.info("Select at least one scenario.")
+        return
+
+    revision, as_of = get_ledger_revision(), date.today().isoformat()
+    market_revision = get_market_revision()
+    results = rate_scenarios(df, revision, as_of, market_revision, scenarios)
+    if results.empty:
+        st.info("No positions with future cashflows to revalue.")
+        return
+
+    summary = scenario_breakdown(results.assign(book='Portfolio'), 'book')
+    fig = go.Figure(go.Bar(
+        x=summary['scenario'], y=summary['pnl'],
+        marker_color=np.where(summary['pnl'] >= 0, '#2DD4A8', '#E8555A'),
+        text=fmt_inr_short_array(summary['pnl']), textposition='outside',
+        textfont=dict(size=10, color='#EAEAEA'),
+    ))
+    fig.update_layout(
+        **CL,
+        title=dict(text="Portfolio P&L by Scenario", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=380, showlegend=False,
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', type='category'),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        margin=dict(l=40, r=20, t=65, b=40),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    skipped = len(df) - results['bond_id'].str.cat(results['account'], sep='|').nunique()
+    if skipped:
+        st.caption(f"{skipped} position(s) without remaining cashflows or a solvable yield are not revalued.")
+    st.caption(_discounting_note(as_of, market_revision)
+               + " The shock at each cashflow's tenor is interpolated between key tenors.")
+
+    _render_table(summary, [
+        ("Scenario", "scenario", "text", {'style': 'font-weight:600'}),
+        ("Base Value", "base_value", "inr"),
+        ("Shocked Value", "value", "inr"),
+        ("P&L", "pnl", "inr", {'style': 'font-weight:600'}),
+        ("P&L %", "pnl_pct", "pct"),
+    ], key="sc_table")
+
+    _render_section_header(f"P&L by {by}", "Per-scenario revaluation of each group", icon="layers", accent="info")
+    view_sc = st.selectbox("Scenario", [name for name, _ in scenarios], key="sc_pick")
+    detail = scenario_breakdown(results[results['scenario'] == view_sc], SCENARIO_GROUPS[by])
+    detail = detail.sort_values('pnl')
+    label_cols = [("Security", "security", "html"), ("Acct", "account", "text")] if by == 'Position' else \
+        [(by, SCENARIO_GROUPS[by], "text", {'style': 'font-weight:600'})]
+    if by == 'Position':
+        detail = detail.assign(security=security_cell_array(detail['issuer'], detail['isin']))
+    _render_table(detail, label_cols + [
+        ("Base Value", "base_value", "inr"),
+        ("Shocked Value", "value", "inr"),
+        ("P&L", "pnl", "inr", {'style': 'font-weight:600'}),
+        ("P&L %", "pnl_pct", "pct"),
+    ], key="sc_detail")
+
+    st.download_button(
+        "EXPORT CSV",
+        lambda: results.drop(columns='bond_id').round(2).to_csv(index=False),
+        "nivesa_rate_scenarios.csv", "text/csv",
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 9: Key-Rate Durations
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_key_rates(df):
+    revision, as_of = get_ledger_revision(), date.today().isoformat()
+    market_revision = get_market_revision()
+    krd = key_rate_durations(df, revision, as_of, market_revision)
+    if krd.empty:
+        st.info("No positions with future cashflows to measure.")
+        return
+    by_acct = krd_by_account(krd)
+
+    fig = go.Figure()
+    for _, r in by_acct.iterrows():
+        fig.add_trace(go.Bar(x=KEY_RATE_LABELS, y=r[KEY_RATE_LABELS].to_numpy(dtype=float), name=r['account'],
+                             marker_color='#FFC300' if r['account'] == 'Portfolio' else None))
+    fig.update_layout(
+        **CL,
+        title=dict(text="Key-Rate Duration Profile", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=400, barmode='group',
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', type='category'),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title='Years'),
+        legend=dict(orientation='h', yanchor='top', y=-0.12, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
+        margin=dict(l=40, r=20, t=65, b=60),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(
+        f"Duration to each key tenor from a {KRD_BUMP_BP:g}bp triangular bump; the tenors sum to effective "
+        f"duration. KR01 is the value change for a 1bp move across the curve. {_discounting_note(as_of, market_revision)}"
+    )
+
+    tenor_cols = [(label, label, "num", {'zero': '-'}) for label in KEY_RATE_LABELS]
+    _render_table(by_acct, [
+        ("Account", "account", "text", {'style': 'font-weight:600'}),
+        ("Value", "base_value", "inr"),
+        *tenor_cols,
+        ("Total", "total", "num", {'style': 'font-weight:600'}),
+        ("KR01", "kr01", "inr"),
+    ], key="krd_acct", sortable=False)
+
+    _render_section_header("Positions", "Key-rate durations per holding", icon="crosshair", accent="info")
+    acct = st.selectbox("Filter by Account", ['All'] + sorted(krd['account'].unique().tolist()), key="krd_acct_filter")
+    rows = (krd if acct == 'All' else krd[krd['account'] == acct]).sort_values('base_value', ascending=False)
+    _render_table(rows.assign(security=security_cell_array(rows['issuer'], rows['isin'])), [
+        ("Security", "security", "html"),
+        ("Acct", "account", "text"),
+        ("Value", "base_value", "inr"),
+        *tenor_cols,
+        ("Total", "total", "num", {'style': 'font-weight:600'}),
+    ], key="krd_table")
+
+    st.download_button(
+        "EXPORT CSV",
+        lambda: krd.drop(columns='bond_id').round(4).to_csv(index=False),
+        "nivesa_key_rate_durations.csv", "text/csv",
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 10: Value at Risk
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_var(df):
+    revision, as_of = get_ledger_revision(), date.today().isoformat()
+    market_revision = get_market_revision()
+    conf = st.selectbox("Confidence", VAR_CONFIDENCES, index=len(VAR_CONFIDENCES) - 1,
+                        format_func=lambda c: f"{c:.1%}", key="var_conf")
+    runs = {h: historical_pnl(df, revision, as_of, market_revision, n) for h, n in VAR_HORIZONS.items()}
+    pnl1, base = runs['1D']
+    if len(pnl1) < VAR_MIN_HISTORY:
+        st.info(
+            f"Historical VaR needs at least {VAR_MIN_HISTORY} daily changes of the {DEFAULT_CURVE} curve; "
+            f"{len(pnl1)} available. Load curve history under Market Data."
         )
+        return
 
-    # ─────────────────────────────────────────────────────────────────────
-    # TAB 6: Transaction Ledger
-    # ─────────────────────────────────────────────────────────────────────
-    with tab_ledger:
+    summary = {h: var_summary(p, conf).set_index('account') for h, (p, _) in runs.items() if len(p)}
+    book = {h: s.loc['Portfolio'] for h, s in summary.items()}
+    cards = st.columns(4)
+    for col, h in zip(cards[::2], VAR_HORIZONS):
+        if h in book:
+            _render_metric(col, "", f"{h} VaR", fmt_inr_short(book[h]['var']),
+                           f"{book[h]['var'] / base['Portfolio']:.2%} of value", icon="shield")
+    for col, h in zip(cards[1::2], VAR_HORIZONS):
+        if h in book:
+            _render_metric(col, "", f"{h} Expected Shortfall", fmt_inr_short(book[h]['es']),
+                           f"Worst: {fmt_inr_short(book[h]['worst'])}", icon="activity")
+
+    fig = go.Figure(go.Histogram(x=pnl1['Portfolio'], nbinsx=60, marker_color='#06b6d4', name='1D P&L'))
+    fig.add_vline(x=-book['1D']['var'], line_color='#E8555A', line_dash='dash',
+                  annotation_text=f"VaR {conf:.1%}", annotation_font_color='#EAEAEA')
+    fig.update_layout(
+        **CL,
+        title=dict(text="Historical 1-Day P&L", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=360, showlegend=False,
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title='Days'),
+        margin=dict(l=40, r=20, t=65, b=40),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(
+        f"{len(pnl1)} daily curve changes from {pnl1.index.min():%d %b %Y} to {pnl1.index.max():%d %b %Y}, "
+        f"applied to today's book at the key tenors; 10-day changes overlap. {_discounting_note(as_of, market_revision)}"
+    )
 
-        led_filter = st.selectbox(
-            "Filter by Account",
-            ['All'] + sorted(df['account'].unique().tolist()),
-            key="led_acct",
+    table = pd.DataFrame({'account': base.index, 'value': base.to_numpy()})
+    for h, s in summary.items():
+        table[f'var_{h}'] = s['var'].reindex(base.index).to_numpy()
+        table[f'es_{h}'] = s['es'].reindex(base.index).to_numpy()
+    cols = [("Account", "account", "text", {'style': 'font-weight:600'}), ("Value", "value", "inr")]
+    for h in summary:
+        cols += [(f"{h} VaR", f"var_{h}", "inr"), (f"{h} ES", f"es_{h}", "inr")]
+    _render_table(table, cols, key="var_table", sortable=False)
+
+    st.download_button(
+        "EXPORT CSV",
+        lambda: pnl1.round(2).to_csv(),
+        "nivesa_historical_pnl_1d.csv", "text/csv",
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 12: Tax Lots
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_tax_lots(df):
+    revision = get_ledger_revision()
+    disposals, lots = realized_gains(revision), lot_book(revision)
+    today = pd.Timestamp(date.today())
+
+    years = sorted(disposals['fy'].unique(), reverse=True)
+    current = financial_year(today)
+    years = years if current in years else [current] + years
+    f1, f2 = st.columns(2)
+    fy = f1.selectbox("Financial Year", years, key="lots_fy")
+    acct = f2.selectbox("Account", ['All'] + sorted(set(lots['account']) | set(disposals['account'])),
+                        key="lots_acct")
+
+    year = disposals[disposals['fy'] == fy]
+    if acct != 'All':
+        year, lots = year[year['account'] == acct], lots[lots['account'] == acct]
+    short, long_ = year.loc[year['term'] == 'Short', 'gain'].sum(), year.loc[year['term'] == 'Long', 'gain'].sum()
+    c1, c2, c3, c4 = st.columns(4)
+    _render_metric(c1, "primary", "Short-Term Gains", fmt_inr_short(short), fy, icon="trending")
+    _render_metric(c2, "info", "Long-Term Gains", fmt_inr_short(long_), fy, icon="trending")
+    _render_metric(c3, "", "Sale Proceeds", fmt_inr_short(year['proceeds'].sum()),
+                   f"{year['sell_id'].nunique()} sales · {len(year)} lot disposals", icon="activity")
+    _render_metric(c4, "", "Open Lots", str(len(lots)),
+                   f"Cost: {fmt_inr_short(lots['open_cost'].sum())}", icon="layers")
+
+    if not disposals.empty:
+        _render_section_header("Realized Gains by Year", "Short- and long-term by account", icon="bar-chart", accent="info")
+        summary = gains_by_year(disposals)
+        if acct != 'All':
+            summary = summary[summary['account'] == acct]
+        _render_table(summary, [
+            ("Year", "fy", "text", {'style': 'font-weight:600'}),
+            ("Account", "account", "text"),
+            ("Proceeds", "proceeds", "inr"),
+            ("Cost", "cost", "inr"),
+            ("Short-Term", "Short", "inr"),
+            ("Long-Term", "Long", "inr"),
+            ("Total", "total", "inr", {'style': 'font-weight:600'}),
+        ], key="lots_years", sortable=False)
+
+    if not year.empty:
+        _render_section_header(f"Disposals · {fy}", "Lots relieved by each sale", icon="layers", accent="")
+        view = year.assign(
+            security=security_cell_array(year['issuer'], year['isin']),
+            bought=year['acquired'].dt.strftime('%d %b %Y'),
+            sold=year['disposed'].dt.strftime('%d %b %Y'),
+        )
+        _render_table(view, [
+            ("Security", "security", "html"),
+            ("Acct", "account", "text"),
+            ("Acquired", "bought", "text", {'sort': 'acquired'}),
+            ("Sold", "sold", "text", {'sort': 'disposed'}),
+            ("Units", "units", "num", {'decimals': 0}),
+            ("Cost", "cost", "inr"),
+            ("Proceeds", "proceeds", "inr"),
+            ("Gain", "gain", "inr", {'style': 'font-weight:600'}),
+            ("Term", "term", "text"),
+        ], key="lots_disposals")
+        st.download_button(
+            "EXPORT CSV",
+            lambda: year.drop(columns=['bond_id']).round(2).to_csv(index=False),
+            f"nivesa_realized_gains_{fy}.csv", "text/csv",
         )
 
-        ltdf = get_transaction_ledger_dataframe()
-        filt_ledger = ltdf if led_filter == 'All' else ltdf[ltdf['account'] == led_filter]
+    _render_section_header("Open Lots", "Remaining cost basis by acquisition", icon="briefcase", accent="")
+    if lots.empty:
+        st.info("No open lots.")
+        return
+    lots = lots.assign(
+        security=security_cell_array(lots['issuer'], lots['isin']),
+        unit_cost=lots['open_cost'] / lots['open_units'],
+        days=(today - lots['acquired']).dt.days,
+        term=np.where(lots['long_term_from'] <= today, 'Long', 'Short'),
+        bought=lots['acquired'].dt.strftime('%d %b %Y'),
+        lt_from=lots['long_term_from'].dt.strftime('%d %b %Y'),
+    )
+    _render_table(lots, [
+        ("Security", "security", "html"),
+        ("Acct", "account", "text"),
+        ("Acquired", "bought", "text", {'sort': 'acquired'}),
+        ("Units", "open_units", "num", {'decimals': 0}),
+        ("Cost", "open_cost", "inr"),
+        ("Cost / Unit", "unit_cost", "inr"),
+        ("Held", "days", "days"),
+        ("Long-Term From", "lt_from", "text", {'sort': 'long_term_from'}),
+        ("Term Today", "term", "text"),
+    ], key="lots_open")
+    st.caption(
+        f"Sales relieve lots FIFO unless another method or a specific lot was chosen when recording the sale. "
+        f"Lots held over {LOT_LONG_TERM_MONTHS['Listed']} months (listed) or "
+        f"{LOT_LONG_TERM_MONTHS['Unlisted']} months (unlisted) are long-term."
+    )
 
-        if filt_ledger.empty:
-            st.info("No transactions found.")
-        else:
-            # Table visualization
-            rows_ledger = ""
-            for _, t in filt_ledger.iterrows():
-                date_str = t['trade_date'].strftime('%d %b %Y')
-                typ_cls = "badge-aaa" if t['transaction_type'] == 'Buy' else \
-                          "badge-below" if t['transaction_type'] == 'Sell' else \
-                          "badge-aa" if t['transaction_type'] == 'Interest_Receipt' else \
-                          "badge-a"
-                typ_badge = f'<span class="badge {typ_cls}">{t["transaction_type"]}</span>'
-
-                rows_ledger += (
-                    f"<tr><td>{date_str}</td>"
-                    f"<td><div style='font-weight:600'>{esc(t['issuer'])}</div>"
-                    f"<div style='font-size:0.75rem;color:#888'>{esc(t['isin'])}</div></td>"
-                    f"<td>{t['account']}</td>"
-                    f"<td>{typ_badge}</td>"
-                    f"<td style='text-align:right'>{int(t['units']) if t['units'] % 1 == 0 else t['units']}</td>"
-                    f"<td style='text-align:right'>{fmt_inr(t['price'])}</td>"
-                    f"<td style='text-align:right;font-weight:600'>{fmt_inr(t['amount'])}</td>"
-                    f"<td>{esc(t['notes']) or '-'}</td></tr>"
-                )
 
-            st.markdown(
-                _render_html_table(
-                    ["Date", "Security", "Acct", "Type", "Units", "Price / Unit", "Total Amount", "Notes"],
-                    rows_ledger,
-                ),
-                unsafe_allow_html=True,
-            )
+# ─────────────────────────────────────────────────────────────────────
+# TAB 13: Accruals
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_accruals(df):
+    revision, today = get_ledger_revision(), date.today()
+    first = db_query("SELECT MIN(trade_date) AS first FROM transactions")['first'].iloc[0]
+    first = pd.to_datetime(first).date() if pd.notna(first) else today
+    years = [financial_year(date(y, 4, 1)) for y in range(today.year if today.month >= 4 else today.year - 1,
+                                                           (first.year if first.month >= 4 else first.year - 1) - 1, -1)]
+    fy = st.selectbox("Financial Year", years, key="acc_fy")
+    fy_start = date(int(fy[2:6]), 4, 1)
+    fy_end = date(fy_start.year + 1, 3, 31)
+    start, end = fy_start.isoformat(), min(fy_end, today).isoformat()
+
+    daily = daily_accruals(revision, start, end)
+    ends = month_end_accruals(revision, fy_start.isoformat(), fy_end.isoformat())
+    closed = ends[ends['month_end'] <= pd.Timestamp(today)]
+    saved = get_accrual_snapshots(fy_start.isoformat(), fy_end.isoformat())
+
+    c1, c2, c3 = st.columns(3)
+    _render_metric(c1, "primary", "Accrued Interest", fmt_inr_short(daily['Portfolio'].iloc[-1]),
+                   f"As of {pd.Timestamp(end):%d %b %Y}", icon="activity")
+    if not closed.empty:
+        last = closed['month_end'].max()
+        _render_metric(c2, "info", "Last Month-End", fmt_inr_short(closed.loc[closed['month_end'] == last, 'accrued'].sum()),
+                       f"{last:%d %b %Y}", icon="layers")
+    _render_metric(c3, "", "Snapshots Saved", f"{saved['month_end'].nunique()}/{closed['month_end'].nunique()}",
+                   "Closed month-ends this year", icon="database")
+
+    fig = go.Figure()
+    for acct in daily.columns.drop('Portfolio'):
+        fig.add_trace(go.Scatter(x=daily.index, y=daily[acct], mode='lines', stackgroup='acct',
+                                 line=dict(width=0.5), name=acct))
+    fig.update_layout(
+        **CL,
+        title=dict(text=f"Daily Accrued Interest · {fy}", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=360,
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        legend=dict(orientation='h', y=1.02, x=1, xanchor='right', yanchor='bottom'),
+        margin=dict(l=40, r=20, t=65, b=40),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    _render_section_header("Month-End Accruals", "Accrued interest at each month's close", icon="layers", accent="info")
+    table = ends.pivot_table(index='month_end', columns='account', values='accrued', aggfunc='sum', fill_value=0.0)
+    accounts = list(table.columns)
+    table['total'] = table.sum(axis=1)
+    booked = saved.groupby('month_end').agg(saved=('accrued', 'sum'), saved_rev=('revision', 'max'))
+    table = table.join(booked).reset_index()
+    table['status'] = np.select(
+        [table['month_end'] > pd.Timestamp(today), table['saved'].isna(),
+         (table['saved'] - table['total']).abs() > 0.005],
+        ['Open', 'Not saved', 'Changed since saved'], 'Saved',
+    )
+    table['month'] = table['month_end'].dt.strftime('%b %Y')
+    _render_table(table, [("Month End", "month", "text", {'style': 'font-weight:600', 'sort': 'month_end'})]
+                  + [(a, a, "inr") for a in accounts]
+                  + [("Total", "total", "inr", {'style': 'font-weight:600'}),
+                     ("Saved", "saved", "inr", {'zero': '-'}), ("Status", "status", "text")],
+                  key="acc_table", sortable=False)
+
+    b1, b2 = st.columns([1, 3])
+    if b1.button("SAVE MONTH-ENDS", key="acc_save", disabled=closed.empty):
+        written = save_accrual_snapshots(closed, revision)
+        if written is not None:
+            set_notification(f"Saved {closed['month_end'].nunique()} month-end accrual snapshot(s).", "success")
+            st.rerun()
+    b2.download_button(
+        "EXPORT CSV",
+        lambda: ends.assign(month_end=ends['month_end'].dt.date)
+        .merge(db_query("SELECT bond_id, issuer, isin FROM securities"), on='bond_id')
+        .drop(columns='bond_id').round(2).to_csv(index=False),
+        f"nivesa_month_end_accruals_{fy}.csv", "text/csv",
+    )
+    st.caption("Saving replaces the stored figures for every closed month-end of the year with the live ones.")
+
+
+# ─────────────────────────────────────────────────────────────────────
+# TAB 11: Rate Simulation
+# ─────────────────────────────────────────────────────────────────────
+
+@st.fragment
+def _tab_montecarlo(df):
+    revision, as_of = get_ledger_revision(), date.today().isoformat()
+    market_revision = get_market_revision()
+    defaults = mc_defaults(as_of, market_revision)
+    with st.form("mc_form"):
+        c1, c2, c3, c4 = st.columns(4)
+        paths = c1.number_input("Paths", 1000, MC_MAX_PATHS, 5000, step=1000, key="mc_paths")
+        horizon = c2.number_input("Horizon (years)", 1, 30, 5, key="mc_horizon")
+        seed = c3.number_input("Seed", 0, 2 ** 31 - 1, 42, key="mc_seed")
+        a = c4.number_input("Mean Reversion", 0.01, 2.0, defaults['a'], step=0.01, format="%.2f", key="mc_a")
+        d1, d2, d3 = st.columns(3)
+        r0 = d1.number_input("Short Rate (%)", -5.0, 30.0, round(defaults['r0'] * 100, 2), step=0.05, key="mc_r0")
+        b = d2.number_input("Long-Run Rate (%)", -5.0, 30.0, round(defaults['b'] * 100, 2), step=0.05, key="mc_b")
+        sigma = d3.number_input("Volatility (%)", 0.0, 10.0, round(defaults['sigma'] * 100, 2), step=0.05, key="mc_sigma")
+        run = st.form_submit_button("RUN SIMULATION")
+
+    if run:
+        params = {'r0': r0 / 100, 'b': b / 100, 'sigma': sigma / 100, 'a': float(a)}
+        spec, accounts = monte_carlo_spec(df, portfolio_cashflows(df, revision, as_of), as_of, horizon, params)
+        state = st.session_state['mc_run'] = {
+            'done': {}, 'accounts': accounts, 'paths': int(paths), 'seed': int(seed),
+            'horizon': int(horizon), 'batches': len(batch_plan(int(seed), int(paths), MC_BATCH_PATHS)),
+            'as_of': as_of, 'revision': (revision, market_revision),
+        }
+        bar = st.progress(0.0, text="Simulating…")
+        # Clicking STOP reruns this fragment, which interrupts the run at the
+        # next progress update; finished batches are already in session state.
+        st.button("STOP", key="mc_stop")
+
+        def _progress(done, total):
+            state['done'] = done
+            bar.progress(len(done) / total, text=f"Simulating… {len(done)}/{total} batches")
+
+        run_monte_carlo(spec, int(paths), int(seed), on_batch=_progress)
+        bar.empty()
+
+    res = st.session_state.get('mc_run')
+    if not res or not res['done']:
+        st.info("Set the short-rate model and run a simulation. "
+                "Defaults come from the benchmark curve when one is loaded under Market Data.")
+        return
 
-            # Excel Export
-            buffer = io.BytesIO()
-            export_df = filt_ledger.copy()
-            if not export_df.empty:
-                export_df['trade_date'] = pd.to_datetime(export_df['trade_date']).dt.date
-
-            col_map_ledger = {
-                'trade_date': 'Date', 'issuer': 'Security', 'isin': 'ISIN',
-                'account': 'Account', 'transaction_type': 'Type',
-                'units': 'Units', 'price': 'Price / Unit', 'amount': 'Total Amount', 'notes': 'Notes'
-            }
-            export_df = export_df.rename(columns=col_map_ledger)
-
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                export_df.to_excel(writer, index=False, sheet_name='Transaction Ledger')
-
-            st.download_button(
-                label="DOWNLOAD EXCEL",
-                data=buffer.getvalue(),
-                file_name=f"nivesa_ledger_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+    table, fan, n = mc_summary(res['done'], res['accounts'])
+    book = table[table['account'] == 'Portfolio'].set_index('metric')
+    inc, term = book.loc['Income'], book.loc['Terminal Value']
+    c1, c2, c3, c4 = st.columns(4)
+    _render_metric(c1, "primary", "Median Income", fmt_inr_short(inc['p50']),
+                   f"{res['horizon']}y coupons + reinvestment", icon="activity")
+    _render_metric(c2, "", "Income 5–95%", f"{fmt_inr_short(inc['p5'])} – {fmt_inr_short(inc['p95'])}",
+                   f"Mean: {fmt_inr_short(inc['mean'])}", icon="bar-chart")
+    _render_metric(c3, "info", "Median Terminal Value", fmt_inr_short(term['p50']),
+                   "Reinvested cash + remaining holdings", icon="briefcase")
+    _render_metric(c4, "", "Terminal Value 5–95%", f"{fmt_inr_short(term['p5'])} – {fmt_inr_short(term['p95'])}",
+                   f"{n:,} paths · seed {res['seed']}", icon="shield")
+
+    x = [pd.Timestamp(res['as_of']) + pd.DateOffset(months=int(m)) for m in fan.index]
+    fig = go.Figure()
+    for lo, hi, alpha in (('p5', 'p95', 0.15), ('p25', 'p75', 0.3)):
+        fig.add_trace(go.Scatter(x=x, y=fan[hi], mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=x, y=fan[lo], mode='lines', line=dict(width=0), fill='tonexty',
+                                 fillcolor=f'rgba(6,182,212,{alpha})', name=f"{lo[1:]}–{hi[1:]}%"))
+    fig.add_trace(go.Scatter(x=x, y=fan['p50'], mode='lines', line=dict(color='#FFC300', width=2), name='Median'))
+    fig.update_layout(
+        **CL,
+        title=dict(text="Reinvested Cash by Month", font=dict(size=13, color='#888'), x=0, y=0.97, yanchor='top'),
+        height=380,
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title=''),
+        legend=dict(orientation='h', y=1.02, x=1, xanchor='right', yanchor='bottom'),
+        margin=dict(l=40, r=20, t=65, b=40),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    if len(res['done']) < res['batches']:
+        st.warning(f"Stopped after {len(res['done'])} of {res['batches']} batches; "
+                   f"figures use the {n:,} paths simulated.")
+    if res['as_of'] != as_of or res['revision'] != (revision, market_revision):
+        st.caption("Positions or market data have changed since this run; run again to refresh.")
+    st.caption(
+        "Vasicek short-rate paths; coupons and principal are reinvested monthly at the path's short rate "
+        "until the horizon, and cashflows after it are valued off the terminal short rate."
+    )
+
+    _render_table(table, [
+        ("Account", "account", "text", {'style': 'font-weight:600'}),
+        ("Metric", "metric", "text"),
+        ("P5", "p5", "inr"), ("P25", "p25", "inr"),
+        ("Median", "p50", "inr", {'style': 'font-weight:600'}),
+        ("P75", "p75", "inr"), ("P95", "p95", "inr"),
+        ("Mean", "mean", "inr"),
+    ], key="mc_table", sortable=False)
+
+    st.download_button(
+        "EXPORT CSV",
+        lambda: table.round(2).to_csv(index=False),
+        "nivesa_rate_simulation.csv", "text/csv",
+    )
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -1463,6 +2870,16 @@ def _render_section_header(title, subtitle="", icon="chart", accent=""):
     )
 
 
+def _option_dates_error(mat, idate, call, put):
+    """Validation message for call/put dates, or None when they are usable."""
+    for label, d in (("Call", call), ("Put", put)):
+        if d is not None and d >= mat:
+            return f"{label} date must be before the maturity date."
+        if d is not None and idate is not None and d <= idate:
+            return f"{label} date must be after the issue date."
+    return None
+
+
 def page_add_security():
     _render_section_header("Add New Security", "Register a bond in the securities master before transacting", icon="cube", accent="cyan")
 
@@ -1487,6 +2904,14 @@ def page_add_security():
             idate = st.date_input("Issue Date", value=None)
             dc = st.selectbox("Day Count", DAY_COUNT_CONVENTIONS)
 
+        c5, c6, c7 = st.columns(3)
+        with c5:
+            call = st.date_input("Call Date", value=None)
+        with c6:
+            put = st.date_input("Put Date", value=None)
+        with c7:
+            bday = st.selectbox("Business Day", BUSINESS_DAY_CONVENTIONS)
+
         notes = st.text_area("Notes")
         submitted = st.form_submit_button("ADD SECURITY")
 
@@ -1497,6 +2922,8 @@ def page_add_security():
                 st.error("Maturity date must be in the future.")
             elif idate is not None and mat <= idate:
                 st.error("Maturity date must be after the issue date.")
+            elif _option_dates_error(mat, idate, call, put):
+                st.error(_option_dates_error(mat, idate, call, put))
             elif not db_query("SELECT 1 FROM securities WHERE isin=?", (isin,)).empty:
                 st.error(f"ISIN **{isin}** already exists in the securities master.")
             else:
@@ -1508,10 +2935,13 @@ def page_add_security():
                 if ok:
                     db_execute(
                         "INSERT INTO security_metadata "
-                        "(bond_id, bond_type, credit_rating, day_count, issue_date, listing, sector, notes) "
-                        "VALUES (?,?,?,?,?,?,?,?)",
-                        (bid, btype, cr, dc, idate.isoformat() if idate else None, listing, sector, notes),
+                        "(bond_id, bond_type, credit_rating, day_count, issue_date, call_date, put_date, "
+                        "business_day, listing, sector, notes) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                        (bid, btype, cr, dc, idate.isoformat() if idate else None,
+                         call.isoformat() if call else None, put.isoformat() if put else None,
+                         bday, listing, sector, notes),
                     )
+                    refresh_security_schedule([bid])
                     set_notification(f"Security **{issuer}** ({isin}) added!", "success")
                     logger.info(f"Added security: {isin}")
                     st.rerun()
@@ -1611,6 +3041,18 @@ def page_edit_security():
                 index=_safe_index(DAY_COUNT_CONVENTIONS, meta['day_count'] if meta is not None else None),
             )
 
+        meta_date = lambda col: pd.to_datetime(meta[col]).date() if meta is not None and pd.notna(meta[col]) else None
+        c5, c6, c7 = st.columns(3)
+        with c5:
+            call = st.date_input("Call Date", value=meta_date('call_date'))
+        with c6:
+            put = st.date_input("Put Date", value=meta_date('put_date'))
+        with c7:
+            bday = st.selectbox(
+                "Business Day", BUSINESS_DAY_CONVENTIONS,
+                index=_safe_index(BUSINESS_DAY_CONVENTIONS, meta['business_day'] if meta is not None else None),
+            )
+
         notes = st.text_area("Notes", value=meta['notes'] if meta is not None else '')
 
         if txn_count > 0:
@@ -1621,19 +3063,101 @@ def page_edit_security():
                 st.error("Issuer required.")
             elif idate is not None and mat <= idate:
                 st.error("Maturity date must be after the issue date.")
+            elif _option_dates_error(mat, idate, call, put):
+                st.error(_option_dates_error(mat, idate, call, put))
             else:
                 db_execute(
                     "UPDATE securities SET issuer=?, maturity_date=?, frequency=?, coupon_rate=?, face_value=? WHERE bond_id=?",
                     (issuer, mat.isoformat(), freq, cpn / 100, fv, bid),
                 )
                 db_execute(
-                    "UPDATE security_metadata SET bond_type=?, credit_rating=?, day_count=?, issue_date=?, listing=?, sector=?, notes=? WHERE bond_id=?",
-                    (btype, cr, dc, idate.isoformat() if idate else None, listing, sector, notes, bid),
+                    "UPDATE security_metadata SET bond_type=?, credit_rating=?, day_count=?, issue_date=?, "
+                    "call_date=?, put_date=?, business_day=?, listing=?, sector=?, notes=? WHERE bond_id=?",
+                    (btype, cr, dc, idate.isoformat() if idate else None,
+                     call.isoformat() if call else None, put.isoformat() if put else None,
+                     bday, listing, sector, notes, bid),
                 )
+                refresh_security_schedule([bid])
+                refresh_tax_lots([bid])   # listing sets the long-term holding period
                 set_notification(f"**{issuer}** updated!", "success")
                 logger.info(f"Updated security: {bid}")
                 st.rerun()
 
+    _render_amortization_editor(bid, sec)
+    _render_coupon_terms_editor(bid, sec, meta_date('issue_date'))
+
+
+def _render_amortization_editor(bid, sec):
+    """Edit the security's contractual principal installments (per unit)."""
+    _render_section_header(
+        "Amortization Schedule",
+        "Contractual principal installments per unit; leave empty for a bullet or to infer from repayments",
+        icon="activity", accent="info",
+    )
+    stored = get_amortization_schedules(bid)
+    edited = st.data_editor(
+        stored[['payment_date', 'principal']],
+        num_rows="dynamic", hide_index=True, key=f"amort_{bid}",
+        column_config={
+            'payment_date': st.column_config.DateColumn("Payment Date", format="DD MMM YYYY", required=True),
+            'principal': st.column_config.NumberColumn("Principal / Unit", min_value=0.0, format="%.2f", required=True),
+        },
+    )
+    if st.button("SAVE SCHEDULE", key=f"amort_save_{bid}"):
+        rows = edited.dropna(how='all').assign(payment_date=lambda d: pd.to_datetime(d['payment_date']))
+        err = validate_amortization_rows(rows, pd.to_datetime(sec['maturity_date']), float(sec['face_value']))
+        if err:
+            st.error(err)
+        elif replace_amortization_schedules(rows.assign(bond_id=bid), [bid]):
+            set_notification(f"Amortization schedule saved ({len(rows)} installments).", "success")
+            logger.info(f"Saved amortization schedule for {bid}: {len(rows)} rows")
+            st.rerun()
+
+
+def _render_coupon_terms_editor(bid, sec, issue_date):
+    """Edit the security's step-up and floating coupon terms."""
+    _render_section_header(
+        "Coupon Terms",
+        f"Rate changes after the {fmt_pct(sec['coupon_rate'])} initial coupon: a fixed rate, or a "
+        f"{DEFAULT_CURVE} benchmark tenor + spread reset every few months; leave empty for a fixed coupon",
+        icon="layers", accent="info",
+    )
+    stored = get_coupon_terms(bid)
+    edited = st.data_editor(
+        stored.assign(coupon_rate=stored['coupon_rate'] * 100, spread=stored['spread'] * 1e4)[COUPON_TERM_COLUMNS],
+        num_rows="dynamic", hide_index=True, key=f"terms_{bid}",
+        column_config={
+            'effective_date': st.column_config.DateColumn("Effective", format="DD MMM YYYY", required=True),
+            'coupon_rate': st.column_config.NumberColumn("Fixed Rate (%)", min_value=0.0, max_value=100.0, format="%.2f"),
+            'benchmark_tenor': st.column_config.TextColumn("Benchmark Tenor", help="e.g. 3M, 1Y"),
+            'spread': st.column_config.NumberColumn("Spread (bp)", format="%.0f"),
+            'reset_months': st.column_config.NumberColumn("Reset (months)", min_value=1, max_value=120, step=1),
+        },
+    )
+    if st.button("SAVE TERMS", key=f"terms_save_{bid}"):
+        rows = edited.dropna(how='all').assign(
+            effective_date=lambda d: pd.to_datetime(d['effective_date']),
+            coupon_rate=lambda d: pd.to_numeric(d['coupon_rate']) / 100,
+            spread=lambda d: pd.to_numeric(d['spread']).fillna(0) / 1e4,
+            reset_months=lambda d: pd.to_numeric(d['reset_months']),
+        )
+        err = validate_coupon_terms(rows, issue_date, pd.to_datetime(sec['maturity_date']))
+        if err:
+            st.error(err)
+        elif replace_coupon_terms(rows, bid):
+            set_notification(f"Coupon terms saved ({len(rows)} terms).", "success")
+            logger.info(f"Saved coupon terms for {bid}: {len(rows)} rows")
+            st.rerun()
+
+    resets = get_coupon_resets()
+    resets = resets[resets['bond_id'] == bid]
+    if not resets.empty:
+        _render_table(resets.assign(reset=resets['reset_date'].dt.strftime('%d %b %Y')), [
+            ("Reset", "reset", "text", {'sort': 'reset_date'}),
+            ("Rate", "coupon_rate", "pct"),
+            ("Source", "source", "text"),
+        ], key=f"resets_{bid}")
+
 
 # ═══════════════════════════════════════════════════════════════════════
 # PAGE: RECORD TRANSACTION
@@ -1714,6 +3238,15 @@ def page_record_transaction(show_header=True):
             if price_dev > 0.5 and price > 0:
                 st.warning(f"Warning: Price {fmt_inr(price)} deviates by >50% from par value {fmt_inr(si['face_value'])}.")
                 st.checkbox("Confirm this price deviation is correct", key="confirm_price_rec")
+
+            # Lot relief: a method, or a specific open lot (remainder FIFO)
+            relief = {m: (m, None) for m in LOT_METHODS[:2]}
+            if ttype == 'Sell':
+                for lot in open_lots(bid, account).itertuples():
+                    label = (f"Lot {pd.to_datetime(lot.acquired).strftime('%d %b %Y')} · {lot.open_units:,.0f} units"
+                             f" @ {fmt_inr(lot.open_cost / lot.open_units)} · {lot.lot_id[:8]}")
+                    relief[label] = ('Specific ID', lot.lot_id)
+                lot_pick = st.selectbox("Lot Relief", list(relief), key="rec_lot")
         elif ttype == 'Principal_Repayment':
             current_units = units_by_account.get(account, 0.0)
             amount = st.number_input("Total Amount", min_value=0.0, format="%.2f")
@@ -1804,7 +3337,11 @@ def page_record_transaction(show_header=True):
                     if not ok:
                         st.error(f"Transaction rejected. This would cause Account **{offending_acct}** to have negative holdings on {pd.to_datetime(offending_date).strftime('%d %b %Y')}.")
                         st.stop()
-                        
+
+                    rebuild_security_schedule(conn, [bid])
+                    if ttype == 'Sell':
+                        c.execute("INSERT INTO lot_instructions VALUES (?,?,?)", (tid, *relief[lot_pick]))
+                    rebuild_tax_lots(conn, [bid])
                     conn.commit()
 
                 set_notification(f"**{ttype.replace('_', ' ')}** recorded!", "success")
@@ -1990,7 +3527,9 @@ def page_edit_transaction():
                         if not ok:
                             st.error(f"Transaction update rejected. This would cause Account **{offending_acct}** to have negative holdings on {pd.to_datetime(offending_date).strftime('%d %b %Y')}.")
                             st.stop()
-                            
+
+                        rebuild_security_schedule(conn, [bond_id])
+                        rebuild_tax_lots(conn, [bond_id])
                         conn.commit()
                         
                     set_notification("Transaction updated!", "success")
@@ -2010,7 +3549,9 @@ def page_edit_transaction():
                     if not ok:
                         st.error(f"Transaction deletion rejected. This would cause Account **{offending_acct}** to have negative holdings on {pd.to_datetime(offending_date).strftime('%d %b %Y')}.")
                         st.stop()
-                        
+
+                    rebuild_security_schedule(conn, [bond_id])
+                    rebuild_tax_lots(conn, [bond_id])
                     conn.commit()
                     
                 set_notification("Transaction deleted!", "success")
@@ -2028,6 +3569,8 @@ def page_view_transactions():
 
     with st.expander("Record New Transaction", expanded=False):
         page_record_transaction(show_header=False)
+    with st.expander("Import Ledger File", expanded=False):
+        _render_ledger_import()
     
     st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
 
@@ -2039,60 +3582,56 @@ def page_view_transactions():
     with f3:
         filter_search = st.text_input("Search Issuer", key="ls")
 
-    query = (
-        "SELECT t.trade_date, s.issuer, s.isin, t.account, t.transaction_type, "
-        "t.units, t.price, t.amount, t.notes "
-        "FROM transactions t JOIN securities s ON t.bond_id=s.bond_id WHERE 1=1"
-    )
-    params = []
-    if filter_acct != 'All':
-        query += " AND t.account=?"
-        params.append(filter_acct)
-    if filter_type != 'All':
-        query += " AND t.transaction_type=?"
-        params.append(filter_type)
-    if filter_search:
-        query += " AND s.issuer LIKE ?"
-        params.append(f"%{filter_search}%")
-    query += " ORDER BY t.trade_date DESC"
-
-    ledger = db_query(query, tuple(params))
+    ledger = db_query(*ledger_export_query(filter_acct, filter_type, filter_search))
     if ledger.empty:
         st.info("No transactions match.")
         return
 
-    ledger['trade_date'] = pd.to_datetime(ledger['trade_date']).dt.strftime('%d %b %Y')
-
-    rows = ""
-    for _, r in ledger.iterrows():
-        if r['transaction_type'] in ['Buy', 'Interest_Receipt']:
-            color_cls = "positive"
-        elif r['transaction_type'] == 'Sell':
-            color_cls = "negative"
-        else:
-            color_cls = ""
-        units_display = f"{abs(r['units']):,.0f}" if r['units'] != 0 else '-'
-        price_display = fmt_inr(r['price']) if r['price'] != 0 else '-'
-        notes_display = esc(r['notes']) or ''
-        rows += (
-            f"<tr><td>{r['trade_date']}</td>"
-            f"<td style='font-weight:600'>{esc(r['issuer'])}</td>"
-            f"<td style='font-size:0.8rem;color:#888'>{esc(r['isin'])}</td>"
-            f"<td>{r['account']}</td>"
-            f"<td class='{color_cls}'>{r['transaction_type'].replace('_', ' ')}</td>"
-            f"<td style='text-align:right'>{units_display}</td>"
-            f"<td style='text-align:right'>{price_display}</td>"
-            f"<td style='text-align:right;font-weight:600'>{fmt_inr(r['amount'])}</td>"
-            f"<td style='font-size:0.8rem;color:#888'>{notes_display}</td></tr>"
-        )
-    st.markdown(
-        _render_html_table(
-            ["Date", "Issuer", "ISIN", "Acct", "Type", "Units", "Price", "Amount", "Notes"],
-            rows,
-        ),
-        unsafe_allow_html=True,
+    ledger['trade_date'] = pd.to_datetime(ledger['trade_date'])
+    ledger['day'] = ledger['trade_date'].dt.strftime('%d %b %Y')
+    ledger['type_label'] = ledger['transaction_type'].map(LEDGER_TYPE_LABELS)
+
+    _render_table(ledger, [
+        ("Date", "day", "text", {'sort': 'trade_date'}),
+        ("Issuer", "issuer", "text", {'style': 'font-weight:600'}),
+        ("ISIN", "isin", "text", {'style': 'font-size:0.8rem;color:#888'}),
+        ("Acct", "account", "text"),
+        ("Type", "type_label", "html"),
+        ("Units", "units", lambda s: s.abs().map('{:,.0f}'.format).where(s != 0, '-'), {'sort': 'units', 'right': True}),
+        ("Price", "price", "inr", {'zero': '-'}),
+        ("Amount", "amount", "inr", {'style': 'font-weight:600'}),
+        ("Notes", "notes", "text", {'style': 'font-size:0.8rem;color:#888'}),
+    ], key="ledger_table")
+    revision = get_ledger_revision()
+    e1, e2, _ = st.columns([1, 1, 3])
+    e1.download_button(
+        "EXPORT LEDGER CSV",
+        lambda: ledger_csv_export(revision, filter_acct, filter_type, filter_search),
+        "nivesa_ledger.csv", "text/csv",
+    )
+    e2.download_button(
+        "EXPORT LEDGER PARQUET",
+        lambda: ledger_parquet_export(revision, filter_acct, filter_type, filter_search),
+        "nivesa_ledger.parquet", PARQUET_MIME,
     )
-    st.download_button("EXPORT LEDGER CSV", ledger.to_csv(index=False), "nivesa_ledger.csv", "text/csv")
+
+
+def _render_ledger_import():
+    """Add transactions from a Parquet or Arrow ledger file (see
+    nivesa.columnar.import_ledger); all or nothing."""
+    st.caption("Columns as EXPORT LEDGER PARQUET writes them; isin may stand in for bond_id and a missing "
+               "transaction_id is generated. Rows already in the ledger are skipped.")
+    upload = st.file_uploader("Ledger file", type=["parquet", "arrow", "feather"], key="ledger_import")
+    if upload is None or not st.button("IMPORT TRANSACTIONS", key="ledger_import_btn"):
+        return
+    try:
+        inserted, skipped = import_ledger(upload)
+    except NivesaError as e:
+        st.error(str(e).replace("\n", "  \n"))
+        logger.error(f"Ledger import failed: {e}")
+        return
+    set_notification(f"Imported {inserted} transactions ({skipped} already in the ledger).", "success")
+    st.rerun()
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -2130,32 +3669,277 @@ def page_securities_master():
     if sm_search:
         filtered_secs = filtered_secs[filtered_secs['issuer'].str.contains(sm_search, case=False, na=False)]
 
-    rows = ""
-    for _, s in filtered_secs.iterrows():
-        dtm = calc_days_to_maturity(s['maturity_date'])
-        mat_str = pd.to_datetime(s['maturity_date']).strftime('%d %b %Y')
-        rating = s.get('credit_rating', 'Unrated') or 'Unrated'
-        bond_type = s.get('bond_type', 'NCD') or 'NCD'
-        sector = s.get('sector', '') or ''
-        rows += (
-            f"<tr><td style='font-weight:600'>{esc(s['issuer'])}</td>"
-            f"<td style='font-size:0.8rem'>{esc(s['isin'])}</td>"
-            f"<td>{bond_type}</td>"
-            f"<td>{rating_badge(rating)}</td>"
-            f"<td style='text-align:right'>{fmt_pct(s['coupon_rate'])}</td>"
-            f"<td style='text-align:right'>{fmt_inr(s['face_value'])}</td>"
-            f"<td>{s['frequency']}</td>"
-            f"<td>{mat_str}</td>"
-            f"<td style='text-align:right'>{dtm}d</td>"
-            f"<td>{esc(sector)}</td></tr>"
+    mat = pd.to_datetime(filtered_secs['maturity_date'])
+    view = filtered_secs.assign(
+        bond_type=filtered_secs['bond_type'].fillna('NCD').replace('', 'NCD'),
+        rating=rating_badge_array(filtered_secs['credit_rating']),
+        maturity=mat.dt.strftime('%d %b %Y'),
+        dtm=(mat - pd.Timestamp(date.today())).dt.days.clip(lower=0),
+    )
+    _render_table(view, [
+        ("Issuer", "issuer", "text", {'style': 'font-weight:600'}),
+        ("ISIN", "isin", "text", {'style': 'font-size:0.8rem'}),
+        ("Type", "bond_type", "text"),
+        ("Rating", "rating", "html"),
+        ("Coupon", "coupon_rate", "pct"),
+        ("Face Value", "face_value", "inr"),
+        ("Freq", "frequency", "text"),
+        ("Maturity", "maturity", "text", {'sort': 'dtm'}),
+        ("Days", "dtm", "days"),
+        ("Sector", "sector", "text"),
+    ], key="sm_table")
+
+    _render_amortization_import(secs)
+
+    # Coupon calendars are rebuilt on every security/ledger write; this
+    # regenerates all of them (e.g. after restoring a database file).
+    if st.button("REBUILD COUPON CALENDAR", key="sm_rebuild"):
+        rows = refresh_security_schedule()
+        if rows is not None:
+            set_notification(f"Coupon calendar rebuilt ({rows} events).", "success")
+            logger.info(f"Rebuilt security_schedule: {rows} rows")
+            st.rerun()
+
+
+def _render_amortization_import(secs):
+    """Bulk-load contractual amortization schedules from a CSV with columns
+    isin, payment_date, principal (per unit). Each ISIN in the file has its
+    stored schedule replaced."""
+    with st.expander("Import Amortization Schedules"):
+        st.caption("CSV columns: " + ", ".join(AMORTIZATION_IMPORT_COLUMNS) + " (principal per unit of face).")
+        upload = st.file_uploader("Schedule CSV", type=["csv"], key="amort_import")
+        if upload is None or not st.button("IMPORT SCHEDULES", key="amort_import_btn"):
+            return
+        try:
+            rows = pd.read_csv(upload)
+        except (ValueError, UnicodeDecodeError) as e:
+            st.error(f"Could not read CSV: {e}")
+            return
+        missing = [c for c in AMORTIZATION_IMPORT_COLUMNS if c not in rows.columns]
+        if missing:
+            st.error(f"Missing columns: {', '.join(missing)}")
+            return
+        rows = rows[AMORTIZATION_IMPORT_COLUMNS].assign(
+            payment_date=lambda d: pd.to_datetime(d['payment_date'], errors='coerce'),
+            principal=lambda d: pd.to_numeric(d['principal'], errors='coerce'),
         )
-    st.markdown(
-        _render_html_table(
-            ["Issuer", "ISIN", "Type", "Rating", "Coupon", "Face Value", "Freq", "Maturity", "Days", "Sector"],
-            rows,
-        ),
-        unsafe_allow_html=True,
+        by_isin = secs.set_index('isin')
+        unknown = sorted(set(rows['isin']) - set(by_isin.index))
+        if unknown:
+            st.error(f"Unknown ISINs: {', '.join(map(str, unknown))}")
+            return
+        for isin, grp in rows.groupby('isin'):
+            err = validate_amortization_rows(grp, pd.to_datetime(by_isin.at[isin, 'maturity_date']),
+                                             float(by_isin.at[isin, 'face_value']))
+            if err:
+                st.error(f"{isin}: {err}")
+                return
+        rows['bond_id'] = rows['isin'].map(by_isin['bond_id'])
+        if replace_amortization_schedules(rows):
+            n_sec = rows['isin'].nunique()
+            set_notification(f"Imported {len(rows)} installments for {n_sec} securities.", "success")
+            logger.info(f"Imported amortization schedules: {len(rows)} rows, {n_sec} securities")
+            st.rerun()
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# PAGE: MARKET DATA
+# ═══════════════════════════════════════════════════════════════════════
+
+def page_market_data():
+    _render_section_header("Market Data", "Prices, benchmark yield curves and spread analytics", icon="trending", accent="cyan")
+    _render_price_loader()
+    _render_curve_loader()
+    _render_holiday_loader()
+    _render_price_summary()
+
+    market_revision = get_market_revision()
+    dates, zeros = zero_curves(market_revision)
+    if not len(dates):
+        st.info("No yield curves loaded.")
+        return
+
+    _render_section_header("Yield Curve", f"{DEFAULT_CURVE} par yields and bootstrapped zero rates", icon="activity", accent="info")
+    labels = pd.to_datetime(dates).strftime('%d %b %Y').tolist()[::-1]
+    pick = st.selectbox("Curve Date", labels, key="md_curve_date")
+    i = len(dates) - 1 - labels.index(pick)
+    pts = db_query(
+        "SELECT tenor, par_yield FROM yield_curves WHERE curve=? AND curve_date=? ORDER BY tenor",
+        (DEFAULT_CURVE, str(dates[i])),
     )
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=pts['tenor'], y=pts['par_yield'] * 100, mode='markers', name='Par Yield',
+                             marker=dict(color='#FFC300', size=8)))
+    fig.add_trace(go.Scatter(x=ZERO_GRID, y=zeros[i] * 100, mode='lines', name='Zero Rate',
+                             line=dict(color='#06b6d4')))
+    fig.update_layout(
+        **CL,
+        height=380,
+        xaxis=dict(gridcolor='rgba(255,255,255,0.05)', title='Tenor (years)'),
+        yaxis=dict(gridcolor='rgba(255,255,255,0.05)', title='%'),
+        legend=dict(orientation='h', yanchor='top', y=-0.15, xanchor='left', x=0, font=dict(size=10), bgcolor='rgba(0,0,0,0)'),
+        margin=dict(l=40, r=20, t=30, b=60),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    df, _ = get_positions_dataframe()
+    as_of = date.today().isoformat()
+    spreads = spread_analytics(df, get_ledger_revision(), as_of, market_revision) if not df.empty else pd.DataFrame()
+    if spreads.empty:
+        return
+    _render_section_header(
+        "Spread Analytics",
+        f"Z-spread over the {pd.Timestamp(spreads['curve_date'].iloc[0]).strftime('%d %b %Y')} curve, "
+        "priced at market where marked, else at cost",
+        icon="crosshair", accent="info",
+    )
+    w = spreads['price'] / spreads['price'].sum()
+    s1, s2, s3 = st.columns(3)
+    _render_metric(s1, "", "Weighted Z-Spread", f"{(w * spreads['z_spread']).sum() * 1e4:,.0f} bp")
+    _render_metric(s2, "", "Spread Duration", f"{(w * spreads['spread_duration']).sum():.2f}y")
+    _render_metric(s3, "", "CS01", fmt_inr_short((spreads['price'] * spreads['spread_duration']).sum() / 1e4),
+                   "Value change per 1bp of spread")
+    rows = spreads.sort_values('price', ascending=False)
+    _render_table(rows.assign(
+        security=security_cell_array(rows['issuer'], rows['isin']),
+        z_bp=rows['z_spread'] * 1e4,
+    ), [
+        ("Security", "security", "html"),
+        ("Acct", "account", "text"),
+        ("Price", "price", "inr"),
+        ("Z-Spread (bp)", "z_bp", "num", {'decimals': 0}),
+        ("Spread Duration", "spread_duration", "years"),
+    ], key="md_spreads")
+    st.download_button(
+        "EXPORT CSV",
+        lambda: spreads.drop(columns='bond_id').assign(z_spread=spreads['z_spread'] * 1e4)
+                       .rename(columns={'z_spread': 'z_spread_bp'}).round(4).to_csv(index=False),
+        "nivesa_spreads.csv", "text/csv",
+    )
+
+
+def _render_price_loader():
+    """Load price files from the drop folder or an upload."""
+    with st.expander("Load Prices"):
+        st.caption(
+            f"CSV/XLSX columns: {', '.join(PRICE_IMPORT_COLUMNS)} (end-of-day clean price per unit). "
+            f"Drop folder: {os.path.abspath(PRICE_DIR)}; files already loaded unchanged are skipped."
+        )
+        if st.button("LOAD DROP FOLDER", key="md_price_load"):
+            loaded, skipped, written, errors = load_price_folder()
+            for name, err in errors:
+                st.error(f"{name}: {err}")
+            if not errors:
+                set_notification(f"Loaded {loaded} price file(s) ({skipped} unchanged), {written} price(s) updated.", "success")
+                st.rerun()
+        upload = st.file_uploader("Price file", type=["csv", "xlsx"], key="md_price_upload")
+        if upload is None or not st.button("IMPORT PRICES", key="md_price_import"):
+            return
+        try:
+            rows, err = parse_price_rows(read_price_file(upload, upload.name), upload.name)
+        except (ValueError, UnicodeDecodeError) as e:
+            rows, err = None, f"Could not read file: {e}"
+        if err:
+            st.error(err)
+            return
+        written = store_prices(rows)
+        if written is not None:
+            set_notification(f"Imported {len(rows)} price(s), {written} updated.", "success")
+            logger.info(f"Imported price file {upload.name}: {written} rows written")
+            st.rerun()
+
+
+def _render_price_summary():
+    """Coverage of the held securities by the latest stored prices."""
+    prices = latest_prices(date.today().isoformat())
+    if prices.empty:
+        return
+    held = db_query("SELECT COUNT(*) AS n FROM securities")['n'].iloc[0]
+    age = (pd.Timestamp(date.today()) - prices['price_date']).dt.days
+    s1, s2, s3 = st.columns(3)
+    _render_metric(s1, "", "Securities Priced", f"{len(prices)} / {held}")
+    _render_metric(s2, "", "Latest Price Date", prices['price_date'].max().strftime('%d %b %Y'))
+    _render_metric(s3, "", "Oldest Price Used", f"{int(age.max())}d old")
+
+
+def _render_curve_loader():
+    """Load curve CSVs from the drop folder or an upload."""
+    with st.expander("Load Yield Curves"):
+        st.caption(
+            f"CSV columns: {', '.join(CURVE_IMPORT_COLUMNS)} (tenor in years or as 3M/10Y, yield in percent; "
+            f"optional curve, default {DEFAULT_CURVE}). Drop folder: {os.path.abspath(CURVE_DIR)}"
+        )
+        if st.button("LOAD DROP FOLDER", key="md_curve_load"):
+            files, written, errors = load_curve_folder()
+            for name, err in errors:
+                st.error(f"{name}: {err}")
+            if not errors:
+                set_notification(f"Loaded {files} curve file(s), {written} point(s) updated.", "success")
+                st.rerun()
+        upload = st.file_uploader("Curve CSV", type=["csv"], key="md_curve_upload")
+        if upload is None or not st.button("IMPORT CURVE", key="md_curve_import"):
+            return
+        try:
+            rows, err = parse_curve_points(pd.read_csv(upload), upload.name)
+        except (ValueError, UnicodeDecodeError) as e:
+            rows, err = None, f"Could not read CSV: {e}"
+        if err:
+            st.error(err)
+            return
+        written = store_curve_points(rows)
+        if written is not None:
+            set_notification(f"Imported {rows['curve_date'].nunique()} curve date(s), {written} point(s) updated.", "success")
+            logger.info(f"Imported curve file {upload.name}: {written} rows written")
+            st.rerun()
+
+
+def _render_holiday_loader():
+    """Show and replace the market holiday calendar."""
+    with st.expander("Holiday Calendar"):
+        holidays = holiday_calendar()
+        upcoming = holidays[holidays >= np.datetime64(date.today(), 'D')][:5]
+        st.caption(
+            f"CSV with a date column (optional name). File: {os.path.abspath(HOLIDAY_FILE)}; "
+            f"{len(holidays)} holiday(s) loaded"
+            + (f", next: {', '.join(pd.to_datetime(upcoming).strftime('%d %b %Y'))}." if len(upcoming) else ".")
+        )
+        upload = st.file_uploader("Holiday CSV", type=["csv"], key="md_holiday_upload")
+        if st.button("REBUILD SCHEDULES", key="md_holiday_rebuild"):
+            _apply_holidays()
+        if upload is None or not st.button("IMPORT HOLIDAYS", key="md_holiday_import"):
+            return
+        try:
+            raw = pd.read_csv(upload)
+            raw.columns = [str(c).strip().lower() for c in raw.columns]
+            days = pd.to_datetime(raw['date'], errors='coerce')
+        except (ValueError, KeyError, UnicodeDecodeError) as e:
+            st.error(f"Could not read CSV: {e}")
+            return
+        if days.isna().any():
+            st.error(f"{int(days.isna().sum())} row(s) with an unreadable date.")
+            return
+        out = pd.DataFrame({'date': days.dt.strftime('%Y-%m-%d'),
+                            'name': raw['name'] if 'name' in raw else ''})
+        try:
+            out.sort_values('date').drop_duplicates('date').to_csv(HOLIDAY_FILE, index=False)
+        except OSError as e:
+            st.error(f"Could not write {HOLIDAY_FILE}: {e}")
+            logger.error(f"Holiday calendar write failed: {e}")
+            return
+        logger.info(f"Imported holiday file {upload.name}: {out['date'].nunique()} dates")
+        _apply_holidays()
+
+
+def _apply_holidays():
+    """Re-roll stored payment calendars against the current holiday file.
+    Cached cashflows are keyed on the ledger revision, which a calendar
+    change does not move, so they are dropped too."""
+    rows = refresh_security_schedule()
+    if rows is None:
+        return
+    st.cache_data.clear()
+    set_notification(f"Holiday calendar applied: {len(holiday_calendar())} holiday(s), {rows} schedule row(s) rebuilt.", "success")
+    st.rerun()
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -2170,6 +3954,7 @@ PAGE_ROUTES = {
     "Edit Security":         lambda: page_edit_security(),
     "Record Transaction":    lambda: page_record_transaction(),
     "Edit Transaction":      lambda: page_edit_transaction(),
+    "Market Data":           lambda: page_market_data(),
 }
 
 
@@ -2203,7 +3988,7 @@ def main():
             unsafe_allow_html=True,
         )
         st.markdown('<div class="sidebar-title">Navigation</div>', unsafe_allow_html=True)
-        pages = ["Dashboard", "Transaction Ledger", "Securities Master", "Add Security", "Edit Security", "Record Transaction", "Edit Transaction"]
+        pages = ["Dashboard", "Transaction Ledger", "Securities Master", "Add Security", "Edit Security", "Record Transaction", "Edit Transaction", "Market Data"]
         page = st.selectbox("Navigation", pages, label_visibility="collapsed", key="nav_main")
         
         # Show spec box matching Pragyam's version box
@@ -2236,7 +4021,10 @@ def main():
     # ── Route ──
     handler = PAGE_ROUTES.get(page)
     if handler:
-        handler()
+        try:
+            handler()
+        except NivesaError as e:
+            st.error(str(e))
 
     # ── Footer ──
     _render_footer()
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+NIVESA engines and computation kernels.
+
+Everything here is importable without Streamlit: the database layer
+(db, schema), the finance, calendar, tax-lot and positions engines, and
+the `python -m nivesa` command line. The Streamlit app runs app.py as a
+script, so anything handed to a worker process lives here too.
+"""
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""Entry point for `python -m nivesa` (see nivesa.cli)."""
+from nivesa.cli import main
+
+if __name__ == "__main__":
+    raise SystemExit(main())
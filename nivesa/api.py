@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only JSON API over the ledger, started with `python -m nivesa serve`.
+
+    GET /positions   ?account= &bond_id= &isin= &issuer= &bond_type= &maturity_from= &maturity_to=
+    GET /totals      ?account=
+    GET /cashflows   ?account= &bond_id= &isin= &from= &to=
+    GET /ledger      ?account= &bond_id= &isin= &type= &from= &to= &limit= &offset=
+    GET /changes     ?since= &table= &limit=
+    GET /            revisions and the endpoint list
+
+Positions, totals and cashflows come from portfolio_analytics, so each
+ledger/market revision is computed once per process however many
+requests read it. Every response carries an ETag built from the
+revisions it was computed at and the request's normalized filter and
+page parameters; a request whose If-None-Match still matches gets 304
+without the analytics being touched. Bodies over
+GZIP_MIN_BYTES are gzipped for clients that accept it. The ledger is
+paged newest first (limit/offset), read in one snapshot with the
+revision its ETag names. Dates are ISO (YYYY-MM-DD), `issuer` matches a
+substring, and other filters match exactly.
+
+/changes is the change-data-capture feed (see nivesa.changes): the log
+entries after seq `since`, oldest first. A client passes the response's
+next_since as its next `since`; the ETag names the newest seq and the
+page asked for (since, table, limit), so polling an unchanged log costs a
+304 while paging on through it never does.
+"""
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+import gzip
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from nivesa.changes import CDC_TABLES, latest_seq, read_changes
+from nivesa.db import NivesaError, connect, get_ledger_revision, get_market_revision, logger
+from nivesa.positions import analytics_key, portfolio_analytics, portfolio_totals
+
+DEFAULT_PORT = 8502
+GZIP_MIN_BYTES = 1024
+LEDGER_PAGE_SIZE = 100
+LEDGER_MAX_PAGE_SIZE = 1000
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+LEDGER_COLUMNS = [
+    'transaction_id', 'trade_date', 'bond_id', 'issuer', 'isin', 'account',
+    'transaction_type', 'units', 'price', 'amount', 'notes',
+]
+
+
+class BadRequest(ValueError):
+    """A query parameter could not be used."""
+
+
+def _date_param(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+    except ValueError:
+        raise BadRequest(f"{name} must be a date (YYYY-MM-DD)") from None
+
+
+def _int_param(params, name, default, low, high):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer") from None
+    if not low <= value <= high:
+        raise BadRequest(f"{name} must be between {low} and {high}")
+    return value
+
+
+def _match(frame, params, exact):
+    """Rows of `frame` equal to every given param in `exact` (param ->
+    column)."""
+    mask = np.ones(len(frame), bool)
+    for name, col in exact.items():
+        if params.get(name) is not None:
+            mask &= (frame[col] == params[name]).to_numpy()
+    return frame[mask]
+
+
+def _records(frame):
+    """JSON text of `frame` as a list of row objects, datetimes as dates."""
+    out = frame.copy()
+    for col in out.columns:
+        if pd.api.types.is_datetime64_any_dtype(out[col]):
+            out[col] = out[col].dt.strftime('%Y-%m-%d')
+    return out.to_json(orient='records')
+
+
+def _scalar(value):
+    value = value.item() if hasattr(value, 'item') else value
+    return None if isinstance(value, float) and not np.isfinite(value) else value
+
+
+# Query parameters each endpoint reads, and which of them are dates.
+ENDPOINT_PARAMS = {
+    '/positions': ['account', 'bond_id', 'isin', 'issuer', 'bond_type', 'maturity_from', 'maturity_to'],
+    '/totals': ['account'],
+    '/cashflows': ['account', 'bond_id', 'isin', 'from', 'to'],
+    '/ledger': ['account', 'bond_id', 'isin', 'type', 'from', 'to'],
+}
+DATE_PARAMS = {'maturity_from', 'maturity_to', 'from', 'to'}
+
+
+def _query_tag(path, params, extra=()):
+    """The parameters `path` reads (plus `extra` (name, value) pairs),
+    normalized and URL-encoded for an ETag: two requests for the same rows
+    get the same text, and no two different ones do."""
+    pairs = [(name, _date_param(params, name) if name in DATE_PARAMS else params.get(name))
+             for name in ENDPOINT_PARAMS[path]]
+    return urlencode(sorted((k, v) for k, v in [*pairs, *extra] if v is not None))
+
+
+def _analytics_etag(path, params):
+    """(analytics_key(), ETag naming it and the request). The calendar
+    stamp goes in at full precision, as the key holds it: two rewrites of
+    the holiday file within one second must still change the tag."""
+    key = analytics_key()
+    revision, market_revision, as_of, stamp = key
+    return key, f'"{revision}.{market_revision}.{as_of}.{stamp!r}?{_query_tag(path, params)}"'
+
+
+def _ledger_params(params):
+    """(limit, offset) of a /ledger request."""
+    limit = _int_param(params, 'limit', LEDGER_PAGE_SIZE, 1, LEDGER_MAX_PAGE_SIZE)
+    offset = _int_param(params, 'offset', 0, 0, 2 ** 62)
+    return limit, offset
+
+
+def _ledger_etag(revision, params):
+    """ETag of one /ledger page: the revision, the filters and the page."""
+    limit, offset = _ledger_params(params)
+    return f'"{revision}?{_query_tag("/ledger", params, [("limit", limit), ("offset", offset)])}"'
+
+
+def positions_body(params, key):
+    df, _, _ = portfolio_analytics(key)
+    if not df.empty:
+        df = _match(df, params, {'account': 'account', 'bond_id': 'bond_id', 'isin': 'isin', 'bond_type': 'bond_type'})
+        if params.get('issuer'):
+            df = df[df['issuer'].str.contains(params['issuer'], case=False, regex=False)]
+        lo, hi = _date_param(params, 'maturity_from'), _date_param(params, 'maturity_to')
+        if lo:
+            df = df[df['maturity_date'] >= lo]
+        if hi:
+            df = df[df['maturity_date'] <= hi]
+    return f'{{"as_of":"{key[2]}","count":{len(df)},"items":{_records(df)}}}'
+
+
+def totals_body(params, key):
+    df, totals, _ = portfolio_analytics(key)
+    if params.get('account') is not None:
+        df = df[df['account'] == params['account']] if not df.empty else df
+        totals = portfolio_totals(df) if not df.empty else {}
+    return json.dumps({'as_of': key[2], 'totals': {k: _scalar(v) for k, v in totals.items()}})
+
+
+def cashflows_body(params, key):
+    _, _, cf = portfolio_analytics(key)
+    if not cf.empty:
+        cf = _match(cf, params, {'account': 'account', 'bond_id': 'bond_id', 'isin': 'isin'})
+        lo, hi = _date_param(params, 'from'), _date_param(params, 'to')
+        if lo:
+            cf = cf[cf['date'] >= lo]
+        if hi:
+            cf = cf[cf['date'] <= hi]
+    return f'{{"as_of":"{key[2]}","count":{len(cf)},"items":{_records(cf)}}}'
+
+
+def ledger_page(params):
+    """(ETag, body) for one page of the ledger, newest first."""
+    limit, offset = _ledger_params(params)
+    where, args = [], []
+    for name, col in (('account', 't.account'), ('bond_id', 't.bond_id'), ('isin', 's.isin'),
+                      ('type', 't.transaction_type')):
+        if params.get(name) is not None:
+            where.append(f"{col}=?")
+            args.append(params[name])
+    for name, op in (('from', '>='), ('to', '<=')):
+        value = _date_param(params, name)
+        if value:
+            where.append(f"t.trade_date {op} ?")
+            args.append(value)
+    base = "FROM transactions t JOIN securities s ON t.bond_id=s.bond_id"
+    if where:
+        base += " WHERE " + " AND ".join(where)
+    cols = ', '.join('s.' + c if c in ('issuer', 'isin') else 't.' + c for c in LEDGER_COLUMNS)
+    try:
+        with closing(connect()) as conn:
+            # One read transaction: the count, the page and the revision
+            # in the ETag come from the same snapshot.
+            conn.execute("BEGIN")
+            revision = conn.execute("SELECT revision FROM ledger_state WHERE id = 1").fetchone()[0]
+            total = conn.execute(f"SELECT COUNT(*) {base}", args).fetchone()[0]
+            page = pd.read_sql_query(
+                f"SELECT {cols} {base} ORDER BY t.trade_date DESC, t.rowid DESC LIMIT ? OFFSET ?",
+                conn, params=args + [limit, offset],
+            )
+            conn.rollback()
+    except sqlite3.Error as e:
+        logger.error(f"Ledger read failed: {e}")
+        raise NivesaError(f"Ledger read failed: {e}") from e
+    nxt = offset + limit if offset + limit < total else None
+    body = (f'{{"revision":{revision},"total":{total},"limit":{limit},"offset":{offset},'
+            f'"next_offset":{json.dumps(nxt)},"items":{_records(page)}}}')
+    return _ledger_etag(revision, params), body
+
+
+def _changes_params(params):
+    """(since, table, limit) of a /changes request."""
+    since = _int_param(params, 'since', 0, 0, 2 ** 62)
+    limit = _int_param(params, 'limit', CHANGES_PAGE_SIZE, 1, CHANGES_MAX_PAGE_SIZE)
+    table = params.get('table')
+    if table is not None and table not in CDC_TABLES:
+        raise BadRequest(f"table must be one of {', '.join(CDC_TABLES)}")
+    return since, table, limit
+
+
+def _changes_etag(latest, since, table, limit):
+    """ETag of one /changes page: the newest seq and the page asked for."""
+    return f'"c{latest}-{since}-{table or ""}-{limit}"'
+
+
+def changes_page(params):
+    """(ETag, body) for the changes after `since`, oldest first."""
+    since, table, limit = _changes_params(params)
+    latest, items, more = read_changes(since, limit, table)
+    # Past the page, or past everything read when the page is the end.
+    next_since = items[-1]['seq'] if more else max(since, latest)
+    body = json.dumps({'since': since, 'latest': latest, 'next_since': next_since, 'more': more, 'items': items})
+    return _changes_etag(latest, since, table, limit), body
+
+
+ANALYTICS = {'/positions': positions_body, '/totals': totals_body, '/cashflows': cashflows_body}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = "Nivesa"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _reject(self):
+        self._send(405, json.dumps({'error': 'read-only API: GET and HEAD only'}), extra={'Allow': 'GET, HEAD'})
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = _reject
+
+    def _respond(self, send_body):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/') or '/'
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if path in ANALYTICS:
+                key, etag = _analytics_etag(path, params)
+                if self._not_modified(etag):
+                    return
+                body = ANALYTICS[path](params, key)
+            elif path == '/ledger':
+                if self._not_modified(_ledger_etag(get_ledger_revision(), params)):
+                    return
+                etag, body = ledger_page(params)
+            elif path == '/changes':
+                if self._not_modified(_changes_etag(latest_seq(), *_changes_params(params))):
+                    return
+                etag, body = changes_page(params)
+            elif path == '/':
+                etag = None
+                body = json.dumps({'ledger_revision': get_ledger_revision(),
+                                   'market_revision': get_market_revision(),
+                                   'change_seq': latest_seq(),
+                                   'endpoints': sorted(ANALYTICS) + ['/ledger', '/changes']})
+            else:
+                self._send(404, json.dumps({'error': f'no such endpoint: {url.path}'}), send_body=send_body)
+                return
+        except BadRequest as e:
+            self._send(400, json.dumps({'error': str(e)}), send_body=send_body)
+            return
+        except NivesaError as e:
+            self._send(500, json.dumps({'error': str(e)}), send_body=send_body)
+            return
+        self._send(200, body, etag, send_body=send_body)
+
+    def _not_modified(self, etag):
+        """Answer 304 if the client already holds `etag`."""
+        tags = [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]
+        if etag not in tags and '*' not in tags:
+            return False
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return True
+
+    def _send(self, status, body, etag=None, send_body=True, extra=None):
+        data = body.encode('utf-8')
+        gzipped = len(data) >= GZIP_MIN_BYTES and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            data = gzip.compress(data, compresslevel=6)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', etag)
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.info("API %s " + format, self.address_string(), *args)
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT):
+    """Serve the API until interrupted."""
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    logger.info(f"API listening on http://{host}:{server.server_port}")
+    print(f"Nivesa API on http://{host}:{server.server_port} (Ctrl+C to stop)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
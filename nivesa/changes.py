@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Change data capture for the ledger and the security master.
+
+Every insert, update and delete on CDC_TABLES appends a row to change_log
+from an AFTER trigger, so the entry commits or rolls back with the write
+that caused it: the app, imports, scripts and manual SQL all land in the
+log. Each entry carries a monotonically increasing seq, the operation,
+the row's primary key and the row before and after as JSON (reals
+rendered with 17 significant digits, so they read back bit for bit).
+Updates that change nothing are not logged. When the log is first
+created, every existing row is recorded once as a SNAPSHOT, so replaying
+the log from seq 0 rebuilds the tables. The log itself is append-only:
+triggers abort any UPDATE or DELETE on it.
+
+Readers keep a watermark (the last seq they have seen) and ask for
+everything after it; SQLite serialises writers and a seq is assigned
+inside the writing transaction, so no change can appear behind a
+watermark that has already moved past it. `python -m nivesa changes` and
+the API's /changes endpoint both read from here.
+"""
+from contextlib import closing, nullcontext
+import json
+import sqlite3
+
+from nivesa.constants import CDC_TABLES
+from nivesa.db import DatabaseError, NivesaError, connect, logger
+
+CHANGE_OPS = ('SNAPSHOT', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def _row_json(conn, table, ref):
+    """SQL expression rendering row `ref` (NEW, OLD or the table itself)
+    of `table` as a JSON object, columns in table order."""
+    parts = []
+    for i, col in enumerate(r[1] for r in conn.execute(f"PRAGMA table_info({table})")):
+        value = (f"CASE typeof({ref}.{col}) WHEN 'real' THEN "
+                 f"CASE WHEN abs({ref}.{col}) < 1e999 THEN printf('%!.17g', {ref}.{col}) ELSE 'null' END "
+                 f"ELSE json_quote({ref}.{col}) END")
+        parts.append(f"""'{"," if i else ""}"{col}":' || {value}""")
+    return "'{' || " + " || ".join(parts) + " || '}'"
+
+
+def _trigger_sql(conn, table, op):
+    key = CDC_TABLES[table]
+    new, old = _row_json(conn, table, 'NEW'), _row_json(conn, table, 'OLD')
+    values = {
+        'INSERT': f"NEW.{key}, NULL, {new}",
+        'UPDATE': f"NEW.{key}, {old}, {new}",
+        'DELETE': f"OLD.{key}, {old}, NULL",
+    }[op]
+    when = f"\nWHEN {old} IS NOT {new}" if op == 'UPDATE' else ""
+    return (f"CREATE TRIGGER trg_cdc_{table}_{op.lower()}\nAFTER {op} ON {table}{when}\nBEGIN\n"
+            f"    INSERT INTO change_log (table_name, op, row_key, old_row, new_row)\n"
+            f"    VALUES ('{table}', '{op}', {values});\nEND")
+
+
+def install_change_capture(conn):
+    """Create change_log, its append-only guards and the capture triggers
+    inside init_db's transaction. A trigger is rebuilt when its table's
+    columns have changed; a new log starts with a SNAPSHOT of every row."""
+    fresh = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='change_log'"
+    ).fetchone() is None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL CHECK (op IN ('SNAPSHOT', 'INSERT', 'UPDATE', 'DELETE')),
+        row_key TEXT NOT NULL,
+        old_row TEXT,
+        new_row TEXT
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_table ON change_log (table_name, seq)")
+    for op in ("UPDATE", "DELETE"):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_change_log_no_{op.lower()}
+        BEFORE {op} ON change_log
+        BEGIN
+            SELECT RAISE(ABORT, 'change_log is append-only');
+        END""")
+    if fresh:
+        for table, key in CDC_TABLES.items():
+            conn.execute(
+                f"INSERT INTO change_log (table_name, op, row_key, new_row) "
+                f"SELECT '{table}', 'SNAPSHOT', {key}, {_row_json(conn, table, table)} FROM {table} ORDER BY rowid"
+            )
+    current = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger' AND name LIKE 'trg_cdc_%'"))
+    for table in CDC_TABLES:
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            name, sql = f"trg_cdc_{table}_{op.lower()}", _trigger_sql(conn, table, op)
+            if current.get(name) != sql:
+                conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+                conn.execute(sql)
+
+
+def _check_table(table):
+    if table is not None and table not in CDC_TABLES:
+        raise NivesaError(f"table must be one of {', '.join(CDC_TABLES)}")
+
+
+def latest_seq():
+    """The newest seq in change_log, 0 if it is empty."""
+    try:
+        with closing(connect()) as conn:
+            return conn.execute("SELECT MAX(seq) FROM change_log").fetchone()[0] or 0
+    except sqlite3.Error as e:
+        logger.error(f"Change log read failed: {e}")
+        raise DatabaseError(f"Change log read failed: {e}") from e
+
+
+def _record(row):
+    seq, changed_at, table, op, key, old, new = row
+    return {'seq': seq, 'changed_at': changed_at, 'table': table, 'op': op, 'key': key,
+            'before': json.loads(old) if old else None, 'after': json.loads(new) if new else None}
+
+
+def iter_changes(since=0, table=None, limit=None, conn=None):
+    """Yield the changes after seq `since` in seq order as dicts (seq,
+    changed_at, table, op, key, before, after), streamed from the cursor.
+    At most `limit` if given. Raises DatabaseError."""
+    _check_table(table)
+    query, args = ("SELECT seq, changed_at, table_name, op, row_key, old_row, new_row "
+                   "FROM change_log WHERE seq > ?"), [since]
+    if table:
+        query += " AND table_name=?"
+        args.append(table)
+    query += " ORDER BY seq"
+    if limit is not None:
+        query += " LIMIT ?"
+        args.append(limit)
+    try:
+        with closing(connect()) if conn is None else nullcontext(conn) as c:
+            for row in c.execute(query, args):
+                yield _record(row)
+    except sqlite3.Error as e:
+        logger.error(f"Change log read failed: {e}")
+        raise DatabaseError(f"Change log read failed: {e}") from e
+
+
+def read_changes(since=0, limit=500, table=None):
+    """One page of the feed read in a single snapshot: (latest, changes,
+    more). `latest` is the newest seq overall, `more` whether changes
+    after the page remain. Raises DatabaseError."""
+    _check_table(table)
+    try:
+        with closing(connect()) as conn:
+            conn.execute("BEGIN")
+            latest = conn.execute("SELECT MAX(seq) FROM change_log").fetchone()[0] or 0
+            page = list(iter_changes(since, table, limit + 1, conn=conn))
+            conn.rollback()
+    except sqlite3.Error as e:
+        logger.error(f"Change log read failed: {e}")
+        raise DatabaseError(f"Change log read failed: {e}") from e
+    return latest, page[:limit], len(page) > limit
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+`python -m nivesa`: positions, portfolio totals, projected cashflows, the
+ledger and saved snapshots from the ledger database, without the
+Streamlit app.
+
+    python -m nivesa positions --format csv --output positions.csv
+    python -m nivesa totals --account REKHA
+    python -m nivesa cashflows --format parquet --output cashflows.parquet
+    python -m nivesa ledger --format arrow --output ledger.arrow
+    python -m nivesa history --stage totals --from 2026-04-01 --format parquet --output totals.parquet
+    python -m nivesa import-ledger --input ledger.parquet
+    python -m nivesa serve --port 8502
+    python -m nivesa snapshot
+    python -m nivesa schedule
+    python -m nivesa changes --since 1200 --table transactions --follow
+
+Output goes to stdout unless --output names a file. Parquet and Arrow
+output is typed and streamed (see nivesa.columnar), and `import-ledger`
+reads such a file back into the ledger. `serve` runs the read-only JSON
+API (see nivesa.api), and `snapshot` writes today's analytics snapshot
+(see nivesa.snapshots), printing each stage's runtime; `schedule`
+regenerates every security's coupon calendar (see nivesa.schedule), and
+`history` exports the saved snapshots of one --stage. `changes` prints
+the change log after --since as one JSON object per line (see
+nivesa.changes); with --follow it keeps polling for new entries until
+interrupted. The database is migrated first, exactly as the app does on
+start.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+from nivesa.constants import CDC_TABLES, STAGES
+
+COMMANDS = [
+    'positions', 'totals', 'cashflows', 'ledger', 'history', 'import-ledger', 'serve', 'snapshot', 'schedule',
+    'changes',
+]
+FORMATS = ['json', 'csv', 'parquet', 'arrow']
+CHANGES_POLL_SECONDS = 2
+
+
+def _parser():
+    p = argparse.ArgumentParser(prog='nivesa', description='Nivesa bond portfolio ledger.')
+    p.add_argument('command', choices=COMMANDS)
+    p.add_argument('--format', choices=FORMATS, default='json')
+    p.add_argument('--output', help='file to write instead of stdout')
+    p.add_argument('--account', help='only this account (not for history)')
+    p.add_argument('--data-dir', help='data directory (default: $NIVESA_DATA_DIR or ./data)')
+    p.add_argument('--stage', choices=STAGES, default='positions', help='history: snapshot stage')
+    p.add_argument('--from', dest='start', help='history: first valuation date (YYYY-MM-DD)')
+    p.add_argument('--to', dest='end', help='history: last valuation date (YYYY-MM-DD)')
+    p.add_argument('--input', help='import-ledger: Parquet or Arrow file to read')
+    p.add_argument('--host', default='127.0.0.1', help='serve: interface to listen on')
+    p.add_argument('--port', type=int, help='serve: port (default 8502)')
+    p.add_argument('--force', action='store_true', help='snapshot: rewrite stages that are already current')
+    p.add_argument('--since', type=int, default=0, help='changes: last seq already seen (default 0, the whole log)')
+    p.add_argument('--table', choices=list(CDC_TABLES), help='changes: only this table')
+    p.add_argument('--follow', action='store_true', help='changes: keep polling for new entries')
+    return p
+
+
+def _report(args):
+    """The requested frame, or dict for totals."""
+    from nivesa.columnar import ledger_query, snapshot_query
+    from nivesa.db import query_frame
+    from nivesa.positions import portfolio_analytics, portfolio_totals
+
+    if args.command == 'ledger':
+        return query_frame(*ledger_query(args.account))
+    if args.command == 'history':
+        return query_frame(*snapshot_query(args.stage, args.start, args.end))
+    df, totals, cf = portfolio_analytics()
+    if args.account:
+        df = df[df['account'] == args.account].reset_index(drop=True) if not df.empty else df
+        cf = cf[cf['account'] == args.account].reset_index(drop=True)
+        totals = portfolio_totals(df) if not df.empty else {}
+    return {'positions': df, 'totals': totals, 'cashflows': cf}[args.command]
+
+
+def _export(args):
+    """Stream the requested rows as Parquet or Arrow."""
+    from nivesa.columnar import export_frame, export_ledger, export_snapshots
+    import pandas as pd
+
+    sink = args.output or sys.stdout.buffer
+    if args.command == 'ledger':
+        export_ledger(sink, args.format, account=args.account)
+    elif args.command == 'history':
+        export_snapshots(args.stage, sink, args.format, args.start, args.end)
+    else:
+        result = _report(args)
+        if isinstance(result, dict):
+            result = pd.DataFrame({'metric': list(result), 'value': [_plain(v) for v in result.values()]})
+        export_frame(result, args.command, sink, args.format)
+
+
+def _plain(value):
+    """JSON-safe scalar: numpy types unwrapped, NaN/inf as null."""
+    value = value.item() if hasattr(value, 'item') else value
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def _write(result, fmt, output):
+    import pandas as pd
+
+    if isinstance(result, dict):
+        if fmt == 'json':
+            text = json.dumps({k: _plain(v) for k, v in result.items()}, indent=2)
+        else:
+            text = pd.DataFrame({'metric': list(result), 'value': [_plain(v) for v in result.values()]}).to_csv(index=False)
+    elif fmt == 'json':
+        text = result.to_json(orient='records', date_format='iso', indent=2)
+    else:
+        text = result.to_csv(index=False)
+    if output:
+        with open(output, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text if text.endswith('\n') else text + '\n')
+
+
+def _import_ledger(path):
+    from nivesa.columnar import import_ledger
+    from nivesa.db import NivesaError
+
+    if not path:
+        raise NivesaError("import-ledger needs --input")
+    inserted, skipped = import_ledger(path)
+    print(f"imported {inserted} transactions, {skipped} already in the ledger")
+
+
+def _snapshot(force):
+    from nivesa.snapshots import run_snapshot
+
+    def report(result):
+        stage, status, rows, seconds = result
+        print(f"{stage:<12}{status:<9}{rows:>8} rows{seconds:>9.2f}s", flush=True)
+
+    started = time.perf_counter()
+    run_snapshot(force, on_stage=report)
+    print(f"{'total':<34}{time.perf_counter() - started:>9.2f}s")
+
+
+def _schedule():
+    from contextlib import closing
+    import sqlite3
+
+    from nivesa.db import DatabaseError, connect, logger
+    from nivesa.schedule import rebuild_security_schedule
+
+    try:
+        with closing(connect()) as conn, conn:
+            rows = rebuild_security_schedule(conn)
+    except sqlite3.Error as e:
+        logger.error(f"Schedule rebuild failed: {e}")
+        raise DatabaseError(f"Schedule rebuild failed: {e}") from e
+    print(f"rebuilt the coupon calendar: {rows} events")
+
+
+def _changes(args):
+    """Stream the change log after --since as NDJSON."""
+    from nivesa.changes import iter_changes
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    since = args.since
+    try:
+        while True:
+            for change in iter_changes(since, args.table):
+                out.write(json.dumps(change) + '\n')
+                since = change['seq']
+            out.flush()
+            if not args.follow:
+                break
+            time.sleep(CHANGES_POLL_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output:
+            out.close()
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.data_dir:
+        # nivesa.db reads the data directory at import.
+        os.environ['NIVESA_DATA_DIR'] = args.data_dir
+
+    from nivesa.db import DATA_DIR, NivesaError
+    from nivesa.schema import init_db
+
+    log_dir = os.path.join(DATA_DIR, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(log_dir, 'nivesa.log'),
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    try:
+        init_db()
+        if args.command == 'serve':
+            from nivesa.api import DEFAULT_PORT, serve
+            serve(args.host, args.port or DEFAULT_PORT)
+        elif args.command == 'snapshot':
+            _snapshot(args.force)
+        elif args.command == 'schedule':
+            _schedule()
+        elif args.command == 'changes':
+            _changes(args)
+        elif args.command == 'import-ledger':
+            _import_ledger(args.input)
+        elif args.format in ('parquet', 'arrow'):
+            _export(args)
+        else:
+            _write(_report(args), args.format, args.output)
+    except NivesaError as e:
+        print(f"nivesa: {e}", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"nivesa: {e}", file=sys.stderr)
+        return 1
+    return 0
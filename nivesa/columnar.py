@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet and Arrow IPC files of the ledger and the analytics.
+
+Exports are written as a stream of batches of at most ROW_GROUP_ROWS rows
+(one Parquet row group or Arrow record batch each). The ledger and the
+snapshot tables come straight from a SQL cursor and positions and cashflows
+in slices of their frame, so a writer never holds more than one batch.
+Columns are typed: dates as date32, amounts as float64 (the doubles the
+database stores, so nothing is rounded) and text as strings. Positions and
+cashflows share the column set of their snapshot stage (nivesa.snapshots),
+so a day's export and that day's snapshot read back identically.
+
+import_ledger is the way back for the ledger. It reads a Parquet or Arrow
+file batch by batch and checks every row against the security master. The
+new transactions go in as one database transaction, with the same
+chronology check, coupon calendar and tax lot rebuild as recording them by
+hand. Rows whose transaction_id is already in the ledger are skipped, so
+importing a file twice changes nothing.
+
+pyarrow is a requirement (requirements.txt) but is imported only when a
+file is read or written, so the rest of the package loads without it;
+these functions then raise NivesaError.
+"""
+from contextlib import closing
+import os
+import sqlite3
+import uuid
+
+import pandas as pd
+
+from nivesa.db import DatabaseError, NivesaError, connect, logger
+from nivesa.lots import TRANSACTION_TYPES, rebuild_tax_lots, validate_ledger_chronology
+from nivesa.schedule import rebuild_security_schedule
+from nivesa.snapshots import SNAPSHOT_COLUMNS, SNAPSHOT_DATE_COLUMNS, SNAPSHOT_TABLES
+
+COLUMNAR_FORMATS = ['parquet', 'arrow']
+ROW_GROUP_ROWS = 65536
+IMPORT_MAX_ERRORS = 10
+
+LEDGER_FIELDS = [
+    ('transaction_id', 'string'), ('trade_date', 'date32'), ('bond_id', 'string'), ('isin', 'string'),
+    ('issuer', 'string'), ('account', 'string'), ('transaction_type', 'string'), ('units', 'float64'),
+    ('price', 'float64'), ('amount', 'float64'), ('notes', 'string'),
+]
+LEDGER_REQUIRED = ['trade_date', 'account', 'transaction_type', 'units', 'price', 'amount']
+_SQL_TYPES = {'TEXT': 'string', 'REAL': 'float64', 'INTEGER': 'int64', '': 'float64'}
+
+
+def _pyarrow():
+    """(pyarrow, pyarrow.parquet, pyarrow.ipc), or NivesaError."""
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise NivesaError(f"Parquet and Arrow files need pyarrow: {e}") from e
+    return pa, pq, ipc
+
+
+def _schema(fields):
+    pa = _pyarrow()[0]
+    return pa.schema([(name, getattr(pa, kind)()) for name, kind in fields])
+
+
+def stage_schema(stage, dated=False):
+    """Arrow schema of a snapshot stage's columns, led by valuation_date
+    if `dated`."""
+    dates = SNAPSHOT_DATE_COLUMNS.get(stage, ())
+    fields = [('valuation_date', 'date32')] if dated else []
+    fields += [(c, 'date32' if c in dates else _SQL_TYPES[kind]) for c, kind in SNAPSHOT_COLUMNS[stage].items()]
+    return _schema(fields)
+
+
+def write_batches(batches, schema, sink, fmt='parquet'):
+    """Write Arrow tables or record batches to `sink` (a path or binary
+    file) as Parquet, one row group each, or an Arrow IPC file. Returns
+    rows written."""
+    _, pq, ipc = _pyarrow()
+    if fmt not in COLUMNAR_FORMATS:
+        raise NivesaError(f"Unknown columnar format: {fmt}")
+    writer = pq.ParquetWriter(sink, schema) if fmt == 'parquet' else ipc.new_file(sink, schema)
+    rows = 0
+    try:
+        for batch in batches:
+            writer.write(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows
+
+
+def _query_batches(query, params, schema):
+    """Batches of a SELECT whose columns are `schema`'s, ISO date text
+    converted to date32."""
+    pa = _pyarrow()[0]
+    try:
+        with closing(connect()) as conn:
+            cur = conn.execute(query, params)
+            while True:
+                rows = cur.fetchmany(ROW_GROUP_ROWS)
+                if not rows:
+                    break
+                arrays = []
+                for field, values in zip(schema, zip(*rows)):
+                    if field.type == pa.date32():
+                        arrays.append(pa.array([v and v[:10] for v in values], pa.string()).cast(field.type))
+                    else:
+                        arrays.append(pa.array(values, field.type))
+                yield pa.record_batch(arrays, schema=schema)
+    except sqlite3.Error as e:
+        logger.error(f"Export query failed: {e}")
+        raise DatabaseError(f"Export query failed: {e}") from e
+
+
+def _frame_batches(frame, schema):
+    """`frame`'s `schema` columns as tables of at most ROW_GROUP_ROWS rows."""
+    pa = _pyarrow()[0]
+    for start in range(0, len(frame), ROW_GROUP_ROWS):
+        part = frame.iloc[start:start + ROW_GROUP_ROWS][schema.names]
+        yield pa.Table.from_pandas(part, preserve_index=False).cast(schema)
+
+
+def ledger_query(account=None, ttype=None, search=None):
+    """(query, params) selecting LEDGER_FIELDS oldest first, with the app's
+    ledger filters (account, transaction type, issuer substring)."""
+    cols = ', '.join(('s.' if name in ('isin', 'issuer') else 't.') + name for name, _ in LEDGER_FIELDS)
+    query = f"SELECT {cols} FROM transactions t JOIN securities s ON t.bond_id=s.bond_id WHERE 1=1"
+    params = []
+    if account and account != 'All':
+        query += " AND t.account=?"
+        params.append(account)
+    if ttype and ttype != 'All':
+        query += " AND t.transaction_type=?"
+        params.append(ttype)
+    if search:
+        query += " AND s.issuer LIKE ?"
+        params.append(f"%{search}%")
+    return query + " ORDER BY t.trade_date, t.rowid", tuple(params)
+
+
+def export_ledger(sink, fmt='parquet', account=None, ttype=None, search=None):
+    """Write the ledger_query rows. Returns rows written."""
+    schema = _schema(LEDGER_FIELDS)
+    return write_batches(_query_batches(*ledger_query(account, ttype, search), schema), schema, sink, fmt)
+
+
+def export_frame(frame, stage, sink, fmt='parquet'):
+    """Write a positions or cashflows frame with the columns of the
+    snapshot stage of that name. Returns rows written."""
+    schema = stage_schema(stage)
+    return write_batches(_frame_batches(frame, schema) if not frame.empty else (), schema, sink, fmt)
+
+
+def snapshot_query(stage, start=None, end=None):
+    """(query, params) selecting a snapshot stage for every saved valuation
+    date, or those from `start` to `end` (ISO dates), oldest first."""
+    cols = ['valuation_date'] + list(SNAPSHOT_COLUMNS[stage])
+    query = (f"SELECT {', '.join(cols)} FROM {SNAPSHOT_TABLES[stage]} WHERE valuation_date BETWEEN ? AND ? "
+             "ORDER BY valuation_date, rowid")
+    return query, (start or '0000-01-01', end or '9999-12-31')
+
+
+def export_snapshots(stage, sink, fmt='parquet', start=None, end=None):
+    """Write the snapshot_query rows. Returns rows written."""
+    schema = stage_schema(stage, dated=True)
+    return write_batches(_query_batches(*snapshot_query(stage, start, end), schema), schema, sink, fmt)
+
+
+def _read_batches(source):
+    """Record batches of a Parquet file, Arrow IPC file or Arrow IPC stream
+    at `source` (a path or seekable binary file)."""
+    pa, pq, ipc = _pyarrow()
+    f = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    try:
+        head = f.read(6)
+        f.seek(0)
+        if head[:4] == b'PAR1':
+            yield from pq.ParquetFile(f).iter_batches(batch_size=ROW_GROUP_ROWS)
+        elif head == b'ARROW1':
+            reader = ipc.open_file(f)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+        else:
+            yield from ipc.open_stream(f)
+    except pa.ArrowException as e:
+        raise NivesaError(f"Not a readable Parquet or Arrow file: {e}") from e
+    finally:
+        if f is not source:
+            f.close()
+
+
+def _ledger_rows(frame, first_row, securities, errors):
+    """Transactions rows (INSERT order) for one batch, appending a message
+    to `errors` for each row that cannot be imported."""
+    missing = [c for c in LEDGER_REQUIRED if c not in frame]
+    if 'bond_id' not in frame and 'isin' not in frame:
+        missing.append('bond_id or isin')
+    if missing:
+        raise NivesaError(f"Ledger file is missing columns: {', '.join(missing)}")
+
+    bond = frame['bond_id'] if 'bond_id' in frame else pd.Series(None, index=frame.index, dtype=object)
+    if 'isin' in frame:
+        bond = bond.where(bond.notna(), frame['isin'].map(securities['by_isin']))
+    trade_date = pd.to_datetime(frame['trade_date'], errors='coerce')
+    units, price, amount = (pd.to_numeric(frame[c], errors='coerce') for c in ('units', 'price', 'amount'))
+    ttype = frame['transaction_type']
+    checks = [
+        (~bond.isin(securities['bond_ids']), "unknown security"),
+        (trade_date.isna(), "trade_date is not a date"),
+        (units.isna() | price.isna() | amount.isna(), "units, price and amount must be numbers"),
+        (~ttype.isin(TRANSACTION_TYPES), f"transaction_type must be one of {', '.join(TRANSACTION_TYPES)}"),
+        (frame['account'].isna() | (frame['account'].astype(str).str.strip() == ''), "account is empty"),
+        (((ttype == 'Buy') & (units <= 0)) | ((ttype == 'Sell') & (units >= 0)),
+         "Buy units must be positive and Sell units negative"),
+    ]
+    found = sorted((i, message) for bad, message in checks for i in bad.to_numpy().nonzero()[0])
+    errors.extend(f"row {first_row + i + 1}: {message}" for i, message in found[:IMPORT_MAX_ERRORS - len(errors)])
+    if errors:
+        return []
+
+    tid = frame['transaction_id'] if 'transaction_id' in frame else pd.Series(None, index=frame.index, dtype=object)
+    notes = frame['notes'] if 'notes' in frame else pd.Series(None, index=frame.index, dtype=object)
+    return [
+        (t if isinstance(t, str) and t else str(uuid.uuid4()), b, acct, d, tt, u, p, a, n if isinstance(n, str) else None)
+        for t, b, acct, d, tt, u, p, a, n in zip(
+            tid, bond, frame['account'].astype(str), trade_date.dt.strftime('%Y-%m-%d'), ttype,
+            units.astype(float), price.astype(float), amount.astype(float), notes,
+        )
+    ]
+
+
+def import_ledger(source):
+    """Add the transactions in a Parquet or Arrow ledger file (as
+    export_ledger writes; bond_id may be replaced by isin and
+    transaction_id omitted). Returns (inserted, skipped); raises
+    NivesaError, with nothing written, if any row is invalid or would
+    leave an account holding negative units."""
+    try:
+        with closing(connect()) as conn, conn:
+            secs = conn.execute("SELECT bond_id, isin FROM securities").fetchall()
+            securities = {'bond_ids': [b for b, _ in secs], 'by_isin': {i: b for b, i in secs}}
+            count = "SELECT COUNT(*) FROM transactions"
+            held = conn.execute(count).fetchone()[0]
+            errors, bonds, rows = [], set(), 0
+            for batch in _read_batches(source):
+                frame = batch.to_pandas()
+                params = _ledger_rows(frame, rows, securities, errors)
+                rows += len(frame)
+                if errors:
+                    if len(errors) >= IMPORT_MAX_ERRORS:
+                        break
+                    continue
+                conn.executemany("INSERT OR IGNORE INTO transactions VALUES (?,?,?,?,?,?,?,?,?)", params)
+                bonds.update(p[1] for p in params)
+            if errors:
+                raise NivesaError("Ledger file rejected:\n" + "\n".join(errors))
+            inserted = conn.execute(count).fetchone()[0] - held
+            for bond_id in sorted(bonds):
+                ok, account, tdate = validate_ledger_chronology(bond_id, conn)
+                if not ok:
+                    raise NivesaError(f"Ledger file rejected: account {account} would hold negative "
+                                      f"units of {bond_id} on {tdate}.")
+            if inserted:
+                rebuild_security_schedule(conn, sorted(bonds))
+                rebuild_tax_lots(conn, sorted(bonds))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ledger import failed: {e}")
+        raise DatabaseError(f"Ledger import failed: {e}") from e
+    logger.info(f"Imported {inserted} transactions ({rows - inserted} already in the ledger)")
+    return inserted, rows - inserted
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Names shared by the engines and the command line.
+
+This module imports nothing, so cli can build its argument choices from
+it before --data-dir is applied (nivesa.db reads the data directory at
+import).
+"""
+
+# Nightly snapshot stages, in run order (see nivesa.snapshots).
+STAGES = ['positions', 'totals', 'cashflows', 'maturity', 'aggregates']
+
+# Change-captured tables -> primary key, parents before children (see
+# nivesa.changes; also the SNAPSHOT order).
+CDC_TABLES = {'securities': 'bond_id', 'security_metadata': 'bond_id', 'transactions': 'transaction_id'}
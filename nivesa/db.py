@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite access shared by the app, the CLI and batch scripts.
+
+Paths come from NIVESA_DATA_DIR (default `data`). Failures surface as
+DatabaseError (a NivesaError) carrying the sqlite message; callers decide
+how to report them (the app shows them in the page, the CLI on stderr).
+"""
+from contextlib import closing
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+DATA_DIR = os.environ.get("NIVESA_DATA_DIR", "data")
+DB_DIR = os.path.join(DATA_DIR, "db")
+DB_FILE = os.path.join(DB_DIR, "portfolio.db")
+
+logger = logging.getLogger("Nivesa")
+
+
+class NivesaError(Exception):
+    """Base class for errors raised by the nivesa package."""
+
+
+class DatabaseError(NivesaError):
+    """A database read or write failed."""
+
+
+def connect():
+    """Create a connection with WAL mode and foreign key enforcement."""
+    conn = sqlite3.connect(DB_FILE, timeout=30.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def query_frame(query, params=()):
+    """Run SELECT; return DataFrame. Raises DatabaseError."""
+    try:
+        with closing(connect()) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+    except sqlite3.Error as e:
+        logger.error(f"Query failed: {e}")
+        raise DatabaseError(f"Query failed: {e}") from e
+
+
+def execute(query, params=()):
+    """Run one INSERT/UPDATE/DELETE in its own transaction. Raises
+    DatabaseError."""
+    try:
+        with closing(connect()) as conn, conn:
+            conn.execute(query, params)
+    except sqlite3.Error as e:
+        logger.error(f"Execution failed: {e}")
+        raise DatabaseError(f"Execution failed: {e}") from e
+
+
+def _read_revision(state_table):
+    """The revision counter held in `state_table` (0 if unreadable)."""
+    try:
+        with closing(connect()) as conn:
+            row = conn.execute(f"SELECT revision FROM {state_table} WHERE id = 1").fetchone()
+        return int(row[0]) if row else 0
+    except sqlite3.Error as e:
+        logger.error(f"Revision lookup failed: {e}")
+        return 0
+
+
+def get_ledger_revision():
+    """Current ledger revision (see ledger_state in init_db). Any insert,
+    update or delete on securities, transactions, security_metadata,
+    amortization_schedule, lot_instructions, coupon_terms or coupon_resets
+    bumps it, so it is a safe cache key for anything derived from those
+    tables."""
+    return _read_revision("ledger_state")
+
+
+def get_market_revision():
+    """Current market data revision (see market_state in init_db), bumped by
+    any change to stored curves or prices."""
+    return _read_revision("market_state")
@@ -0,0 +1,893 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed income calculations: day counts, yields and durations, coupon
+schedules, business-day rolling, the columnar cashflow engine and the
+batch workout-yield solver. Inputs and outputs are plain values, numpy
+arrays and DataFrames; nothing here reads the database.
+"""
+from datetime import date
+import calendar
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from nivesa.db import DATA_DIR, logger
+
+FREQ_MAP = {'Monthly': 12, 'Quarterly': 4, 'Semi-Annual': 2, 'Annual': 1}
+DAY_COUNT_CONVENTIONS = ["30/360", "Actual/365", "Actual/360", "Actual/Actual"]
+DEFAULT_CURVE = "GSEC"
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# FINANCIAL CALCULATIONS
+# ═══════════════════════════════════════════════════════════════════════
+
+def day_count_fraction(start_date, end_date, convention="Actual/365"):
+    try:
+        sd = pd.to_datetime(start_date).date()
+        ed = pd.to_datetime(end_date).date()
+        if convention == "30/360":
+            d1 = min(sd.day, 30)
+            d2 = min(ed.day, 30) if d1 == 30 else ed.day
+            days = 360 * (ed.year - sd.year) + 30 * (ed.month - sd.month) + (d2 - d1)
+            return max(0, days / 360.0)
+        elif convention == "Actual/360":
+            return max(0, (ed - sd).days / 360.0)
+        elif convention == "Actual/Actual":
+            # Proper ISDA Actual/Actual: split the interval by calendar year and
+            # divide each part's actual days by that year's length (365 or 366),
+            # summing whole years between. The old 365.25 shortcut mis-priced
+            # leap-year-spanning periods by ~0.2% (verified vs QuantLib ISDA).
+            if ed <= sd:
+                return 0.0
+            if sd.year == ed.year:
+                diy = 366 if calendar.isleap(sd.year) else 365
+                return (ed - sd).days / diy
+            frac = 0.0
+            diy1 = 366 if calendar.isleap(sd.year) else 365
+            frac += (date(sd.year + 1, 1, 1) - sd).days / diy1
+            frac += (ed.year - sd.year - 1)
+            diy2 = 366 if calendar.isleap(ed.year) else 365
+            frac += (ed - date(ed.year, 1, 1)).days / diy2
+            return max(0.0, frac)
+        else: # Actual/365
+            return max(0, (ed - sd).days / 365.0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def calc_accrued_interest(face_value, coupon_rate, frequency, day_count="Actual/365", last_coupon_date=None, maturity_date=None):
+    try:
+        today = date.today()
+        if maturity_date is not None:
+            mat = pd.to_datetime(maturity_date).date()
+            if mat <= today:
+                return 0.0
+        
+        if last_coupon_date is None:
+            freq = FREQ_MAP.get(frequency, 1)
+            days = ((365.25 / freq) / 2)
+            return face_value * coupon_rate / 365.25 * days
+        
+        frac = day_count_fraction(last_coupon_date, today, day_count)
+        return face_value * coupon_rate * frac
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def period_rates(coupon_rate, resets, starts):
+    """Coupon rate of the periods starting on `starts` for one security:
+    the last of its `resets` ((reset dates, rates), see coupon_rates) on or
+    before each start, else `coupon_rate`."""
+    starts = np.asarray(starts, dtype='datetime64[D]')
+    if resets is None or not len(resets[0]):
+        return np.full(starts.shape, float(coupon_rate))
+    i = np.searchsorted(resets[0], starts, side='right') - 1
+    return np.where(i >= 0, resets[1][np.maximum(i, 0)], float(coupon_rate))
+
+
+def calc_macaulay_duration(fv, coupon_rate, frequency, maturity_str, ytm, day_count="Actual/365", resets=None):
+    try:
+        mat_date = pd.to_datetime(maturity_str).date()
+        today = date.today()
+        if mat_date <= today or ytm <= 0: return 0.0
+        
+        schedule = generate_cashflow_schedule(fv, coupon_rate, frequency, maturity_str, resets=resets)
+        if not schedule: return 0.0
+        
+        freq = FREQ_MAP.get(frequency, 1)
+        pv_w = pv_s = 0.0
+        for cf in schedule:
+            t = day_count_fraction(today, cf['date'], day_count)
+            if t > 0:
+                pv = cf['total'] / ((1 + ytm / freq) ** (freq * t))
+                pv_w += t * pv
+                pv_s += pv
+        return pv_w / pv_s if pv_s else 0.0
+    except (ValueError, TypeError, ZeroDivisionError):
+        return 0.0
+
+
+def calc_modified_duration(mac, ytm, frequency):
+    freq = FREQ_MAP.get(frequency, 1)
+    return mac / (1 + ytm / freq) if ytm > 0 else mac
+
+
+def calc_yield_to_cost(fv_pu, cost_pu, coupon_rate, maturity_str, frequency, day_count="Actual/365", as_of=None,
+                       resets=None):
+    """Yield actually locked in at purchase: the IRR equating the price paid
+    per unit to ALL cashflows from the purchase date to maturity.
+
+    `as_of` is the valuation/purchase anchor (default today). Anchoring at the
+    purchase date is what makes this a true *yield-to-cost*: discounting only
+    the REMAINING cashflows from today against the ORIGINAL cost — while
+    dropping coupons already received — made the number drift as the bond
+    seasoned (verified: +72bps on a seasoned discount bond, -66bps on a
+    premium bond). Anchoring at purchase makes it invariant to seasoning."""
+    try:
+        mat_date = pd.to_datetime(maturity_str).date()
+        anchor = as_of if as_of is not None else date.today()
+        if mat_date <= anchor or cost_pu <= 0: return 0.0
+
+        schedule = generate_cashflow_schedule(fv_pu, coupon_rate, frequency, maturity_str, as_of=anchor, resets=resets)
+        if not schedule: return 0.0
+
+        freq = FREQ_MAP.get(frequency, 1)
+        cfs = []
+        for cf in schedule:
+            t = day_count_fraction(anchor, cf['date'], day_count)
+            if t > 0:
+                cfs.append((t, cf['total']))
+
+        if not cfs: return 0.0
+
+        y = 0.08
+        for _ in range(100):
+            npv = -cost_pu
+            d_npv = 0.0
+            for t, cf in cfs:
+                factor = 1 + y / freq
+                if factor <= 0.0001:
+                    y = -freq + 0.0001 * freq
+                    factor = 1 + y / freq
+                term = factor ** (-freq * t)
+                npv += cf * term
+                d_npv += -t * cf * (factor ** (-freq * t - 1))
+
+            if abs(d_npv) < 1e-12:
+                break
+
+            dy = npv / d_npv
+            y_new = y - dy
+            if abs(dy) < 1e-8:
+                y = y_new
+                break
+            y = y_new
+
+        if np.isnan(y) or np.isinf(y) or y < -1.0 or y > 5.0:
+            return 0.0
+        return y
+    except (ValueError, TypeError, FloatingPointError):
+        return 0.0
+
+
+def _xirr(cashflows):
+    """Money-weighted IRR of dated (date, amount) cashflows. Newton on
+    Actual/365 time from the earliest date; returns 0.0 if degenerate."""
+    if len(cashflows) < 2:
+        return 0.0
+    cfs = sorted(cashflows)
+    d0 = cfs[0][0]
+    ts = [(((d - d0).days) / 365.0, a) for d, a in cfs]
+    # need at least one sign change to have a root
+    signs = {1 if a > 0 else (-1 if a < 0 else 0) for _, a in ts}
+    if not (1 in signs and -1 in signs):
+        return 0.0
+    y = 0.10
+    for _ in range(200):
+        f = df = 0.0
+        for t, a in ts:
+            base = 1 + y
+            if base <= 1e-6:
+                y = -1 + 1e-6
+                base = 1 + y
+            f  += a / base ** t
+            df += -t * a / base ** (t + 1)
+        if abs(df) < 1e-12:
+            break
+        step = f / df
+        y -= step
+        if abs(step) < 1e-9:
+            break
+    if np.isnan(y) or np.isinf(y) or y < -0.999 or y > 5.0:
+        return 0.0
+    return y
+
+
+def calc_position_yield_to_cost(txns, coupon_rate, frequency, maturity_str,
+                                face_value_pu, day_count="Actual/365", installments=None, resets=None,
+                                exercise_date=None):
+    """True money-weighted yield-to-cost for a whole position, robust to
+    principal amortization and multiple purchases: the IRR of
+    position_cashflows (same arguments)."""
+    return _xirr(position_cashflows(txns, coupon_rate, frequency, maturity_str, face_value_pu, day_count,
+                                    installments, resets, exercise_date))
+
+
+def position_cashflows(txns, coupon_rate, frequency, maturity_str,
+                       face_value_pu, day_count="Actual/365", installments=None, resets=None,
+                       exercise_date=None):
+    """Dated (date, amount) cashflows a position's yield-to-cost is the IRR
+    of; empty when it has none (matured, closed or degenerate).
+
+    Cashflows: Buys are outflows; Sells, Interest_Receipts and
+    Principal_Repayments are inflows (at their actual dates). Coupons are
+    projected on the OUTSTANDING balance, which steps down at each recorded
+    principal repayment — so an amortizing bond earns coupon on the declining
+    balance, not on a phantom bullet. The remaining outstanding principal is
+    redeemed at maturity.
+
+    `face_value_pu` is the CURRENT outstanding face per unit. The prior engine
+    computed remaining face as `units*face_value - principal_repaid`, which
+    DOUBLE-COUNTED amortization when face_value already reflected the
+    outstanding (post-repayment) balance — driving YTC negative. Reconstructing
+    the original face as `outstanding + total_repaid` and treating repayments
+    as the inflows they are removes that error. For a plain bullet bond (no
+    repayments) this reduces exactly to the purchase-anchored bullet YTC.
+
+    `installments` is the security's contractual schedule as (date, principal
+    per unit) pairs: installments still ahead are projected as inflows that
+    step the balance down, and only what they leave is redeemed at maturity.
+    Each coupon pays the rate in force at its period start (`resets`, see
+    period_rates).
+
+    With `exercise_date` (a call or put before maturity) the position is
+    redeemed there instead: coupons and installments up to that date, then
+    the remaining principal plus the coupon accrued since the last coupon
+    date. Their IRR is the yield to that workout on the same
+    purchase-anchored basis, so yield-to-worst compares like with like."""
+    try:
+        freq = FREQ_MAP.get(frequency, 1)
+        months = 12 // freq
+        mat = pd.to_datetime(maturity_str).date()
+        end = pd.to_datetime(exercise_date).date() if exercise_date is not None else mat
+        # A matured bond has no future cashflows; an XIRR over purely historical
+        # flows converges to a meaningless number. Report N/A instead.
+        if mat <= date.today() or end <= date.today() or end > mat:
+            return []
+
+        trade = txns[txns['transaction_type'].isin(['Buy', 'Sell'])]
+        cur_u = trade['units'].sum()
+        if cur_u <= 0:
+            return []
+        total_repaid = txns[txns['transaction_type'] == 'Principal_Repayment']['amount'].sum()
+        outstanding = cur_u * face_value_pu
+        original_face = outstanding + total_repaid
+        if outstanding <= 0:
+            return []
+
+        reps = sorted(
+            (pd.to_datetime(r['trade_date']).date(), r['amount'])
+            for _, r in txns[txns['transaction_type'] == 'Principal_Repayment'].iterrows()
+        )
+
+        future, redemption = [], outstanding
+        for d, pu in sorted(installments or []):
+            if date.today() < d < end and redemption > 1e-6:
+                pay = min(pu * cur_u, redemption)
+                future.append((d, pay))
+                redemption -= pay
+        reps = sorted(reps + future)
+
+        cfs = []
+        for _, r in txns.iterrows():
+            d = pd.to_datetime(r['trade_date']).date()
+            tt = r['transaction_type']
+            if tt == 'Buy':
+                cfs.append((d, -r['amount']))
+            elif tt == 'Sell':
+                cfs.append((d, r['amount']))
+            elif tt in ('Interest_Receipt', 'Principal_Repayment'):
+                cfs.append((d, r['amount']))
+
+        # Anchor coupon projection at the units-weighted average buy date, not
+        # the first buy: when capital is deployed in staggered lots (e.g. a
+        # small lot, then a larger lot months later), projecting coupons on the
+        # full reconstructed balance from the earliest date would credit coupons
+        # on capital not yet invested and overstate the yield. (Single-lot
+        # positions collapse to the buy date, matching the bullet-bond YTC.)
+        buys_df = txns[txns['transaction_type'] == 'Buy']
+        bu = buys_df['units'].abs()
+        word = (bu * buys_df['trade_date'].apply(lambda x: pd.to_datetime(x).toordinal())).sum()
+        anchor = date.fromordinal(int(round(word / bu.sum()))) if bu.sum() > 0 else pd.to_datetime(buys_df['trade_date'].min()).date()
+        cds, dd = [], mat
+        while dd > anchor:
+            cds.append(dd)
+            dd -= relativedelta(months=months)
+        cds.sort()
+        starts = [dd] + cds[:-1]
+        rates = period_rates(coupon_rate, resets, starts)
+        for d, rate in zip(cds, rates):
+            if d > end:
+                break
+            bal = original_face - sum(a for rd, a in reps if rd <= d)
+            if bal > 0:
+                cfs.append((d, bal * rate / freq))
+        cfs.extend(future)
+        if end not in cds:
+            # Exercised between coupon dates: accrued interest is paid too.
+            i = next(i for i, d in enumerate(cds) if d > end)
+            redemption += redemption * rates[i] * day_count_fraction(starts[i], end, day_count)
+        cfs.append((end, redemption))  # redeem remaining principal at maturity or exercise
+        return cfs
+    except (ValueError, TypeError, ZeroDivisionError, FloatingPointError):
+        return []
+
+
+def generate_amortizing_schedule(outstanding, coupon_rate, frequency, maturity_str,
+                                 installment, period_months, as_of=None):
+    """Project an amortizing bond's remaining cashflows: coupons on the
+    DECLINING balance plus principal installments on the inferred cadence,
+    with any residual redeemed at maturity. `installment`/`period_months` are
+    estimated from recorded repayment history; this is a projection, not a
+    contractual schedule. Falls back to a bullet if no cadence is known."""
+    try:
+        mat = pd.to_datetime(maturity_str).date()
+        anchor = as_of if as_of is not None else date.today()
+        freq = FREQ_MAP.get(frequency, 1)
+        cmonths = 12 // freq
+
+        # Future principal installment dates (inferred cadence), until balance
+        # is exhausted or maturity is reached.
+        prin_by_date = {}
+        if installment and installment > 0 and period_months and period_months > 0:
+            bal = outstanding
+            d = anchor + relativedelta(months=period_months)
+            guard = 0
+            while d < mat and bal > 1e-6 and guard < 600:
+                pay = min(installment, bal)
+                prin_by_date[d] = prin_by_date.get(d, 0.0) + pay
+                bal -= pay
+                d += relativedelta(months=period_months)
+                guard += 1
+            residual = max(0.0, bal)
+        else:
+            residual = outstanding
+        prin_by_date[mat] = prin_by_date.get(mat, 0.0) + residual
+
+        # Coupon dates from maturity back to anchor.
+        cds, d = [], mat
+        while d > anchor:
+            cds.append(d)
+            d -= relativedelta(months=cmonths)
+        cds = sorted(cds)
+
+        # Merge coupon and principal dates; coupon accrues on the balance
+        # outstanding just before each date.
+        all_dates = sorted(set(cds) | set(prin_by_date.keys()))
+        cfs = []
+        bal = outstanding
+        prev = anchor
+        for d in all_dates:
+            coupon = 0.0
+            if d in cds:
+                coupon = bal * coupon_rate / freq
+            prin = prin_by_date.get(d, 0.0)
+            cfs.append({'date': d, 'coupon': coupon, 'principal': prin,
+                        'total': coupon + prin,
+                        'type': 'Maturity + Coupon' if d == mat else ('Amortization' if prin > 0 else 'Coupon')})
+            bal = max(0.0, bal - prin)
+            prev = d
+        return cfs
+    except (ValueError, TypeError):
+        return []
+
+
+def calc_days_to_maturity(s):
+    try:
+        return max(0, (pd.to_datetime(s) - pd.to_datetime(date.today())).days)
+    except (ValueError, TypeError):
+        return 0
+
+
+def generate_cashflow_schedule(fv_pu, coupon_rate, frequency, maturity_str, units=1, as_of=None, resets=None):
+    """Coupon schedule anchored to maturity, stepping back one period at a
+    time, emitting every cashflow strictly after `as_of` (default: today).
+    Passing the purchase date reconstructs the full original stream (used to
+    compute the yield actually locked in at cost). With `resets` each coupon
+    pays the rate in force at its period start (see period_rates)."""
+    try:
+        mat = pd.to_datetime(maturity_str).date()
+        anchor = as_of if as_of is not None else date.today()
+        freq = FREQ_MAP.get(frequency, 1)
+        months = 12 // freq
+        dates = []
+        d = mat
+        while d > anchor:
+            dates.append(d)
+            d -= relativedelta(months=months)
+        dates.sort()
+        rates = period_rates(coupon_rate, resets, [d] + dates[:-1])
+        cfs = []
+        for d, rate in zip(dates, rates):
+            cpn = fv_pu * rate / freq * units
+            prin = fv_pu * units if d == mat else 0
+            cfs.append({'date': d, 'coupon': cpn, 'principal': prin, 'total': cpn + prin,
+                        'type': 'Maturity + Coupon' if d == mat else 'Coupon'})
+        return cfs
+    except (ValueError, TypeError):
+        return []
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# KEYED LOOKUPS
+# ═══════════════════════════════════════════════════════════════════════
+# Sorted (code, date) int64 keys let one searchsorted answer "the latest
+# row on or before this date" for any number of securities and dates at
+# once; the coupon rate in force on a period's start is the main use, and
+# the app's daily accrual grid uses the same two functions.
+
+def date_keys(code, day):
+    """int64 keys ordering by integer `code` (a security or position
+    number), then datetime64[D] `day`; broadcast together, any shape."""
+    return np.asarray(code, dtype=np.int64) * 1_000_000 + np.asarray(day, dtype='datetime64[D]').astype(np.int64)
+
+
+def asof_index(keys, query):
+    """Index into sorted `keys` of the last key <= each query key (-1 if
+    none). Callers check the hit has the query's code."""
+    return np.searchsorted(keys, query, side='right') - 1
+
+
+def coupon_rates(resets, bond_ids, starts, default):
+    """Coupon rate in force on `starts` (datetime64[D]) for `bond_ids`
+    (broadcast together, any shape): the last of `resets` for the security
+    on or before the date, else `default` (the security's rate)."""
+    starts = np.asarray(starts, dtype='datetime64[D]')
+    bond_ids = np.broadcast_to(np.asarray(bond_ids, dtype=object), starts.shape)
+    out = np.broadcast_to(np.asarray(default, dtype=float), starts.shape).copy()
+    if resets is None or resets.empty or not starts.size:
+        return out
+    code = {b: i for i, b in enumerate(pd.unique(resets['bond_id']))}
+    rcode = resets['bond_id'].map(code).to_numpy(dtype=np.int64)
+    rday = pd.to_datetime(resets['reset_date']).to_numpy().astype('datetime64[D]')
+    order = np.lexsort((rday, rcode))
+    rcode, keys = rcode[order], date_keys(rcode[order], rday[order])
+    rate = resets['coupon_rate'].to_numpy(dtype=float)[order]
+    qcode = pd.Series(bond_ids.ravel()).map(code).fillna(-1).to_numpy(dtype=np.int64).reshape(starts.shape)
+    ok = (qcode >= 0) & ~np.isnat(starts)
+    i = asof_index(keys, date_keys(np.where(ok, qcode, 0), np.where(ok, starts, np.datetime64(0, 'D'))))
+    hit = ok & (i >= 0) & (rcode[np.maximum(i, 0)] == qcode)
+    out[hit] = rate[i[hit]]
+    return out
+
+
+def parse_tenors(values):
+    """Tenors in years from numbers (years) or labels like '3M', '10Y', '91D'."""
+    s = pd.Series(values).astype(str).str.strip().str.upper()
+    num = pd.to_numeric(s.str.rstrip('YMD'), errors='coerce').to_numpy(dtype=float)
+    unit = s.str[-1].to_numpy(dtype=object)
+    return np.where(unit == 'M', num / 12, np.where(unit == 'D', num / 365, num))
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# BUSINESS DAYS
+# ═══════════════════════════════════════════════════════════════════════
+# Payment dates roll off weekends and market holidays by each security's
+# convention (security_metadata.business_day): Following moves a date to
+# the next business day; Modified Following does too unless that crosses
+# into the next month, when it moves back instead. Holidays come from one
+# local CSV (a `date` column, optional `name`) read once per file change
+# into a sorted datetime64 array, so rolling a whole cashflow grid is a
+# few vectorized passes, each one searchsorted against it. Coupon periods
+# run between adjusted dates; coupon amounts stay a full period's.
+
+HOLIDAY_FILE = os.path.join(DATA_DIR, "holidays.csv")
+BUSINESS_DAY_CONVENTIONS = ["Unadjusted", "Following", "Modified Following"]
+
+
+@functools.lru_cache(maxsize=4)
+def _read_holidays(path, mtime):
+    """Sorted unique holiday dates in `path` (mtime only keys the cache)."""
+    try:
+        raw = pd.read_csv(path)
+        raw.columns = [str(c).strip().lower() for c in raw.columns]
+        days = pd.to_datetime(raw['date'], errors='coerce').dropna()
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Holiday calendar {path} unreadable: {e}")
+        return np.array([], dtype='datetime64[D]')
+    return np.unique(days.to_numpy().astype('datetime64[D]'))
+
+
+def holiday_calendar():
+    """Market holidays from HOLIDAY_FILE (empty if there is none)."""
+    try:
+        mtime = os.path.getmtime(HOLIDAY_FILE)
+    except OSError:
+        return np.array([], dtype='datetime64[D]')
+    return _read_holidays(HOLIDAY_FILE, mtime)
+
+
+def holiday_stamp():
+    """Modification time of HOLIDAY_FILE (0 if there is none), so caches of
+    anything rolled by the calendar can key on it."""
+    try:
+        return os.path.getmtime(HOLIDAY_FILE)
+    except OSError:
+        return 0.0
+
+
+def _roll(d, step, holidays):
+    """Move each date by `step` days until it is neither a weekend day nor
+    in `holidays`."""
+    d = d.copy()
+    n = len(holidays)
+    while True:
+        weekday = (d.astype(np.int64) + 3) % 7            # 1970-01-01 was a Thursday
+        i = np.minimum(np.searchsorted(holidays, d), max(n - 1, 0))
+        closed = (weekday >= 5) | ((holidays[i] == d) if n else False)
+        if not closed.any():
+            return d
+        d[closed] += step
+
+
+def adjust_business_days(dates, conventions, holidays=None):
+    """`dates` (datetime64[D], any shape) rolled by `conventions`, one of
+    BUSINESS_DAY_CONVENTIONS each (broadcast against `dates`). NaT and
+    Unadjusted dates pass through."""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    conv = np.broadcast_to(np.asarray(conventions, dtype=object), dates.shape)
+    todo = (conv != 'Unadjusted') & ~np.isnat(dates)
+    if not todo.any():
+        return dates
+    holidays = holiday_calendar() if holidays is None else holidays
+    d = dates[todo]
+    out = _roll(d, 1, holidays)
+    modified = conv[todo] == 'Modified Following'
+    crossed = modified & (out.astype('datetime64[M]') != d.astype('datetime64[M]'))
+    if crossed.any():
+        out[crossed] = _roll(d[crossed], -1, holidays)
+    adjusted = dates.copy()
+    adjusted[todo] = out
+    return adjusted
+
+
+def _business_day_conventions(frame):
+    """Per-row business-day convention of a positions/securities frame."""
+    if 'business_day' not in frame:
+        return np.full(len(frame), 'Unadjusted', dtype=object)
+    return frame['business_day'].fillna('Unadjusted').to_numpy(dtype=object)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# CASHFLOW ENGINE
+# ═══════════════════════════════════════════════════════════════════════
+# Projects the remaining coupons and principal of every position in one
+# columnar pass (one row per position per payment date). Dates match the
+# scalar generators above exactly: coupons step back from maturity and
+# inferred installments step forward from the valuation date, one
+# relativedelta period at a time. Each step clips the day to the month
+# length and the clip compounds (31 Jan -> 31 Oct -> 31 Jul -> 30 Apr ->
+# 30 Jan), i.e. the day is a running minimum over the months visited.
+
+CASHFLOW_COLUMNS = ['date', 'bond_id', 'account', 'issuer', 'isin', 'coupon', 'principal', 'total', 'type']
+AMORT_MAX_INSTALLMENTS = 600
+
+
+def _stepped_dates(start, months, first, count, direction):
+    """(positions x count) grid of datetime64[D]: row i holds start[i]
+    moved by k*months[i] months for k = first .. first+count-1, with the
+    compounding month-end clipping of repeated relativedelta steps."""
+    start_m = start.astype('datetime64[M]')
+    k = np.arange(first, first + count)
+    grid = start_m[:, None] + direction * k[None, :] * months[:, None]
+    month_len = ((grid + 1).astype('datetime64[D]') - grid.astype('datetime64[D]')).astype(int)
+    day = (start - start_m.astype('datetime64[D]')).astype(int) + 1
+    day = np.minimum.accumulate(np.minimum(day[:, None], month_len), axis=1)
+    return grid.astype('datetime64[D]') + (day - 1)
+
+
+def project_cashflows(positions, as_of, installments=None, resets=None):
+    """All positions' cashflows strictly after `as_of` (ISO date string).
+
+    Bullets pay a coupon each period and the face at maturity. Amortizing
+    positions also repay installments before maturity, with coupons on the
+    declining balance and the residual redeemed at maturity, as in
+    generate_amortizing_schedule. Installments come from the contractual
+    schedule (`installments`: bond_id, payment_date, principal per unit)
+    where the security has one, else from the inferred cadence
+    (amort_installment/amort_months). Payment dates are rolled by each
+    position's business_day convention, and each coupon pays the rate in
+    force at its period start (`resets`, see coupon_rates)."""
+    empty = pd.DataFrame(columns=CASHFLOW_COLUMNS)
+    if positions.empty:
+        return empty
+    anchor = np.datetime64(as_of, 'D')
+    mat = pd.to_datetime(positions['maturity_date']).to_numpy().astype('datetime64[D]')
+    p = positions[mat > anchor].reset_index(drop=True)
+    mat = mat[mat > anchor]
+    if p.empty:
+        return empty
+
+    freq = p['frequency'].map(FREQ_MAP).fillna(1).to_numpy(dtype=int)
+    months_out = (mat.astype('datetime64[M]') - anchor.astype('datetime64[M]')).astype(int)
+    outstanding = p['position_face_value'].to_numpy(dtype=float)
+
+    # Coupon dates, maturity first; the grid over-allocates by a period and
+    # the anchor test trims it.
+    cpn_months = 12 // freq
+    grid = _stepped_dates(mat, cpn_months, 0, int((months_out // cpn_months).max()) + 3, -1)
+    ci, ck = np.nonzero(grid[:, :-1] > anchor)
+    ev_pos, ev_date = [ci], [grid[ci, ck]]
+    ev_cpn, ev_prin = [np.ones(len(ci), bool)], [np.zeros(len(ci))]
+    # The next column back is each coupon's period start.
+    cpn_rate = coupon_rates(resets, p['bond_id'].to_numpy()[ci], grid[ci, ck + 1],
+                            p['coupon_rate'].to_numpy(dtype=float)[ci])
+    ev_rate = [cpn_rate]
+
+    # Inferred installments, stopping before maturity or once the balance
+    # is exhausted (both monotone, so the kept cells are a prefix per row).
+    paid = np.zeros(len(p))
+    contractual = np.zeros(len(p), bool)
+    if installments is not None and not installments.empty:
+        ins = installments.merge(pd.DataFrame({'bond_id': p['bond_id'], 'pos': np.arange(len(p))}), on='bond_id')
+        contractual[ins['pos'].to_numpy()] = True
+        ins_date = pd.to_datetime(ins['payment_date']).to_numpy().astype('datetime64[D]')
+        ipos = ins['pos'].to_numpy()
+        ins = pd.DataFrame({
+            'pos': ipos, 'date': ins_date,
+            'due': ins['principal'].to_numpy(dtype=float) * p['current_units'].to_numpy(dtype=float)[ipos],
+        })[(ins_date > anchor) & (ins_date < mat[ipos])].sort_values(['pos', 'date'])
+        if not ins.empty:
+            ipos = ins['pos'].to_numpy()
+            due_before = ins.groupby('pos')['due'].cumsum().to_numpy() - ins['due'].to_numpy()
+            pay = np.clip(outstanding[ipos] - due_before, 0.0, ins['due'].to_numpy())
+            np.add.at(paid, ipos, pay)
+            live = pay > 0
+            ev_pos.append(ipos[live]); ev_date.append(ins['date'].to_numpy()[live])
+            ev_cpn.append(np.zeros(int(live.sum()), bool)); ev_prin.append(pay[live])
+            ev_rate.append(np.zeros(int(live.sum())))
+
+    inst = p['amort_installment'].fillna(0).to_numpy(dtype=float)
+    step = p['amort_months'].fillna(0).to_numpy(dtype=int)
+    am = np.flatnonzero((inst > 0) & (step > 0) & ~contractual)
+    if len(am):
+        count = int(min(AMORT_MAX_INSTALLMENTS, (months_out[am] // step[am]).max() + 1,
+                        np.ceil(outstanding[am] / inst[am]).max() + 1))
+        grid = _stepped_dates(np.full(len(am), anchor), step[am], 1, count, 1)
+        before = outstanding[am, None] - np.arange(count)[None, :] * inst[am, None]
+        keep = (grid < mat[am, None]) & (before > 1e-6)
+        pay = np.where(keep, np.minimum(inst[am, None], before), 0.0)
+        paid[am] += pay.sum(axis=1)
+        ai, aj = np.nonzero(keep)
+        ev_pos.append(am[ai]); ev_date.append(grid[ai, aj])
+        ev_cpn.append(np.zeros(len(ai), bool)); ev_prin.append(pay[ai, aj])
+        ev_rate.append(np.zeros(len(ai)))
+
+    n = len(p)
+    ev_pos.append(np.arange(n)); ev_date.append(mat)
+    ev_cpn.append(np.zeros(n, bool)); ev_prin.append(np.maximum(0.0, outstanding - paid))
+    ev_rate.append(np.zeros(n))
+
+    # Roll payment dates to business days before merging same-day events.
+    conv = _business_day_conventions(p)
+    ev_pos = np.concatenate(ev_pos)
+    ev = pd.DataFrame({
+        'pos': ev_pos, 'date': adjust_business_days(np.concatenate(ev_date), conv[ev_pos]),
+        'is_cpn': np.concatenate(ev_cpn), 'principal': np.concatenate(ev_prin), 'rate': np.concatenate(ev_rate),
+    })
+    ev = ev[ev['date'] > anchor]
+    mat = adjust_business_days(mat, conv)
+    ev = ev.groupby(['pos', 'date'], sort=True).agg(
+        is_cpn=('is_cpn', 'max'), principal=('principal', 'sum'), rate=('rate', 'max')).reset_index()
+
+    pos = ev['pos'].to_numpy()
+    paid_before = ev.groupby('pos')['principal'].cumsum().to_numpy() - ev['principal'].to_numpy()
+    balance = np.maximum(0.0, outstanding[pos] - paid_before)
+    coupon = np.where(ev['is_cpn'], balance * ev['rate'].to_numpy() / freq[pos], 0.0)
+    principal = ev['principal'].to_numpy()
+    dates = ev['date'].to_numpy()
+
+    cf = pd.DataFrame({
+        'date': dates,
+        'bond_id': p['bond_id'].to_numpy()[pos],
+        'account': p['account'].to_numpy()[pos],
+        'issuer': p['issuer'].to_numpy()[pos],
+        'isin': p['isin'].to_numpy()[pos],
+        'coupon': coupon,
+        'principal': principal,
+        'total': coupon + principal,
+        'type': np.select([dates == mat[pos], principal > 0], ['Maturity + Coupon', 'Amortization'], 'Coupon'),
+    })
+    return cf.sort_values('date', kind='stable', ignore_index=True)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# WORKOUT YIELDS
+# ═══════════════════════════════════════════════════════════════════════
+# Yield-to-worst and duration to the worst exercise date for every
+# position. The yields to maturity, call and put are yield_to_cost,
+# yield_to_call and yield_to_put, all purchase-anchored (see
+# calc_position_yield_to_cost), so with no call yield-to-worst IS
+# yield-to-cost. Calls are the issuer's option, so the worst is the lower of
+# yield to maturity and yield to call; the put is the holder's option and is
+# reported but never "worst". The call and put legs are solved for the
+# whole book at once (solve_xirr). When the worst workout is maturity its
+# cashflows are the position's own, so duration to worst is the position's
+# Macaulay duration, at the same today-anchored yield. To a call it is the
+# duration of the very cashflows the yield to call is the IRR of (coupons on
+# the amortizing balance, installments, then principal plus accrued at the
+# call date), those still ahead discounted at that yield (flow_durations).
+
+WORKOUT_KINDS = {'Maturity': 'yield_to_cost', 'Call': 'yield_to_call'}
+WORKOUT_COLUMNS = ['yield_to_worst', 'workout_type', 'workout_date', 'duration_to_worst', 'mod_duration_to_worst']
+
+
+def _date_parts(d):
+    """(year, month, day) int arrays of a datetime64[D] array."""
+    y = d.astype('datetime64[Y]').astype(int) + 1970
+    m = d.astype('datetime64[M]').astype(int) % 12 + 1
+    return y, m, (d - d.astype('datetime64[M]')).astype(int) + 1
+
+
+def year_fractions(starts, ends, conventions):
+    """Vectorized day_count_fraction: row i of `ends` (positions x k,
+    datetime64[D]) measured from starts[i] under conventions[i]."""
+    starts = starts[:, None]
+    days = (ends - starts).astype(int)
+    conv = np.asarray(conventions, dtype=object)[:, None]
+    sy, sm, sd = _date_parts(starts)
+    ey, em, ed = _date_parts(ends)
+    d1 = np.minimum(sd, 30)
+    d2 = np.where(d1 == 30, np.minimum(ed, 30), ed)
+    thirty = (360 * (ey - sy) + 30 * (em - sm) + (d2 - d1)) / 360.0
+    # ISDA Actual/Actual; the split-year sum also reduces to days / year
+    # length when both dates fall in the same year.
+    year_len = lambda y: np.where((y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0)), 366, 365)
+    jan1 = lambda y: (y - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    act_act = ((jan1(sy + 1) - starts).astype(int) / year_len(sy) + (ey - sy - 1)
+               + (ends - jan1(ey)).astype(int) / year_len(ey))
+    act_act = np.where(days > 0, act_act, 0.0)
+    out = np.select([conv == '30/360', conv == 'Actual/360', conv == 'Actual/Actual'],
+                    [thirty, days / 360.0, act_act], days / 365.0)
+    return np.maximum(out, 0.0)
+
+
+def solve_yields(price, cf, t, freq, base=0.0):
+    """Per-row yield equating `price` to cashflows `cf` at times `t` (rows
+    padded with zero cashflows), compounding `freq` times a year. Rows that
+    do not converge to a sane yield come back NaN. With `base` (a rate per
+    cashflow) the solve is for the flat spread over it instead."""
+    f = freq[:, None].astype(float)
+    y = np.full(len(price), 0.08)
+    active = np.ones(len(price), bool)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for _ in range(100):
+            if not active.any():
+                break
+            floor = 1 + y / freq <= 0.0001
+            y = np.where(active & floor, -freq + 0.0001 * freq, y)
+            factor = 1 + (base + y[:, None]) / f
+            npv = (cf * factor ** (-f * t)).sum(axis=1) - price
+            d_npv = (-t * cf * factor ** (-f * t - 1)).sum(axis=1)
+            flat = np.abs(d_npv) < 1e-12
+            dy = np.where(flat, 0.0, npv / np.where(flat, 1.0, d_npv))
+            step = active & ~flat
+            y = np.where(step, y - dy, y)
+            active &= ~flat & ~(np.abs(dy) < 1e-8)
+    return np.where(np.isfinite(y) & (y >= -1.0) & (y <= 5.0), y, np.nan)
+
+
+def _flow_matrix(flows):
+    """Dated cashflow lists padded to one (lists x cashflows) matrix: amounts,
+    days since the epoch and each list's length (padding is a zero cashflow
+    on day 0)."""
+    n = len(flows)
+    lens = np.fromiter((len(f) for f in flows), dtype=int, count=n)
+    row = np.repeat(np.arange(n), lens)
+    col = np.arange(len(row)) - np.repeat(np.cumsum(lens) - lens, lens)
+    width = int(lens.max()) if n else 0
+    cf, days = np.zeros((n, width)), np.zeros((n, width), dtype=np.int64)
+    cf[row, col] = np.array([a for f in flows for _, a in f], dtype=float)
+    days[row, col] = np.array([d for f in flows for d, _ in f], dtype='datetime64[D]').astype(np.int64)
+    return cf, days, lens
+
+
+def solve_xirr(flows):
+    """_xirr of every list of dated (date, amount) cashflows in `flows` in
+    one solve: annual compounding on Actual/365 time from each list's
+    earliest date. NaN where a list has no sign change or no sane root."""
+    out = np.full(len(flows), np.nan)
+    cf, days, lens = _flow_matrix(flows)
+    if not lens.any():
+        return out
+    held = np.arange(cf.shape[1]) < lens[:, None]
+    first = np.where(held, days, np.iinfo(np.int64).max).min(axis=1)
+    t = np.where(held, days - first[:, None], 0) / 365.0
+    ok = (cf > 0).any(axis=1) & (cf < 0).any(axis=1)
+    out[ok] = solve_yields(np.zeros(int(ok.sum())), cf[ok], t[ok], np.ones(int(ok.sum()), dtype=int))
+    return out
+
+
+def flow_durations(flows, yields, as_of=None):
+    """Macaulay duration of each list of dated cashflows in `flows` from
+    `as_of` (today): the cashflows still ahead discounted at the matching
+    solve_xirr yield, on its basis (annual compounding, Actual/365). NaN
+    where the yield is not positive or nothing is left to receive."""
+    cf, days, _ = _flow_matrix(flows)
+    y = np.asarray(yields, dtype=float)
+    t = (days - np.datetime64(as_of or date.today(), 'D').astype(np.int64)) / 365.0
+    cf = np.where(t > 0, cf, 0.0)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        pv = cf * (1 + y)[:, None] ** -t
+        mac = (t * pv).sum(axis=1) / pv.sum(axis=1)
+    return np.where((y > 0) & np.isfinite(mac), mac, np.nan)
+
+
+def workout_yields(positions, call_flows, as_of=None):
+    """WORKOUT_COLUMNS for every position (index-aligned), from its
+    purchase-anchored yields (WORKOUT_KINDS; 0 or NaN is N/A), durations
+    and call date. `call_flows` are the positions' position_cashflows to
+    their call dates (an empty list without one), in the same order."""
+    today = np.datetime64(as_of or date.today(), 'D')
+    n = len(positions)
+    units = positions['current_units'].to_numpy(dtype=float)
+    mat = pd.to_datetime(positions['maturity_date']).to_numpy().astype('datetime64[D]')
+    live = (mat > today) & (units > 0)
+
+    rows = []
+    for kind, col in WORKOUT_KINDS.items():
+        y = positions[col].to_numpy(dtype=float)
+        if kind == 'Maturity':
+            when, ok = mat, live
+        else:
+            when = pd.to_datetime(positions['call_date']).to_numpy().astype('datetime64[D]')
+            ok = live & ~np.isnat(when) & (when > today) & (when < mat)
+        ok &= np.isfinite(y) & (y != 0)
+        rows.append(pd.DataFrame({'pos': np.flatnonzero(ok), 'kind': kind, 'when': when[ok], 'y': y[ok]}))
+    w = pd.concat(rows, ignore_index=True)
+    to_mat = w[w['kind'] == 'Maturity']
+    pos = to_mat['pos'].to_numpy(dtype=int)
+    mac = positions['macaulay_duration'].to_numpy(dtype=float)[pos]
+    mod = positions['modified_duration'].to_numpy(dtype=float)[pos]
+    to_mat = to_mat.assign(mac=np.where(mac > 0, mac, np.nan), mod=np.where(mac > 0, mod, np.nan))
+    to_call = w[w['kind'] == 'Call']
+    y = to_call['y'].to_numpy(dtype=float)
+    mac = flow_durations([call_flows[i] for i in to_call['pos']], y, today)
+    to_call = to_call.assign(mac=mac, mod=mac / (1 + y))
+    w = pd.concat([to_mat, to_call], ignore_index=True)
+
+    worst = (w.sort_values(['pos', 'y', 'when'], kind='stable')
+             .drop_duplicates('pos').set_index('pos').reindex(range(n)))
+    return pd.DataFrame({
+        'yield_to_worst': worst['y'].to_numpy(dtype=float),
+        'workout_type': worst['kind'].to_numpy(dtype=object),
+        'workout_date': pd.to_datetime(worst['when']).to_numpy(),
+        'duration_to_worst': worst['mac'].to_numpy(dtype=float),
+        'mod_duration_to_worst': worst['mod'].to_numpy(dtype=float),
+    }, index=positions.index)
+
+
+def cashflow_matrix(positions, cashflows, as_of):
+    """Projected cashflows laid out for batch solves: long (pos, amount, t)
+    arrays over the positive cashflow rows, plus the same padded to
+    positions x cashflows (t in years under each position's day count)."""
+    n = len(positions)
+    key = positions[['bond_id', 'account']].reset_index(drop=True).rename_axis('pos').reset_index()
+    cf = cashflows.merge(key, on=['bond_id', 'account'])
+    cf = cf[cf['total'] > 0]
+    pos = cf['pos'].to_numpy(dtype=int)
+    conv = positions['day_count'].fillna('Actual/365').to_numpy(dtype=object)
+    dates = cf['date'].to_numpy().astype('datetime64[D]')[:, None]
+    t = year_fractions(np.full(len(cf), np.datetime64(as_of, 'D')), dates, conv[pos])[:, 0]
+    amounts = cf['total'].to_numpy(dtype=float)
+
+    # Pad to positions x cashflows so one Newton solve covers the book.
+    col = cf.groupby('pos').cumcount().to_numpy()
+    width = int(col.max()) + 1 if len(col) else 1
+    cfm, tm = np.zeros((n, width)), np.zeros((n, width))
+    cfm[pos, col], tm[pos, col] = amounts, t
+    return pos, amounts, t, cfm, tm
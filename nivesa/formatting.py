@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Indian-number and percent formatting for the app, the CLI and the API.
+
+fmt_inr renders ₹1,23,456.78 (lakh/crore digit grouping), fmt_inr_short
+₹1.23 Cr / ₹4.56 L, and fmt_pct a decimal fraction as a percent. A
+missing (None, NaN), infinite or non-numeric value renders as MISSING in
+all three, never as a zero.
+
+Each has a column-at-a-time variant (*_array) that takes any array-like
+and returns an object ndarray of strings identical, element for element,
+to the scalar helper. Amount columns repeat heavily (lot sizes, coupons,
+face values), so the INR formatters format each distinct value once and
+scatter the results back; fmt_inr itself is memoized across calls.
+"""
+import functools
+import math
+
+import numpy as np
+import pandas as pd
+
+MISSING = "—"
+
+
+@functools.lru_cache(maxsize=16384)
+def _fmt_inr_float(amount):
+    """Memoized core of fmt_inr for one finite float."""
+    s = f"{abs(amount):.2f}"
+    digits, dec = s[:-3], s[-2:]
+    if len(digits) > 3:
+        head, r = digits[:-3], (len(digits) - 3) % 2
+        pairs = [head[:r]] if r else []
+        pairs += [head[k:k + 2] for k in range(r, len(head), 2)]
+        digits = ','.join(pairs) + ',' + digits[-3:]
+    return f"{'-₹' if amount < 0 else '₹'}{digits}.{dec}"
+
+
+def _finite(value):
+    """`value` as a finite float, or None."""
+    try:
+        v = float(value)
+    except (ValueError, TypeError):
+        return None
+    return v if math.isfinite(v) else None
+
+
+def fmt_inr(amount):
+    """Indian numbering: ₹1,23,456.78"""
+    v = _finite(amount)
+    return MISSING if v is None else _fmt_inr_float(v)
+
+
+def fmt_inr_short(amount):
+    """Compact: ₹1.23 Cr, ₹4.56 L"""
+    v = _finite(amount)
+    if v is None:        return MISSING
+    if abs(v) >= 1e7:    return f"₹{v/1e7:.2f} Cr"
+    if abs(v) >= 1e5:    return f"₹{v/1e5:.2f} L"
+    return _fmt_inr_float(v)
+
+
+def fmt_pct(value, decimals=2):
+    v = _finite(value)
+    return MISSING if v is None else f"{v*100:.{decimals}f}%"
+
+
+def _float_array(values):
+    """Coerce any array-like to float64; non-numeric entries become NaN."""
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'fiu':
+        return values.astype(float, copy=False)
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float)
+
+
+def _memoized(format_unique):
+    """Wrap a float-array formatter so each distinct value is formatted once."""
+    @functools.wraps(format_unique)
+    def wrapper(values, *args):
+        a = _float_array(values)
+        codes, uniq = pd.factorize(a, use_na_sentinel=False)
+        if len(uniq) == len(a):
+            return format_unique(a, *args)
+        return format_unique(np.asarray(uniq, dtype=float), *args)[codes]
+    return wrapper
+
+
+@_memoized
+def fmt_inr_array(a):
+    """Vectorized fmt_inr(), sharing the scalar's memo for each distinct value."""
+    return np.array([_fmt_inr_float(v) if math.isfinite(v) else MISSING for v in a.tolist()], dtype=object)
+
+
+@_memoized
+def fmt_inr_short_array(a):
+    """Vectorized fmt_inr_short(): ₹1.23 Cr / ₹4.56 L / full INR below 1 L."""
+    out = fmt_inr_array(a)
+    mag = np.abs(np.nan_to_num(a))
+    for floor, unit in ((1e5, ' L'), (1e7, ' Cr')):
+        sel = mag >= floor
+        if sel.any():
+            out[sel] = '₹' + np.char.mod('%.2f', a[sel] / floor).astype(object) + unit
+    out[~np.isfinite(a)] = MISSING
+    return out
+
+
+def fmt_pct_array(values, decimals=2):
+    """Vectorized fmt_pct()."""
+    a = _float_array(values)
+    out = np.char.mod(f'%.{decimals}f%%', a * 100).astype(object)
+    return np.where(np.isfinite(a), out, MISSING).astype(object)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Tax lots.
+
+Every Buy opens a lot (keyed by its transaction id) and every Sell
+relieves open lots of the same (bond, account) by the method recorded in
+lot_instructions: FIFO (the default), average cost (pro rata across the
+open lots, so the cost relieved is the pooled average) or specific
+identification (the named lot first, any remainder FIFO). Principal
+repayments return capital, reducing each open lot's cost by the
+repayment per unit. Lots and disposals are stored in tax_lots and
+lot_disposals and replayed per security inside the same transaction as
+any write to its ledger, so reports read stored rows instead of
+replaying the ledger.
+"""
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+
+TRANSACTION_TYPES = ['Buy', 'Sell', 'Interest_Receipt', 'Principal_Repayment']
+LOT_METHODS = ['FIFO', 'Average Cost', 'Specific ID']
+LOT_LONG_TERM_MONTHS = {'Unlisted': 36, 'Listed': 12}   # held longer than this is long-term
+LOT_EPS = 1e-6
+LOT_COLUMNS = ['lot_id', 'bond_id', 'account', 'acquired', 'units', 'cost', 'open_units', 'open_cost']
+DISPOSAL_COLUMNS = [
+    'sell_id', 'lot_id', 'bond_id', 'account', 'acquired', 'disposed',
+    'units', 'cost', 'proceeds', 'gain', 'term', 'fy',
+]
+
+
+def financial_year(d):
+    """Indian financial year (April-March) label of a date, e.g. 'FY2025-26'."""
+    start = d.year if d.month >= 4 else d.year - 1
+    return f"FY{start}-{(start + 1) % 100:02d}"
+
+
+def _relieve_lots(book, units, method, lot_id=None):
+    """[(lot, units)] taken from the open lots `book` (acquisition order)
+    to cover a sale of `units` by `method`."""
+    if method == 'Average Cost':
+        held = sum(lot['open_units'] for lot in book)
+        return [(lot, units * lot['open_units'] / held) for lot in book] if held > 0 else []
+    queue = sorted(book, key=lambda lot: lot['lot_id'] != lot_id) if method == 'Specific ID' else book
+    taken, left = [], units
+    for lot in queue:
+        if left <= LOT_EPS:
+            break
+        q = min(left, lot['open_units'])
+        taken.append((lot, q))
+        left -= q
+    return taken
+
+
+def replay_lots(txns, instructions, long_term_months):
+    """(lots, disposals) as LOT_COLUMNS / DISPOSAL_COLUMNS frames from the
+    transactions of one or more securities. `instructions` maps a Sell's
+    transaction_id to (method, lot_id); `long_term_months` maps bond_id to
+    the holding period beyond which a disposal is long-term. Same-day
+    trades run Buys, then Sells, then repayments (units held after the
+    day's trades), each in recording order (`seq`)."""
+    order = {'Buy': 0, 'Sell': 1, 'Principal_Repayment': 2}
+    t = txns[txns['transaction_type'].isin(order)].assign(_ord=lambda x: x['transaction_type'].map(order))
+    t = t.sort_values(['bond_id', 'account', 'trade_date', '_ord', 'seq'])
+    lots, disposals = [], []
+    for (bid, acct), grp in t.groupby(['bond_id', 'account'], sort=False):
+        hold = relativedelta(months=long_term_months.get(bid, LOT_LONG_TERM_MONTHS['Unlisted']))
+        book = []
+        for tr in grp.itertuples(index=False):
+            day = pd.Timestamp(tr.trade_date).date()
+            if tr.transaction_type == 'Buy':
+                lot = {'lot_id': tr.transaction_id, 'bond_id': bid, 'account': acct, 'acquired': day,
+                       'units': abs(tr.units), 'cost': tr.amount,
+                       'open_units': abs(tr.units), 'open_cost': tr.amount}
+                lots.append(lot)
+                book.append(lot)
+            elif tr.transaction_type == 'Sell':
+                units = abs(tr.units)
+                px = tr.amount / units if units else 0.0
+                method, chosen = instructions.get(tr.transaction_id, ('FIFO', None))
+                for lot, q in _relieve_lots(book, units, method, chosen):
+                    cost = lot['open_cost'] * q / lot['open_units']
+                    lot['open_units'] -= q
+                    lot['open_cost'] -= cost
+                    disposals.append({
+                        'sell_id': tr.transaction_id, 'lot_id': lot['lot_id'], 'bond_id': bid, 'account': acct,
+                        'acquired': lot['acquired'], 'disposed': day, 'units': q, 'cost': cost,
+                        'proceeds': q * px, 'gain': q * px - cost,
+                        'term': 'Long' if day > lot['acquired'] + hold else 'Short', 'fy': financial_year(day),
+                    })
+            else:
+                held = sum(lot['open_units'] for lot in book)
+                per_unit = tr.price if tr.price > 0 else (tr.amount / held if held > 0 else 0.0)
+                for lot in book:
+                    lot['open_cost'] = max(0.0, lot['open_cost'] - per_unit * lot['open_units'])
+            book = [lot for lot in book if lot['open_units'] > LOT_EPS]
+    lots = pd.DataFrame(lots, columns=LOT_COLUMNS)
+    lots.loc[lots['open_units'] <= LOT_EPS, ['open_units', 'open_cost']] = 0.0
+    return lots, pd.DataFrame(disposals, columns=DISPOSAL_COLUMNS)
+
+
+def rebuild_tax_lots(conn, bond_ids=None):
+    """Replay tax_lots and lot_disposals for `bond_ids` (default: every
+    security) on an open connection; the caller owns the transaction.
+    Returns the number of lots written.
+
+    Each security is replayed whole: a back-dated trade changes which lots
+    every later Sell relieves (and their cost), so nothing from the first
+    affected date on could be kept, and the write's chronology check has
+    already read the security's trades."""
+    where, params = "", ()
+    if bond_ids is not None:
+        bond_ids = list(bond_ids)
+        if not bond_ids:
+            return 0
+        where = f" WHERE bond_id IN ({','.join('?' * len(bond_ids))})"
+        params = tuple(bond_ids)
+    txns = pd.read_sql_query(
+        f"SELECT rowid AS seq, transaction_id, bond_id, account, trade_date, transaction_type, units, price, amount "
+        f"FROM transactions{where}", conn, params=params,
+    )
+    instr = pd.read_sql_query(
+        f"SELECT i.transaction_id, i.method, i.lot_id FROM lot_instructions i "
+        f"JOIN transactions USING (transaction_id){where}", conn, params=params,
+    )
+    listing = pd.read_sql_query(f"SELECT bond_id, listing FROM security_metadata{where}", conn, params=params)
+    long_term = {b: LOT_LONG_TERM_MONTHS['Unlisted' if pd.isna(l) or l == 'Unlisted' else 'Listed']
+                 for b, l in zip(listing['bond_id'], listing['listing'])}
+    instructions = {t: (m, l) for t, m, l in instr.itertuples(index=False, name=None)}
+    lots, disposals = replay_lots(txns, instructions, long_term)
+
+    conn.execute(f"DELETE FROM tax_lots{where}", params)
+    conn.execute(f"DELETE FROM lot_disposals{where}", params)
+    for table, frame, cols in (('tax_lots', lots, LOT_COLUMNS), ('lot_disposals', disposals, DISPOSAL_COLUMNS)):
+        out = frame.copy()
+        for col in ('acquired', 'disposed'):
+            if col in out:
+                out[col] = [d.isoformat() for d in out[col]]
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+            out.itertuples(index=False, name=None),
+        )
+    return len(lots)
+
+
+def validate_ledger_chronology(bond_id, conn):
+    """Ensure running balance of units for all accounts never drops below 0.
+
+    Same-day ties are ordered Buy-before-Sell: transaction_id is a random
+    UUID, so ordering by it made same-day Buy→Sell pairs pass or fail at
+    random depending on lexical UUID order. Buy-first is the most permissive
+    ordering consistent with same-day settlement netting.
+    """
+    c = conn.cursor()
+    c.execute(
+        "SELECT account, trade_date, units, transaction_type FROM transactions "
+        "WHERE bond_id=? AND transaction_type IN ('Buy', 'Sell') "
+        "ORDER BY trade_date, CASE transaction_type WHEN 'Buy' THEN 0 ELSE 1 END, transaction_id",
+        (bond_id,)
+    )
+    txns = c.fetchall()
+    
+    balances = {}
+    for account, tdate, units, ttype in txns:
+        balances[account] = balances.get(account, 0.0) + units
+        if balances[account] < -1e-5:
+            return False, account, tdate
+
+    return True, None, None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo reinvestment kernels.
+
+Short rates follow a Vasicek process (exact Gaussian transition, monthly
+steps). A batch simulates `n_paths` rate paths and reinvests each
+account's projected monthly inflows at the path's short rate until the
+horizon; cashflows beyond the horizon are valued with the Vasicek
+zero-coupon bond price at the terminal short rate. Everything is plain
+numpy and picklable, and a batch depends only on its seed, so results do
+not change with the number of worker processes.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import numpy as np
+
+
+def vasicek_paths(r0, a, b, sigma, dt, steps, n_paths, rng):
+    """(n_paths x steps+1) short-rate paths starting at r0."""
+    decay = np.exp(-a * dt)
+    vol = sigma * np.sqrt((1 - decay ** 2) / (2 * a))
+    shocks = rng.standard_normal((n_paths, steps)) * vol
+    r = np.empty((n_paths, steps + 1))
+    r[:, 0] = r0
+    for s in range(steps):
+        r[:, s + 1] = r[:, s] * decay + b * (1 - decay) + shocks[:, s]
+    return r
+
+
+def vasicek_bond_price(r, a, b, sigma, tau):
+    """Zero-coupon bond prices (len(r) x len(tau)) at short rate r for
+    maturities tau years ahead."""
+    tau = np.asarray(tau, dtype=float)
+    B = (1 - np.exp(-a * tau)) / a
+    A = (b - sigma ** 2 / (2 * a ** 2)) * (B - tau) - sigma ** 2 * B ** 2 / (4 * a)
+    return np.exp(A[None, :] - B[None, :] * np.asarray(r, dtype=float)[:, None])
+
+
+def simulate_batch(spec, seed, n_paths):
+    """One batch of paths. `spec` holds the model (r0, a, b, sigma, dt,
+    steps) and per-account arrays: inflows and coupons (accounts x steps,
+    received at the end of each step), tail (accounts x k cashflows after
+    the horizon) at tail_tau years past it.
+
+    Returns (income, terminal, cash_path): income and terminal value per
+    path and account (n_paths x accounts), and the portfolio's reinvested
+    cash at the end of every step (n_paths x steps)."""
+    rng = np.random.default_rng(seed)
+    dt, steps = spec['dt'], spec['steps']
+    r = vasicek_paths(spec['r0'], spec['a'], spec['b'], spec['sigma'], dt, steps, n_paths, rng)
+    growth = 1 + r[:, 1:steps] * dt                      # growth over steps 1..steps-1
+    # Growth from the end of step t to the horizon: product of later steps.
+    after = np.ones((n_paths, steps))
+    after[:, :-1] = np.cumprod(growth[:, ::-1], axis=1)[:, ::-1]
+    inflows = spec['inflows']
+    cash = after @ inflows.T
+    income = spec['coupons'].sum(axis=1)[None, :] + cash - inflows.sum(axis=1)[None, :]
+    tail_pv = vasicek_bond_price(r[:, -1], spec['a'], spec['b'], spec['sigma'], spec['tail_tau']) @ spec['tail'].T
+    # Portfolio cash at each step: inflows to date grown to that step.
+    to_date = np.concatenate([np.ones((n_paths, 1)), np.cumprod(growth, axis=1)], axis=1)
+    cash_path = np.cumsum(inflows.sum(axis=0)[None, :] / to_date, axis=1) * to_date
+    return income, cash + tail_pv, cash_path.astype(np.float32)
+
+
+def batch_plan(seed, n_paths, batch_paths):
+    """[(seed sequence, paths)] per batch: the run's SeedSequence spawned
+    once per batch, so batch i always draws the same numbers."""
+    sizes = [min(batch_paths, n_paths - start) for start in range(0, n_paths, batch_paths)]
+    return list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+
+
+def iter_batches(spec, plan, workers=1, skip=()):
+    """Yield (batch index, simulate_batch result) for each batch of `plan`
+    not in `skip`, in completion order. With more than one worker the
+    batches are spread over a process pool; closing the generator early
+    cancels batches that have not started."""
+    todo = [i for i in range(len(plan)) if i not in skip]
+    if workers <= 1:
+        for i in todo:
+            yield i, simulate_batch(spec, *plan[i])
+        return
+    ctx = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+    try:
+        futures = {pool.submit(simulate_batch, spec, *plan[i]): i for i in todo}
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
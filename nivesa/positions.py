@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Positions engine.
+
+Replays the ledger into one row per open (bond, account) with cost,
+income, yield, duration, accrual and market-value columns, plus the
+portfolio totals the dashboard headline shows. Also the projected
+cashflows and market marks those rows are valued with, and a process-wide
+cache of all three keyed by everything they depend on (analytics_key),
+shared by the app, the API and batch jobs, and the aggregation cube the
+dashboard tables slice.
+"""
+from datetime import date
+import functools
+import threading
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from nivesa.db import get_ledger_revision, get_market_revision, query_frame
+from nivesa.finance import (
+    CASHFLOW_COLUMNS, FREQ_MAP, calc_accrued_interest, calc_days_to_maturity, calc_macaulay_duration,
+    calc_modified_duration, calc_position_yield_to_cost, calc_yield_to_cost, cashflow_matrix, holiday_stamp,
+    period_rates, position_cashflows, project_cashflows, solve_xirr, solve_yields, workout_yields,
+)
+from nivesa.schedule import (
+    amortization_by_bond, get_amortization_schedules, get_coupon_resets, get_last_coupon_dates,
+    security_resets,
+)
+
+MTM_COLUMNS = ['price_date', 'clean_price', 'dirty_price', 'market_value', 'dirty_value', 'unrealized_pnl', 'ytm']
+# Date columns of the positions and cashflows frames, and the one dtype
+# they carry whether computed here or read back from a snapshot; a missing
+# date is NaT.
+ANALYTICS_DATE_COLUMNS = {'positions': ['maturity_date', 'workout_date', 'price_date'], 'cashflows': ['date']}
+ANALYTICS_DATE_DTYPE = 'datetime64[us]'
+
+
+def latest_prices(as_of):
+    """Latest clean price on or before `as_of` for every held security's ISIN."""
+    df = query_frame(
+        "SELECT p.isin, p.price_date, p.clean_price FROM prices p "
+        "JOIN (SELECT isin, MAX(price_date) AS d FROM prices "
+        "      WHERE price_date <= ? AND isin IN (SELECT isin FROM securities) GROUP BY isin) m "
+        "ON p.isin = m.isin AND p.price_date = m.d",
+        (as_of,),
+    )
+    if df.empty:
+        return pd.DataFrame(columns=['isin', 'price_date', 'clean_price'])
+    df['price_date'] = pd.to_datetime(df['price_date'])
+    return df
+
+
+def cashflow_projection(positions, as_of):
+    """project_cashflows for `positions` with the stored amortization
+    schedules and coupon resets."""
+    return project_cashflows(positions, as_of, get_amortization_schedules(), get_coupon_resets())
+
+
+def mark_to_market(positions, as_of, cashflows=None):
+    """MTM_COLUMNS per position (index-aligned, NaN where unpriced): clean
+    and dirty price per unit, clean and dirty market value, unrealized P&L
+    against cost, and yield to maturity from the dirty value, solved for
+    all marked positions at once. `cashflows` defaults to
+    cashflow_projection(positions, as_of)."""
+    if cashflows is None:
+        cashflows = cashflow_projection(positions, as_of)
+    px = positions[['isin']].merge(latest_prices(as_of), on='isin', how='left')
+    units = positions['current_units'].to_numpy(dtype=float)
+    clean = px['clean_price'].to_numpy(dtype=float)
+    accrued = positions['accrued_interest'].to_numpy(dtype=float)
+    market = units * clean
+    dirty = market + accrued
+    _, _, _, cfm, tm = cashflow_matrix(positions, cashflows, as_of)
+    freq = positions['frequency'].map(FREQ_MAP).fillna(1).to_numpy(dtype=int)
+    marked = np.isfinite(dirty) & (cfm.sum(axis=1) > 0)
+    ytm = np.where(marked, solve_yields(np.nan_to_num(dirty), cfm, tm, freq), np.nan)
+    return pd.DataFrame({
+        'price_date': px['price_date'].to_numpy(),
+        'clean_price': clean,
+        'dirty_price': np.divide(dirty, units, out=np.full(len(units), np.nan), where=units > 0),
+        'market_value': market,
+        'dirty_value': dirty,
+        'unrealized_pnl': market - positions['cost_basis'].to_numpy(dtype=float),
+        'ytm': ytm,
+    }, index=positions.index)
+
+
+def build_positions(valuation=None):
+    """(positions, totals) for every open (bond, account) in the ledger, as
+    of today: cost and realized P&L on running average cost, yields and
+    durations, accrued interest, workout yields and market marks.
+    `valuation` maps the positions frame to MTM_COLUMNS (default
+    mark_to_market). Raises DatabaseError."""
+    secs = query_frame("SELECT * FROM securities")
+    if secs.empty: return pd.DataFrame(), {}
+    secs['maturity_date'] = pd.to_datetime(secs['maturity_date'])
+
+    txns = query_frame("SELECT * FROM transactions")
+    if txns.empty: return pd.DataFrame(), {}
+    txns['trade_date'] = pd.to_datetime(txns['trade_date'])
+
+    meta = query_frame("SELECT * FROM security_metadata")
+    last_coupons = get_last_coupon_dates(date.today())
+    contract = amortization_by_bond(get_amortization_schedules())
+    resets = get_coupon_resets()
+    by_bond_resets = security_resets(resets)
+    positions = []
+    workout_flows = {'call_date': [], 'put_date': []}
+
+    for (bid, acct), grp in txns.groupby(['bond_id', 'account']):
+        si = secs[secs['bond_id'] == bid]
+        if si.empty: continue
+        si = si.iloc[0]
+        mi = meta[meta['bond_id'] == bid].iloc[0] if not meta.empty and bid in meta['bond_id'].values else None
+
+        # Chronological running average-cost engine.
+        # Realized P&L on a Sell must use the average cost of units held AT
+        # THE TIME OF SALE — a lifetime buy-VWAP would let buys made AFTER a
+        # sell retroactively change that sale's P&L (look-ahead). Same-day
+        # ties process Buys before Sells, matching validate_ledger_chronology.
+        trades = grp[grp['transaction_type'].isin(['Buy', 'Sell'])].copy()
+        trades['_ord'] = (trades['transaction_type'] == 'Sell').astype(int)
+        trades = trades.sort_values(['trade_date', '_ord'])
+
+        units_held = cost_held = r_pnl = 0.0
+        for _, tr in trades.iterrows():
+            if tr['transaction_type'] == 'Buy':
+                units_held += abs(tr['units'])
+                cost_held  += tr['amount']
+            else:  # Sell (stored with negative units)
+                su = abs(tr['units'])
+                avg = cost_held / units_held if units_held > 0 else 0.0
+                r_pnl      += tr['amount'] - su * avg
+                cost_held  -= su * avg
+                units_held -= su
+
+        cur_u = units_held
+        if cur_u <= 0: continue
+
+        avg_px   = cost_held / units_held if units_held > 0 else 0.0
+        int_recv = grp[grp['transaction_type'] == 'Interest_Receipt']['amount'].sum()
+        reps_df  = grp[grp['transaction_type'] == 'Principal_Repayment'].sort_values('trade_date')
+        prin_rep = reps_df['amount'].sum()
+        cost     = cost_held - prin_rep
+
+        # A stored contractual schedule drives the projection directly.
+        # Without one, infer the amortization cadence from recorded repayments
+        # so the cashflow projection can step the remaining principal down
+        # realistically instead of dropping it all at maturity as a phantom
+        # bullet (an estimate only).
+        installments = contract.get(bid)
+        if installments is not None:
+            amort_source, amort_installment, amort_months = 'contractual', 0.0, 0
+        else:
+            amort_source = 'inferred' if len(reps_df) else ''
+            amort_installment = float(reps_df['amount'].median()) if len(reps_df) else 0.0
+            if len(reps_df) >= 2:
+                gaps = reps_df['trade_date'].diff().dropna().dt.days
+                amort_months = int(max(1, round(gaps.median() / 30.44)))
+            else:
+                amort_months = 12 // FREQ_MAP.get(si['frequency'], 1)
+
+        # Outstanding face = current units * current (post-amortization) face per
+        # unit. face_value already reflects the outstanding balance, so it must
+        # NOT be reduced by principal_repaid again — doing so double-counted
+        # amortization and drove YTC negative on amortizing bonds.
+        face     = cur_u * si['face_value']
+        cost_pu  = cost / cur_u if cur_u else 0
+        fv_pu    = face / cur_u if cur_u else 0
+        
+        day_count = mi['day_count'] if mi is not None and pd.notna(mi['day_count']) else 'Actual/365'
+        rs = by_bond_resets.get(bid)
+
+        # YTC = true money-weighted yield-to-cost over the position's actual
+        # cashflows (repayments counted as inflows, coupons on the declining
+        # balance). Seasoning-invariant; reduces to the bullet YTC when there is
+        # no amortization.
+        ytc = calc_position_yield_to_cost(grp, si['coupon_rate'], si['frequency'], si['maturity_date'], si['face_value'], day_count, installments, rs)
+        # Cashflows to call and put on the same basis, redeemed at the
+        # exercise date; their yields are solved for the whole book at once
+        # below (see workout_yields). N/A without a date before maturity.
+        for col, flows in workout_flows.items():
+            when = mi[col] if mi is not None and pd.notna(mi[col]) else None
+            flows.append(position_cashflows(grp, si['coupon_rate'], si['frequency'], si['maturity_date'],
+                                            si['face_value'], day_count, installments, rs, exercise_date=when)
+                         if when is not None else [])
+        # Duration is a TODAY risk metric: discount the REMAINING cashflows at a
+        # today-anchored yield (best current-yield proxy absent a market mark).
+        y_today = calc_yield_to_cost(fv_pu, cost_pu, si['coupon_rate'], si['maturity_date'], si['frequency'], day_count,
+                                     as_of=date.today(), resets=rs)
+        if y_today > 0:
+            mac = calc_macaulay_duration(fv_pu, si['coupon_rate'], si['frequency'], si['maturity_date'], y_today, day_count, rs)
+            mod = calc_modified_duration(mac, y_today, si['frequency'])
+        else:
+            mac = 0.0
+            mod = 0.0
+            
+        dtm = calc_days_to_maturity(si['maturity_date'])
+        
+        # Last coupon on or before today, from the persisted calendar; before
+        # the first coupon the accrual runs from the issue date.
+        mat_date = pd.to_datetime(si['maturity_date']).date()
+        today = date.today()
+        issue_date = pd.to_datetime(mi['issue_date']).date() if mi is not None and pd.notna(mi['issue_date']) else None
+        last_coupon = last_coupons.get(bid)
+        if last_coupon is None:
+            last_coupon = issue_date
+        if last_coupon is None:
+            # Calendar not built yet: step back from maturity.
+            last_coupon = mat_date
+            while last_coupon > today:
+                last_coupon -= relativedelta(months=12 // FREQ_MAP.get(si['frequency'], 1))
+        elif issue_date is not None:
+            last_coupon = max(last_coupon, issue_date)
+
+        # The current period's rate (step-up/floating terms), which also sets
+        # the running annual coupon.
+        cur_rate = float(period_rates(si['coupon_rate'], rs, [last_coupon])[0])
+        ann_cpn = cur_u * fv_pu * cur_rate
+        
+        # Set accrued interest to 0 if matured
+        if mat_date <= today:
+            acc_int = 0.0
+        else:
+            acc_int = calc_accrued_interest(fv_pu, cur_rate, si['frequency'], day_count, last_coupon, mat_date) * cur_u
+            
+        first_buy = trades.loc[trades['transaction_type'] == 'Buy', 'trade_date'].min()
+        hold_days = (pd.to_datetime(date.today()) - first_buy).days if pd.notna(first_buy) else 0
+
+        positions.append({
+            'bond_id': bid, 'account': acct,
+            'issuer': si['issuer'], 'isin': si['isin'],
+            'maturity_date': si['maturity_date'],
+            'coupon_rate': cur_rate, 'frequency': si['frequency'],
+            'current_units': cur_u, 'cost_basis': cost, 'avg_buy_price': avg_px,
+            'realized_pnl': r_pnl, 'interest_received': int_recv,
+            'principal_repaid': prin_rep, 'position_face_value': face,
+            'amort_installment': amort_installment, 'amort_months': amort_months,
+            'amort_source': amort_source,
+            'annual_coupon_income': ann_cpn, 'nominal_yield': cur_rate,
+            'yield_to_cost': ytc, 'macaulay_duration': mac,
+            'modified_duration': mod, 'days_to_maturity': dtm,
+            'day_count': day_count,
+            'business_day': mi['business_day'] if mi is not None else 'Unadjusted',
+            'call_date': mi['call_date'] if mi is not None else None,
+            'put_date':  mi['put_date']  if mi is not None else None,
+            'years_to_maturity': dtm / 365.25, 'accrued_interest': acc_int,
+            'holding_days': hold_days,
+            'bond_type':      mi['bond_type']      if mi is not None else 'NCD',
+            'credit_rating':  mi['credit_rating']  if mi is not None else 'Unrated',
+            'sector':         mi['sector']          if mi is not None else 'Financials',
+        })
+
+    if not positions: return pd.DataFrame(), {}
+    df = pd.DataFrame(positions)
+    n = len(df)
+    y = solve_xirr(workout_flows['call_date'] + workout_flows['put_date'])
+    df['yield_to_call'], df['yield_to_put'] = y[:n], y[n:]
+    df = df.join(workout_yields(df, workout_flows['call_date']))
+    df = df.join(valuation(df) if valuation is not None else mark_to_market(df, date.today().isoformat()))
+    tc = df['cost_basis'].sum()
+    df['weight'] = df['cost_basis'] / tc if tc > 0 else 0
+    return df, portfolio_totals(df)
+
+
+def portfolio_totals(df):
+    """Headline totals and weighted averages of a positions frame (all of
+    build_positions' rows or any subset, e.g. one account)."""
+    # Portfolio averages are weighted by cost basis (invested capital — the
+    # best available PV proxy in a ledger with no market marks). This matches
+    # the cost-weighted NY/YC aggregation used in every dashboard table, so
+    # headline and tables now share one statistical basis. Duration and YTC
+    # are averaged over VALID observations only: a position whose solver
+    # returned 0 renders as "N/A" in the table, so silently including it as
+    # 0% in the weighted average would corrupt the headline number.
+    tf = df['position_face_value'].sum()
+    tc = df['cost_basis'].sum()
+
+    def w(col, valid_mask=None):
+        sub = df if valid_mask is None else df[valid_mask]
+        ws = sub['cost_basis'].sum()
+        return (sub[col] * sub['cost_basis']).sum() / ws if ws > 0 else 0.0
+
+    return {
+        'Total Cost Basis':       tc,
+        'Total Face Value':       tf,
+        'Total Annual Coupon':    df['annual_coupon_income'].sum(),
+        'Total Accrued Interest': df['accrued_interest'].sum(),
+        'Total Interest Received':df['interest_received'].sum(),
+        'Total Principal Repaid': df['principal_repaid'].sum(),
+        'Total Realized PnL':    df['realized_pnl'].sum(),
+        'Num Positions':          len(df),
+        'Num Issuers':            df['issuer'].nunique(),
+        'Num Accounts':           df['account'].nunique(),
+        'Weighted Nominal Yield': w('nominal_yield'),
+        'Weighted YTC':           w('yield_to_cost', df['yield_to_cost'] > 0),
+        'Weighted Mac Duration':  w('macaulay_duration', df['macaulay_duration'] > 0),
+        'Weighted Mod Duration':  w('modified_duration', df['macaulay_duration'] > 0),
+        'Weighted YTW':           w('yield_to_worst', df['yield_to_worst'].notna()),
+        'Weighted Duration to Worst':     w('duration_to_worst', df['duration_to_worst'] > 0),
+        'Weighted Mod Duration to Worst': w('mod_duration_to_worst', df['duration_to_worst'] > 0),
+        'Weighted Avg Maturity':  w('years_to_maturity'),
+        'Marked Positions':       int(df['market_value'].notna().sum()),
+        # NaN, not 0, when nothing is marked.
+        'Total Market Value':     df['market_value'].sum(min_count=1),
+        'Total Unrealized PnL':   df['unrealized_pnl'].sum(min_count=1),
+        'Weighted YTM':           w('ytm', df['ytm'].notna()),
+    }
+
+
+MATURITY_BUCKET_ORDER = ["0-3M", "3-6M", "6-12M", "1-2Y", "2-3Y", "3-5Y", "5Y+"]
+MATURITY_BUCKET_EDGES = [90, 180, 365, 730, 1095, 1825]   # inclusive upper bounds, days
+
+
+def maturity_bucket(days):
+    """Classify an array of days-to-maturity into ladder buckets."""
+    idx = np.searchsorted(MATURITY_BUCKET_EDGES, np.asarray(days, dtype=float), side='left')
+    return np.asarray(MATURITY_BUCKET_ORDER, dtype=object)[idx]
+
+
+# Aggregation cube: positions summed over every dimension a dashboard table
+# groups by. Yields are carried as cost-weighted numerators (NY, YC) with
+# their denominators (Cost, ValidC) so any slice can re-aggregate by plain
+# sums and divide once at the end.
+CUBE_DIMENSIONS = ['account', 'issuer', 'isin', 'credit_rating', 'sector', 'bond_type', 'mb']
+CUBE_MEASURES = ['Cost', 'Face', 'Inc', 'Units', 'NY', 'YC', 'ValidC', 'Pos']
+
+
+def aggregation_cube(positions):
+    """CUBE_DIMENSIONS x CUBE_MEASURES sums of a positions frame. Depends on
+    the valuation date through days-to-maturity (the maturity bucket)."""
+    p = positions
+    cost = p['cost_basis']
+    # YTC weighting excludes N/A (ytc<=0) positions from BOTH the numerator and
+    # the denominator, matching the headline Weighted YTC. Zeroing only one side
+    # would let a negative/NA position corrupt the group average.
+    ytc_ok = p['yield_to_cost'] > 0
+    cube = pd.DataFrame({
+        'account': p['account'], 'issuer': p['issuer'], 'isin': p['isin'],
+        'credit_rating': p['credit_rating'], 'sector': p['sector'], 'bond_type': p['bond_type'],
+        'mb': maturity_bucket(p['days_to_maturity']),
+        'Cost': cost,
+        'Face': p['position_face_value'],
+        'Inc': p['annual_coupon_income'],
+        'Units': p['current_units'],
+        'NY': p['nominal_yield'] * cost,
+        'YC': (p['yield_to_cost'] * cost).where(ytc_ok, 0.0),
+        'ValidC': cost.where(ytc_ok, 0.0),
+        'Pos': 1,
+    })
+    return cube.groupby(CUBE_DIMENSIONS, sort=False, dropna=False)[CUBE_MEASURES].sum().reset_index()
+
+
+_analytics_lock = threading.Lock()
+
+
+def analytics_key():
+    """(ledger revision, market revision, today, holiday calendar stamp):
+    positions, totals and cashflows change only when one of these does."""
+    return get_ledger_revision(), get_market_revision(), date.today().isoformat(), holiday_stamp()
+
+
+def analytics_dates(frame, stage):
+    """`frame` with the ANALYTICS_DATE_COLUMNS of `stage` ('positions' or
+    'cashflows') cast in place to ANALYTICS_DATE_DTYPE."""
+    for col in ANALYTICS_DATE_COLUMNS.get(stage, ()):
+        if col in frame:
+            frame[col] = pd.to_datetime(frame[col]).astype(ANALYTICS_DATE_DTYPE)
+    return frame
+
+
+def compute_analytics(as_of):
+    """(positions, totals, cashflows) valued at `as_of`, replaying the
+    ledger; the cashflow projection is shared with the market marks."""
+    cashflows = {}
+
+    def valuation(df):
+        cashflows['cf'] = cashflow_projection(df, as_of)
+        return mark_to_market(df, as_of, cashflows['cf'])
+
+    positions, totals = build_positions(valuation)
+    cashflows = cashflows.get('cf', pd.DataFrame(columns=CASHFLOW_COLUMNS))
+    return analytics_dates(positions, 'positions'), totals, analytics_dates(cashflows, 'cashflows')
+
+
+@functools.lru_cache(maxsize=4)
+def _portfolio_analytics(revision, market_revision, as_of, calendar_stamp):
+    # Imported here: nivesa.snapshots builds its tables with this module.
+    from nivesa.snapshots import load_analytics
+
+    key = (revision, market_revision, as_of, calendar_stamp)
+    return load_analytics(key) or compute_analytics(as_of)
+
+
+def portfolio_analytics(key=None):
+    """(positions, totals, cashflows) for `key` (default: analytics_key()),
+    read from a current nightly snapshot or else computed, once per key,
+    and shared by every caller in the process, so the frames must not be
+    modified."""
+    key = key or analytics_key()
+    with _analytics_lock:
+        return _portfolio_analytics(*key)
+
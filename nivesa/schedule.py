@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+Coupon terms and the persisted coupon calendar: expanding step-up and
+floating terms into dated resets, and building each security's payment
+events into security_schedule. The rebuild_* functions work on an open
+connection so they commit with the ledger write that triggered them.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from nivesa.db import query_frame
+from nivesa.finance import (
+    AMORT_MAX_INSTALLMENTS, DEFAULT_CURVE, FREQ_MAP, _business_day_conventions, _stepped_dates,
+    adjust_business_days, parse_tenors, period_rates,
+)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# COUPON TERMS
+# ═══════════════════════════════════════════════════════════════════════
+# securities.coupon_rate is the rate a security starts with; coupon_terms
+# rows change it from their effective date, either to a fixed rate (step-up
+# or step-down NCDs) or to a floating benchmark + spread re-fixed every
+# reset_months. A fixing is the benchmark tenor's par yield, interpolated
+# on the latest DEFAULT_CURVE on or before the reset date, so resets past
+# the last loaded curve carry today's benchmark forward; a reset before
+# any curve has no fixing and leaves the rate where it was. Terms expand
+# into coupon_resets (one row per dated rate), rebuilt with the security's
+# calendar and whenever curves load. A coupon period pays the rate in
+# force on its unadjusted start date, found by one searchsorted over
+# (security, reset date) keys for any number of periods at once.
+
+COUPON_TERM_COLUMNS = ['effective_date', 'coupon_rate', 'benchmark_tenor', 'spread', 'reset_months']
+RESET_COLUMNS = ['bond_id', 'reset_date', 'coupon_rate', 'source']
+
+
+def get_coupon_terms(bond_id=None):
+    """coupon_terms rows for every security or just `bond_id`."""
+    query = f"SELECT bond_id, {', '.join(COUPON_TERM_COLUMNS)} FROM coupon_terms"
+    params = ()
+    if bond_id:
+        query += " WHERE bond_id=?"
+        params = (bond_id,)
+    df = query_frame(query + " ORDER BY bond_id, effective_date", params)
+    if df.empty:
+        return pd.DataFrame(columns=['bond_id'] + COUPON_TERM_COLUMNS)
+    df['effective_date'] = pd.to_datetime(df['effective_date'])
+    return df
+
+
+def get_coupon_resets():
+    """Every security's dated coupon rates (RESET_COLUMNS)."""
+    df = query_frame(f"SELECT {', '.join(RESET_COLUMNS)} FROM coupon_resets ORDER BY bond_id, reset_date")
+    if df.empty:
+        return pd.DataFrame(columns=RESET_COLUMNS)
+    df['reset_date'] = pd.to_datetime(df['reset_date'])
+    return df
+
+
+def security_resets(resets):
+    """{bond_id: (reset dates, rates)} for period_rates."""
+    if resets is None or resets.empty:
+        return {}
+    when = pd.to_datetime(resets['reset_date']).to_numpy().astype('datetime64[D]')
+    rate = resets['coupon_rate'].to_numpy(dtype=float)
+    return {bid: (when[idx], rate[idx]) for bid, idx in resets.groupby('bond_id').indices.items()}
+
+
+def benchmark_fixings(curves, tenors, dates):
+    """Par yield at `tenors` (years) on the latest curve in `curves`
+    (curve_date, tenor, par_yield rows) on or before each of `dates`,
+    linear in tenor and flat past the ends; NaN before the first curve."""
+    out = np.full(len(dates), np.nan)
+    if curves.empty or not len(dates):
+        return out
+    curve_dates = np.unique(curves['curve_date'].to_numpy(dtype=str))
+    ci = np.searchsorted(curve_dates, np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]')), side='right') - 1
+    points = dict(tuple(curves.sort_values('tenor').groupby('curve_date')))
+    for c in np.unique(ci[ci >= 0]):
+        pts = points[curve_dates[c]]
+        sel = ci == c
+        out[sel] = np.interp(tenors[sel], pts['tenor'].to_numpy(dtype=float), pts['par_yield'].to_numpy(dtype=float))
+    return out
+
+
+def expand_coupon_terms(terms, maturities, curves):
+    """RESET_COLUMNS rows for coupon_terms rows `terms`: a fixed term is one
+    reset on its effective date; a floating term resets every reset_months
+    from it until the security's next term or maturity (`maturities`:
+    {bond_id: datetime64[D]}), fixed from `curves` (see benchmark_fixings)
+    plus the spread."""
+    if terms.empty:
+        return pd.DataFrame(columns=RESET_COLUMNS)
+    t = terms.assign(effective_date=pd.to_datetime(terms['effective_date'])).sort_values(
+        ['bond_id', 'effective_date'], ignore_index=True)
+    bond = t['bond_id'].to_numpy(dtype=object)
+    eff = t['effective_date'].to_numpy().astype('datetime64[D]')
+    last = np.append(bond[1:] != bond[:-1], True)
+    end = np.where(last, np.array([maturities[b] for b in bond], dtype='datetime64[D]'), np.roll(eff, -1))
+    floating = t['benchmark_tenor'].fillna('').astype(str).str.strip().ne('').to_numpy()
+
+    parts = [pd.DataFrame({'bond_id': bond[~floating], 'reset_date': eff[~floating],
+                           'coupon_rate': t['coupon_rate'].to_numpy(dtype=float)[~floating], 'source': 'step'})]
+    fl = np.flatnonzero(floating)
+    if len(fl):
+        step = t['reset_months'].to_numpy(dtype=float)[fl].astype(int)
+        count = int(((end[fl].astype('datetime64[M]') - eff[fl].astype('datetime64[M]')).astype(int) // step).max()) + 2
+        grid = _stepped_dates(eff[fl], step, 0, count, 1)
+        r, c = np.nonzero(grid < end[fl, None])
+        when = grid[r, c]
+        fixing = (benchmark_fixings(curves, parse_tenors(t['benchmark_tenor'].to_numpy()[fl])[r], when)
+                  + t['spread'].fillna(0).to_numpy(dtype=float)[fl][r])
+        ok = np.isfinite(fixing)
+        parts.append(pd.DataFrame({'bond_id': bond[fl][r][ok], 'reset_date': when[ok],
+                                   'coupon_rate': fixing[ok], 'source': 'benchmark'}))
+    out = pd.concat(parts, ignore_index=True).sort_values(['bond_id', 'reset_date'], ignore_index=True)
+    out['reset_date'] = pd.to_datetime(out['reset_date']).dt.strftime('%Y-%m-%d')
+    return out[RESET_COLUMNS]
+
+
+def rebuild_coupon_resets(conn, bond_ids=None):
+    """Re-expand coupon_terms into coupon_resets for `bond_ids` (default:
+    every security) on an open connection, rewriting a security's rows only
+    when its rates changed. Returns the resets (RESET_COLUMNS)."""
+    where, params = "", ()
+    if bond_ids is not None:
+        where = f" WHERE bond_id IN ({','.join('?' * len(bond_ids))})"
+        params = tuple(bond_ids)
+    read = lambda q, p=params: pd.read_sql_query(q, conn, params=p)
+    terms = read(f"SELECT bond_id, {', '.join(COUPON_TERM_COLUMNS)} FROM coupon_terms{where}")
+    old = read(f"SELECT {', '.join(RESET_COLUMNS)} FROM coupon_resets{where} ORDER BY bond_id, reset_date")
+    if terms.empty and old.empty:
+        return old
+    curves = pd.DataFrame(columns=['curve_date', 'tenor', 'par_yield'])
+    if terms['benchmark_tenor'].notna().any():
+        curves = read("SELECT curve_date, tenor, par_yield FROM yield_curves WHERE curve=?", (DEFAULT_CURVE,))
+    secs = read(f"SELECT bond_id, maturity_date FROM securities{where}")
+    maturities = dict(zip(secs['bond_id'], pd.to_datetime(secs['maturity_date']).to_numpy().astype('datetime64[D]')))
+    new = expand_coupon_terms(terms[terms['bond_id'].isin(maturities)], maturities, curves)
+    same = lambda a, b: (len(a) == len(b) and (a['reset_date'].to_numpy() == b['reset_date'].to_numpy()).all()
+                         and np.allclose(a['coupon_rate'].to_numpy(dtype=float), b['coupon_rate'].to_numpy(dtype=float),
+                                         rtol=0, atol=1e-12))
+    changed = [b for b in set(old['bond_id']) | set(new['bond_id'])
+               if not same(old[old['bond_id'] == b], new[new['bond_id'] == b])]
+    if changed:
+        conn.executemany("DELETE FROM coupon_resets WHERE bond_id=?", [(b,) for b in changed])
+        conn.executemany(
+            f"INSERT INTO coupon_resets ({', '.join(RESET_COLUMNS)}) VALUES (?,?,?,?)",
+            new[new['bond_id'].isin(changed)].itertuples(index=False, name=None),
+        )
+    return new
+
+
+def validate_coupon_terms(rows, issue_date, maturity):
+    """Error message for a frame of COUPON_TERM_COLUMNS (decimal rates), or
+    None. Each term needs a unique effective date inside the security's
+    life and either a fixed rate or a benchmark tenor with a reset period."""
+    if rows['effective_date'].isna().any():
+        return "Every term needs an effective date."
+    if rows['effective_date'].duplicated().any():
+        return "Effective dates must be unique."
+    if (rows['effective_date'] >= pd.Timestamp(maturity)).any():
+        return "Terms must take effect before maturity."
+    if issue_date is not None and (rows['effective_date'] <= pd.Timestamp(issue_date)).any():
+        return "Terms must take effect after the issue date."
+    tenor = rows['benchmark_tenor'].fillna('').astype(str).str.strip()
+    floating = tenor.ne('')
+    if (floating == rows['coupon_rate'].notna()).any():
+        return "Give each term either a fixed rate or a benchmark tenor, not both."
+    if (~floating & ~rows['coupon_rate'].between(0, 1)).any():
+        return "Fixed rates must be between 0% and 100%."
+    if floating.any():
+        if not np.isfinite(parse_tenors(tenor[floating])).all() or not (parse_tenors(tenor[floating]) > 0).all():
+            return "Benchmark tenors must look like 3M, 1Y or 0.25."
+        if not (rows.loc[floating, 'reset_months'] > 0).all():
+            return "Floating terms need a reset period in months."
+    return None
+
+
+# ═══════════════════════════════════════════════════════════════════════
+# COUPON CALENDAR
+# ═══════════════════════════════════════════════════════════════════════
+# security_schedule persists each security's payment events per unit held:
+# every coupon date (with its accrual period) from issue, or from the first
+# recorded trade when no issue date is known, through maturity; projected
+# amortization installments; and the redemption of the residual face at
+# maturity. Dates use the same maturity-anchored stepping as the cashflow
+# engine. Principal events run on from the last recorded repayment, not
+# from the day the rows were built, so a calendar stays valid as days pass
+# and is the same whenever it is rebuilt. Rows are rebuilt inside the same
+# transaction as any write to the security or its ledger (and on demand
+# with `python -m nivesa schedule`), so "what is due next month" or "last
+# coupon before today" are indexed range lookups.
+
+def get_amortization_schedules(bond_id=None):
+    """Contractual installments (bond_id, payment_date, principal per unit),
+    one indexed read for every security or just `bond_id`."""
+    query = "SELECT bond_id, payment_date, principal FROM amortization_schedule"
+    params = ()
+    if bond_id:
+        query += " WHERE bond_id=?"
+        params = (bond_id,)
+    df = query_frame(query + " ORDER BY bond_id, payment_date", params)
+    if df.empty:
+        return pd.DataFrame(columns=['bond_id', 'payment_date', 'principal'])
+    df['payment_date'] = pd.to_datetime(df['payment_date'])
+    return df
+
+
+def amortization_by_bond(schedules):
+    """{bond_id: [(date, principal per unit), ...]} in date order."""
+    if schedules.empty:
+        return {}
+    dates = pd.to_datetime(schedules['payment_date']).dt.date
+    return {
+        bid: list(zip(dates[idx], schedules['principal'][idx].astype(float)))
+        for bid, idx in schedules.groupby('bond_id').groups.items()
+    }
+
+
+SCHEDULE_COLUMNS = [
+    'bond_id', 'payment_date', 'event_type', 'period_start', 'period_end',
+    'coupon_rate', 'principal', 'source',
+]
+
+
+def _infer_unit_amortization(txns, frequency):
+    """(installment per unit, cadence in months, last repayment date) from
+    a security's recorded Principal_Repayment rows, or None.
+
+    Repayments carry a per-unit price when recorded through the app; older
+    rows store only the amount, so units held in that account on the date
+    are reconstructed from the Buy/Sell history."""
+    reps = txns[txns['transaction_type'] == 'Principal_Repayment']
+    if reps.empty:
+        return None
+    trades = txns[txns['transaction_type'].isin(['Buy', 'Sell'])]
+    held = np.array([
+        trades.loc[(trades['account'] == r.account) & (trades['trade_date'] <= r.trade_date), 'units'].sum()
+        for r in reps.itertuples()
+    ])
+    price = reps['price'].to_numpy(dtype=float)
+    amount = reps['amount'].to_numpy(dtype=float)
+    per_unit = np.where(price > 0, price, np.divide(amount, held, out=np.zeros_like(amount), where=held > 0))
+    per_unit = per_unit[per_unit > 0]
+    if not len(per_unit):
+        return None
+    dates = pd.to_datetime(reps['trade_date']).drop_duplicates().sort_values()
+    if len(dates) >= 2:
+        months = int(max(1, round(dates.diff().dropna().dt.days.median() / 30.44)))
+    else:
+        months = 12 // FREQ_MAP.get(frequency, 1)
+    return float(np.median(per_unit)), months, dates.iloc[-1]
+
+
+def build_security_schedule(sec, issue_date, txns, as_of, installments=None, business_day='Unadjusted',
+                            resets=None):
+    """Payment events for one security as a DataFrame of SCHEDULE_COLUMNS.
+
+    `sec` is a securities row, `txns` the security's transactions. Coupon
+    periods start at `issue_date` (first period) when known; otherwise the
+    calendar opens with the coupon date on or before the earliest trade
+    (`as_of` for a security with no trades). Contractual `installments`
+    ((date, principal per unit) pairs) are listed as given; without them,
+    installments inferred from the ledger are projected on the observed
+    cadence after the last recorded repayment. `sec`'s face is what is
+    outstanding after that repayment, and whatever the installments dated
+    after it leave is redeemed at maturity. Each coupon
+    carries the rate in force at its period start (`resets`, see
+    period_rates). Payment dates and coupon period bounds are then rolled
+    by `business_day`."""
+    mat = np.datetime64(pd.to_datetime(sec['maturity_date']).date(), 'D')
+    months = 12 // FREQ_MAP.get(sec['frequency'], 1)
+    anchor = pd.to_datetime(as_of).date()
+    if issue_date is not None:
+        start = np.datetime64(issue_date, 'D')
+    else:
+        first = pd.to_datetime(txns['trade_date']).min() if not txns.empty else pd.NaT
+        start = np.datetime64(first.date() if pd.notna(first) else anchor, 'D')
+
+    # Ascending coupon grid reaching at least two periods before `start`.
+    span = int((mat.astype('datetime64[M]') - start.astype('datetime64[M]')).astype(int)) // months + 3
+    grid = _stepped_dates(np.array([mat]), np.array([months]), 0, max(span, 2), -1)[0][::-1]
+    if issue_date is not None:
+        dates = grid[grid > start]
+        starts = np.concatenate([[start], dates[:-1]])
+    else:
+        first = max(int(np.searchsorted(grid, start, side='right')) - 1, 1)
+        dates, starts = grid[first:], grid[first - 1:-1]
+
+    events = [pd.DataFrame({
+        'payment_date': dates, 'event_type': 'Coupon',
+        'period_start': starts, 'period_end': dates,
+        'coupon_rate': period_rates(sec['coupon_rate'], resets, starts), 'principal': 0.0, 'source': 'terms',
+    })]
+
+    residual = float(sec['face_value'])
+    amort = None if installments else _infer_unit_amortization(txns, sec['frequency'])
+    repaid = pd.to_datetime(txns.loc[txns['transaction_type'] == 'Principal_Repayment', 'trade_date']).max()
+    if installments:
+        when = np.array([np.datetime64(d, 'D') for d, _ in installments])
+        unit = np.array([pu for _, pu in installments], dtype=float)
+        ahead = when < mat
+        if pd.notna(repaid):
+            ahead &= when > np.datetime64(repaid.date(), 'D')
+        due_before = np.cumsum(unit[ahead]) - unit[ahead]
+        residual = max(0.0, residual - np.clip(residual - due_before, 0.0, unit[ahead]).sum())
+        events.append(pd.DataFrame({
+            'payment_date': when[when < mat], 'event_type': 'Amortization',
+            'period_start': None, 'period_end': None,
+            'coupon_rate': 0.0, 'principal': unit[when < mat], 'source': 'contractual',
+        }))
+    elif amort is not None:
+        installment, step, last = amort
+        last = np.datetime64(last.date(), 'D')
+        count = min(AMORT_MAX_INSTALLMENTS,
+                    int((mat.astype('datetime64[M]') - last.astype('datetime64[M]')).astype(int)) // step + 1)
+        if count > 0:
+            grid = _stepped_dates(np.array([last]), np.array([step]), 1, count, 1)[0]
+            grid = grid[grid < mat]
+            before = residual - np.arange(len(grid)) * installment
+            grid, before = grid[before > 1e-6], before[before > 1e-6]
+            pay = np.minimum(installment, before)
+            residual = max(0.0, residual - pay.sum())
+            events.append(pd.DataFrame({
+                'payment_date': grid, 'event_type': 'Amortization',
+                'period_start': None, 'period_end': None,
+                'coupon_rate': 0.0, 'principal': pay, 'source': 'inferred',
+            }))
+
+    events.append(pd.DataFrame({
+        'payment_date': [mat], 'event_type': 'Redemption',
+        'period_start': None, 'period_end': None,
+        'coupon_rate': 0.0, 'principal': residual, 'source': 'terms',
+    }))
+    out = pd.concat(events, ignore_index=True)
+    for col in ('payment_date', 'period_start', 'period_end'):
+        when = adjust_business_days(pd.to_datetime(out[col]).to_numpy(), business_day)
+        out[col] = pd.Series(when).dt.strftime('%Y-%m-%d').astype(object).where(out[col].notna(), None)
+    out['bond_id'] = sec['bond_id']
+    return out.sort_values(['payment_date', 'event_type'], ignore_index=True)[SCHEDULE_COLUMNS]
+
+
+def rebuild_security_schedule(conn, bond_ids=None, as_of=None):
+    """Regenerate security_schedule rows for `bond_ids` (default: every
+    security) on an open connection; the caller owns the transaction."""
+    as_of = as_of or date.today()
+    where, params = "", ()
+    if bond_ids is not None:
+        bond_ids = list(bond_ids)
+        if not bond_ids:
+            return 0
+        where = f" WHERE bond_id IN ({','.join('?' * len(bond_ids))})"
+        params = tuple(bond_ids)
+    secs = pd.read_sql_query(f"SELECT * FROM securities{where}", conn, params=params)
+    meta = pd.read_sql_query(f"SELECT bond_id, issue_date, business_day FROM security_metadata{where}",
+                             conn, params=params)
+    txns = pd.read_sql_query(
+        f"SELECT bond_id, account, trade_date, transaction_type, units, price, amount FROM transactions{where}",
+        conn, params=params,
+    )
+    amort = pd.read_sql_query(
+        f"SELECT bond_id, payment_date, principal FROM amortization_schedule{where} ORDER BY bond_id, payment_date",
+        conn, params=params,
+    )
+    contract = amortization_by_bond(amort)
+    resets = security_resets(rebuild_coupon_resets(conn, bond_ids))
+    issue = dict(zip(meta['bond_id'], meta['issue_date']))
+    rolls = dict(zip(meta['bond_id'], _business_day_conventions(meta)))
+    by_bond = dict(tuple(txns.groupby('bond_id'))) if not txns.empty else {}
+
+    conn.execute(f"DELETE FROM security_schedule{where}", params)
+    rows = 0
+    for _, sec in secs.iterrows():
+        idate = issue.get(sec['bond_id'])
+        idate = pd.to_datetime(idate).date() if idate is not None and pd.notna(idate) else None
+        sched = build_security_schedule(sec, idate, by_bond.get(sec['bond_id'], txns.iloc[0:0]), as_of,
+                                        contract.get(sec['bond_id']), rolls.get(sec['bond_id'], 'Unadjusted'),
+                                        resets.get(sec['bond_id']))
+        conn.executemany(
+            f"INSERT INTO security_schedule ({', '.join(SCHEDULE_COLUMNS)}) VALUES ({','.join('?' * len(SCHEDULE_COLUMNS))})",
+            sched.itertuples(index=False, name=None),
+        )
+        rows += len(sched)
+    return rows
+
+
+def get_last_coupon_dates(as_of):
+    """{bond_id: last coupon date on or before `as_of`} from the calendar."""
+    df = query_frame(
+        "SELECT bond_id, MAX(payment_date) AS last_coupon FROM security_schedule "
+        "WHERE event_type='Coupon' AND payment_date <= ? GROUP BY bond_id",
+        (as_of.isoformat(),),
+    )
+    if df.empty:
+        return {}
+    return dict(zip(df['bond_id'], pd.to_datetime(df['last_coupon']).dt.date))
+
+
+def get_schedule_events(start, end, bond_id=None):
+    """Calendar events with start <= payment_date <= end, joined with the
+    security master, in payment-date order."""
+    query = (
+        "SELECT e.*, s.issuer, s.isin FROM security_schedule e "
+        "JOIN securities s ON e.bond_id=s.bond_id "
+        "WHERE e.payment_date BETWEEN ? AND ?"
+    )
+    params = [start.isoformat(), end.isoformat()]
+    if bond_id:
+        query += " AND e.bond_id=?"
+        params.append(bond_id)
+    df = query_frame(query + " ORDER BY e.payment_date, e.bond_id", tuple(params))
+    if not df.empty:
+        df['payment_date'] = pd.to_datetime(df['payment_date'])
+    return df
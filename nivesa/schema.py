@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Database schema and migrations.
+
+init_db creates every table, index and trigger if missing, applies column
+migrations to older databases and backfills the derived tables (coupon
+calendars, tax lots) for rows that predate them. It is idempotent and
+cheap on a current database, so every entry point runs it first.
+"""
+from contextlib import closing
+import os
+import sqlite3
+
+from nivesa.changes import install_change_capture
+from nivesa.db import DB_DIR, DatabaseError, connect, logger
+from nivesa.lots import rebuild_tax_lots
+from nivesa.schedule import rebuild_security_schedule
+from nivesa.snapshots import SNAPSHOT_COLUMNS, SNAPSHOT_TABLES
+
+
+def init_db():
+    """Initialize / migrate database to current schema. Raises DatabaseError."""
+    os.makedirs(DB_DIR, exist_ok=True)
+    try:
+        # closing() releases the handle; `conn` context scopes the txn
+        with closing(connect()) as conn, conn:
+            c = conn.cursor()
+            c.execute("PRAGMA journal_mode=WAL")
+
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS securities (
+                bond_id TEXT PRIMARY KEY,
+                issuer TEXT NOT NULL,
+                isin TEXT NOT NULL UNIQUE,
+                maturity_date TEXT NOT NULL,
+                frequency TEXT NOT NULL,
+                coupon_rate REAL NOT NULL,
+                face_value REAL NOT NULL
+            )""")
+
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                transaction_id TEXT PRIMARY KEY,
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                trade_date TEXT NOT NULL,
+                transaction_type TEXT NOT NULL,
+                units REAL NOT NULL,
+                price REAL NOT NULL,
+                amount REAL NOT NULL,
+                notes TEXT,
+                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
+            )""")
+
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS security_metadata (
+                bond_id TEXT PRIMARY KEY,
+                bond_type TEXT DEFAULT 'NCD',
+                credit_rating TEXT DEFAULT 'Unrated',
+                day_count TEXT DEFAULT 'Actual/365',
+                issue_date TEXT,
+                call_date TEXT,
+                put_date TEXT,
+                business_day TEXT DEFAULT 'Unadjusted',
+                listing TEXT DEFAULT 'Unlisted',
+                sector TEXT DEFAULT 'Financials',
+                notes TEXT,
+                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
+            )""")
+            if 'business_day' not in {r[1] for r in c.execute("PRAGMA table_info(security_metadata)")}:
+                c.execute("ALTER TABLE security_metadata ADD COLUMN business_day TEXT DEFAULT 'Unadjusted'")
+
+            # Contractual amortization: dated principal installments per unit
+            # of face, entered on Edit Security or bulk-imported. When a
+            # security has rows here they replace the installment cadence
+            # inferred from recorded repayments.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS amortization_schedule (
+                bond_id TEXT NOT NULL,
+                payment_date TEXT NOT NULL,
+                principal REAL NOT NULL,
+                PRIMARY KEY (bond_id, payment_date),
+                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
+            )""")
+
+            # Market data: benchmark par-yield curve points by date (see
+            # YIELD CURVES). Versioned by market_state rather than the ledger
+            # revision, so loading market data never invalidates ledger caches.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS yield_curves (
+                curve TEXT NOT NULL,
+                curve_date TEXT NOT NULL,
+                tenor REAL NOT NULL,
+                par_yield REAL NOT NULL,
+                source TEXT,
+                PRIMARY KEY (curve, curve_date, tenor)
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_curves_date ON yield_curves (curve_date)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS market_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                revision INTEGER NOT NULL DEFAULT 0
+            )""")
+            # End-of-day clean prices per unit, loaded from the price drop
+            # folder (see MARK TO MARKET); price_files records which files
+            # have been loaded so unchanged files are skipped.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS prices (
+                isin TEXT NOT NULL,
+                price_date TEXT NOT NULL,
+                clean_price REAL NOT NULL,
+                source TEXT,
+                PRIMARY KEY (isin, price_date)
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_prices_date ON prices (price_date)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS price_files (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                rows INTEGER NOT NULL,
+                loaded_at TEXT NOT NULL
+            )""")
+            c.execute("INSERT OR IGNORE INTO market_state (id, revision) VALUES (1, 0)")
+            for table in ("yield_curves", "prices"):
+                for op in ("INSERT", "UPDATE", "DELETE"):
+                    c.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_market_{table}_{op.lower()}
+                    AFTER {op} ON {table}
+                    BEGIN
+                        UPDATE market_state SET revision = revision + 1 WHERE id = 1;
+                    END""")
+
+            # Tax lots (see TAX LOTS): lot_instructions records how a Sell
+            # relieves lots and is ledger input; tax_lots and lot_disposals
+            # are derived, replayed per security on every ledger write.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS lot_instructions (
+                transaction_id TEXT PRIMARY KEY,
+                method TEXT NOT NULL,
+                lot_id TEXT,
+                FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id) ON DELETE CASCADE
+            )""")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS tax_lots (
+                lot_id TEXT PRIMARY KEY,
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                acquired TEXT NOT NULL,
+                units REAL NOT NULL,
+                cost REAL NOT NULL,
+                open_units REAL NOT NULL,
+                open_cost REAL NOT NULL
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_lots_position ON tax_lots (bond_id, account)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS lot_disposals (
+                sell_id TEXT NOT NULL,
+                lot_id TEXT NOT NULL,
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                acquired TEXT NOT NULL,
+                disposed TEXT NOT NULL,
+                units REAL NOT NULL,
+                cost REAL NOT NULL,
+                proceeds REAL NOT NULL,
+                gain REAL NOT NULL,
+                term TEXT NOT NULL,
+                fy TEXT NOT NULL
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_disposals_position ON lot_disposals (bond_id, account)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_disposals_fy ON lot_disposals (fy)")
+
+            # Coupon terms (see COUPON TERMS): dated fixed or benchmark +
+            # spread rates are ledger input; coupon_resets holds them expanded
+            # to one row per dated rate and is rewritten only where a rate
+            # changes, so it bumps the ledger revision exactly when coupons do.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS coupon_terms (
+                bond_id TEXT NOT NULL,
+                effective_date TEXT NOT NULL,
+                coupon_rate REAL,
+                benchmark_tenor TEXT,
+                spread REAL NOT NULL DEFAULT 0,
+                reset_months INTEGER,
+                PRIMARY KEY (bond_id, effective_date),
+                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
+            )""")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS coupon_resets (
+                bond_id TEXT NOT NULL,
+                reset_date TEXT NOT NULL,
+                coupon_rate REAL NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (bond_id, reset_date)
+            )""")
+
+            # Month-end accrued interest as booked (see ACCRUALS), with the
+            # ledger revision it was computed at.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS accrual_snapshots (
+                month_end TEXT NOT NULL,
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                units REAL NOT NULL,
+                face REAL NOT NULL,
+                coupon_rate REAL NOT NULL,
+                accrued REAL NOT NULL,
+                revision INTEGER NOT NULL,
+                saved_at TEXT NOT NULL,
+                PRIMARY KEY (month_end, bond_id, account)
+            )""")
+
+            # Nightly analytics snapshots (see nivesa.snapshots): one table
+            # per stage stamped with the valuation date, and per stage the
+            # revisions it was computed at and how long it took.
+            for stage, columns in SNAPSHOT_COLUMNS.items():
+                table = SNAPSHOT_TABLES[stage]
+                cols = ",\n".join(f"{name} {kind}".rstrip() for name, kind in columns.items())
+                c.execute(f"CREATE TABLE IF NOT EXISTS {table} (\nvaluation_date TEXT NOT NULL,\n{cols}\n)")
+                c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table} (valuation_date)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS snapshot_runs (
+                valuation_date TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                ledger_revision INTEGER NOT NULL,
+                market_revision INTEGER NOT NULL,
+                calendar_stamp REAL NOT NULL,
+                rows INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                completed_at TEXT NOT NULL,
+                PRIMARY KEY (valuation_date, stage)
+            )""")
+
+            # Ledger revision: a single counter bumped by triggers on every
+            # write to the ledger or the security master, so caches and
+            # exports can key on one integer instead of re-reading tables.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS ledger_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                revision INTEGER NOT NULL DEFAULT 0
+            )""")
+            c.execute("INSERT OR IGNORE INTO ledger_state (id, revision) VALUES (1, 0)")
+            for table in ("securities", "transactions", "security_metadata", "amortization_schedule",
+                          "lot_instructions", "coupon_terms", "coupon_resets"):
+                for op in ("INSERT", "UPDATE", "DELETE"):
+                    c.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_revision_{table}_{op.lower()}
+                    AFTER {op} ON {table}
+                    BEGIN
+                        UPDATE ledger_state SET revision = revision + 1 WHERE id = 1;
+                    END""")
+
+            # Coupon calendar: one row per payment event, derived from the
+            # security master and the ledger (see COUPON CALENDAR). Not part
+            # of the ledger revision; it is rebuilt whenever its inputs change.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS security_schedule (
+                bond_id TEXT NOT NULL,
+                payment_date TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                period_start TEXT,
+                period_end TEXT,
+                coupon_rate REAL NOT NULL DEFAULT 0,
+                principal REAL NOT NULL DEFAULT 0,
+                source TEXT NOT NULL DEFAULT 'terms',
+                FOREIGN KEY (bond_id) REFERENCES securities (bond_id)
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_payment_date ON security_schedule (payment_date)")
+            c.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_schedule_bond_date
+                ON security_schedule (bond_id, payment_date, event_type)
+            """)
+
+            # Coupon reconciliation results, refreshed incrementally: a
+            # (bond, account) pair is re-reconciled only when its fingerprint
+            # in reconciliation_state changes or a coupon falls due.
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS coupon_reconciliation (
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                due_date TEXT,
+                units REAL,
+                expected REAL,
+                transaction_id TEXT,
+                received_date TEXT,
+                received REAL,
+                days_late INTEGER,
+                status TEXT NOT NULL
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_recon_position ON coupon_reconciliation (bond_id, account)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS reconciliation_state (
+                bond_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                as_of TEXT NOT NULL,
+                PRIMARY KEY (bond_id, account)
+            )""")
+
+            # Change data capture: triggers append every write to the
+            # ledger and security master to change_log (see nivesa.changes).
+            install_change_capture(conn)
+
+            # Auto-populate metadata for any securities missing it
+            c.execute("""
+                INSERT OR IGNORE INTO security_metadata (bond_id)
+                SELECT bond_id FROM securities
+                WHERE bond_id NOT IN (SELECT bond_id FROM security_metadata)
+            """)
+
+            # Build calendars for securities that predate the table
+            missing = [r[0] for r in c.execute(
+                "SELECT bond_id FROM securities "
+                "WHERE bond_id NOT IN (SELECT DISTINCT bond_id FROM security_schedule)"
+            )]
+            if missing:
+                rebuild_security_schedule(conn, missing)
+
+            # ... and lots for ledgers that predate theirs
+            missing = [r[0] for r in c.execute(
+                "SELECT DISTINCT bond_id FROM transactions WHERE transaction_type='Buy' "
+                "AND bond_id NOT IN (SELECT DISTINCT bond_id FROM tax_lots)"
+            )]
+            if missing:
+                rebuild_tax_lots(conn, missing)
+
+            conn.commit()
+            logger.info("Database initialized / migrated OK.")
+    except sqlite3.Error as e:
+        logger.error(f"DB init failed: {e}")
+        raise DatabaseError(f"Database initialization failed: {e}") from e
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Nightly analytics snapshots, written by `python -m nivesa snapshot` (run it
+from cron after midnight).
+
+The job values the portfolio for today in STAGES: positions, totals,
+projected cashflows, maturity buckets and the aggregation cube. Each stage
+goes into its snapshot_* table stamped with the valuation date. A stage's
+rows and its snapshot_runs entry (revisions, row count, runtime) are
+committed together. An interrupted run therefore resumes at the first
+stage it has not finished. Re-running a date replaces only the stages whose
+ledger, market or holiday revisions have since moved on, or every stage
+with `force`.
+
+portfolio_analytics and the dashboard's cube read a stage directly when it
+was written at the current analytics_key, so the first visit of the day
+loads tables instead of replaying the ledger.
+"""
+from contextlib import closing
+from datetime import datetime
+import sqlite3
+import time
+
+import pandas as pd
+
+from nivesa.constants import STAGES
+from nivesa.db import DatabaseError, NivesaError, connect, logger, query_frame
+from nivesa.positions import (
+    ANALYTICS_DATE_COLUMNS, CUBE_DIMENSIONS, MATURITY_BUCKET_ORDER, aggregation_cube, analytics_dates,
+    analytics_key, cashflow_projection, compute_analytics, maturity_bucket, portfolio_totals,
+)
+
+# Column -> SQL type per stage, in frame order. Dates are stored as ISO text
+# and parsed back on read to the dtype compute_analytics gives them
+# (SNAPSHOT_DATE_COLUMNS).
+SNAPSHOT_COLUMNS = {
+    'positions': {
+        'bond_id': 'TEXT', 'account': 'TEXT', 'issuer': 'TEXT', 'isin': 'TEXT', 'maturity_date': 'TEXT',
+        'coupon_rate': 'REAL', 'frequency': 'TEXT', 'current_units': 'REAL', 'cost_basis': 'REAL',
+        'avg_buy_price': 'REAL', 'realized_pnl': 'REAL', 'interest_received': 'REAL',
+        'principal_repaid': 'REAL', 'position_face_value': 'REAL', 'amort_installment': 'REAL',
+        'amort_months': 'INTEGER', 'amort_source': 'TEXT', 'annual_coupon_income': 'REAL',
+        'nominal_yield': 'REAL', 'yield_to_cost': 'REAL', 'macaulay_duration': 'REAL',
+        'modified_duration': 'REAL', 'days_to_maturity': 'INTEGER', 'day_count': 'TEXT',
+        'business_day': 'TEXT', 'call_date': 'TEXT', 'put_date': 'TEXT', 'years_to_maturity': 'REAL',
+        'accrued_interest': 'REAL', 'holding_days': 'INTEGER', 'bond_type': 'TEXT', 'credit_rating': 'TEXT',
+        'sector': 'TEXT', 'yield_to_call': 'REAL', 'yield_to_put': 'REAL', 'yield_to_worst': 'REAL',
+        'workout_type': 'TEXT', 'workout_date': 'TEXT', 'duration_to_worst': 'REAL',
+        'mod_duration_to_worst': 'REAL', 'price_date': 'TEXT', 'clean_price': 'REAL', 'dirty_price': 'REAL',
+        'market_value': 'REAL', 'dirty_value': 'REAL', 'unrealized_pnl': 'REAL', 'ytm': 'REAL',
+        'weight': 'REAL',
+    },
+    # No declared type on value: SQLite keeps counts as integers and sums as
+    # reals instead of coercing both to one affinity.
+    'totals': {'metric': 'TEXT', 'value': ''},
+    'cashflows': {
+        'date': 'TEXT', 'bond_id': 'TEXT', 'account': 'TEXT', 'issuer': 'TEXT', 'isin': 'TEXT',
+        'coupon': 'REAL', 'principal': 'REAL', 'total': 'REAL', 'type': 'TEXT',
+    },
+    'maturity': {
+        'account': 'TEXT', 'bucket': 'TEXT', 'positions': 'INTEGER', 'face': 'REAL', 'cost': 'REAL',
+        'income': 'REAL',
+    },
+    'aggregates': {
+        **{d: 'TEXT' for d in CUBE_DIMENSIONS},
+        'Cost': 'REAL', 'Face': 'REAL', 'Inc': 'REAL', 'Units': 'REAL', 'NY': 'REAL', 'YC': 'REAL',
+        'ValidC': 'REAL', 'Pos': 'INTEGER',
+    },
+}
+SNAPSHOT_TABLES = {stage: f"snapshot_{stage}" for stage in STAGES}
+SNAPSHOT_DATE_COLUMNS = ANALYTICS_DATE_COLUMNS
+
+
+def _run_key(key):
+    """The snapshot_runs columns identifying `key`: its revisions and
+    calendar stamp (the date is the row's valuation_date)."""
+    revision, market_revision, _, stamp = key
+    return int(revision), int(market_revision), float(stamp)
+
+
+def current_stages(key):
+    """{stage: (rows, seconds)} of key's date written at key's revisions."""
+    runs = query_frame(
+        "SELECT stage, ledger_revision, market_revision, calendar_stamp, rows, seconds "
+        "FROM snapshot_runs WHERE valuation_date=?", (key[2],),
+    )
+    want = _run_key(key)
+    return {
+        r.stage: (r.rows, r.seconds) for r in runs.itertuples()
+        if (r.ledger_revision, r.market_revision, r.calendar_stamp) == want
+    }
+
+
+def read_stage(stage, valuation_date):
+    """The rows saved for `stage` on `valuation_date` as a frame, dates
+    parsed; the positions stage of an empty book is an empty frame."""
+    cols = list(SNAPSHOT_COLUMNS[stage])
+    if stage == 'totals':
+        # Read natively into an object column so counts stay ints; a NULL
+        # is a total that was NaN (e.g. market value with nothing marked).
+        try:
+            with closing(connect()) as conn:
+                rows = conn.execute(
+                    "SELECT metric, value FROM snapshot_totals WHERE valuation_date=? ORDER BY rowid",
+                    (valuation_date,),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Query failed: {e}")
+            raise DatabaseError(f"Query failed: {e}") from e
+        values = [float('nan') if r[1] is None else r[1] for r in rows]
+        return pd.DataFrame({'metric': [r[0] for r in rows], 'value': pd.Series(values, dtype=object)})
+    df = query_frame(
+        f"SELECT {', '.join(cols)} FROM {SNAPSHOT_TABLES[stage]} WHERE valuation_date=? ORDER BY rowid",
+        (valuation_date,),
+    )
+    if stage == 'positions' and df.empty:
+        return pd.DataFrame()
+    # A column that is NULL throughout reads back as None objects.
+    reals = [c for c, kind in SNAPSHOT_COLUMNS[stage].items() if kind == 'REAL']
+    df[reals] = df[reals].astype(float)
+    return analytics_dates(df, stage)
+
+
+def _totals_dict(frame):
+    return dict(zip(frame['metric'], frame['value']))
+
+
+def load_snapshot_stage(stage, key):
+    """`stage`'s frame if it was saved at `key`, else None (also when the
+    snapshot tables cannot be read)."""
+    try:
+        if stage not in current_stages(key):
+            return None
+        return read_stage(stage, key[2])
+    except DatabaseError:
+        return None
+
+
+def load_analytics(key):
+    """(positions, totals, cashflows) as portfolio_analytics returns them,
+    from a snapshot current at `key`, or None."""
+    try:
+        done = current_stages(key)
+        if not {'positions', 'totals', 'cashflows'} <= set(done):
+            return None
+        positions, totals, cashflows = (read_stage(s, key[2]) for s in ('positions', 'totals', 'cashflows'))
+    except DatabaseError:
+        return None
+    logger.info(f"Analytics for {key[2]} loaded from snapshot")
+    return positions, _totals_dict(totals), cashflows
+
+
+def maturity_buckets(positions):
+    """Positions, face, cost and annual coupon per (account, maturity
+    bucket), buckets in ladder order."""
+    p = positions
+    out = pd.DataFrame({
+        'account': p['account'],
+        'bucket': pd.Categorical(maturity_bucket(p['days_to_maturity']), categories=MATURITY_BUCKET_ORDER),
+        'positions': 1, 'face': p['position_face_value'], 'cost': p['cost_basis'],
+        'income': p['annual_coupon_income'],
+    })
+    out = out.groupby(['account', 'bucket'], observed=True).sum().reset_index()
+    out['bucket'] = out['bucket'].astype(str)
+    return out
+
+
+def _stage_frame(stage, memo, as_of):
+    """`stage`'s rows. Later stages reuse what the positions stage computed
+    this run, or on a resumed run the positions it saved."""
+    if stage == 'positions':
+        memo['positions'], memo['totals'], memo['cashflows'] = compute_analytics(as_of)
+        extra = set(memo['positions'].columns) - set(SNAPSHOT_COLUMNS['positions'])
+        if extra:
+            raise NivesaError(f"Positions columns missing from SNAPSHOT_COLUMNS: {sorted(extra)}")
+        return memo['positions']
+    if 'positions' not in memo:
+        memo['positions'] = read_stage('positions', as_of)
+    positions = memo['positions']
+    if positions.empty:
+        return pd.DataFrame(columns=list(SNAPSHOT_COLUMNS[stage]))
+    if stage == 'totals':
+        totals = memo.get('totals') or portfolio_totals(positions)
+        return pd.DataFrame({'metric': list(totals), 'value': pd.Series(list(totals.values()), dtype=object)})
+    if stage == 'cashflows':
+        return memo['cashflows'] if 'cashflows' in memo else cashflow_projection(positions, as_of)
+    if stage == 'maturity':
+        return maturity_buckets(positions)
+    return aggregation_cube(positions)
+
+
+def _write_stage(conn, stage, key, frame, started):
+    """Replace `stage`'s rows for key's date with `frame` and record the
+    run, in one transaction. Returns the seconds since `started`."""
+    cols = list(SNAPSHOT_COLUMNS[stage])
+    out = frame.reindex(columns=cols)
+    for col in SNAPSHOT_DATE_COLUMNS.get(stage, ()):
+        out[col] = pd.to_datetime(out[col]).dt.strftime('%Y-%m-%d')
+    table = SNAPSHOT_TABLES[stage]
+    with conn:
+        conn.execute(f"DELETE FROM {table} WHERE valuation_date=?", (key[2],))
+        conn.executemany(
+            f"INSERT INTO {table} (valuation_date, {', '.join(cols)}) VALUES (?{', ?' * len(cols)})",
+            ((key[2],) + row for row in out.itertuples(index=False, name=None)),
+        )
+        seconds = time.perf_counter() - started
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshot_runs (valuation_date, stage, ledger_revision, market_revision, "
+            "calendar_stamp, rows, seconds, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key[2], stage, *_run_key(key), len(out), seconds, datetime.now().isoformat(timespec='seconds')),
+        )
+    return seconds
+
+
+def run_snapshot(force=False, on_stage=None):
+    """Write today's snapshot, skipping stages already current unless
+    `force`. Returns [(stage, status, rows, seconds)], status 'written' or
+    'current' (seconds as recorded then); `on_stage` is called with each
+    tuple as it completes. Raises NivesaError."""
+    key = analytics_key()
+    as_of = key[2]
+    done = {} if force else current_stages(key)
+    memo = {}
+    results = []
+    try:
+        with closing(connect()) as conn:
+            for stage in STAGES:
+                if stage in done:
+                    result = (stage, 'current', *done[stage])
+                else:
+                    started = time.perf_counter()
+                    frame = _stage_frame(stage, memo, as_of)
+                    seconds = _write_stage(conn, stage, key, frame, started)
+                    result = (stage, 'written', len(frame), seconds)
+                    logger.info(f"Snapshot {as_of} {stage}: {len(frame)} rows in {seconds:.2f}s")
+                results.append(result)
+                if on_stage:
+                    on_stage(result)
+    except sqlite3.Error as e:
+        logger.error(f"Snapshot {as_of} failed: {e}")
+        raise DatabaseError(f"Snapshot {as_of} failed: {e}") from e
+    return results
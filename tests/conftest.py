@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: a throwaway data directory with a small seeded ledger.
+
+nivesa.db reads NIVESA_DATA_DIR at import, so it is set here before any
+test module imports the package.
+"""
+from contextlib import closing
+from datetime import date, timedelta
+import os
+import shutil
+import tempfile
+
+_DATA_DIR = tempfile.mkdtemp(prefix="nivesa-test-")
+os.environ["NIVESA_DATA_DIR"] = _DATA_DIR
+
+import pytest
+
+from nivesa.db import connect
+from nivesa.schema import init_db
+
+
+def _day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+# (bond_id, issuer, isin, maturity, frequency, coupon, face, day count, call, put)
+SECURITIES = [
+    ('B1', 'ALPHA FINANCE', 'INE000A01011', _day(700), 'Monthly', 0.11, 100000.0, 'Actual/365', None, None),
+    ('B2', 'BETA CAPITAL', 'INE000B01012', _day(1200), 'Semi-Annual', 0.095, 1000.0, 'Actual/Actual', None, None),
+    ('B3', 'GAMMA HOUSING', 'INE000C01013', _day(1500), 'Quarterly', 0.10, 10000.0, '30/360', _day(400), _day(800)),
+    ('B4', 'DELTA MICROFIN', 'INE000D01014', _day(45), 'Monthly', 0.12, 100000.0, 'Actual/365', None, None),
+]
+
+# (transaction_id, bond_id, account, trade date, type, units, price)
+TRADES = [
+    ('T1', 'B1', 'REKHA', _day(-200), 'Buy', 5, 99500.0),
+    ('T2', 'B1', 'HEMANG', _day(-30), 'Buy', 2, 100800.0),
+    ('T3', 'B2', 'REKHA', _day(-400), 'Buy', 100, 985.0),
+    ('T4', 'B2', 'REKHA', _day(-100), 'Buy', 50, 1004.0),
+    ('T5', 'B3', 'MANTHAN', _day(-90), 'Buy', 20, 10150.0),
+    ('T6', 'B4', 'HIMA', _day(-300), 'Buy', 3, 99000.0),
+    ('T7', 'B2', 'REKHA', _day(-20), 'Sell', -30, 1010.0),
+]
+
+
+@pytest.fixture(scope="session")
+def ledger():
+    """The seeded data directory; securities and trades above."""
+    init_db()
+    with closing(connect()) as conn, conn:
+        for bid, issuer, isin, mat, freq, cpn, fv, dc, call, put in SECURITIES:
+            conn.execute("INSERT INTO securities VALUES (?,?,?,?,?,?,?)", (bid, issuer, isin, mat, freq, cpn, fv))
+            conn.execute(
+                "INSERT INTO security_metadata (bond_id, day_count, call_date, put_date) VALUES (?,?,?,?)",
+                (bid, dc, call, put),
+            )
+        for tid, bid, acct, tdate, ttype, units, price in TRADES:
+            conn.execute("INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?)",
+                         (tid, bid, acct, tdate, ttype, units, price, abs(units) * price, None))
+    init_db()  # builds the coupon calendars and tax lots
+    yield _DATA_DIR
+    shutil.rmtree(_DATA_DIR, ignore_errors=True)
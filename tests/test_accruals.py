@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+from nivesa.finance import calc_accrued_interest, day_count_fraction
+
+# Quarterly periods, stepping up to 11% in the last; 200 of 1000 face per
+# unit repaid on the 30 June coupon date, so today's face is 800.
+PERIODS = [('2024-12-31', '2025-03-31', 0.10), ('2025-03-31', '2025-06-30', 0.10),
+           ('2025-06-30', '2025-09-30', 0.10), ('2025-09-30', '2025-12-31', 0.11)]
+TXNS = pd.DataFrame({
+    'bond_id': 'X1', 'account': 'A',
+    'trade_date': ['2025-01-10', '2025-06-30'], 'transaction_type': ['Buy', 'Principal_Repayment'],
+    'units': [10.0, 0.0], 'price': [1000.0, 200.0], 'amount': [10000.0, 2000.0],
+})
+SECS = pd.DataFrame({'bond_id': ['X1'], 'face_value': [800.0]})
+
+
+def _schedule(periods):
+    start, end, rate = zip(*periods)
+    return pd.DataFrame({'bond_id': 'X1', 'period_start': start, 'period_end': end, 'coupon_rate': rate})
+
+
+@pytest.mark.parametrize('day_count', ['Actual/365', '30/360', 'Actual/Actual'])
+def test_accrual_matrix_matches_scalar_accrual(day_count):
+    days = ['2025-01-05', '2025-02-15', '2025-03-31', '2025-06-30', '2025-07-15', '2025-11-20']
+    meta = pd.DataFrame({'bond_id': ['X1'], 'day_count': [day_count]})
+    pairs, units, face, rate, accrued = app.accrual_matrix(
+        np.array(days, dtype='datetime64[D]'), TXNS, SECS, meta, _schedule(PERIODS))
+    assert pairs.values.tolist() == [['X1', 'A']]
+
+    # Before the buy nothing is held; on a coupon date (including the
+    # repayment date) the new period has just begun.
+    assert units[0].tolist() == [0.0, 10.0, 10.0, 10.0, 10.0, 10.0]
+    assert accrued[0, [0, 2, 3]].tolist() == [0.0, 0.0, 0.0]
+    # The coupon before the repayment is on 1000 per unit, after it on 800.
+    assert face[0, 1:].tolist() == [1000.0, 1000.0, 800.0, 800.0, 800.0]
+    for col, (start, on_face, cpn) in {1: ('2024-12-31', 1000.0, 0.10), 4: ('2025-06-30', 800.0, 0.10),
+                                       5: ('2025-09-30', 800.0, 0.11)}.items():
+        expected = 10 * on_face * cpn * day_count_fraction(start, days[col], day_count)
+        assert accrued[0, col] == pytest.approx(expected, rel=1e-12)
+        assert rate[0, col] == cpn
+
+
+@pytest.mark.parametrize('day_count', ['Actual/365', '30/360', 'Actual/Actual'])
+def test_accrual_matrix_today_matches_calc_accrued_interest(day_count):
+    today = date.today()
+    last = today - timedelta(days=40)
+    periods = [(last.isoformat(), (today + timedelta(days=50)).isoformat(), 0.095)]
+    txns = TXNS.iloc[:1].assign(trade_date=(today - timedelta(days=100)).isoformat())
+    meta = pd.DataFrame({'bond_id': ['X1'], 'day_count': [day_count]})
+    *_, accrued = app.accrual_matrix(np.array([today], dtype='datetime64[D]'), txns, SECS, meta, _schedule(periods))
+    scalar = calc_accrued_interest(10 * 800.0, 0.095, 'Quarterly', day_count, last_coupon_date=last)
+    assert accrued[0, 0] == pytest.approx(scalar, rel=1e-12)
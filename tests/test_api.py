@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from http.server import ThreadingHTTPServer
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from nivesa.api import ApiHandler
+
+
+@pytest.fixture(scope="module")
+def api(ledger):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def _get(url, etag=None):
+    """(status, ETag, body) of GET `url`, sending `etag` as If-None-Match."""
+    req = urllib.request.Request(url, headers={'If-None-Match': etag} if etag else {})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, resp.headers['ETag'], json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers['ETag'], None
+
+
+def test_changes_paging_with_if_none_match_reads_every_page(api):
+    status, _, whole = _get(f"{api}/changes")
+    assert status == 200 and len(whole['items']) > 4
+
+    since, etag, seen = 0, None, []
+    while True:
+        status, etag, page = _get(f"{api}/changes?since={since}&limit=2", etag)
+        assert status == 200
+        seen += [c['seq'] for c in page['items']]
+        since = page['next_since']
+        if not page['more']:
+            break
+    assert seen == [c['seq'] for c in whole['items']]
+
+    # Asking for the last page again with its ETag is a 304.
+    status, again, _ = _get(f"{api}/changes?since={page['since']}&limit=2", etag)
+    assert status == 304 and again == etag
+
+
+def test_ledger_etag_covers_page_and_filters(api):
+    status, first, page = _get(f"{api}/ledger?limit=2")
+    assert status == 200 and page['next_offset'] == 2
+    assert _get(f"{api}/ledger?limit=2", first)[0] == 304
+    assert _get(f"{api}/ledger?limit=2&offset=2", first)[0] == 200
+    assert _get(f"{api}/ledger?limit=2&account=REKHA", first)[0] == 200
+    # Equivalent spellings of a filter are the same page.
+    _, dated, _ = _get(f"{api}/ledger?limit=2&from=2020-01-01")
+    assert _get(f"{api}/ledger?from=2020-1-1&limit=2", dated)[0] == 304
+
+
+@pytest.mark.parametrize("path, other", [
+    ("/positions", "/positions?issuer=beta"),
+    ("/cashflows", "/cashflows?account=REKHA"),
+    ("/totals", "/totals?account=HIMA"),
+])
+def test_analytics_etag_covers_filters(api, path, other):
+    status, etag, _ = _get(f"{api}{path}")
+    assert status == 200
+    assert _get(f"{api}{path}", etag)[0] == 304
+    status, filtered, _ = _get(f"{api}{other}", etag)
+    assert status == 200 and filtered != etag
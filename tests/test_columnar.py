@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nivesa.columnar import COLUMNAR_FORMATS, export_ledger, import_ledger
+from nivesa.db import NivesaError, connect, query_frame
+
+LEDGER = "SELECT * FROM transactions ORDER BY transaction_id"
+
+
+def _parquet(rows):
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False), buffer)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def fresh_bond(ledger):
+    """A security with no trades, removed again with everything imported
+    against it."""
+    with closing(connect()) as conn, conn:
+        conn.execute("INSERT INTO securities VALUES ('C9', 'CHI LEASING', 'INE000C09019', '2029-03-31', "
+                     "'Quarterly', 0.105, 1000.0)")
+    yield 'C9'
+    with closing(connect()) as conn, conn:
+        for table in ('lot_disposals', 'tax_lots', 'security_schedule', 'transactions', 'securities'):
+            conn.execute(f"DELETE FROM {table} WHERE bond_id='C9'")
+
+
+@pytest.mark.parametrize('fmt', COLUMNAR_FORMATS)
+def test_reimporting_an_export_changes_nothing(ledger, fmt):
+    before = query_frame(LEDGER)
+    buffer = io.BytesIO()
+    assert export_ledger(buffer, fmt) == len(before)
+    buffer.seek(0)
+    assert import_ledger(buffer) == (0, len(before))
+    pd.testing.assert_frame_equal(query_frame(LEDGER), before)
+
+
+def test_import_keys_rows_by_isin_and_skips_repeats(fresh_bond):
+    rows = [
+        {'isin': 'INE000C09019', 'trade_date': '2025-01-15', 'account': 'REKHA', 'transaction_type': 'Buy',
+         'units': 4.0, 'price': 1000.0, 'amount': 4000.0},
+        {'transaction_id': 'C9-S1', 'bond_id': 'C9', 'trade_date': '2025-05-15', 'account': 'REKHA',
+         'transaction_type': 'Sell', 'units': -1.0, 'price': 1010.0, 'amount': 1010.0},
+    ]
+    assert import_ledger(_parquet(rows)) == (2, 0)
+    # A second run without transaction_ids would add the Buy again, so
+    # repeat only the keyed Sell.
+    assert import_ledger(_parquet(rows[1:])) == (0, 1)
+    got = query_frame("SELECT transaction_type, units FROM transactions WHERE bond_id='C9' ORDER BY trade_date")
+    assert got.values.tolist() == [['Buy', 4.0], ['Sell', -1.0]]
+    # The import rebuilt the security's lots and calendar.
+    lots = query_frame("SELECT open_units FROM tax_lots WHERE bond_id='C9'")
+    assert lots['open_units'].tolist() == [3.0]
+    assert len(query_frame("SELECT 1 FROM security_schedule WHERE bond_id='C9'"))
+
+
+def test_invalid_rows_are_reported_and_nothing_is_written(fresh_bond):
+    rows = [
+        {'bond_id': 'C9', 'trade_date': '2025-01-15', 'account': 'REKHA', 'transaction_type': 'Buy',
+         'units': 4.0, 'price': 1000.0, 'amount': 4000.0},
+        {'bond_id': 'NOPE', 'trade_date': '2025-01-16', 'account': 'REKHA', 'transaction_type': 'Buy',
+         'units': 1.0, 'price': 1000.0, 'amount': 1000.0},
+        {'bond_id': 'C9', 'trade_date': 'someday', 'account': ' ', 'transaction_type': 'Gift',
+         'units': -1.0, 'price': 1000.0, 'amount': 1000.0},
+    ]
+    with pytest.raises(NivesaError) as e:
+        import_ledger(_parquet(rows))
+    message = str(e.value)
+    assert "row 2: unknown security" in message
+    assert "row 3: trade_date is not a date" in message and "row 3: account is empty" in message
+    assert "row 1" not in message
+    assert query_frame("SELECT * FROM transactions WHERE bond_id='C9'").empty
+
+    with pytest.raises(NivesaError, match="missing columns: amount"):
+        import_ledger(_parquet([{k: v for k, v in rows[0].items() if k != 'amount'}]))
+
+
+def test_import_that_breaks_chronology_is_rolled_back(fresh_bond):
+    rows = [
+        {'bond_id': 'C9', 'trade_date': '2025-03-01', 'account': 'HIMA', 'transaction_type': 'Buy',
+         'units': 2.0, 'price': 1000.0, 'amount': 2000.0},
+        # Sold before it was bought.
+        {'bond_id': 'C9', 'trade_date': '2025-02-01', 'account': 'HIMA', 'transaction_type': 'Sell',
+         'units': -2.0, 'price': 1000.0, 'amount': 2000.0},
+    ]
+    with pytest.raises(NivesaError, match="account HIMA would hold negative units of C9 on 2025-02-01"):
+        import_ledger(_parquet(rows))
+    assert query_frame("SELECT * FROM transactions WHERE bond_id='C9'").empty
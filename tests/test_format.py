@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from nivesa.formatting import (
+    MISSING, fmt_inr, fmt_inr_array, fmt_inr_short, fmt_inr_short_array, fmt_pct, fmt_pct_array,
+)
+
+VALUES = [0.0, 1.5, -2.345, 99999.994, 123456.78, -1.23e7, 4.5e9, 0.1234, np.nan, np.inf, -np.inf, None, 'x']
+
+
+@pytest.mark.parametrize("array_fmt, scalar_fmt", [
+    (fmt_inr_array, fmt_inr),
+    (fmt_inr_short_array, fmt_inr_short),
+    (fmt_pct_array, fmt_pct),
+])
+def test_array_formatters_match_scalar(array_fmt, scalar_fmt):
+    assert list(array_fmt(VALUES)) == [scalar_fmt(v) for v in VALUES]
+
+
+@pytest.mark.parametrize("fmt", [fmt_inr, fmt_inr_short, fmt_pct])
+def test_missing_values_are_not_shown_as_zero(fmt):
+    for v in (np.nan, np.inf, None, 'x'):
+        assert fmt(v) == MISSING
+    assert list(fmt_pct_array([np.nan, 0.05], 1)) == [MISSING, '5.0%']
+
+
+def test_indian_digit_grouping():
+    assert fmt_inr(123456789.5) == '₹12,34,56,789.50'
+    assert fmt_inr(-1234.5) == '-₹1,234.50'
+    assert fmt_inr_short(2.5e7) == '₹2.50 Cr'
+    assert fmt_inr_short(4.56e5) == '₹4.56 L'
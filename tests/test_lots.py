@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+from nivesa.lots import financial_year, replay_lots
+
+
+def _txns(*rows):
+    """Ledger frame as rebuild_tax_lots reads it, from (id, date, type,
+    units, amount) rows of bond X1 in account A."""
+    return pd.DataFrame([
+        {'seq': i, 'transaction_id': tid, 'bond_id': 'X1', 'account': 'A', 'trade_date': day,
+         'transaction_type': tt, 'units': units, 'price': abs(amount / units) if units else 0.0, 'amount': amount}
+        for i, (tid, day, tt, units, amount) in enumerate(rows)
+    ])
+
+
+TWO_LOTS = _txns(
+    ('L1', '2024-01-10', 'Buy', 10, 1000.0),
+    ('L2', '2024-06-10', 'Buy', 10, 1100.0),
+    ('S1', '2025-03-01', 'Sell', -15, 1800.0),
+)
+
+
+def _relieved(method, lot_id=None):
+    lots, disposals = replay_lots(TWO_LOTS, {'S1': (method, lot_id)}, {'X1': 12})
+    assert disposals['proceeds'].sum() == pytest.approx(1800.0)
+    assert disposals['units'].sum() == pytest.approx(15)
+    return (lots.set_index('lot_id')[['open_units', 'open_cost']],
+            disposals.set_index('lot_id')[['units', 'cost', 'gain']])
+
+
+def test_fifo_relieves_oldest_lot_first():
+    lots, sold = _relieved('FIFO')
+    assert sold['units'].to_dict() == {'L1': 10, 'L2': 5}
+    assert sold['cost'].to_dict() == pytest.approx({'L1': 1000.0, 'L2': 550.0})
+    assert sold['gain'].to_dict() == pytest.approx({'L1': 200.0, 'L2': 50.0})
+    assert lots.loc['L1'].tolist() == [0.0, 0.0]
+    assert lots.loc['L2'].tolist() == pytest.approx([5, 550.0])
+
+
+def test_average_cost_relieves_pro_rata():
+    lots, sold = _relieved('Average Cost')
+    assert sold['units'].to_dict() == pytest.approx({'L1': 7.5, 'L2': 7.5})
+    assert sold['cost'].sum() == pytest.approx(15 * 2100.0 / 20)
+    assert lots['open_units'].to_dict() == pytest.approx({'L1': 2.5, 'L2': 2.5})
+
+
+def test_specific_id_relieves_named_lot_then_fifo():
+    lots, sold = _relieved('Specific ID', 'L2')
+    assert sold['units'].to_dict() == {'L2': 10, 'L1': 5}
+    assert sold['cost'].to_dict() == pytest.approx({'L2': 1100.0, 'L1': 500.0})
+    assert lots['open_units'].to_dict() == pytest.approx({'L1': 5, 'L2': 0.0})
+
+
+def test_repayment_reduces_open_cost_per_unit():
+    txns = _txns(
+        ('L1', '2024-01-10', 'Buy', 10, 1000.0),
+        ('R1', '2024-07-10', 'Principal_Repayment', 0, 200.0),
+        ('S1', '2024-09-10', 'Sell', -5, 450.0),
+    )
+    lots, disposals = replay_lots(txns, {}, {'X1': 12})
+    assert disposals['cost'].tolist() == pytest.approx([400.0])
+    assert lots['open_cost'].tolist() == pytest.approx([400.0])
+
+
+@pytest.mark.parametrize('listing_months, sold, term, fy', [
+    # Listed: held longer than 12 months is long-term; the anniversary
+    # itself is still short-term.
+    (12, '2025-03-31', 'Short', 'FY2024-25'),
+    (12, '2025-04-01', 'Long', 'FY2025-26'),
+    # Unlisted (also the default for a bond with no metadata): 36 months.
+    (None, '2027-03-31', 'Short', 'FY2026-27'),
+    (None, '2027-04-01', 'Long', 'FY2027-28'),
+])
+def test_holding_period_and_financial_year(listing_months, sold, term, fy):
+    txns = _txns(('L1', '2024-03-31', 'Buy', 10, 1000.0), ('S1', sold, 'Sell', -10, 1100.0))
+    long_term = {'X1': listing_months} if listing_months else {}
+    _, disposals = replay_lots(txns, {}, long_term)
+    assert disposals[['term', 'fy']].values.tolist() == [[term, fy]]
+
+
+def test_financial_year_turns_in_april():
+    assert financial_year(pd.Timestamp('2025-03-31').date()) == 'FY2024-25'
+    assert financial_year(pd.Timestamp('2025-04-01').date()) == 'FY2025-26'
+    assert financial_year(pd.Timestamp('2099-12-31').date()) == 'FY2099-00'
+
+
+def test_same_day_buy_is_available_to_sell():
+    txns = _txns(('S1', '2024-05-02', 'Sell', -4, 440.0), ('L1', '2024-05-02', 'Buy', 4, 400.0))
+    lots, disposals = replay_lots(txns, {}, {'X1': 12})
+    assert disposals['lot_id'].tolist() == ['L1']
+    assert lots['open_units'].tolist() == [0.0]
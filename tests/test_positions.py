@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nivesa.db import query_frame
+from nivesa.finance import calc_position_yield_to_cost, position_cashflows, solve_xirr, workout_yields
+from nivesa.positions import build_positions, portfolio_totals
+
+
+@pytest.fixture(scope="module")
+def positions(ledger):
+    df, _ = build_positions()
+    return df
+
+
+def test_plain_bullet_yield_to_worst_is_yield_to_cost(positions):
+    # With no call the worst workout is maturity, and yield-to-worst is
+    # yield-to-cost itself.
+    plain = positions[positions['call_date'].isna() & positions['yield_to_worst'].notna()]
+    assert len(plain)
+    assert (plain['workout_type'] == 'Maturity').all()
+    np.testing.assert_allclose(plain['yield_to_worst'], plain['yield_to_cost'], rtol=0, atol=1e-9)
+
+
+def test_maturity_workout_duration_is_macaulay_duration(positions):
+    to_mat = positions[positions['workout_type'] == 'Maturity']
+    assert len(to_mat)
+    np.testing.assert_allclose(to_mat['duration_to_worst'], to_mat['macaulay_duration'], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(to_mat['mod_duration_to_worst'], to_mat['modified_duration'], rtol=0, atol=1e-12)
+
+
+def test_batch_call_and_put_yields_match_scalar_solve(ledger, positions):
+    txns = query_frame("SELECT * FROM transactions")
+    secs = query_frame("SELECT * FROM securities").set_index('bond_id')
+    exercised = positions[positions['call_date'].notna() | positions['put_date'].notna()]
+    assert len(exercised)
+    for _, p in exercised.iterrows():
+        grp = txns[(txns['bond_id'] == p['bond_id']) & (txns['account'] == p['account'])]
+        si = secs.loc[p['bond_id']]
+        for col in ('call', 'put'):
+            y = calc_position_yield_to_cost(grp, si['coupon_rate'], si['frequency'], si['maturity_date'],
+                                            si['face_value'], p['day_count'], exercise_date=p[f'{col}_date'])
+            assert y != 0
+            assert p[f'yield_to_{col}'] == pytest.approx(y, abs=1e-7)
+
+
+def test_market_totals_are_nan_when_nothing_is_marked(positions):
+    totals = portfolio_totals(positions)
+    assert totals['Marked Positions'] == 0
+    assert np.isnan(totals['Total Market Value'])
+    assert np.isnan(totals['Total Unrealized PnL'])
+
+
+def test_call_workout_duration_covers_amortization():
+    # An amortizing callable bond: 600 of 1000 face per unit repaid in installments
+    # ahead of the call date, which a bullet projection would ignore.
+    today = date.today()
+    on = lambda days: today + timedelta(days=days)
+    txns = pd.DataFrame({'trade_date': [on(-100).isoformat()], 'transaction_type': ['Buy'],
+                         'units': [10.0], 'amount': [10000.0]})
+    installments = [(on(90), 200.0), (on(270), 200.0), (on(450), 200.0)]
+    call = on(600)
+    args = (txns, 0.10, 'Quarterly', on(1500).isoformat(), 1000.0, 'Actual/365')
+    amortizing = position_cashflows(*args, installments, exercise_date=call)
+    bullet = position_cashflows(*args, exercise_date=call)
+    assert [d for d, _ in amortizing if d in dict(installments)] == [d for d, _ in installments]
+
+    def to_call(flows):
+        y = solve_xirr([flows])[0]
+        pos = pd.DataFrame({
+            'current_units': [10.0], 'maturity_date': [on(1500)], 'call_date': [call],
+            'yield_to_cost': [y + 0.01], 'yield_to_call': [y],
+            'macaulay_duration': [3.0], 'modified_duration': [2.7],
+        })
+        row = workout_yields(pos, [flows]).iloc[0]
+        assert row['workout_type'] == 'Call' and row['yield_to_worst'] == y
+        # Macaulay duration of the same cashflows still ahead, at that yield.
+        t = np.array([(d - today).days / 365.0 for d, _ in flows])
+        pv = np.array([a for _, a in flows]) * (1 + y) ** -t
+        ahead = t > 0
+        assert row['duration_to_worst'] == pytest.approx((t * pv)[ahead].sum() / pv[ahead].sum(), abs=1e-12)
+        assert row['mod_duration_to_worst'] == pytest.approx(row['duration_to_worst'] / (1 + y), abs=1e-12)
+        return row['duration_to_worst']
+
+    # Principal returned early shortens the duration to the call.
+    assert to_call(amortizing) < to_call(bullet) - 0.2
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+
+import pandas as pd
+import pytest
+
+import app
+from nivesa.db import connect, query_frame
+
+DUES = ['2025-03-31', '2025-06-30', '2025-09-30', '2025-12-31']
+SCHEDULE = pd.DataFrame({'bond_id': 'X1', 'payment_date': pd.to_datetime(DUES), 'coupon_rate': 0.12})
+SECS = pd.DataFrame({'bond_id': ['X1'], 'maturity_date': ['2028-12-31'], 'frequency': ['Quarterly'],
+                     'coupon_rate': [0.12], 'face_value': [1000.0]})
+AS_OF = pd.Timestamp('2026-01-02')
+
+
+def _txns(*rows):
+    """Ledger rows of bond X1 from (id, account, date, type, units, amount)."""
+    t = pd.DataFrame(rows, columns=['transaction_id', 'account', 'trade_date', 'transaction_type', 'units', 'amount'])
+    return t.assign(bond_id='X1', price=0.0, trade_date=pd.to_datetime(t['trade_date']))
+
+
+# A holds from the 31 March record date (15 days before) exactly; B buys a
+# day later and is first entitled to the June coupon.
+TRADES = _txns(('BA', 'A', '2025-03-16', 'Buy', 10, 10000.0), ('BB', 'B', '2025-03-17', 'Buy', 10, 10000.0))
+PAIRS = pd.DataFrame({'bond_id': 'X1', 'account': ['A', 'B']})
+
+
+def test_expected_coupons_follow_record_date():
+    exp = app.expected_coupons(PAIRS, SCHEDULE, SECS, TRADES, AS_OF)
+    due = exp.groupby('account')['due_date'].apply(lambda d: [x.strftime('%Y-%m-%d') for x in sorted(d)])
+    assert due['A'] == DUES
+    assert due['B'] == DUES[1:]
+    assert exp['expected'].tolist() == pytest.approx([10 * 1000 * 0.12 / 4] * len(exp))
+    # Nothing due after as_of.
+    assert len(app.expected_coupons(PAIRS, SCHEDULE, SECS, TRADES, pd.Timestamp('2025-06-29'))) == 1
+
+
+def test_expected_coupons_on_face_before_repayment():
+    txns = pd.concat([TRADES, _txns(('R1', 'A', '2025-06-30', 'Principal_Repayment', 0, 2000.0))])
+    secs = SECS.assign(face_value=800.0)   # today's face, after 200 per unit was repaid
+    exp = app.expected_coupons(PAIRS.iloc[:1], SCHEDULE, secs, txns, AS_OF).set_index('due_date')
+    # Up to and including the repayment date the coupon is on 1000 per unit.
+    assert exp['expected'].tolist() == pytest.approx([300.0, 300.0, 240.0, 240.0])
+
+
+def test_match_receipts_classifies_each_due():
+    exp = app.expected_coupons(PAIRS, SCHEDULE, SECS, TRADES, AS_OF)
+    receipts = _txns(
+        ('R1', 'A', '2025-03-31', 'Interest_Receipt', 0, 300.0),   # on the day
+        ('R2', 'A', '2025-07-02', 'Interest_Receipt', 0, 250.0),   # within grace, short
+        ('R3', 'B', '2025-07-20', 'Interest_Receipt', 0, 300.0),   # 20 days late
+        ('R4', 'B', '2025-09-26', 'Interest_Receipt', 0, 300.0),   # early, within the window
+        ('R5', 'A', '2025-05-10', 'Interest_Receipt', 0, 300.0),   # nothing left for it
+    )[['bond_id', 'account', 'transaction_id', 'trade_date', 'amount']]
+    out = app.match_receipts(exp, receipts, AS_OF)
+    status = {(r.account, r.due_date.strftime('%Y-%m-%d') if pd.notna(r.due_date) else None): r.status
+              for r in out.itertuples()}
+    assert status == {
+        ('A', '2025-03-31'): 'Matched', ('A', '2025-06-30'): 'Short', ('A', '2025-09-30'): 'Missing',
+        ('A', '2025-12-31'): 'Pending', ('A', None): 'Unexpected',
+        ('B', '2025-06-30'): 'Late', ('B', '2025-09-30'): 'Matched', ('B', '2025-12-31'): 'Pending',
+    }
+    late = out[out['transaction_id'] == 'R3'].iloc[0]
+    assert late['days_late'] == 20
+    assert out.loc[out['transaction_id'] == 'R4', 'days_late'].iloc[0] == 0
+
+
+def _b1_rows():
+    state = query_frame("SELECT as_of FROM reconciliation_state WHERE bond_id='B1' AND account='REKHA'")
+    rows = query_frame("SELECT due_date, status FROM coupon_reconciliation WHERE bond_id='B1' AND account='REKHA'")
+    return state['as_of'].iloc[0], dict(zip(rows['due_date'], rows['status']))
+
+
+def test_reconcile_rechecks_positions_while_a_due_is_in_grace(ledger):
+    with closing(connect()) as conn, conn:
+        conn.execute("DELETE FROM reconciliation_state")
+        conn.execute("DELETE FROM coupon_reconciliation")
+    dues = query_frame("SELECT payment_date FROM security_schedule WHERE bond_id='B1' AND event_type='Coupon' "
+                       "AND payment_date > date('now') ORDER BY payment_date")['payment_date']
+    due = pd.Timestamp(dues.iloc[0])
+    day = lambda n: (due + pd.Timedelta(days=n)).date()
+
+    _, first = app.reconcile_coupons(day(-1))
+    assert first > 0
+    assert app.reconcile_coupons(day(-1))[1] == 0          # nothing changed, nothing recomputed
+    app.reconcile_coupons(day(1))
+    as_of, rows = _b1_rows()
+    assert (as_of, rows[due.strftime('%Y-%m-%d')]) == (day(1).isoformat(), 'Pending')
+    # Still inside the grace window: re-checked even though its inputs did not change.
+    app.reconcile_coupons(day(2))
+    assert _b1_rows()[0] == day(2).isoformat()
+    app.reconcile_coupons(day(10))
+    as_of, rows = _b1_rows()
+    assert (as_of, rows[due.strftime('%Y-%m-%d')]) == (day(10).isoformat(), 'Missing')
+    # Once the due has left the window the stored result stands.
+    app.reconcile_coupons(day(11))
+    assert _b1_rows() == (day(10).isoformat(), rows)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nivesa.db import connect, query_frame
+from nivesa.finance import adjust_business_days
+from nivesa.schedule import build_security_schedule, rebuild_security_schedule
+
+SEC = pd.Series({'bond_id': 'A1', 'maturity_date': '2028-06-30', 'frequency': 'Quarterly',
+                 'coupon_rate': 0.10, 'face_value': 800.0})
+TXNS = pd.DataFrame({
+    'bond_id': 'A1', 'account': 'REKHA',
+    'trade_date': ['2025-06-30', '2025-12-31', '2026-03-31'],
+    'transaction_type': ['Buy', 'Principal_Repayment', 'Principal_Repayment'],
+    'units': [10.0, 0.0, 0.0], 'price': [1000.0, 100.0, 100.0], 'amount': [10000.0, 1000.0, 1000.0],
+})
+
+
+def test_inferred_amortization_does_not_depend_on_build_date():
+    early = build_security_schedule(SEC, date(2025, 6, 30), TXNS, date(2026, 4, 1))
+    late = build_security_schedule(SEC, date(2025, 6, 30), TXNS, date(2027, 9, 1))
+    pd.testing.assert_frame_equal(early, late)
+
+    amort = early[early['event_type'] == 'Amortization']
+    # 100 per unit every 3 months from the last repayment, until the 800
+    # outstanding is gone.
+    assert amort['payment_date'].iloc[0] == '2026-06-30'
+    assert amort['principal'].sum() == 800.0
+    assert early.loc[early['event_type'] == 'Redemption', 'principal'].item() == 0.0
+
+
+def test_contractual_installments_before_the_last_repayment_are_not_redeemed_again():
+    installments = [(date(2025, 12, 31), 100.0), (date(2026, 3, 31), 100.0), (date(2027, 3, 31), 300.0)]
+    sched = build_security_schedule(SEC, date(2025, 6, 30), TXNS, date(2026, 4, 1), installments)
+    assert (sched['event_type'] == 'Amortization').sum() == 3
+    assert sched.loc[sched['event_type'] == 'Redemption', 'principal'].item() == 500.0
+
+
+# 31 May 2025 is a Saturday and 2 June the Monday after it.
+@pytest.mark.parametrize('convention, holidays, rolled', [
+    ('Unadjusted', [], '2025-05-31'),
+    ('Following', [], '2025-06-02'),
+    ('Following', ['2025-06-02'], '2025-06-03'),
+    # Following would leave May, so Modified Following rolls back instead.
+    ('Modified Following', [], '2025-05-30'),
+    ('Modified Following', ['2025-05-30'], '2025-05-29'),
+])
+def test_business_day_roll_across_month_end(convention, holidays, rolled):
+    out = adjust_business_days(np.array(['2025-05-31'], dtype='datetime64[D]'), convention,
+                               np.array(holidays, dtype='datetime64[D]'))
+    assert out.tolist() == [np.datetime64(rolled, 'D').item()]
+
+
+def test_business_days_keep_open_days_and_nat():
+    dates = np.array([['2025-06-30', 'NaT'], ['2025-08-15', '2025-08-16']], dtype='datetime64[D]')
+    out = adjust_business_days(dates, ['Following', 'Modified Following'], np.array(['2025-08-15'], dtype='datetime64[D]'))
+    assert np.datetime_as_string(out).tolist() == [['2025-06-30', 'NaT'], ['2025-08-18', '2025-08-18']]
+
+
+def test_step_up_terms_set_the_calendar_coupon_rate(ledger):
+    terms = [('2025-06-30', 0.09), ('2026-06-30', 0.10), ('2027-06-30', 0.115)]
+    try:
+        with closing(connect()) as conn, conn:
+            conn.execute("INSERT INTO securities VALUES ('S9', 'STEP ISSUER', 'INE000S01019', '2028-06-30', "
+                         "'Quarterly', 0.09, 1000.0)")
+            conn.execute("INSERT INTO security_metadata (bond_id, issue_date) VALUES ('S9', '2025-06-30')")
+            conn.executemany("INSERT INTO coupon_terms (bond_id, effective_date, coupon_rate) VALUES ('S9', ?, ?)", terms)
+            rebuild_security_schedule(conn, ['S9'])
+        resets = query_frame("SELECT reset_date, coupon_rate, source FROM coupon_resets WHERE bond_id='S9'")
+        sched = query_frame("SELECT period_start, coupon_rate FROM security_schedule "
+                            "WHERE bond_id='S9' AND event_type='Coupon' ORDER BY payment_date")
+    finally:
+        with closing(connect()) as conn, conn:
+            for table in ('security_schedule', 'coupon_resets', 'coupon_terms', 'security_metadata', 'securities'):
+                conn.execute(f"DELETE FROM {table} WHERE bond_id='S9'")
+
+    assert resets.values.tolist() == [[d, r, 'step'] for d, r in terms]
+    assert len(sched) == 12
+    # Each coupon pays the rate in force at its period start.
+    expected = np.select([sched['period_start'] >= '2027-06-30', sched['period_start'] >= '2026-06-30'],
+                         [0.115, 0.10], 0.09)
+    assert sched['coupon_rate'].tolist() == expected.tolist()
+    assert sched['coupon_rate'].value_counts().to_dict() == {0.09: 4, 0.10: 4, 0.115: 4}
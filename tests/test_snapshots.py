@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from nivesa.positions import analytics_key, compute_analytics
+from nivesa.snapshots import load_analytics, run_snapshot
+
+
+def test_snapshot_round_trip_keeps_live_frames_and_dtypes(ledger):
+    key = analytics_key()
+    positions, totals, cashflows = compute_analytics(key[2])
+    run_snapshot(force=True)
+    loaded = load_analytics(analytics_key())
+    assert loaded is not None
+    snap_positions, snap_totals, snap_cashflows = loaded
+
+    pd.testing.assert_series_equal(snap_positions.dtypes, positions.dtypes)
+    pd.testing.assert_series_equal(snap_cashflows.dtypes, cashflows.dtypes)
+    assert positions['price_date'].isna().all()  # no price file: NaT, not object NaN
+    pd.testing.assert_frame_equal(snap_positions, positions)
+    pd.testing.assert_frame_equal(snap_cashflows, cashflows)
+    pd.testing.assert_series_equal(pd.Series(snap_totals, dtype=object), pd.Series(totals, dtype=object))